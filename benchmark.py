@@ -0,0 +1,2094 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark cho MQTT Fuel Station Client
+Chạy trên máy dev/lab, không cần cài lên trạm:
+
+    python3 benchmark.py codec --snapshots captured.jsonl
+    python3 benchmark.py load --clients 20 --pumps 16 --duration 60
+    python3 benchmark.py mabom --pumps 10000
+    python3 benchmark.py polling --hours 24
+    python3 benchmark.py startup --runs 5
+    python3 benchmark.py publish --stations 8 --pumps 16 --rtt 0.05
+    python3 benchmark.py ingest --workers 1 2 4 --stations 500
+    python3 benchmark.py storm --clients 200 --downtime 10
+    python3 benchmark.py tls --reconnects 50 --key rsa
+    python3 benchmark.py remediation --gaps 3 --daylaidulieu-delay 2
+    python3 benchmark.py liveness --clients 4 --stations-per-client 25
+    python3 benchmark.py push --modes poll sse unix file --idle 60
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import clientMQTT
+import serverMQTT
+from replay import ReplayStation, StubMQTT
+
+# ==================== DỮ LIỆU MẪU ====================
+def make_snapshot(pump_count, seed=0):
+    """Tạo một snapshot GetfullupdateArr giả lập với pump_count vòi"""
+    rng = random.Random(seed)
+    snapshot = []
+    for idcot in range(1, pump_count + 1):
+        mabom = rng.randint(1000, 90000)
+        snapshot.append({
+            'id': idcot,
+            'pump': mabom,
+            'status': rng.choice(['sẵn sàng', 'sẵn sàng', 'sẵn sàng', 'đang bơm']),
+            'MaBomMoiNhat': {'pump': mabom},
+            'isDisconnected': False
+        })
+    return snapshot
+
+def load_snapshots(path):
+    """Đọc snapshot đã ghi lại: file JSON lines (mỗi dòng một mảng) hoặc một mảng JSON"""
+    with open(path, 'r', encoding='utf-8') as file:
+        content = file.read().strip()
+    if content.startswith('['):
+        return [json.loads(content)]
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+def get_snapshots(args):
+    if args.snapshots:
+        return load_snapshots(args.snapshots)
+    return [make_snapshot(args.pumps, seed) for seed in range(20)]
+
+# ==================== CODEC ====================
+def bench_codec(args):
+    """So sánh kích thước payload và thời gian mã hóa của các codec"""
+    snapshots = get_snapshots(args)
+    messages = [{
+        'port': '12345',
+        'version': 'ARM-1.0',
+        'mac': '00:00:00:00:00:00',
+        'timestamp': '2026-01-01T00:00:00',
+        'data': snapshot
+    } for snapshot in snapshots]
+
+    baseline = None
+    print(f"{'codec':<16}{'bytes/msg':>12}{'ratio':>8}{'encode µs':>12}{'decode µs':>12}")
+    for name in clientMQTT.available_codecs():
+        codec = clientMQTT.PayloadCodec(name)
+        payloads = [codec.encode(message) for message in messages]
+
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for message in messages:
+                codec.encode(message)
+        encode_us = (time.perf_counter() - started) / (args.rounds * len(messages)) * 1e6
+
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for payload in payloads:
+                codec.decode(payload)
+        decode_us = (time.perf_counter() - started) / (args.rounds * len(payloads)) * 1e6
+
+        size = sum(len(payload) for payload in payloads) / len(payloads)
+        baseline = baseline or size
+        print(f"{name:<16}{size:>12.0f}{baseline / size:>8.2f}{encode_us:>12.1f}{decode_us:>12.1f}")
+
+# ==================== BỘ ĐIỀU KHIỂN GIẢ LẬP ====================
+class FakeController:
+    """Giả lập localhost:6969 cho nhiều trạm: /station/<k>/GetfullupdateArr, /station/<k>/daylaidulieu/<id>
+
+    Vòi bơm tự giao dịch ngẫu nhiên; có thể chèn theo kịch bản: mã bơm nhảy
+    cóc (gap), mất kết nối, MaBomMoiNhat không khớp. Thời điểm chèn gap được
+    ghi lại để đo độ trễ từ sự kiện tới cảnh báo trên broker.
+
+    Đẩy thay đổi (nguồn đẩy của client): SSE ở /station/<k>/events (chunked,
+    bản đầy đủ khi kết nối rồi "update" các vòi đổi), Unix socket
+    (start_unix_feed, NDJSON) và file NDJSON ghi thêm (add_feed_file).
+    """
+
+    def __init__(self, stations, pumps, seed=0, transaction_rate=0.05):
+        self.rng = random.Random(seed)
+        self.transaction_rate = transaction_rate
+        self.state = {
+            str(station): [{
+                'id': idcot,
+                'pump': self.rng.randint(1000, 90000),
+                'status': 'sẵn sàng',
+                'isDisconnected': False,
+                'mismatch': False
+            } for idcot in range(1, pumps + 1)]
+            for station in range(stations)
+        }
+        self.injected = {}  # (station, pump_id, mabom) -> thời điểm chèn gap
+        self.requests = 0
+        self.daylaidulieu_delay = 0  # Giả lập daylaidulieu chậm (giây)
+        self.daylaidulieu_calls = 0
+        self.feeds = {}  # trạm -> [(writer, 'sse' | 'ndjson')] đang nhận thay đổi
+        self.feed_files = {}  # trạm -> file NDJSON
+        self.pushed = {}  # trạm -> {id: vòi} của bản đã đẩy
+        self.unix_servers = []
+        self.server = None
+
+    def snapshot(self, station):
+        return [{
+            'id': pump['id'],
+            'pump': pump['pump'],
+            'status': pump['status'],
+            'MaBomMoiNhat': {'pump': pump['pump'] + (1 if pump['mismatch'] else 0)},
+            'isDisconnected': pump['isDisconnected']
+        } for pump in self.state[station]]
+
+    def tick(self):
+        """Một bước mô phỏng: vòi đang bơm kết thúc giao dịch, vòi rảnh có thể bắt đầu"""
+        for pumps in self.state.values():
+            for pump in pumps:
+                if pump['isDisconnected']:
+                    continue
+                if pump['status'] == 'đang bơm':
+                    pump['status'] = 'sẵn sàng'
+                    pump['pump'] += 1
+                elif self.rng.random() < self.transaction_rate:
+                    pump['status'] = 'đang bơm'
+        self.push()
+
+    def inject_gap(self, station=None):
+        """Cho một vòi rảnh nhảy mã bơm (+2) để client phát cảnh báo nonsequential"""
+        station = station or self.rng.choice(list(self.state))
+        idle = [pump for pump in self.state[station] if pump['status'] == 'sẵn sàng' and not pump['isDisconnected']]
+        if not idle:
+            return None
+        pump = self.rng.choice(idle)
+        pump['pump'] += 2
+        self.injected[(station, str(pump['id']), pump['pump'])] = time.monotonic()
+        self.push(station)
+        return pump
+
+    def set_disconnected(self, station, pump_id, value):
+        self.state[station][pump_id - 1]['isDisconnected'] = value
+        self.push(station)
+
+    def set_mismatch(self, station, pump_id, value):
+        self.state[station][pump_id - 1]['mismatch'] = value
+        self.push(station)
+
+    # ---------- nguồn đẩy ----------
+    @staticmethod
+    def _frame(kind, data, style):
+        body = json.dumps(data, ensure_ascii=False)
+        if style == 'ndjson':
+            return (json.dumps({'event': kind, 'data': data}, ensure_ascii=False) + '\n').encode('utf-8')
+        event = f"event: {kind}\ndata: {body}\n\n".encode('utf-8')
+        return f"{len(event):x}\r\n".encode('ascii') + event + b'\r\n'  # Một chunk HTTP mỗi sự kiện
+
+    def push(self, station=None):
+        """Đẩy các vòi đã đổi từ lần đẩy trước tới client đang nhận"""
+        if not self.feeds and not self.feed_files:
+            return
+        for name in [station] if station is not None else list(self.state):
+            if not self.feeds.get(name) and name not in self.feed_files:
+                continue
+            previous = self.pushed.get(name, {})
+            current = {item['id']: item for item in self.snapshot(name)}
+            changed = [item for key, item in current.items() if previous.get(key) != item]
+            self.pushed[name] = current
+            if not changed:
+                continue
+            for writer, style in list(self.feeds.get(name, ())):
+                writer.write(self._frame('update', changed, style))
+            if name in self.feed_files:
+                with open(self.feed_files[name], 'ab') as file:
+                    file.write(self._frame('update', changed, 'ndjson'))
+
+    async def _serve_feed(self, station, reader, writer, style):
+        """Gửi bản đầy đủ rồi giữ kết nối nhận thay đổi cho tới khi client đóng"""
+        # Khi không còn client nào nhận, push() không cập nhật bản đã đẩy: lấy lại theo bản đầy đủ
+        if not self.feeds.get(station) and station not in self.feed_files:
+            self.pushed[station] = {item['id']: item for item in self.snapshot(station)}
+        writer.write(self._frame('snapshot', self.snapshot(station), style))
+        self.feeds.setdefault(station, []).append((writer, style))
+        try:
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.feeds[station].remove((writer, style))
+
+    async def start_unix_feed(self, station, path):
+        server = await asyncio.start_unix_server(
+            lambda reader, writer: self._serve_feed(station, reader, writer, 'ndjson'), path)
+        self.unix_servers.append(server)
+        return server
+
+    def add_feed_file(self, station, path):
+        open(path, 'ab').close()
+        self.pushed.setdefault(station, {item['id']: item for item in self.snapshot(station)})
+        self.feed_files[station] = path
+
+    def close(self):
+        self.server.close()
+        for server in self.unix_servers:
+            server.close()
+        for writers in self.feeds.values():
+            for writer, _ in writers:
+                writer.close()
+
+    def inject_for(self, setter, duration):
+        """Bật một lỗi (mất kết nối / không khớp) trên vòi ngẫu nhiên trong duration giây"""
+        station = self.rng.choice(list(self.state))
+        pump_id = self.rng.randint(1, len(self.state[station]))
+        setter(station, pump_id, True)
+        asyncio.get_running_loop().call_later(duration, setter, station, pump_id, False)
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    def url(self, station):
+        return f"http://127.0.0.1:{self.port}/station/{station}"
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                self.requests += 1
+                parts = request_line.decode('latin-1').split()[1].strip('/').split('/')
+                status, body = 404, b'{}'
+                if len(parts) >= 3 and parts[0] == 'station' and parts[1] in self.state:
+                    if parts[2] == 'GetfullupdateArr':
+                        status, body = 200, json.dumps(self.snapshot(parts[1])).encode('utf-8')
+                    elif parts[2] == 'events':
+                        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                                     b"Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n")
+                        await self._serve_feed(parts[1], reader, writer, 'sse')
+                        break
+                    elif parts[2] == 'daylaidulieu':
+                        self.daylaidulieu_calls += 1
+                        if self.daylaidulieu_delay:
+                            await asyncio.sleep(self.daylaidulieu_delay)
+                        status = 200
+                writer.write(f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n".encode('ascii') + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+# ==================== MQTT BROKER THAY THẾ ====================
+def topic_matches(pattern, topic):
+    """So khớp topic với filter MQTT có + và #"""
+    pattern_parts = pattern.split('/')
+    topic_parts = topic.split('/')
+    for index, part in enumerate(pattern_parts):
+        if part == '#':
+            return True
+        if index >= len(topic_parts) or (part != '+' and part != topic_parts[index]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+def _remaining_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+def _mqtt_string(value):
+    data = value.encode('utf-8')
+    return struct.pack('>H', len(data)) + data
+
+class MiniBroker:
+    """Broker MQTT 3.1.1 tối giản chạy trong tiến trình để benchmark
+
+    Hỗ trợ CONNECT (clean session hoặc phiên bền, Last Will, keepalive),
+    SUBSCRIBE (+/#, shared subscription $share/<nhóm>/...), PUBLISH QoS 0/1
+    (retained), PINGREQ, DISCONNECT. Message gửi tới subscriber luôn ở QoS 0;
+    mỗi nhóm shared nhận một bản, chia vòng lượt giữa các thành viên; bản
+    retained chỉ gửi cho subscription thường. Phiên bền giữ subscription và
+    xếp hàng message trong lúc client mất kết nối. Last Will được gửi khi
+    kết nối đóng không có DISCONNECT hoặc quá 1.5 lần keepalive không nhận
+    packet nào (không gửi khi bị kết nối cùng client ID thay thế hoặc khi
+    broker dừng). Ghi lại thời điểm nhận mỗi message để tính thông lượng và
+    độ trễ. ssl_context: nghe bằng TLS.
+    """
+
+    def __init__(self, ack_delay=0, ssl_context=None):
+        self.ack_delay = ack_delay  # Trễ gửi PUBACK (giây), giả lập RTT tới server thật
+        self.ssl_context = ssl_context
+        self.sessions = {}
+        self.received = []  # (monotonic, topic, payload)
+        self.listeners = []  # callback(topic, payload, received_at)
+        self.connects = 0
+        self.connect_times = []  # monotonic của mỗi CONNECT được chấp nhận
+        self.persistent = {}  # client_id -> {'subscriptions', 'queue'} của phiên bền
+        self.shared_turns = {}  # nhóm shared -> số message đã chia
+        self.retained = {}  # topic -> payload retained
+        self.wills = 0  # Số Last Will đã gửi
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port, ssl=self.ssl_context)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def drain(self):
+        """Chờ các subscriber đọc bớt khi bộ đệm ghi đầy (khi bơm message liên tục)"""
+        for session in list(self.sessions.values()):
+            try:
+                await session['writer'].drain()
+            except ConnectionError:
+                pass
+
+    async def stop(self):
+        self.server.close()
+        for session in list(self.sessions.values()):
+            session['will'] = None
+            session['writer'].transport.abort()
+        await self.server.wait_closed()
+
+    async def restart(self, downtime, keep_sessions=True):
+        """Giả lập broker khởi động lại: cắt mọi kết nối, từ chối kết nối trong downtime giây
+
+        keep_sessions: broker có lưu phiên bền (như mosquitto persistence true)
+        """
+        await self.stop()
+        if not keep_sessions:
+            self.persistent.clear()
+        await asyncio.sleep(downtime)
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', self.port, ssl=self.ssl_context)
+    def _send(self, writer, packet_type, body):
+        writer.write(bytes((packet_type,)) + _remaining_length(len(body)) + body)
+
+    def publish(self, topic, payload, retain=False):
+        """Gửi message tới mọi subscriber khớp topic (dùng để gửi lệnh cho client)"""
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        body = _mqtt_string(topic) + payload
+        groups = {}
+        for session in list(self.sessions.values()):
+            matched = False
+            for pattern in session['subscriptions']:
+                if pattern.startswith('$share/'):
+                    _, group, shared_filter = pattern.split('/', 2)
+                    if topic_matches(shared_filter, topic):
+                        members = groups.setdefault(group, [])
+                        if not members or members[-1] is not session:
+                            members.append(session)
+                elif not matched and topic_matches(pattern, topic):
+                    matched = True
+                    self._send(session['writer'], 0x30, body)
+        for group, members in groups.items():
+            turn = self.shared_turns.get(group, 0)
+            self.shared_turns[group] = turn + 1
+            self._send(members[turn % len(members)]['writer'], 0x30, body)
+        # Phiên bền đang mất kết nối: giữ lại để gửi khi client kết nối lại
+        for client_id, stored in self.persistent.items():
+            if client_id not in self.sessions and any(
+                    not pattern.startswith('$share/') and topic_matches(pattern, topic)
+                    for pattern in stored['subscriptions']):
+                stored['queue'].append(body)
+
+    async def _read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        multiplier, length = 1, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, await reader.readexactly(length)
+
+    async def handle(self, reader, writer):
+        client_id = None
+        session = {'writer': writer, 'subscriptions': set(), 'will': None}
+        keepalive = 0
+        try:
+            while True:
+                if keepalive:
+                    header, body = await asyncio.wait_for(self._read_packet(reader), 1.5 * keepalive)
+                else:
+                    header, body = await self._read_packet(reader)
+                packet_type = header & 0xF0
+                if packet_type == 0x10:  # CONNECT
+                    flags_offset = 2 + struct.unpack_from('>H', body, 0)[0] + 1
+                    flags = body[flags_offset]
+                    clean = bool(flags & 0x02)
+                    keepalive = struct.unpack_from('>H', body, flags_offset + 1)[0]
+                    offset = flags_offset + 3
+                    id_length = struct.unpack_from('>H', body, offset)[0]
+                    client_id = body[offset + 2:offset + 2 + id_length].decode('utf-8')
+                    offset += 2 + id_length
+                    if flags & 0x04:  # Last Will: topic, message; QoS bit 3-4, retain bit 5
+                        length = struct.unpack_from('>H', body, offset)[0]
+                        will_topic = body[offset + 2:offset + 2 + length].decode('utf-8')
+                        offset += 2 + length
+                        length = struct.unpack_from('>H', body, offset)[0]
+                        session['will'] = (will_topic, body[offset + 2:offset + 2 + length], bool(flags & 0x20))
+                    previous = self.sessions.get(client_id)
+                    if previous is not None:
+                        previous['will'] = None
+                        previous['writer'].transport.abort()  # Client ID trùng: kết nối mới thay kết nối cũ
+                    stored = self.persistent.pop(client_id, None) if clean else self.persistent.get(client_id)
+                    present = not clean and stored is not None
+                    if not clean:
+                        if stored is None:
+                            stored = self.persistent[client_id] = {'subscriptions': set(), 'queue': []}
+                        session['subscriptions'] = stored['subscriptions']
+                    self.sessions[client_id] = session
+                    self.connects += 1
+                    self.connect_times.append(time.monotonic())
+                    self._send(writer, 0x20, bytes((int(present), 0)))
+                    if present:
+                        for queued in stored['queue']:
+                            self._send(writer, 0x30, queued)
+                        stored['queue'].clear()
+                elif packet_type == 0x80:  # SUBSCRIBE
+                    offset, granted, patterns = 2, b'', []
+                    while offset < len(body):
+                        length = struct.unpack_from('>H', body, offset)[0]
+                        patterns.append(body[offset + 2:offset + 2 + length].decode('utf-8'))
+                        granted += bytes((min(body[offset + 2 + length], 1),))
+                        offset += 3 + length
+                    session['subscriptions'].update(patterns)
+                    self._send(writer, 0x90, body[:2] + granted)
+                    for topic, payload in list(self.retained.items()):
+                        if any(not pattern.startswith('$share/') and topic_matches(pattern, topic)
+                               for pattern in patterns):
+                            self._send(writer, 0x31, _mqtt_string(topic) + payload)
+                elif packet_type == 0x30:  # PUBLISH
+                    received_at = time.monotonic()
+                    qos = (header >> 1) & 0x3
+                    length = struct.unpack_from('>H', body, 0)[0]
+                    topic = body[2:2 + length].decode('utf-8')
+                    offset = 2 + length
+                    if qos:
+                        if self.ack_delay:
+                            asyncio.get_running_loop().call_later(
+                                self.ack_delay, self._send, writer, 0x40, body[offset:offset + 2])
+                        else:
+                            self._send(writer, 0x40, body[offset:offset + 2])
+                        offset += 2
+                    payload = body[offset:]
+                    self.received.append((received_at, topic, payload))
+                    for listener in self.listeners:
+                        listener(topic, payload, received_at)
+                    self.publish(topic, payload, retain=bool(header & 0x01))
+                elif packet_type == 0xC0:  # PINGREQ
+                    self._send(writer, 0xD0, b'')
+                elif packet_type == 0xE0:  # DISCONNECT
+                    session['will'] = None
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+        finally:
+            if client_id is not None and self.sessions.get(client_id) is session:
+                del self.sessions[client_id]
+            writer.close()
+            if session['will'] is not None:
+                topic, payload, retain = session['will']
+                self.wills += 1
+                self.publish(topic, payload, retain=retain)
+
+# ==================== ĐO TÀI NGUYÊN TIẾN TRÌNH ====================
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+def process_cpu_seconds(pid):
+    """Tổng thời gian CPU (user + system) của tiến trình, đọc từ /proc"""
+    with open(f'/proc/{pid}/stat', 'r') as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def process_rss_kb(pid):
+    """RSS hiện tại của tiến trình (kB), đọc từ /proc"""
+    with open(f'/proc/{pid}/status', 'r') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# ==================== LOAD TEST ====================
+def run_worker(args):
+    """Tiến trình con: một client (gateway) kết nối tới broker/controller của driver"""
+    clientMQTT.configure_log_levels(args.log_level)
+    clientMQTT.MQTT_BROKER_HOST = '127.0.0.1'
+    clientMQTT.MQTT_BROKER_PORT = args.broker_port
+    clientMQTT.METRICS_PORT = 0  # Nhiều client trên cùng máy, không mở endpoint metrics
+    clientMQTT.LIVENESS_MODE = args.liveness
+    clientMQTT.MQTT_KEEPALIVE = args.keepalive
+    definitions = [{
+        'port': station,
+        'controller_url': f"{args.controller}/station/{station}",
+        'mac': f"02:00:00:00:{int(station) // 256 % 256:02x}:{int(station) % 256:02x}",
+        'version': 'BENCH-1.0',
+        'restart_command': ['true'],
+        'feed': args.feed.replace('{station}', station) if args.feed else None
+    } for station in args.stations.split(',')]
+    gateway = clientMQTT.FuelStationGateway.from_definitions(definitions)
+    asyncio.run(gateway.run())
+
+def spawn_worker(broker_port, controller_url, stations, workdir, log_level,
+                 liveness=clientMQTT.LIVENESS_MODE, keepalive=clientMQTT.MQTT_KEEPALIVE, feed=None):
+    """Chạy một client trong tiến trình riêng (thư mục làm việc riêng cho logs/queue)
+
+    feed: nguồn đẩy snapshot, "{station}" được thay bằng port của từng trạm
+    """
+    command = [sys.executable, os.path.abspath(__file__), 'worker',
+               '--broker-port', str(broker_port), '--controller', controller_url,
+               '--stations', ','.join(stations), '--log-level', log_level,
+               '--liveness', liveness, '--keepalive', str(keepalive)]
+    if feed:
+        command += ['--feed', feed]
+    return subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+async def run_load(args):
+    station_count = args.clients * args.stations_per_client
+    controller = FakeController(station_count, args.pumps, seed=args.seed)
+    broker = MiniBroker()
+    await controller.start()
+    broker_port = await broker.start()
+
+    latencies = []
+
+    def on_warning(topic, payload, received_at):
+        if topic != clientMQTT.TOPICS['station_warning']:
+            return
+        for message in clientMQTT.unpack_batch(clientMQTT.decode_payload(payload)):
+            key = (str(message.get('port')), str(message.get('pump_id')), message.get('mabom'))
+            injected_at = controller.injected.pop(key, None)
+            if injected_at is not None:
+                latencies.append(received_at - injected_at)
+
+    broker.listeners.append(on_warning)
+
+    workdir = tempfile.mkdtemp(prefix='fuel-bench-')
+    workers = []
+    stations = [str(station) for station in range(station_count)]
+    for index in range(args.clients):
+        client_dir = os.path.join(workdir, f"client-{index}")
+        os.makedirs(client_dir)
+        chunk = stations[index * args.stations_per_client:(index + 1) * args.stations_per_client]
+        workers.append(spawn_worker(broker_port, f"http://127.0.0.1:{controller.port}", chunk, client_dir, args.log_level))
+
+    try:
+        # Chờ mọi client kết nối và subscribe
+        deadline = time.monotonic() + 30
+        while len(broker.sessions) < args.clients and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        if args.getdata:
+            for station in stations:
+                command = {'command': 'getdata', 'data': {'getdata': 'On', 'mode': args.getdata}}
+                broker.publish(f"{clientMQTT.TOPICS['station_command']}/{station}", json.dumps(command).encode('utf-8'))
+
+        # Bỏ qua vài giây đầu (khởi động, lần gửi đầu tiên) trước khi đo
+        await asyncio.sleep(args.warmup)
+        cpu_start = {worker.pid: process_cpu_seconds(worker.pid) for worker in workers}
+        received_start = len(broker.received)
+        requests_start = controller.requests
+        started = time.monotonic()
+        next_gap = started
+        next_disconnect = started + args.disconnect_interval if args.disconnect_interval else None
+        next_mismatch = started + args.mismatch_interval if args.mismatch_interval else None
+        rss = {worker.pid: [] for worker in workers}
+
+        while time.monotonic() - started < args.duration:
+            controller.tick()
+            if time.monotonic() >= next_gap:
+                controller.inject_gap()
+                next_gap += args.gap_interval
+            if next_disconnect is not None and time.monotonic() >= next_disconnect:
+                controller.inject_for(controller.set_disconnected, args.disconnect_duration)
+                next_disconnect += args.disconnect_interval
+            if next_mismatch is not None and time.monotonic() >= next_mismatch:
+                controller.inject_for(controller.set_mismatch, args.mismatch_duration)
+                next_mismatch += args.mismatch_interval
+            for worker in workers:
+                rss[worker.pid].append(process_rss_kb(worker.pid))
+            await asyncio.sleep(0.5)
+
+        elapsed = time.monotonic() - started
+        cpu = {worker.pid: (process_cpu_seconds(worker.pid) - cpu_start[worker.pid]) / elapsed * 100 for worker in workers}
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        await broker.stop()
+        controller.server.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    messages = broker.received[received_start:]
+    per_topic = {}
+    for _, topic, payload in messages:
+        name = topic.split('/')[1]
+        count, size = per_topic.get(name, (0, 0))
+        per_topic[name] = (count + 1, size + len(payload))
+
+    result = {
+        'clients': args.clients,
+        'stations': station_count,
+        'pumps_per_station': args.pumps,
+        'duration_s': round(elapsed, 1),
+        'publish_per_s': round(len(messages) / elapsed, 1),
+        'bytes_per_s': round(sum(len(payload) for _, _, payload in messages) / elapsed, 1),
+        'per_topic': {name: {'msg_per_s': round(count / elapsed, 2), 'bytes_per_s': round(size / elapsed, 1)}
+                      for name, (count, size) in sorted(per_topic.items())},
+        'controller_requests_per_s': round((controller.requests - requests_start) / elapsed, 1),
+        'alert_latency_ms': {
+            'count': len(latencies),
+            'missed': len(controller.injected),
+            'p50': round(percentile(latencies, 0.5) * 1000, 1),
+            'p95': round(percentile(latencies, 0.95) * 1000, 1),
+            'max': round(max(latencies) * 1000, 1) if latencies else float('nan')
+        },
+        'cpu_percent_per_client': {'mean': round(statistics.mean(cpu.values()), 2), 'max': round(max(cpu.values()), 2)},
+        'rss_kb_per_client': {'mean': round(statistics.mean(max(values) for values in rss.values())),
+                              'max': max(max(values) for values in rss.values())}
+    }
+    return result
+
+def bench_load(args):
+    """Chạy K client với bộ điều khiển giả lập và broker trong tiến trình"""
+    result = asyncio.run(run_load(args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+        return
+    print(f"Clients: {result['clients']}  trạm: {result['stations']}  vòi/trạm: {result['pumps_per_station']}  "
+          f"thời gian đo: {result['duration_s']} s")
+    print(f"Publish: {result['publish_per_s']} msg/s, {result['bytes_per_s']} B/s  "
+          f"(bộ điều khiển: {result['controller_requests_per_s']} req/s)")
+    for name, stats in result['per_topic'].items():
+        print(f"  {name:<12}{stats['msg_per_s']:>10} msg/s{stats['bytes_per_s']:>12} B/s")
+    latency = result['alert_latency_ms']
+    print(f"Độ trễ cảnh báo (ms): n={latency['count']} bỏ lỡ={latency['missed']} "
+          f"p50={latency['p50']} p95={latency['p95']} max={latency['max']}")
+    print(f"CPU mỗi client: trung bình {result['cpu_percent_per_client']['mean']}%  "
+          f"max {result['cpu_percent_per_client']['max']}%")
+    print(f"RSS mỗi client: trung bình {result['rss_kb_per_client']['mean']} kB  "
+          f"max {result['rss_kb_per_client']['max']} kB")
+
+# ==================== KIỂM TRA MÃ BƠM (DẠNG CỘT) ====================
+def mabom_stream(pumps, ticks, seed=0):
+    """Chuỗi (thời điểm, snapshot) giả lập theo đồng hồ ảo, có đủ các tình huống của check_mabom:
+    giao dịch, nhảy mã, mất kết nối ngắn/dài, cả trạm mất kết nối, MaBomMoiNhat lệch,
+    vòi trùng id, mã bơm dạng chuỗi, phần tử thiếu trường hoặc hỏng"""
+    rng = random.Random(seed)
+    now = datetime(2026, 1, 1)
+    state = [{'id': idcot, 'pump': rng.randint(1000, 90000), 'status': 'sẵn sàng',
+              'isDisconnected': False, 'mismatch': 0} for idcot in range(1, pumps + 1)]
+    outage = 0
+    for _ in range(ticks):
+        now += timedelta(seconds=rng.choice([1.5, 2, 2, 2, 2.5, 30]))
+        if outage:
+            outage -= 1
+        elif rng.random() < 0.01:
+            outage = rng.randint(1, 60)
+        for pump in state:
+            roll = rng.random()
+            if pump['isDisconnected']:
+                if roll < 0.05:
+                    pump['isDisconnected'] = False
+                continue
+            if roll < 0.003:
+                pump['isDisconnected'] = True
+            elif roll < 0.01:
+                pump['pump'] += rng.choice([2, 3, -1, 0])
+            elif roll < 0.02:
+                pump['mismatch'] = rng.randint(1, 6)
+            elif pump['status'] == 'đang bơm':
+                pump['status'] = 'sẵn sàng'
+                pump['pump'] += 1
+            elif roll < 0.1:
+                pump['status'] = 'đang bơm'
+        snapshot = []
+        for pump in state:
+            item = {
+                'id': pump['id'],
+                'pump': pump['pump'],
+                'status': pump['status'],
+                'MaBomMoiNhat': {'pump': pump['pump'] + (1 if pump['mismatch'] else 0)},
+                'isDisconnected': bool(outage) or pump['isDisconnected']
+            }
+            if pump['mismatch']:
+                pump['mismatch'] -= 1
+            snapshot.append(item)
+        roll = rng.random()
+        if roll < 0.02:
+            snapshot.append(dict(rng.choice(snapshot)))
+        elif roll < 0.03:
+            snapshot[rng.randrange(len(snapshot))]['pump'] = str(rng.randint(1, 5))
+        elif roll < 0.04:
+            snapshot[rng.randrange(len(snapshot))].pop('pump')
+        elif roll < 0.045:
+            snapshot[rng.randrange(len(snapshot))]['MaBomMoiNhat'] = None
+        elif roll < 0.05:
+            snapshot = []
+        yield now, snapshot
+
+def recorded_stream(path, interval=clientMQTT.SNAPSHOT_POLL_INTERVAL):
+    """Snapshot đã ghi lại: bản ghi của clientMQTT.py --record (giữ thời điểm gốc), hoặc
+    file JSON lines được gán thời điểm theo chu kỳ poll"""
+    if os.path.isdir(path) or path.endswith('.gz'):
+        yield from clientMQTT.read_recording(path)
+        return
+    now = datetime(2026, 1, 1)
+    for snapshot in load_snapshots(path):
+        now += timedelta(seconds=interval)
+        yield now, snapshot
+
+def compare_engines(stream):
+    """Chạy cùng chuỗi (thời điểm, snapshot) qua check_mabom gốc và ColumnarMabomChecker
+
+    Trả về (số snapshot, số hành động, khác biệt đầu tiên hoặc None); khác biệt là
+    (vị trí, thời điểm, hành động của check_mabom, hành động của columnar).
+    """
+    reference = ReplayStation()
+    columnar = clientMQTT.ColumnarMabomChecker()
+    total = count = 0
+    previous = None
+    for count, (now, snapshot) in enumerate(stream, 1):
+        expected = reference.check(snapshot, now, previous)
+        actions = columnar.check(snapshot, now, previous)
+        previous = now
+        if actions != expected:
+            return count, total, (count - 1, now, expected, actions)
+        total += len(actions)
+    return count, total, None
+
+def bench_mabom(args):
+    """Đối chiếu ColumnarMabomChecker với check_mabom gốc và đo thời gian ở số vòi lớn"""
+    clientMQTT.configure_log_levels('CRITICAL')
+
+    # Đối chiếu: cùng chuỗi snapshot, hai bên phải cho cùng chuỗi hành động
+    if args.snapshots:
+        stream = recorded_stream(args.snapshots)
+    else:
+        stream = mabom_stream(args.diff_pumps, args.diff_ticks, args.seed)
+    count, total, difference = compare_engines(stream)
+    if difference is not None:
+        tick, now, expected, actions = difference
+        print(f"KHÁC BIỆT tại snapshot {tick} ({now.isoformat()}):")
+        print(f"  check_mabom: {expected}")
+        print(f"  columnar:    {actions}")
+        sys.exit(1)
+    print(f"Đối chiếu: {count} snapshot, {total} hành động, khớp hoàn toàn")
+
+    # Hiệu năng: N vòi, trạng thái đã ổn định sau vài snapshot đầu
+    stream = list(mabom_stream(args.pumps, args.ticks, args.seed))
+    warm = args.ticks // 5
+    for name, engine in (('check_mabom', ReplayStation()),
+                         ('columnar', clientMQTT.ColumnarMabomChecker(args.pumps))):
+        for now, snapshot in stream[:warm]:
+            engine.check(snapshot, now)
+        started = time.perf_counter()
+        for now, snapshot in stream[warm:]:
+            engine.check(snapshot, now)
+        elapsed = (time.perf_counter() - started) / (len(stream) - warm)
+        print(f"{name:<14}{args.pumps:>8} vòi{elapsed * 1000:>10.2f} ms/snapshot"
+              f"{args.pumps / elapsed / 1e6:>8.2f} M vòi/s")
+
+# ==================== POLL THÍCH ỨNG ====================
+def station_day_stream(pumps, hours, seed=0, tick=clientMQTT.SNAPSHOT_POLL_INTERVAL):
+    """Trạng thái thật của trạm theo từng tick: ban ngày đông khách, ban đêm gần như rảnh,
+    thỉnh thoảng một vòi mất kết nối (ngắn hoặc quá DISCONNECT_ALERT_SECONDS)"""
+    rng = random.Random(seed)
+    now = datetime(2026, 1, 1)
+    state = [{'id': idcot, 'pump': rng.randint(1000, 90000), 'status': 'sẵn sàng',
+              'isDisconnected': False, 'busy_until': now, 'offline_until': now}
+             for idcot in range(1, pumps + 1)]
+    for _ in range(int(hours * 3600 / tick)):
+        now += timedelta(seconds=tick)
+        start_rate = 0.004 if 6 <= now.hour < 22 else 0.0002
+        for pump in state:
+            if pump['isDisconnected']:
+                if now >= pump['offline_until']:
+                    pump['isDisconnected'] = False
+            elif rng.random() < 0.00002:
+                pump['isDisconnected'] = True
+                pump['offline_until'] = now + timedelta(seconds=rng.choice([10, 40, 90, 300]))
+            elif pump['status'] == 'đang bơm':
+                if now >= pump['busy_until']:
+                    pump['status'] = 'sẵn sàng'
+                    pump['pump'] += 1
+            elif rng.random() < start_rate:
+                pump['status'] = 'đang bơm'
+                pump['busy_until'] = now + timedelta(seconds=rng.randint(30, 180))
+        yield now, [{'id': pump['id'], 'pump': pump['pump'], 'status': pump['status'],
+                     'MaBomMoiNhat': {'pump': pump['pump']}, 'isDisconnected': pump['isDisconnected']}
+                    for pump in state]
+
+def bench_polling(args):
+    """So sánh số lần poll và độ trễ phát hiện giữa poll cố định và AdaptivePollInterval
+
+    Chuỗi thật được lấy mẫu theo đồng hồ ảo: mỗi lần poll thấy snapshot mới nhất
+    tính tới thời điểm đó.
+    """
+    clientMQTT.configure_log_levels('CRITICAL')
+    if args.snapshots:
+        truth = list(recorded_stream(args.snapshots))
+    else:
+        truth = list(station_day_stream(args.pumps, args.hours, args.seed))
+    if not truth:
+        sys.exit("Không có snapshot")
+
+    # Sự kiện cần phát hiện: mọi thay đổi trạng thái vòi, và riêng lúc vòi bắt đầu mất kết nối
+    changes, disconnects = [], []
+    previous = {}
+    for index, (now, snapshot) in enumerate(truth):
+        current = {item.get('id'): (item.get('status'), item.get('pump'), item.get('isDisconnected', False))
+                   for item in snapshot}
+        if index and current != previous:
+            changes.append(index)
+        if any(value[2] and not previous.get(idcot, (None, None, True))[2] for idcot, value in current.items()):
+            disconnects.append(index)
+        previous = current
+
+    pacer = clientMQTT.AdaptivePollInterval(min_interval=args.min_interval, max_interval=args.max_interval)
+    start = truth[0][0]
+    offsets = [(now - start).total_seconds() for now, _ in truth]
+    end = offsets[-1]
+    poll_times = []
+    clock, index = 0.0, 0
+    while clock <= end:
+        while index + 1 < len(truth) and offsets[index + 1] <= clock:
+            index += 1
+        poll_times.append((clock, index))
+        clock += pacer.observe(truth[index][1])
+
+    def latencies(events):
+        result, cursor = [], 0
+        for event in events:
+            while cursor < len(poll_times) and poll_times[cursor][1] < event:
+                cursor += 1
+            if cursor < len(poll_times):
+                result.append(poll_times[cursor][0] - offsets[event])
+        return result
+
+    # Cảnh báo 'disconnection' thật: chạy check_mabom trên các snapshot mà poll thấy
+    engine = ReplayStation()
+    alerts = {}  # id vòi -> [thời điểm cảnh báo (giây từ đầu chuỗi)]
+    previous = None
+    for clock, index in poll_times:
+        now = start + timedelta(seconds=clock)
+        for action in engine.check(truth[index][1], now, previous):
+            if action[:2] == ('warning', 'disconnection'):
+                alerts.setdefault(str(action[2]), []).append(clock)
+        previous = now
+
+    # Đối chiếu với các lần mất kết nối thật (bắt đầu, kết thúc) của từng vòi
+    outages, down = [], {}
+    for offset, (_, snapshot) in zip(offsets, truth):
+        for item in snapshot:
+            pump_id = str(item.get('id'))
+            if item.get('isDisconnected', False):
+                down.setdefault(pump_id, offset)
+            elif pump_id in down:
+                outages.append((pump_id, down.pop(pump_id), offset))
+    outages.extend((pump_id, begin, end) for pump_id, begin in down.items())
+    window = clientMQTT.DISCONNECT_ALERT_SECONDS
+    alert_delays, missed, early = [], 0, 0
+    for pump_id, begin, finish in outages:
+        fired = [clock for clock in alerts.get(pump_id, ()) if begin <= clock <= finish + pacer.max_interval]
+        if fired:
+            alert_delays.append(fired[0] - begin)
+            early += fired[0] - begin < window * 3 / 4
+        elif finish - begin > window + args.min_interval:
+            missed += 1
+
+    fixed_polls = int(end // args.min_interval) + 1
+    print(f"Chuỗi {end / 3600:.1f} giờ, {len(truth[0][1])} vòi, {len(changes)} thay đổi, "
+          f"{len(disconnects)} lần mất kết nối; chu kỳ {args.min_interval:g}–{pacer.max_interval:g} giây")
+    print(f"Poll cố định   {fixed_polls:>10} lần")
+    print(f"Poll thích ứng {len(poll_times):>10} lần ({100 * (1 - len(poll_times) / fixed_polls):.0f}% ít hơn)")
+    for name, values in (('thay đổi trạng thái', latencies(changes)), ('mất kết nối', latencies(disconnects))):
+        if values:
+            print(f"Trễ phát hiện {name:<20} p50 {percentile(values, 0.5):6.1f} s  "
+                  f"p99 {percentile(values, 0.99):6.1f} s  max {max(values):6.1f} s")
+    if alert_delays:
+        print(f"Cảnh báo sau lúc mất thật   n {len(alert_delays)}  min {min(alert_delays):6.1f} s  "
+              f"p50 {percentile(alert_delays, 0.5):6.1f} s  max {max(alert_delays):6.1f} s  "
+              f"(bỏ lỡ {missed}, sớm {early})")
+    # Poll cố định cảnh báo trong vòng window + một chu kỳ nhanh; poll thích ứng không được muộn hơn
+    if missed or early or max(alert_delays, default=0) > window + args.min_interval:
+        print(f"VƯỢT CỬA SỔ CẢNH BÁO {window} giây")
+        sys.exit(1)
+
+# ==================== KHỞI ĐỘNG ====================
+# Chạy main() thật của client (gateway một trạm), chỉ trỏ broker về broker cục bộ
+STARTUP_SCRIPT = (
+    "import sys\n"
+    "sys.path.insert(0, sys.argv[1])\n"
+    "import clientMQTT\n"
+    "clientMQTT.MQTT_BROKER_HOST = '127.0.0.1'\n"
+    "clientMQTT.MQTT_BROKER_PORT = int(sys.argv[2])\n"
+    "sys.argv = [sys.argv[0], '--gateway', sys.argv[3], '--metrics-port', '0']\n"
+    "clientMQTT.main()\n"
+)
+
+async def run_startup(args):
+    controller = FakeController(1, args.pumps, seed=args.seed)
+    broker = MiniBroker()
+    await controller.start()
+    broker_port = await broker.start()
+    heartbeat = asyncio.Event()
+    broker.listeners.append(lambda topic, payload, received_at:
+                            topic == clientMQTT.TOPICS['station_heartbeat'] and heartbeat.set())
+
+    workdir = tempfile.mkdtemp(prefix='fuel-startup-')
+    stations_file = os.path.join(workdir, 'stations.json')
+    with open(stations_file, 'w', encoding='utf-8') as file:
+        json.dump([{'port': '0', 'controller_url': controller.url('0'), 'restart_command': ['true']}], file)
+    results = []
+    try:
+        for run in range(args.runs):
+            heartbeat.clear()
+            connects = broker.connects
+            started = time.monotonic()
+            process = subprocess.Popen(
+                [sys.executable, '-c', STARTUP_SCRIPT, os.path.dirname(os.path.abspath(__file__)),
+                 str(broker_port), stations_file],
+                cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            connected = None
+            try:
+                deadline = started + args.timeout
+                while not heartbeat.is_set() and time.monotonic() < deadline:
+                    if connected is None and broker.connects > connects:
+                        connected = time.monotonic() - started
+                    await asyncio.sleep(0.002)
+                first_heartbeat = time.monotonic() - started if heartbeat.is_set() else None
+                if connected is None and broker.connects > connects:
+                    connected = first_heartbeat
+            finally:
+                process.terminate()
+                await asyncio.get_running_loop().run_in_executor(None, process.wait)
+            # Lần đầu chưa có cache thông tin trạm trong thư mục làm việc
+            results.append({'run': run, 'cache': 'cold' if run == 0 else 'warm',
+                            'connect_s': connected, 'first_heartbeat_s': first_heartbeat})
+    finally:
+        await broker.stop()
+        controller.server.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def bench_startup(args):
+    """Thời gian từ lúc khởi chạy tiến trình client tới heartbeat đầu tiên trên broker"""
+    results = asyncio.run(run_startup(args))
+    if args.json:
+        print(json.dumps(results))
+        return
+    for result in results:
+        connect = result['connect_s']
+        heartbeat = result['first_heartbeat_s']
+        print(f"Lần {result['run'] + 1} ({result['cache']}): kết nối "
+              f"{'-' if connect is None else f'{connect * 1000:.0f} ms'}, heartbeat đầu tiên "
+              f"{'quá thời gian chờ' if heartbeat is None else f'{heartbeat * 1000:.0f} ms'}")
+    warm = [result['first_heartbeat_s'] for result in results[1:] if result['first_heartbeat_s'] is not None]
+    if warm:
+        print(f"Trung vị (warm): {statistics.median(warm) * 1000:.0f} ms")
+
+# ==================== PUBLISH GOM LÔ ====================
+async def run_publish(args, window, topic_qos):
+    """Gateway args.stations trạm trên một kết nối; mỗi đợt mọi vòi của mọi trạm mất kết nối cùng lúc
+    (một cảnh báo + một sự kiện mỗi vòi), kèm heartbeat và dữ liệu đầy đủ của từng trạm"""
+    broker = MiniBroker(ack_delay=args.rtt)
+    broker_port = await broker.start()
+    clientMQTT.MQTT_BROKER_HOST = '127.0.0.1'
+    clientMQTT.MQTT_BROKER_PORT = broker_port
+    clientMQTT.TOPIC_QOS = topic_qos
+
+    sent = {}  # (port, pump_id) -> monotonic lúc gọi publish_warning
+    latencies = []
+    delivered = [0]
+
+    def on_publish(topic, payload, received_at):
+        for message in clientMQTT.unpack_batch(clientMQTT.decode_payload(payload)):
+            delivered[0] += 1
+            started = sent.pop((message.get('port'), message.get('pump_id')), None)
+            if topic == clientMQTT.TOPICS['station_warning'] and started is not None:
+                latencies.append(received_at - started)
+
+    broker.listeners.append(on_publish)
+    workdir = tempfile.mkdtemp(prefix='fuel-publish-')
+    cwd = os.getcwd()
+    os.chdir(workdir)  # hàng đợi offline của client nằm trong thư mục tạm
+    connection = clientMQTT.MQTTFuelStationClient()
+    connection.publisher.window = window
+    stations = []
+    for index in range(args.stations):
+        station = clientMQTT.MQTTFuelStationClient(connection=connection)
+        station.port = str(index)
+        station.version, station.mac = 'BENCH-1.0', '02:00:00:00:00:00'
+        connection.add_station(station)
+        stations.append(station)
+    connection.attach_loop(asyncio.get_running_loop())
+    snapshot = make_snapshot(args.pumps, args.seed)
+    try:
+        if not await connection.connect():
+            sys.exit("Không kết nối được broker cục bộ")
+        await asyncio.sleep(0.2)
+        received_start = len(broker.received)
+        delivered[0] = 0
+        expected = 0
+        started = time.monotonic()
+        for burst in range(args.bursts):
+            for station in stations:
+                station.publish_data(snapshot)
+                station.publish_heartbeat()
+                events = []
+                for pump in range(args.pumps):
+                    pump_id = f"{burst}-{pump}"
+                    sent[(station.port, pump_id)] = time.monotonic()
+                    station.publish_warning('disconnection', pump_id, pump)
+                    events.append({'type': 'disconnected', 'pump_id': pump_id})
+                station.publish_events(events)
+                expected += args.pumps + 3
+            await asyncio.sleep(args.interval)
+        deadline = time.monotonic() + 30
+        while delivered[0] < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.005)
+        elapsed = time.monotonic() - started
+        # Chờ PUBACK cuối cùng để số in-flight về 0
+        while connection.inflight and time.monotonic() < deadline:
+            await asyncio.sleep(0.005)
+    finally:
+        connection.disconnect()
+        await broker.stop()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    packets = broker.received[received_start:]
+    return {
+        'window_ms': window * 1000,
+        'messages': delivered[0],
+        'packets': len(packets),
+        'bytes': sum(len(payload) for _, _, payload in packets),
+        'msg_per_s': round(delivered[0] / elapsed, 1),
+        'warning_latency_ms': {
+            'p50': round(percentile(latencies, 0.5) * 1000, 1),
+            'p95': round(percentile(latencies, 0.95) * 1000, 1),
+            'max': round(max(latencies) * 1000, 1) if latencies else float('nan')
+        }
+    }
+
+def bench_publish(args):
+    """So sánh publish từng message QoS 1 (như trước) với BatchPublisher (gom lô, QoS theo topic)"""
+    clientMQTT.configure_log_levels('CRITICAL')
+    clientMQTT.METRICS_PORT = 0
+    results = {
+        'từng message': asyncio.run(run_publish(args, 0, {})),
+        'gom lô': asyncio.run(run_publish(args, args.window, dict(clientMQTT.TOPIC_QOS)))
+    }
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+        return
+    print(f"{args.stations} trạm x {args.pumps} vòi, {args.bursts} đợt, RTT PUBACK {args.rtt * 1000:.0f} ms")
+    for name, result in results.items():
+        latency = result['warning_latency_ms']
+        print(f"{name:<14}{result['messages']:>7} msg{result['packets']:>7} gói{result['bytes']:>10} B"
+              f"{result['msg_per_s']:>10} msg/s   cảnh báo p50 {latency['p50']} ms  p95 {latency['p95']} ms"
+              f"  max {latency['max']} ms")
+
+# ==================== KẾT NỐI LẠI HÀNG LOẠT ====================
+class LegacyBackoff:
+    """Cách kết nối lại trước đây: thử ngay khi mất kết nối, sau đó cứ 5 giây một lần"""
+
+    def __init__(self, delay=5):
+        self.delay = delay
+        self.attempts = 0
+
+    def next_delay(self):
+        self.attempts += 1
+        return 0 if self.attempts == 1 else self.delay
+
+    def reset(self):
+        self.attempts = 0
+
+class StormClient(clientMQTT.MQTTFuelStationClient):
+    """Một trạm trên kết nối riêng, ghi lại thời điểm mỗi lần thử kết nối (không dùng hàng đợi offline)"""
+
+    def __init__(self, port, attempts):
+        super().__init__()
+        self.port = port
+        self.version, self.mac = 'BENCH-1.0', f"02:00:00:{int(port) >> 16 & 0xFF:02x}:{int(port) >> 8 & 0xFF:02x}:{int(port) & 0xFF:02x}"
+        self.attempts = attempts
+        self.add_station(self)
+
+    def start_offline_queue(self):
+        pass
+
+    async def connect(self, timeout=clientMQTT.MQTT_CONNECT_TIMEOUT):
+        self.attempts.append(time.monotonic())
+        return await super().connect(timeout)
+
+def peak_rate(times, window=0.1):
+    """Số sự kiện lớn nhất trong một cửa sổ window giây"""
+    times = sorted(times)
+    peak, start = 0, 0
+    for end, moment in enumerate(times):
+        while moment - times[start] > window:
+            start += 1
+        peak = max(peak, end - start + 1)
+    return peak
+
+async def run_storm(args, legacy):
+    """args.clients trạm kết nối tới broker cục bộ; broker khởi động lại (giữ phiên bền),
+    trong lúc tắt server gửi một lệnh getdata cho mỗi trạm"""
+    broker = MiniBroker()
+    clientMQTT.MQTT_BROKER_HOST = '127.0.0.1'
+    clientMQTT.MQTT_BROKER_PORT = await broker.start()
+    responses = set()
+    broker.listeners.append(lambda topic, payload, received_at: topic == clientMQTT.TOPICS['station_response'] and
+                            responses.update(str(message.get('port')) for message in
+                                             clientMQTT.unpack_batch(clientMQTT.decode_payload(payload))))
+    loop = asyncio.get_running_loop()
+    attempts = []
+    clients = []
+    tasks = []
+    for index in range(args.clients):
+        client = StormClient(str(20000 + index), attempts)
+        client.clean_session = legacy  # Trước đây: clean session, mất lệnh gửi lúc offline
+        client.backoff = LegacyBackoff() if legacy else clientMQTT.ReconnectBackoff(rng=random.Random(args.seed + index))
+        client.attach_loop(loop)
+        clients.append(client)
+        tasks.append(asyncio.ensure_future(client.maintain_connection()))
+    try:
+        deadline = time.monotonic() + 60
+        while sum(client.connected for client in clients) < len(clients) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.5)  # Chờ SUBSCRIBE xong
+        del attempts[:]
+        restart = asyncio.ensure_future(broker.restart(args.downtime))
+        await asyncio.sleep(0.1)
+        for client in clients:
+            command = {'command': 'getdata', 'command_id': f"storm-{client.port}", 'data': {'getdata': 'Off'}}
+            broker.publish(f"{clientMQTT.TOPICS['station_command']}/{client.port}", json.dumps(command).encode('utf-8'))
+        await restart
+        back_up = time.monotonic()
+        connects_start = len(broker.connect_times)
+        reconnected = {}
+        deadline = back_up + args.timeout
+        while len(reconnected) < len(clients) and time.monotonic() < deadline:
+            for client in clients:
+                if client.connected and client.port not in reconnected:
+                    reconnected[client.port] = time.monotonic() - back_up
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.5)  # Chờ lệnh được chuyển tiếp và kết quả gửi lên
+    finally:
+        for client in clients:
+            client.disconnect()
+        for task in tasks:
+            task.cancel()
+        await broker.stop()
+    delays = list(reconnected.values())
+    return {
+        'mode': 'cũ (clean session, thử lại mỗi 5 s)' if legacy else 'mới (phiên bền, backoff + jitter)',
+        'attempts': len(attempts),
+        'attempts_peak_per_100ms': peak_rate(attempts),
+        'connects_peak_per_100ms': peak_rate(broker.connect_times[connects_start:]),
+        'reconnected': len(reconnected),
+        'reconnect_s': {'p50': round(percentile(delays, 0.5), 2), 'p95': round(percentile(delays, 0.95), 2),
+                        'max': round(max(delays), 2) if delays else float('nan')},
+        'commands_answered': len(responses)
+    }
+
+def bench_storm(args):
+    """So sánh kết nối lại sau khi broker khởi động lại: cách cũ và backoff + jitter + phiên bền"""
+    clientMQTT.configure_log_levels('CRITICAL')
+    clientMQTT.METRICS_PORT = 0
+    workdir = tempfile.mkdtemp(prefix='fuel-storm-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = [asyncio.run(run_storm(args, legacy)) for legacy in (True, False)]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+        return
+    print(f"{args.clients} trạm, broker tắt {args.downtime:g} s rồi khởi động lại (giữ phiên bền), "
+          f"một lệnh mỗi trạm gửi trong lúc tắt")
+    for result in results:
+        delay = result['reconnect_s']
+        print(f"{result['mode']}")
+        print(f"  thử kết nối {result['attempts']}, đỉnh {result['attempts_peak_per_100ms']} lần thử / "
+              f"{result['connects_peak_per_100ms']} CONNECT mỗi 100 ms")
+        print(f"  kết nối lại {result['reconnected']}/{args.clients} sau p50 {delay['p50']} s, p95 {delay['p95']} s, "
+              f"max {delay['max']} s; lệnh được trả lời {result['commands_answered']}/{args.clients}")
+
+# ==================== XỬ LÝ SỰ CỐ ====================
+class RemediationStation(clientMQTT.FuelStationClient):
+    """Một trạm không kết nối MQTT; ghi lại thời điểm mỗi lần check_mabom và mỗi cảnh báo
+
+    legacy: restartall / daylaidulieu chạy đồng bộ ngay trong check_mabom như trước đây.
+    """
+
+    def __init__(self, controller_url, legacy):
+        self.check_times = []
+        self.warnings = []  # (monotonic, pump_id, mabom)
+        self.events = []
+        self.legacy = legacy
+        self.restarts = 0
+        super().__init__(mqtt_client=StubMQTT([]), controller_url=controller_url)
+        self.mqtt_client.getdata_enabled = False
+        self.mqtt_client.publish_warning = lambda warning_type, pump_id, mabom: self.warnings.append(
+            (time.monotonic(), pump_id, mabom))
+        self.mqtt_client.publish_events = self.events.extend
+        self.port = '0'
+
+    def check_mabom(self, data, now=None, since=None):
+        self.check_times.append(time.monotonic())
+        super().check_mabom(data, now, since)
+
+    def restart_controller(self, settle_time=0, reason=None, pump_id='all'):
+        self.restarts += 1
+        if not self.legacy:
+            return super().restart_controller(settle_time, reason, pump_id)
+        subprocess.run(self.restart_command)
+        if settle_time:
+            time.sleep(settle_time)
+
+    def call_daylaidulieu(self, pump_id, reason=None):
+        if not self.legacy:
+            return super().call_daylaidulieu(pump_id, reason)
+        clientMQTT.call_daylaidulieu_api(pump_id, self.controller_url)
+
+async def run_remediation(args, legacy):
+    """Một trạm poll bộ điều khiển giả lập có daylaidulieu chậm; định kỳ chèn gap và một lần lệch mã bơm"""
+    controller = FakeController(1, args.pumps, seed=args.seed)
+    controller.daylaidulieu_delay = args.daylaidulieu_delay
+    await controller.start()
+    station = RemediationStation(controller.url('0'), legacy)
+    station.restart_command = ['sleep', str(args.restart_seconds)]
+    scheduler = clientMQTT.AsyncScheduler()
+    scheduler.spawn(station.poller.run(), 'poll')
+    scheduler.spawn(station.remediation.run(), 'remediation')
+    scheduler.every(1, lambda: asyncio.sleep(0, controller.tick()), 'tick')
+    try:
+        await asyncio.sleep(3)  # Lịch sử mã bơm ban đầu
+        started = time.monotonic()
+        injected_checks = len(station.check_times)
+        # Vòi 1 lệch MaBomMoiNhat qua nhiều giao dịch liên tiếp: restartall + daylaidulieu
+        mismatched = controller.state['0'][0]
+        controller.set_mismatch('0', 1, True)
+        next_gap = next_transaction = started
+        while time.monotonic() - started < args.duration:
+            if mismatched['mismatch'] and time.monotonic() >= next_transaction:
+                mismatched['pump'] += 1
+                next_transaction += station.poller.interval
+                if time.monotonic() - started >= args.mismatch_seconds:
+                    controller.set_mismatch('0', 1, False)
+            if time.monotonic() >= next_gap:
+                # Vài vòi nhảy mã cùng lúc: nhiều daylaidulieu trong một snapshot
+                for _ in range(args.gaps):
+                    controller.inject_gap('0')
+                next_gap += args.gap_interval
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(args.daylaidulieu_delay * args.gaps + args.restart_seconds + 5)
+    finally:
+        await scheduler.stop()
+        controller.server.close()
+    checks = station.check_times[injected_checks:]
+    restarts = station.restarts
+    gaps = [later - earlier for earlier, later in zip(checks, checks[1:])]
+    latency = []
+    for (station_id, pump_id, mabom), injected_at in controller.injected.items():
+        # Vòi có thể bắt đầu giao dịch trước lần poll kế tiếp: cảnh báo mang mã bơm khác mã đã chèn
+        detected = [moment for moment, warned_pump, warned_mabom in station.warnings
+                    if warned_pump == pump_id and moment >= injected_at]
+        if detected:
+            latency.append(min(detected) - injected_at)
+    return {
+        'mode': 'cũ (đồng bộ trong check_mabom)' if legacy else 'mới (RemediationEngine)',
+        'snapshots': len(checks),
+        'check_gap_s': {'p50': round(percentile(gaps, 0.5), 2), 'max': round(max(gaps), 2) if gaps else None},
+        'gaps_injected': len(controller.injected),
+        'gaps_detected': len(latency),
+        'detect_s': {'p50': round(percentile(latency, 0.5), 2), 'p95': round(percentile(latency, 0.95), 2)},
+        'daylaidulieu_calls': controller.daylaidulieu_calls,
+        'restarts': restarts,
+        'reported': len([event for event in station.events if event.get('type') == 'remediation'])
+    }
+
+def bench_remediation(args):
+    """Nhịp phát hiện và độ trễ cảnh báo khi restartall / daylaidulieu chậm: đồng bộ và hàng đợi nền"""
+    clientMQTT.configure_log_levels('CRITICAL')
+    workdir = tempfile.mkdtemp(prefix='fuel-remediation-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = [asyncio.run(run_remediation(args, legacy)) for legacy in (True, False)]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+        return
+    print(f"{args.pumps} vòi, {args.gaps} gap mỗi {args.gap_interval:g} s trong {args.duration:g} s, daylaidulieu "
+          f"{args.daylaidulieu_delay:g} s, restartall {args.restart_seconds:g} s + chờ 3 s")
+    for result in results:
+        print(f"{result['mode']}")
+        print(f"  {result['snapshots']} snapshot, khoảng cách p50 {result['check_gap_s']['p50']} s, "
+              f"max {result['check_gap_s']['max']} s")
+        print(f"  cảnh báo gap {result['gaps_detected']}/{result['gaps_injected']} sau p50 {result['detect_s']['p50']} s, "
+              f"p95 {result['detect_s']['p95']} s")
+        print(f"  restartall {result['restarts']}, daylaidulieu gọi {result['daylaidulieu_calls']} lần, "
+              f"báo kết quả {result['reported']}")
+
+# ==================== THU NHẬN PHÍA SERVER ====================
+def ingest_payloads(stations, pumps, seed=0):
+    """Các (topic, payload) của một vòng gửi của stations trạm, theo đúng schema của client
+
+    Mỗi trạm: heartbeat, dữ liệu delta, một message sự kiện; cứ 10 trạm có một
+    cảnh báo và một dữ liệu đầy đủ (keyframe, gửi trước delta nên delta của các
+    trạm này được dựng lại đầy đủ, trạm khác ghi delta chưa đồng bộ); gateway 8
+    trạm gom heartbeat thành envelope.
+    """
+    rng = random.Random(seed)
+    codec = clientMQTT.PayloadCodec('json')
+    timestamp = '2026-01-01T00:00:00'
+    payloads = []
+    heartbeats = []
+    for station in range(stations):
+        port = str(10000 + station)
+        heartbeats.append({'port': port, 'msg_id': f"h{station}"})
+        if len(heartbeats) == 8 or station == stations - 1:
+            payloads.append((clientMQTT.TOPICS['station_heartbeat'], codec.encode({'batch': heartbeats})))
+            heartbeats = []
+        if station % 10 == 0:
+            payloads.append((clientMQTT.TOPICS['station_data'], codec.encode({
+                'port': port, 'version': 'ARM-1.0', 'mac': '02:00:00:00:00:00', 'timestamp': timestamp,
+                'data': make_snapshot(pumps, seed + station), 'seq': 1, 'msg_id': f"f{station}"})))
+        changed = {str(pump): {'status': rng.choice(['sẵn sàng', 'đang bơm']), 'pump': rng.randint(1000, 90000)}
+                   for pump in rng.sample(range(1, pumps + 1), min(2, pumps))}
+        payloads.append((clientMQTT.TOPICS['station_data'], codec.encode({
+            'port': port, 'version': 'ARM-1.0', 'mac': '02:00:00:00:00:00', 'timestamp': timestamp,
+            'mode': 'delta', 'changed': changed, 'seq': 2, 'msg_id': f"d{station}"})))
+        payloads.append((f"{clientMQTT.TOPICS['station_event']}/{port}", codec.encode({
+            'port': port, 'timestamp': timestamp, 'msg_id': f"e{station}",
+            'events': [{'type': 'started', 'pump_id': '1', 'time': timestamp},
+                       {'type': 'finished', 'pump_id': '1', 'time': timestamp}]})))
+        if station % 10 == 0:
+            payloads.append((clientMQTT.TOPICS['station_warning'], codec.encode({
+                'port': port, 'warning_type': 'nonsequential', 'pump_id': '3', 'mabom': 1234,
+                'timestamp': timestamp, 'msg_id': f"w{station}"})))
+    return payloads
+
+async def run_ingest(args, workers):
+    """Bơm message liên tục qua broker cục bộ tới workers tiến trình thu nhận trong args.duration giây"""
+    broker = MiniBroker()
+    broker_port = await broker.start()
+    workdir = tempfile.mkdtemp(prefix='fuel-ingest-')
+    cwd = os.getcwd()
+    os.chdir(workdir)  # log của worker và kho dạng cột nằm trong thư mục tạm
+    store_dir = os.path.join(workdir, 'ingest')
+    service = serverMQTT.IngestService(workers, '127.0.0.1', broker_port, store_dir, log_level='WARNING')
+    payloads = ingest_payloads(args.stations, args.pumps, args.seed)
+    subscriptions = (workers * len(serverMQTT.ingest_subscriptions()) + len(serverMQTT.PRESENCE_TOPICS)
+                     + len(serverMQTT.ingest_subscriptions(topics=serverMQTT.INGEST_ORDERED_TOPICS)))
+    try:
+        service.start()
+        deadline = time.monotonic() + 60
+        while (sum(len(session['subscriptions']) for session in broker.sessions.values()) < subscriptions
+               and time.monotonic() < deadline):
+            await asyncio.sleep(0.05)
+        cpu_start = {process.pid: process_cpu_seconds(process.pid) for process in service.processes}
+        published = 0
+        started = time.monotonic()
+        while time.monotonic() - started < args.duration:
+            for topic, payload in payloads:
+                broker.publish(topic, payload)
+                published += 1
+                if published % 200 == 0:
+                    await broker.drain()
+            service.poll(timeout=0)
+        generated = time.monotonic() - started
+        # Chờ worker xử lý hết phần còn trong bộ đệm
+        while service.totals().get('packets', 0) < published and time.monotonic() - started < args.duration + 60:
+            await asyncio.sleep(0.05)
+            service.poll(timeout=0)
+        elapsed = time.monotonic() - started
+        cpu = sum(process_cpu_seconds(process.pid) - cpu_start[process.pid] for process in service.processes)
+    finally:
+        service.stop()
+        await broker.stop()
+        os.chdir(cwd)
+
+    totals = service.totals()
+    try:
+        stored = {table: sum(len(block['port']) for path in serverMQTT.table_segments(table, store_dir)
+                             for block in serverMQTT.read_blocks(path, ['port']))
+                  for table in serverMQTT.INGEST_TABLES.values()}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'workers': workers,
+        'published_packets': published,
+        'packets': totals.get('packets', 0),
+        'messages': totals.get('messages', 0),
+        'rejected': totals.get('rejected', 0),
+        'rows': totals.get('rows', 0),
+        'data_synced': totals.get('synced', 0),
+        'data_unsynced': totals.get('unsynced', 0),
+        'stored_rows': stored,
+        'stations_online': len(service.liveness.online),
+        'publish_seconds': round(generated, 2),
+        'msg_per_s': round(totals.get('messages', 0) / elapsed),
+        'worker_cpu_s': round(cpu, 2),
+        'msg_per_s_per_core': round(totals.get('messages', 0) / cpu) if cpu else None
+    }
+
+def bench_ingest(args):
+    """Thông lượng thu nhận (message/s, message/s trên mỗi core CPU của worker) theo số worker"""
+    clientMQTT.configure_log_levels('WARNING')
+    results = [asyncio.run(run_ingest(args, workers)) for workers in args.workers]
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+        return
+    print(f"{args.stations} trạm x {args.pumps} vòi, bơm liên tục {args.duration:g} s qua broker cục bộ")
+    print(f"{'worker':>7}{'gói':>9}{'message':>10}{'dòng':>10}{'bỏ':>5}{'online':>8}{'msg/s':>9}"
+          f"{'CPU s':>8}{'msg/s/core':>12}")
+    for result in results:
+        print(f"{result['workers']:>7}{result['packets']:>9}{result['messages']:>10}{result['rows']:>10}"
+              f"{result['rejected']:>5}{result['stations_online']:>8}{result['msg_per_s']:>9}"
+              f"{result['worker_cpu_s']:>8}{result['msg_per_s_per_core']:>12}")
+        print(f"  station_data đồng bộ {result['data_synced']}, delta chưa đồng bộ {result['data_unsynced']}")
+        if sum(result['stored_rows'].values()) != result['rows']:
+            print(f"  ⚠️ Số dòng trong kho {result['stored_rows']} khác số dòng worker báo")
+
+# ==================== HANDSHAKE TLS ====================
+def make_certificates(directory, key_type='rsa'):
+    """Tạo CA, chứng chỉ broker (SAN 127.0.0.1/localhost) và chứng chỉ client bằng openssl CLI"""
+    newkey = ['-newkey', 'rsa:2048'] if key_type == 'rsa' else ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1']
+    paths = {name: os.path.join(directory, name) for name in
+             ('ca.pem', 'ca.key', 'server.pem', 'server.key', 'client.pem', 'client.key')}
+
+    def openssl(*arguments):
+        subprocess.run(['openssl', *arguments], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    openssl('req', '-x509', *newkey, '-nodes', '-days', '1', '-subj', '/CN=fuel-bench-ca',
+            '-keyout', paths['ca.key'], '-out', paths['ca.pem'])
+    for name, subject, extension in (('server', '/CN=localhost', 'subjectAltName=IP:127.0.0.1,DNS:localhost'),
+                                     ('client', '/CN=fuel-bench-client', 'extendedKeyUsage=clientAuth')):
+        request = os.path.join(directory, f"{name}.csr")
+        extfile = os.path.join(directory, f"{name}.ext")
+        with open(extfile, 'w') as file:
+            file.write(extension + '\n')
+        openssl('req', *newkey, '-nodes', '-subj', subject, '-keyout', paths[f"{name}.key"], '-out', request)
+        openssl('x509', '-req', '-days', '1', '-in', request, '-CA', paths['ca.pem'], '-CAkey', paths['ca.key'],
+                '-CAcreateserial', '-extfile', extfile, '-out', paths[f"{name}.pem"])
+    return paths
+
+def broker_tls_context(directory, ciphers):
+    """TLS phía broker: bắt buộc chứng chỉ client, theo thứ tự bộ mã client đưa ra"""
+    context = clientMQTT.ssl.create_default_context(clientMQTT.ssl.Purpose.CLIENT_AUTH,
+                                                    cafile=os.path.join(directory, 'ca.pem'))
+    context.load_cert_chain(os.path.join(directory, 'server.pem'), os.path.join(directory, 'server.key'))
+    context.verify_mode = clientMQTT.ssl.CERT_REQUIRED
+    context.set_ciphers(ciphers)
+    context.options &= ~clientMQTT.ssl.OP_CIPHER_SERVER_PREFERENCE
+    return context
+
+def run_tls_broker(args):
+    """Tiến trình con: broker plain + TLS, in hai port rồi chạy tới khi bị dừng (CPU đo riêng)"""
+    async def serve():
+        plain = MiniBroker()
+        secure = MiniBroker(ssl_context=broker_tls_context(args.certs, args.ciphers))
+        print(json.dumps({'plain': await plain.start(), 'tls': await secure.start()}), flush=True)
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+async def run_reconnects(broker, reconnects):
+    """Kết nối / ngắt kết nối một client reconnects lần; trả về thời gian tới CONNACK và CPU mỗi lần"""
+    client = clientMQTT.MQTTFuelStationClient(broker=broker)
+    client.start_offline_queue = lambda: None
+    client.attach_loop(asyncio.get_running_loop())
+    durations, cpu, resumed = [], [], []
+    details = None
+    for _ in range(reconnects):
+        cpu_start = time.process_time()
+        started = time.perf_counter()
+        if not await client.connect():
+            raise RuntimeError(f"Không kết nối được broker {broker['host']}:{broker['port']}")
+        durations.append(time.perf_counter() - started)
+        cpu.append(time.process_time() - cpu_start)
+        if client.tls_context is not None:
+            sock = client.tls_context.last_socket
+            resumed.append(sock.session_reused)
+            details = f"{sock.version()} {sock.cipher()[0]}"
+        client.client.disconnect()
+        await asyncio.wait_for(client.disconnected_event.wait(), 5)
+    client.commands.shutdown()
+    return durations, cpu, resumed, details
+
+def bench_tls(args):
+    """Thời gian kết nối lại và CPU: TCP thường, TLS handshake đầy đủ, TLS dùng lại phiên"""
+    clientMQTT.configure_log_levels('CRITICAL')
+    clientMQTT.METRICS_PORT = 0
+    if shutil.which('openssl') is None:
+        print("Cần openssl CLI để tạo chứng chỉ thử nghiệm")
+        return
+    script = os.path.abspath(__file__)
+    workdir = tempfile.mkdtemp(prefix='fuel-tls-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    process = None
+    try:
+        make_certificates(workdir, args.key)
+        command = [sys.executable, script, 'tls-broker',
+                   '--certs', workdir, '--ciphers', args.ciphers]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        ports = json.loads(process.stdout.readline())
+        tls = {'ca_certs': 'ca.pem', 'certfile': 'client.pem', 'keyfile': 'client.key', 'ciphers': args.ciphers}
+        modes = [('tcp', None)]
+        for version in args.versions:
+            modes.append((f"{version} đầy đủ", dict(tls, max_version=version, resume=False)))
+            modes.append((f"{version} dùng lại", dict(tls, max_version=version, resume=True)))
+        results = []
+        for name, tls_config in modes:
+            broker = {'host': '127.0.0.1', 'port': ports['tls' if tls_config else 'plain'], 'transport': 'tcp',
+                      'ws_path': clientMQTT.MQTT_WS_PATH, 'tls': tls_config}
+            broker_cpu = process_cpu_seconds(process.pid)
+            durations, cpu, resumed, details = asyncio.run(run_reconnects(broker, args.reconnects + 1))
+            broker_cpu = process_cpu_seconds(process.pid) - broker_cpu
+            # Bỏ lần đầu: luôn là handshake đầy đủ (chưa có phiên để dùng lại)
+            durations, cpu, resumed = durations[1:], cpu[1:], resumed[1:]
+            results.append({
+                'mode': name,
+                'negotiated': details,
+                'resumed': sum(resumed),
+                'connect_ms': {'p50': round(percentile(durations, 0.5) * 1000, 2),
+                               'p95': round(percentile(durations, 0.95) * 1000, 2)},
+                'client_cpu_ms': round(sum(cpu) / len(cpu) * 1000, 2),
+                'broker_cpu_ms': round(broker_cpu / (args.reconnects + 1) * 1000, 2)
+            })
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+        return
+    print(f"{args.reconnects} lần kết nối lại mỗi chế độ qua loopback, khóa {args.key}, chứng chỉ client bắt buộc")
+    print(f"{'chế độ':<18}{'phiên':>6}{'p50 ms':>9}{'p95 ms':>9}{'CPU client ms':>15}{'CPU broker ms':>15}  bộ mã")
+    for result in results:
+        print(f"{result['mode']:<18}{result['resumed']:>6}{result['connect_ms']['p50']:>9}{result['connect_ms']['p95']:>9}"
+              f"{result['client_cpu_ms']:>15}{result['broker_cpu_ms']:>15}  {result['negotiated'] or '-'}")
+
+# ==================== LIVENESS ====================
+async def run_liveness(args, mode):
+    """Một chế độ liveness: tải broker lúc ổn định và thời gian server phát hiện trạm treo
+
+    Client khởi động trước dịch vụ thu nhận: ở chế độ 'will' server chỉ biết trạm
+    online qua bản retained. Bộ điều khiển giả lập đứng yên (không có snapshot
+    mới) để chỉ còn lưu lượng liveness. Một tiến trình client bị SIGSTOP (treo,
+    không đóng socket) để đo thời gian tới khi server coi các trạm của nó offline.
+    """
+    station_count = args.clients * args.stations_per_client
+    controller = FakeController(station_count, args.pumps, seed=args.seed)
+    broker = MiniBroker()
+    await controller.start()
+    broker_port = await broker.start()
+    workdir = tempfile.mkdtemp(prefix='fuel-liveness-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    stations = [str(station) for station in range(station_count)]
+    chunks = [stations[index * args.stations_per_client:(index + 1) * args.stations_per_client]
+              for index in range(args.clients)]
+    workers = []
+    service = None
+    try:
+        for index, chunk in enumerate(chunks):
+            client_dir = os.path.join(workdir, f"client-{index}")
+            os.makedirs(client_dir)
+            workers.append(spawn_worker(broker_port, f"http://127.0.0.1:{controller.port}", chunk, client_dir,
+                                        'WARNING', liveness=mode, keepalive=args.keepalive))
+        deadline = time.monotonic() + 30
+        while len(broker.sessions) < args.clients and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(args.warmup)
+
+        service = serverMQTT.IngestService(1, '127.0.0.1', broker_port, os.path.join(workdir, 'ingest'),
+                                           log_level='WARNING')
+        service.start()
+        started = time.monotonic()
+        deadline = started + 60
+        while len(service.liveness.online) < station_count and time.monotonic() < deadline:
+            service.poll(timeout=0)
+            await asyncio.sleep(0.05)
+        online_after = time.monotonic() - started
+
+        received_start = len(broker.received)
+        started = time.monotonic()
+        while time.monotonic() - started < args.duration:
+            service.poll(timeout=0)
+            await asyncio.sleep(0.2)
+        elapsed = time.monotonic() - started
+        per_topic = {}
+        for _, topic, _ in broker.received[received_start:]:
+            key = clientMQTT._topic_key(topic)
+            per_topic[key] = per_topic.get(key, 0) + 1
+
+        victim = workers[0]
+        stopped = time.monotonic()
+        os.kill(victim.pid, signal.SIGSTOP)
+        detected = None
+        while time.monotonic() - stopped < args.timeout:
+            service.poll(timeout=0)
+            if not any(port in service.liveness.online for port in chunks[0]):
+                detected = time.monotonic() - stopped
+                break
+            await asyncio.sleep(0.1)
+        os.kill(victim.pid, signal.SIGCONT)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        if service is not None:
+            service.stop()
+        await broker.stop()
+        controller.server.close()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'mode': mode,
+        'stations': station_count,
+        'online_seconds': round(online_after, 2) if len(service.liveness.online) else None,
+        'msg_per_s': round(sum(per_topic.values()) / elapsed, 2),
+        'per_topic': {key: round(count / elapsed, 2) for key, count in sorted(per_topic.items())},
+        'wills': broker.wills,
+        'detect_seconds': round(detected, 1) if detected is not None else None
+    }
+
+def bench_liveness(args):
+    """So sánh heartbeat 10 s với trạng thái retained + Last Will: tải broker và độ trễ phát hiện offline"""
+    clientMQTT.configure_log_levels('WARNING')
+    results = [asyncio.run(run_liveness(args, mode)) for mode in args.modes]
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+        return
+    print(f"{args.clients} client x {args.stations_per_client} trạm, keepalive {args.keepalive} s, "
+          f"đo {args.duration:g} s lúc ổn định; treo (SIGSTOP) một client")
+    print(f"{'chế độ':<11}{'online sau s':>13}{'msg/s':>9}{'phát hiện s':>13}{'Last Will':>11}  theo topic (msg/s)")
+    for result in results:
+        topics = ', '.join(f"{key} {rate:g}" for key, rate in result['per_topic'].items()) or '-'
+        print(f"{result['mode']:<11}{str(result['online_seconds']):>13}{result['msg_per_s']:>9}"
+              f"{str(result['detect_seconds']):>13}{result['wills']:>11}  {topics}")
+
+# ==================== NGUỒN ĐẨY SNAPSHOT ====================
+async def run_push(args, mode):
+    """Một backend lấy snapshot: độ trễ gap -> cảnh báo khi trạm hoạt động, CPU và request khi trạm rảnh"""
+    station_count = args.clients * args.stations_per_client
+    controller = FakeController(station_count, args.pumps, seed=args.seed)
+    broker = MiniBroker()
+    await controller.start()
+    broker_port = await broker.start()
+    workdir = tempfile.mkdtemp(prefix='fuel-push-')
+    stations = [str(station) for station in range(station_count)]
+    feed = None
+    if mode == 'sse':
+        feed = '/events'
+    elif mode == 'unix':
+        feed = f"unix://{workdir}/feed-{{station}}.sock"
+        for station in stations:
+            await controller.start_unix_feed(station, os.path.join(workdir, f"feed-{station}.sock"))
+    elif mode == 'file':
+        feed = f"file://{workdir}/feed-{{station}}.ndjson"
+        for station in stations:
+            controller.add_feed_file(station, os.path.join(workdir, f"feed-{station}.ndjson"))
+
+    latencies = []
+
+    def on_warning(topic, payload, received_at):
+        if topic != clientMQTT.TOPICS['station_warning']:
+            return
+        for message in clientMQTT.unpack_batch(clientMQTT.decode_payload(payload)):
+            key = (str(message.get('port')), str(message.get('pump_id')), message.get('mabom'))
+            injected_at = controller.injected.pop(key, None)
+            if injected_at is not None:
+                latencies.append(received_at - injected_at)
+
+    broker.listeners.append(on_warning)
+    workers = []
+    try:
+        for index in range(args.clients):
+            client_dir = os.path.join(workdir, f"client-{index}")
+            os.makedirs(client_dir)
+            chunk = stations[index * args.stations_per_client:(index + 1) * args.stations_per_client]
+            workers.append(spawn_worker(broker_port, f"http://127.0.0.1:{controller.port}", chunk, client_dir,
+                                        'WARNING', feed=feed))
+        deadline = time.monotonic() + 30
+        while len(broker.sessions) < args.clients and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(args.warmup)
+
+        # Trạm hoạt động: vòi giao dịch, chèn gap định kỳ
+        requests_start = controller.requests
+        started = time.monotonic()
+        next_gap = started
+        while time.monotonic() - started < args.duration:
+            controller.tick()
+            if time.monotonic() >= next_gap:
+                controller.inject_gap()
+                next_gap += args.gap_interval
+            await asyncio.sleep(0.5)
+        active_requests = (controller.requests - requests_start) / (time.monotonic() - started)
+
+        # Trạm rảnh: không còn thay đổi
+        await asyncio.sleep(2)
+        cpu_start = {worker.pid: process_cpu_seconds(worker.pid) for worker in workers}
+        requests_start = controller.requests
+        started = time.monotonic()
+        await asyncio.sleep(args.idle)
+        elapsed = time.monotonic() - started
+        idle_cpu = [(process_cpu_seconds(worker.pid) - cpu_start[worker.pid]) / elapsed * 100 for worker in workers]
+        idle_requests = (controller.requests - requests_start) / elapsed
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        await broker.stop()
+        controller.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'mode': mode,
+        'stations': station_count,
+        'alert_latency_ms': {
+            'count': len(latencies),
+            'missed': len(controller.injected),
+            'p50': round(percentile(latencies, 0.5) * 1000, 1),
+            'p95': round(percentile(latencies, 0.95) * 1000, 1)
+        },
+        'active_requests_per_s': round(active_requests, 2),
+        'idle_requests_per_s': round(idle_requests, 3),
+        'idle_cpu_percent_per_client': round(statistics.mean(idle_cpu), 3)
+    }
+
+def bench_push(args):
+    """So sánh poll GetfullupdateArr với các nguồn đẩy (SSE, Unix socket, file NDJSON)"""
+    clientMQTT.configure_log_levels('WARNING')
+    results = [asyncio.run(run_push(args, mode)) for mode in args.modes]
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+        return
+    print(f"{args.clients} client x {args.stations_per_client} trạm x {args.pumps} vòi; hoạt động {args.duration:g} s "
+          f"(gap mỗi {args.gap_interval:g} s), rảnh {args.idle:g} s")
+    print(f"{'backend':<9}{'gap':>5}{'bỏ lỡ':>7}{'p50 ms':>9}{'p95 ms':>9}{'req/s hoạt động':>17}"
+          f"{'req/s rảnh':>12}{'CPU rảnh %':>12}")
+    for result in results:
+        latency = result['alert_latency_ms']
+        print(f"{result['mode']:<9}{latency['count']:>5}{latency['missed']:>7}{latency['p50']:>9}{latency['p95']:>9}"
+              f"{result['active_requests_per_s']:>17}{result['idle_requests_per_s']:>12}"
+              f"{result['idle_cpu_percent_per_client']:>12}")
+
+# ==================== LỊCH SỬ TRÊN THIẾT BỊ ====================
+def measure_history_ring(args, directory):
+    """Trong tiến trình: chi phí ghi mỗi lần poll và thời gian truy vấn trên ring đầy"""
+    ring = clientMQTT.HistoryRing(os.path.join(directory, 'bench.ring'), max_bytes=args.ring_bytes)
+    polls = ring.capacity // args.pumps
+    # Đồng hồ ảo: mỗi lần poll cách nhau SNAPSHOT_POLL_INTERVAL giây, kết thúc ở hiện tại
+    now = time.time()
+    start = now - polls * clientMQTT.SNAPSHOT_POLL_INTERVAL
+    stream = mabom_stream(args.pumps, polls, seed=args.seed)
+    started = time.perf_counter()
+    for index, (_, snapshot) in enumerate(stream):
+        ring.append(snapshot, datetime.fromtimestamp(start + index * clientMQTT.SNAPSHOT_POLL_INTERVAL))
+    append_us = (time.perf_counter() - started) / polls * 1e6
+    queries = {}
+    for name, step, changes in (('raw', 0, False), ('changes', 0, True), ('step 60s', 60, False)):
+        started = time.perf_counter()
+        count = sum(1 for _ in clientMQTT.downsample_history(ring.samples(now - args.window, now), step, changes))
+        queries[name] = {'samples': count, 'ms': round((time.perf_counter() - started) * 1000, 1)}
+    ring.close()
+    return {
+        'ring_bytes': args.ring_bytes,
+        'capacity_samples': ring.capacity,
+        'retention_hours': round(polls * clientMQTT.SNAPSHOT_POLL_INTERVAL / 3600, 1),
+        'append_us_per_poll': round(append_us, 1),
+        'queries': queries
+    }
+
+async def run_history(args, directory):
+    """Một client thật: lưu lượng lúc ghi lịch sử, rồi gửi lệnh history và đo các chunk trả về"""
+    controller = FakeController(1, args.pumps, seed=args.seed)
+    broker = MiniBroker()
+    await controller.start()
+    broker_port = await broker.start()
+    worker = spawn_worker(broker_port, f"http://127.0.0.1:{controller.port}", ['0'], directory, 'WARNING')
+    response_topic = clientMQTT.TOPICS['station_response']
+    try:
+        deadline = time.monotonic() + 30
+        while not broker.sessions and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(args.warmup)
+        received_start = len(broker.received)
+        started = time.monotonic()
+        while time.monotonic() - started < args.duration:
+            controller.tick()
+            await asyncio.sleep(0.5)
+        elapsed = time.monotonic() - started
+        recording_bytes = sum(len(payload) for _, _, payload in broker.received[received_start:])
+
+        received_start = len(broker.received)
+        requested = time.monotonic()
+        command = {'command': 'history', 'command_id': 'bench-history',
+                   'data': {'seconds': args.duration + args.warmup, 'step': args.step, 'changes': args.changes}}
+        broker.publish(f"{clientMQTT.TOPICS['station_command']}/0", json.dumps(command).encode('utf-8'))
+        result = None
+        chunks = []
+        deadline = time.monotonic() + 60
+        while result is None and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            for received_at, topic, payload in broker.received[received_start:]:
+                if topic != response_topic:
+                    continue
+                for message in clientMQTT.unpack_batch(clientMQTT.decode_payload(payload)):
+                    if message.get('command') != 'history':
+                        continue
+                    if 'chunk' in message:
+                        chunks.append((received_at, len(payload), len(message['samples']['t'])))
+                    else:
+                        result = (received_at, message)
+            received_start = len(broker.received)
+    finally:
+        worker.terminate()
+        try:
+            worker.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+        await broker.stop()
+        controller.close()
+    return {
+        'recording_seconds': round(elapsed, 1),
+        'uplink_bytes_per_s_while_recording': round(recording_bytes / elapsed, 1),
+        'chunks': len(chunks),
+        'samples': sum(samples for _, _, samples in chunks),
+        'bytes': sum(size for _, size, _ in chunks),
+        'first_chunk_ms': round((chunks[0][0] - requested) * 1000, 1) if chunks else None,
+        'complete_ms': round((result[0] - requested) * 1000, 1) if result else None,
+        'status': result[1].get('status') if result else 'timeout'
+    }
+
+def bench_history(args):
+    """Lịch sử ring buffer trên thiết bị: chi phí ghi / truy vấn và lệnh history qua MQTT"""
+    clientMQTT.configure_log_levels('WARNING')
+    directory = tempfile.mkdtemp(prefix='fuel-history-')
+    try:
+        ring = measure_history_ring(args, directory)
+        command = asyncio.run(run_history(args, directory))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.json:
+        print(json.dumps({'ring': ring, 'command': command}, ensure_ascii=False))
+        return
+    print(f"Ring {ring['ring_bytes']} byte: {ring['capacity_samples']} mẫu, {args.pumps} vòi poll mỗi "
+          f"{clientMQTT.SNAPSHOT_POLL_INTERVAL} s giữ {ring['retention_hours']} giờ; "
+          f"ghi {ring['append_us_per_poll']} µs/lần poll")
+    print(f"Truy vấn {args.window:g} s gần nhất:")
+    for name, stats in ring['queries'].items():
+        print(f"  {name:<10}{stats['samples']:>9} mẫu{stats['ms']:>10} ms")
+    print(f"Client thật, {args.pumps} vòi, ghi {command['recording_seconds']} s: uplink "
+          f"{command['uplink_bytes_per_s_while_recording']} B/s (getdata tắt)")
+    print(f"Lệnh history (step {args.step:g}, changes {args.changes}): {command['status']}, {command['samples']} mẫu, "
+          f"{command['chunks']} chunk, {command['bytes']} byte; chunk đầu {command['first_chunk_ms']} ms, "
+          f"xong {command['complete_ms']} ms")
+
+# ==================== MAIN ====================
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MQTT Fuel Station Client")
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    codec_parser = subparsers.add_parser('codec', help="Kích thước payload và thời gian mã hóa theo codec")
+    codec_parser.add_argument('--snapshots', help="File snapshot GetfullupdateArr đã ghi lại")
+    codec_parser.add_argument('--pumps', type=int, default=16, help="Số vòi khi dùng dữ liệu giả lập")
+    codec_parser.add_argument('--rounds', type=int, default=200)
+    codec_parser.set_defaults(func=bench_codec)
+
+    load_parser = subparsers.add_parser('load', help="Load test K client với bộ điều khiển giả lập và broker cục bộ")
+    load_parser.add_argument('--clients', type=int, default=4, help="Số tiến trình client (K)")
+    load_parser.add_argument('--stations-per-client', type=int, default=1, help="Số trạm mỗi client (chế độ gateway)")
+    load_parser.add_argument('--pumps', type=int, default=16, help="Số vòi mỗi trạm (N)")
+    load_parser.add_argument('--duration', type=float, default=30, help="Thời gian đo (giây)")
+    load_parser.add_argument('--warmup', type=float, default=5, help="Thời gian khởi động trước khi đo (giây)")
+    load_parser.add_argument('--gap-interval', type=float, default=1.0, help="Chèn một mã bơm nhảy cóc mỗi N giây")
+    load_parser.add_argument('--disconnect-interval', type=float, default=0, help="Cho một vòi mất kết nối mỗi N giây (0: tắt)")
+    load_parser.add_argument('--disconnect-duration', type=float, default=70, help="Thời gian mất kết nối (giây)")
+    load_parser.add_argument('--mismatch-interval', type=float, default=0, help="Cho một vòi lệch MaBomMoiNhat mỗi N giây (0: tắt)")
+    load_parser.add_argument('--mismatch-duration', type=float, default=8, help="Thời gian lệch mã bơm (giây)")
+    load_parser.add_argument('--getdata', choices=['full', 'delta'], help="Bật getdata trên mọi trạm với chế độ này")
+    load_parser.add_argument('--log-level', default='WARNING', help="Mức log của client con")
+    load_parser.add_argument('--seed', type=int, default=0)
+    load_parser.add_argument('--json', action='store_true', help="In kết quả dạng JSON (để so sánh giữa các phiên bản)")
+    load_parser.set_defaults(func=bench_load)
+
+    mabom_parser = subparsers.add_parser('mabom', help="Đối chiếu và đo bộ kiểm tra mã bơm dạng cột")
+    mabom_parser.add_argument('--snapshots', help="Bản ghi (--record) hoặc file snapshot để đối chiếu (mặc định: giả lập)")
+    mabom_parser.add_argument('--diff-pumps', type=int, default=24, help="Số vòi của chuỗi đối chiếu giả lập")
+    mabom_parser.add_argument('--diff-ticks', type=int, default=20000, help="Số snapshot của chuỗi đối chiếu giả lập")
+    mabom_parser.add_argument('--pumps', type=int, default=10000, help="Số vòi khi đo thời gian")
+    mabom_parser.add_argument('--ticks', type=int, default=50)
+    mabom_parser.add_argument('--seed', type=int, default=0)
+    mabom_parser.set_defaults(func=bench_mabom)
+
+    polling_parser = subparsers.add_parser('polling', help="Số lần poll và độ trễ phát hiện của poll thích ứng")
+    polling_parser.add_argument('--snapshots', help="Bản ghi (--record) hoặc file snapshot (mặc định: một ngày giả lập)")
+    polling_parser.add_argument('--pumps', type=int, default=16)
+    polling_parser.add_argument('--hours', type=float, default=24)
+    polling_parser.add_argument('--min-interval', type=float, default=clientMQTT.SNAPSHOT_POLL_INTERVAL)
+    polling_parser.add_argument('--max-interval', type=float, default=clientMQTT.SNAPSHOT_POLL_MAX_INTERVAL)
+    polling_parser.add_argument('--seed', type=int, default=0)
+    polling_parser.set_defaults(func=bench_polling)
+
+    startup_parser = subparsers.add_parser('startup', help="Thời gian khởi động tới heartbeat đầu tiên")
+    startup_parser.add_argument('--runs', type=int, default=5, help="Số lần khởi động (lần đầu không có cache)")
+    startup_parser.add_argument('--pumps', type=int, default=16)
+    startup_parser.add_argument('--timeout', type=float, default=30, help="Thời gian chờ tối đa mỗi lần (giây)")
+    startup_parser.add_argument('--seed', type=int, default=0)
+    startup_parser.add_argument('--json', action='store_true')
+    startup_parser.set_defaults(func=bench_startup)
+
+    publish_parser = subparsers.add_parser('publish', help="Thông lượng và độ trễ của publisher gom lô")
+    publish_parser.add_argument('--stations', type=int, default=8, help="Số trạm trên một kết nối (gateway)")
+    publish_parser.add_argument('--pumps', type=int, default=16)
+    publish_parser.add_argument('--bursts', type=int, default=10, help="Số đợt mất kết nối toàn trạm")
+    publish_parser.add_argument('--interval', type=float, default=0.2, help="Khoảng cách giữa các đợt (giây)")
+    publish_parser.add_argument('--rtt', type=float, default=0.05, help="Trễ PUBACK của broker (giây)")
+    publish_parser.add_argument('--window', type=float, default=clientMQTT.PUBLISH_BATCH_WINDOW)
+    publish_parser.add_argument('--seed', type=int, default=0)
+    publish_parser.add_argument('--json', action='store_true')
+    publish_parser.set_defaults(func=bench_publish)
+
+    ingest_parser = subparsers.add_parser('ingest', help="Thông lượng của dịch vụ thu nhận serverMQTT.py")
+    ingest_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="Các số worker cần đo")
+    ingest_parser.add_argument('--stations', type=int, default=500)
+    ingest_parser.add_argument('--pumps', type=int, default=16)
+    ingest_parser.add_argument('--duration', type=float, default=10, help="Thời gian bơm message (giây)")
+    ingest_parser.add_argument('--seed', type=int, default=0)
+    ingest_parser.add_argument('--json', action='store_true')
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    storm_parser = subparsers.add_parser('storm', help="Kết nối lại hàng loạt khi broker khởi động lại")
+    storm_parser.add_argument('--clients', type=int, default=200, help="Số trạm (mỗi trạm một kết nối)")
+    storm_parser.add_argument('--downtime', type=float, default=10, help="Thời gian broker tắt (giây)")
+    storm_parser.add_argument('--timeout', type=float, default=180, help="Thời gian chờ mọi trạm kết nối lại (giây)")
+    storm_parser.add_argument('--seed', type=int, default=0)
+    storm_parser.add_argument('--json', action='store_true')
+    storm_parser.set_defaults(func=bench_storm)
+
+    remediation_parser = subparsers.add_parser('remediation', help="Nhịp phát hiện khi restartall / daylaidulieu chậm")
+    remediation_parser.add_argument('--pumps', type=int, default=16)
+    remediation_parser.add_argument('--duration', type=float, default=30, help="Thời gian chèn lỗi (giây)")
+    remediation_parser.add_argument('--gaps', type=int, default=3, help="Số vòi nhảy mã mỗi lần chèn")
+    remediation_parser.add_argument('--gap-interval', type=float, default=5, help="Chèn gap mỗi N giây")
+    remediation_parser.add_argument('--daylaidulieu-delay', type=float, default=2, help="Thời gian trả lời daylaidulieu (giây)")
+    remediation_parser.add_argument('--restart-seconds', type=float, default=2, help="Thời gian chạy lệnh restartall (giây)")
+    remediation_parser.add_argument('--mismatch-seconds', type=float, default=10, help="Thời gian một vòi lệch MaBomMoiNhat (giây)")
+    remediation_parser.add_argument('--seed', type=int, default=0)
+    remediation_parser.add_argument('--json', action='store_true')
+    remediation_parser.set_defaults(func=bench_remediation)
+
+    tls_parser = subparsers.add_parser('tls', help="Chi phí handshake TLS khi kết nối lại (đầy đủ / dùng lại phiên)")
+    tls_parser.add_argument('--reconnects', type=int, default=50, help="Số lần kết nối lại mỗi chế độ")
+    tls_parser.add_argument('--key', choices=['rsa', 'ec'], default='rsa', help="Loại khóa của CA/broker/client")
+    tls_parser.add_argument('--versions', nargs='+', default=['TLSv1.3', 'TLSv1.2'], choices=['TLSv1.3', 'TLSv1.2'])
+    tls_parser.add_argument('--ciphers', default=clientMQTT.MQTT_TLS_CIPHERS, help="Bộ mã TLS 1.2 (chuỗi OpenSSL)")
+    tls_parser.add_argument('--json', action='store_true')
+    tls_parser.set_defaults(func=bench_tls)
+
+    liveness_parser = subparsers.add_parser('liveness', help="Tải broker và độ trễ phát hiện offline theo chế độ liveness")
+    liveness_parser.add_argument('--clients', type=int, default=4, help="Số tiến trình client (gateway)")
+    liveness_parser.add_argument('--stations-per-client', type=int, default=25)
+    liveness_parser.add_argument('--pumps', type=int, default=4)
+    liveness_parser.add_argument('--modes', nargs='+', default=['heartbeat', 'will'], choices=['heartbeat', 'will'])
+    liveness_parser.add_argument('--keepalive', type=int, default=clientMQTT.MQTT_KEEPALIVE, help="Keepalive MQTT (giây)")
+    liveness_parser.add_argument('--warmup', type=float, default=5, help="Chờ client ổn định trước khi khởi động server (giây)")
+    liveness_parser.add_argument('--duration', type=float, default=60, help="Thời gian đo tải lúc ổn định (giây)")
+    liveness_parser.add_argument('--timeout', type=float, default=120, help="Chờ phát hiện offline tối đa (giây)")
+    liveness_parser.add_argument('--seed', type=int, default=0)
+    liveness_parser.add_argument('--json', action='store_true')
+    liveness_parser.set_defaults(func=bench_liveness)
+
+    push_parser = subparsers.add_parser('push', help="Poll so với nguồn đẩy snapshot: độ trễ cảnh báo, tải khi rảnh")
+    push_parser.add_argument('--clients', type=int, default=2, help="Số tiến trình client (gateway)")
+    push_parser.add_argument('--stations-per-client', type=int, default=5)
+    push_parser.add_argument('--pumps', type=int, default=16)
+    push_parser.add_argument('--modes', nargs='+', default=['poll', 'sse', 'unix', 'file'],
+                             choices=['poll', 'sse', 'unix', 'file'])
+    push_parser.add_argument('--warmup', type=float, default=3)
+    push_parser.add_argument('--duration', type=float, default=20, help="Thời gian trạm hoạt động (giây)")
+    push_parser.add_argument('--gap-interval', type=float, default=0.5, help="Chèn gap mỗi N giây")
+    push_parser.add_argument('--idle', type=float, default=30, help="Thời gian đo khi trạm rảnh (giây)")
+    push_parser.add_argument('--seed', type=int, default=0)
+    push_parser.add_argument('--json', action='store_true')
+    push_parser.set_defaults(func=bench_push)
+
+    history_parser = subparsers.add_parser('history', help="Lịch sử trên thiết bị: chi phí ghi / truy vấn, lệnh history")
+    history_parser.add_argument('--pumps', type=int, default=16)
+    history_parser.add_argument('--ring-bytes', type=int, default=clientMQTT.HISTORY_MAX_BYTES)
+    history_parser.add_argument('--window', type=float, default=3600, help="Khoảng truy vấn trên ring (giây)")
+    history_parser.add_argument('--warmup', type=float, default=3)
+    history_parser.add_argument('--duration', type=float, default=30, help="Thời gian client ghi lịch sử (giây)")
+    history_parser.add_argument('--step', type=float, default=0, help="step của lệnh history (giây, 0: đầy đủ)")
+    history_parser.add_argument('--changes', action='store_true', help="Lệnh history chỉ lấy mẫu có thay đổi")
+    history_parser.add_argument('--seed', type=int, default=0)
+    history_parser.add_argument('--json', action='store_true')
+    history_parser.set_defaults(func=bench_history)
+
+    tls_broker_parser = subparsers.add_parser('tls-broker', help=argparse.SUPPRESS)
+    tls_broker_parser.add_argument('--certs', required=True)
+    tls_broker_parser.add_argument('--ciphers', required=True)
+    tls_broker_parser.set_defaults(func=run_tls_broker)
+
+    worker_parser = subparsers.add_parser('worker', help=argparse.SUPPRESS)
+    worker_parser.add_argument('--broker-port', type=int, required=True)
+    worker_parser.add_argument('--controller', required=True)
+    worker_parser.add_argument('--stations', required=True)
+    worker_parser.add_argument('--log-level', default='WARNING')
+    worker_parser.add_argument('--liveness', default=clientMQTT.LIVENESS_MODE)
+    worker_parser.add_argument('--keepalive', type=int, default=clientMQTT.MQTT_KEEPALIVE)
+    worker_parser.add_argument('--feed')
+    worker_parser.set_defaults(func=run_worker)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -13,41 +13,260 @@ import subprocess
 import re
 import random
 import logging
+import logging.handlers
+import queue
+import shutil
+import atexit
+import argparse
 from datetime import datetime, timedelta
-from threading import Thread
 import requests
+import zlib
+import asyncio
+import signal
+from urllib.parse import urlsplit
+import struct
+import uuid
+import hashlib
+import socket
+import ssl
+import glob
+import gzip
+import bisect
+import selectors
+import mmap
+import operator
+from collections import OrderedDict
+from itertools import repeat
+from threading import Thread, Lock, Event, get_ident, local
+
+# Thư viện tùy chọn cho codec nhị phân / nén (không bắt buộc cài)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# numpy cho bộ kiểm tra mã bơm dạng cột (gateway lớn / replay phía server); chỉ import
+# khi tạo ColumnarMabomChecker để không kéo dài thời gian khởi động client trên trạm
+np = None
+
+def _load_numpy():
+    """Import numpy lần đầu cần dùng; None nếu chưa cài"""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
 
 # ==================== CẤU HÌNH LOGGING CHI TIẾT ====================
+def get_app_dir(name):
+    """Thư mục dữ liệu của client trong /opt/fuel-client-mqtt hoặc thư mục hiện tại"""
+    if os.path.exists("/opt/fuel-client-mqtt"):
+        return f"/opt/fuel-client-mqtt/{name}"
+    return f"./{name}"
+
+LOG_LEVEL = 'INFO'  # Mức log chung
+# Mức log riêng theo phân hệ: http = gọi bộ điều khiển, mqtt = publish/heartbeat/hàng đợi,
+# paho = log nội bộ của thư viện paho. Đổi lúc chạy bằng --log-level "http=DEBUG,paho=INFO"
+LOG_LEVELS = {'http': 'INFO', 'mqtt': 'INFO', 'paho': 'WARNING'}
+LOG_FORMAT = 'text'  # 'text' hoặc 'json' (mỗi dòng một object, cho công cụ thu log)
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024  # Xoay vòng file log khi vượt kích thước ...
+LOG_ROTATE_INTERVAL = 24 * 3600  # ... hoặc sau N giây
+LOG_BACKUP_COUNT = 7  # Số file log cũ (nén gzip) được giữ lại
+LOG_QUEUE_SIZE = 10000  # Số bản ghi tối đa chờ ghi; đầy thì bỏ bản ghi thay vì chặn
+LOG_RATE_LIMIT_INTERVAL = 60  # Cửa sổ giới hạn message lặp lại (giây) ...
+LOG_RATE_LIMIT_BURST = 5  # ... mỗi message giống nhau chỉ ghi tối đa N lần mỗi cửa sổ
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Xoay vòng file log theo kích thước hoặc thời gian, file cũ được nén gzip"""
+
+    def __init__(self, filename, max_bytes=LOG_FILE_MAX_BYTES, interval=LOG_ROTATE_INTERVAL,
+                 backup_count=LOG_BACKUP_COUNT):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+class JsonLogFormatter(logging.Formatter):
+    """Mỗi bản ghi một dòng JSON: time, level, logger, msg (và exc nếu có)"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class RepeatFilter(logging.Filter):
+    """Giới hạn message lặp lại trong các vòng lặp
+
+    Message giống nhau (cùng logger, mức và nội dung mẫu) chỉ được ghi tối đa
+    burst lần mỗi interval giây; số lần bị bỏ được ghi kèm lần ghi kế tiếp.
+    """
+
+    def __init__(self, interval=LOG_RATE_LIMIT_INTERVAL, burst=LOG_RATE_LIMIT_BURST):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}  # khóa -> [đầu cửa sổ, số lần đã ghi, số lần bị bỏ]
+        self.lock = Lock()
+
+    def filter(self, record):
+        if not self.burst or record.levelno >= logging.CRITICAL:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or record.created - window[0] >= self.interval:
+                if window is not None and window[2]:
+                    record.msg = f"{record.msg} (+{window[2]} lần lặp lại đã bị lược)"
+                if len(self.windows) >= 4096:
+                    self._prune(record.created)
+                self.windows[key] = [record.created, 1, 0]
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+    def _prune(self, now):
+        for key in [key for key, window in self.windows.items() if now - window[0] >= self.interval]:
+            del self.windows[key]
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Chuyển bản ghi sang thread ghi log qua hàng đợi có giới hạn
+
+    Luồng gọi log không bao giờ chờ ghi đĩa: hàng đợi đầy thì bản ghi bị bỏ
+    (được đếm). Dòng log chỉ được định dạng ở thread ghi.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Chỉ ghép message với tham số; thời gian, mức... định dạng ở thread ghi
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def configure_log_levels(levels):
+    """Đặt mức log: "DEBUG" cho cả client, hoặc "http=DEBUG,paho=INFO" (dict) theo phân hệ"""
+    if isinstance(levels, str):
+        parsed = {}
+        for part in levels.split(','):
+            name, _, level = part.rpartition('=')
+            name, level = name.strip(), level.strip().upper()
+            if not name:
+                # Mức chung áp dụng cho mọi phân hệ, trừ khi được chỉ định riêng sau đó
+                parsed.update(dict.fromkeys(LOG_LEVELS, level))
+            parsed[name] = level
+        levels = parsed
+    for name, level in levels.items():
+        target = logging.getLogger(__name__).getChild(name) if name else logging.getLogger()
+        target.setLevel(level)
+
 def setup_logging():
-    """Thiết lập hệ thống logging chi tiết"""
+    """Thiết lập logging không chặn: các luồng chỉ đưa bản ghi vào hàng đợi,
+    một thread riêng ghi ra console và file (xoay vòng, nén gzip)"""
     # Tạo thư mục log trong thư mục hiện tại hoặc /opt/fuel-client-mqtt/logs
-    if os.path.exists("/opt/fuel-client-mqtt"):
-        log_dir = "/opt/fuel-client-mqtt/logs"
-    else:
-        log_dir = "./logs"
+    log_dir = get_app_dir("logs")
     
     os.makedirs(log_dir, exist_ok=True)
     
-    # Cấu hình logging chính
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(f'{log_dir}/client_mqtt.log', encoding='utf-8'),
-            logging.StreamHandler()
-        ]
-    )
-    
+    # Giống basicConfig: không cấu hình lại nếu chương trình import đã có handler
+    root = logging.getLogger()
+    if not root.handlers:
+        if LOG_FORMAT == 'json':
+            formatter = JsonLogFormatter()
+        else:
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        file_handler = CompressedRotatingFileHandler(f'{log_dir}/client_mqtt.log')
+        console_handler = logging.StreamHandler()
+        for handler in (file_handler, console_handler):
+            handler.setFormatter(formatter)
+
+        queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        queue_handler.addFilter(RepeatFilter())
+        listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, console_handler,
+                                                  respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)  # Ghi nốt các bản ghi còn trong hàng đợi khi thoát
+        root.addHandler(queue_handler)
+
+    configure_log_levels(dict(LOG_LEVELS, **{'': LOG_LEVEL}))
     return logging.getLogger(__name__)
 
 # Khởi tạo logging
 logger = setup_logging()
+http_logger = logger.getChild('http')  # Gọi HTTP tới bộ điều khiển (mỗi chu kỳ poll)
+mqtt_logger = logger.getChild('mqtt')  # Publish, heartbeat, hàng đợi offline
 
 # ==================== CẤU HÌNH MQTT ====================
+# Giá trị mặc định; host/port/transport/TLS thực tế đọc từ BROKER_CONFIG_FILE nếu có
+# (xem load_broker_config)
 MQTT_BROKER_HOST = "103.77.166.69"  # Kết nối về server, không phải localhost
 MQTT_BROKER_PORT = 1883
-MQTT_KEEPALIVE = 60
+MQTT_TRANSPORT = 'tcp'  # 'tcp' hoặc 'websockets' (qua proxy/firewall chỉ mở HTTP)
+MQTT_WS_PATH = '/mqtt'  # Đường dẫn endpoint WebSocket của broker
+MQTT_TLS = None  # None: không mã hóa; dict cấu hình TLS như khóa "tls" trong BROKER_CONFIG_FILE
+# Ưu tiên ChaCha20-Poly1305: nhanh hơn AES-GCM trên board ARM không có lệnh AES phần cứng.
+# Chỉ áp dụng cho TLS 1.2; bộ mã TLS 1.3 không chọn được từ Python (đặt "max_version":
+# "TLSv1.2" để ép dùng danh sách này)
+MQTT_TLS_CIPHERS = 'ECDHE+CHACHA20:ECDHE+AESGCM:!aNULL:!MD5'
+MQTT_TLS_RESUME = True  # Dùng lại phiên TLS (session ticket) khi kết nối lại, bỏ qua handshake đầy đủ
+BROKER_CONFIG_FILE = get_app_dir("broker.json")
+MQTT_KEEPALIVE = 20  # Broker coi trạm mất kết nối (và gửi Last Will) sau 1.5 x N giây im lặng (= 3 nhịp heartbeat cũ)
 MQTT_QOS = 1
+MQTT_CONNECT_TIMEOUT = 10  # Thời gian chờ CONNACK tối đa (giây)
+MQTT_RECONNECT_BASE_DELAY = 1  # Mức chờ ban đầu trước khi kết nối lại (giây) ...
+MQTT_RECONNECT_MAX_DELAY = 120  # ... nhân đôi sau mỗi lần thất bại, tối đa N giây (chờ ngẫu nhiên trong [0, mức])
+MQTT_RECONNECT_STABLE_SECONDS = 60  # Kết nối giữ được N giây thì lần mất kết nối sau bắt đầu lại từ mức ban đầu
+MQTT_CLEAN_SESSION = False  # Phiên bền: broker giữ subscription và lệnh QoS 1 trong lúc trạm mất kết nối
+MQTT_CLIENT_ID_PREFIX = 'fuel'  # Client ID ổn định: <prefix>-<port hoặc gw+hash các port>-<MAC>
+MQTT_MISC_INTERVAL = 5  # Chu kỳ gọi loop_misc (keepalive/ping) của paho (giây)
+HEARTBEAT_INTERVAL = 10  # Chu kỳ gửi heartbeat ở chế độ LIVENESS_MODE = 'heartbeat' (giây)
+# 'will': online/offline do broker công bố qua trạng thái retained + Last Will của kết nối,
+# thông tin trạm gửi một lần (retained), heartbeat chậm chỉ mang metrics;
+# 'heartbeat': heartbeat mỗi HEARTBEAT_INTERVAL giây như trước (server cũ)
+LIVENESS_MODE = 'will'
+SLOW_HEARTBEAT_INTERVAL = 300  # Chu kỳ heartbeat ở chế độ 'will' (giây)
 
 # Topics MQTT
 TOPICS = {
@@ -56,39 +275,1565 @@ TOPICS = {
     'station_command': 'fuel_station/command',
     'station_response': 'fuel_station/response',
     'station_warning': 'fuel_station/warning',
-    'station_heartbeat': 'fuel_station/heartbeat'
+    'station_heartbeat': 'fuel_station/heartbeat',
+    'station_event': 'fuel_station/event',
+    # Chế độ 'will': trạng thái retained theo kết nối (<topic>/<client ID>, kèm Last Will) và
+    # theo trạm (station_status/<port>, kèm thông tin trạm); trạm online khi cả hai là online
+    'station_connection': 'fuel_station/connection'
 }
 
+# ==================== CẤU HÌNH PUBLISH (GOM LÔ) ====================
+PUBLISH_BATCH_WINDOW = 0.05  # Gom message cùng topic trong N giây thành một envelope (0: gửi ngay)
+PUBLISH_BATCH_MAX = 50  # Số message tối đa mỗi envelope
+PUBLISH_BATCH_TOPICS = ('station_warning', 'station_event', 'station_heartbeat', 'station_status',
+                        'station_response')  # station_data (lớn) không gom, chỉ xếp theo ưu tiên
+MQTT_MAX_INFLIGHT = 20  # Số message QoS>0 chờ PUBACK tối đa
+# QoS theo topic: heartbeat mất một nhịp không sao (nhịp sau tới sau HEARTBEAT_INTERVAL)
+TOPIC_QOS = {'station_heartbeat': 0}
+# Thứ tự gửi trong một lượt (nhỏ gửi trước); khi cửa sổ in-flight đầy chỉ còn topic
+# có ưu tiên < PUBLISH_BULK_PRIORITY được gửi, dữ liệu lớn chờ lượt sau
+TOPIC_PRIORITY = {'station_warning': 0, 'station_response': 1, 'station_status': 1, 'station_event': 2,
+                  'station_heartbeat': 3, 'station_data': 4}
+PUBLISH_BULK_PRIORITY = 4
+
+# ==================== CẤU HÌNH THỰC THI LỆNH ====================
+COMMAND_WORKERS = 2  # Số lệnh chạy đồng thời (restart/ssh/laymabom)
+COMMAND_QUEUE_SIZE = 16  # Số lệnh chờ tối đa; vượt quá thì từ chối và báo lại server
+COMMAND_TIMEOUT = 60  # Thời gian chạy tối đa mặc định của một lệnh (giây) ...
+COMMAND_TIMEOUTS = {'ssh': 300, 'laymabom': 15, 'restart': 30, 'history': 300}  # ... riêng từng lệnh
+COMMAND_OUTPUT_LIMIT = 16 * 1024  # Giữ tối đa N byte stdout / stderr mỗi lệnh
+COMMAND_EXIT_POLL_INTERVAL = 0.2  # Chu kỳ kiểm tra shell đã thoát khi tiến trình nền còn giữ pipe (giây)
+COMMAND_DEDUP_SIZE = 256  # Nhớ kết quả N lệnh gần nhất để bỏ lệnh gửi lặp (theo command_id)
+
+# ==================== CẤU HÌNH HÀNG ĐỢI OFFLINE ====================
+OFFLINE_QUEUE_DIR = get_app_dir("queue")
+OFFLINE_QUEUE_MAX_BYTES = 16 * 1024 * 1024  # Giới hạn tổng dung lượng hàng đợi trên thẻ nhớ
+OFFLINE_QUEUE_SEGMENT_BYTES = 512 * 1024  # Kích thước tối đa mỗi file segment
+OFFLINE_QUEUE_FSYNC_RECORDS = 20  # fsync sau mỗi N bản ghi ...
+OFFLINE_QUEUE_FSYNC_INTERVAL = 2  # ... hoặc sau N giây
+OFFLINE_QUEUE_DRAIN_RATE = 20  # Số message tối đa mỗi giây khi xả hàng đợi
+OFFLINE_QUEUE_DRAIN_BATCH = 50  # Số message mỗi lượt xả (chờ PUBACK cả lượt)
+# Topic được lưu vào hàng đợi khi mất kết nối (heartbeat cũ không còn giá trị)
+DURABLE_TOPICS = ('station_data', 'station_status', 'station_warning', 'station_event', 'station_response')
+
+# ==================== CẤU HÌNH BỘ ĐIỀU KHIỂN (localhost:6969) ====================
+CONTROLLER_BASE_URL = "http://localhost:6969"
+GETFULLUPDATE_URL = f"{CONTROLLER_BASE_URL}/GetfullupdateArr"
+RESTART_ALL_COMMAND = ['forever', 'restartall']  # Lệnh khởi động lại bộ điều khiển
+RESTART_TIMEOUT = 120  # Thời gian chờ tối đa lệnh restartall (giây), quá thì kill
+DAYLAIDULIEU_TIMEOUT = 10  # Thời gian chờ tối đa API daylaidulieu (giây)
+SNAPSHOT_POLL_INTERVAL = 2  # Chu kỳ lấy snapshot khi trạm có hoạt động (giây)
+SNAPSHOT_POLL_MAX_INTERVAL = 30  # Chu kỳ dài nhất khi mọi vòi rảnh và ổn định (giây)
+SNAPSHOT_POLL_BACKOFF = 1.5  # Mỗi bước giãn chu kỳ nhân với hệ số này ...
+SNAPSHOT_POLL_IDLE_POLLS = 5  # ... sau N lần poll liên tiếp không có thay đổi
+HTTP_READ_CHUNK = 64 * 1024  # Kích thước mỗi lần đọc luồng sự kiện của nguồn đẩy (SSE)
+# Nguồn đẩy snapshot của bộ điều khiển (None: chỉ poll GetfullupdateArr): "/events" (SSE, tương đối với
+# controller_url) hoặc "http://...", "unix:///run/fuel/feed.sock", "file:///var/log/fuel/feed.ndjson"
+SNAPSHOT_FEED = None
+SNAPSHOT_FEED_RETRY_INTERVAL = 30  # Nguồn đẩy lỗi: poll trong N giây rồi thử kết nối lại
+SNAPSHOT_FEED_FILE_INTERVAL = 0.05  # Chu kỳ đọc phần mới của file feed ngay sau khi có dữ liệu (giây) ...
+SNAPSHOT_FEED_FILE_MAX_INTERVAL = 0.5  # ... nhân đôi mỗi lần đọc không có gì mới, tối đa N giây
+SNAPSHOT_FEED_FILE_ROTATE_CHECK = 1  # Chu kỳ kiểm tra file feed bị xoay vòng / cắt ngắn (giây)
+SNAPSHOT_FEED_LINE_LIMIT = 16 * 1024 * 1024  # Độ dài tối đa một dòng NDJSON (snapshot đầy đủ) qua Unix socket
+DATA_PUBLISH_INTERVAL = 10  # Chu kỳ gửi dữ liệu trạm khi getdata bật (giây)
+DATA_KEYFRAME_INTERVAL = 30  # Chế độ delta: gửi bản đầy đủ sau mỗi N lần gửi
+
+# ==================== CẤU HÌNH THÔNG TIN TRẠM ====================
+AUTORUN_FILE = '/opt/autorun'  # Chứa port SSH tunnel và cờ ips/fuelmet
+GAS_CONTROLLER_PATHS = ['/home/Phase_3/GasController.js', '/home/giang/Phase_3/GasController.js']
+IDENTITY_CACHE_FILE = get_app_dir("identity.json")  # port/version/MAC đã đọc, theo mtime file nguồn
+IDENTITY_REFRESH_INTERVAL = 3600  # Đọc lại thông tin trạm nền mỗi N giây
+DISK_CHECK_DELAY = 60  # Kiểm tra dung lượng ổ cứng lần đầu sau khi khởi động N giây ...
+DISK_CHECK_INTERVAL = 6 * 3600  # ... rồi mỗi N giây
+DISK_USAGE_THRESHOLD = 85  # Xóa file log khi ổ cứng dùng quá N%
+
+# Ngưỡng của check_mabom (replay.py cho phép thử giá trị khác trên dữ liệu đã ghi lại)
+DISCONNECT_ALERT_SECONDS = 65  # Cảnh báo khi vòi mất kết nối lâu hơn N giây
+MISMATCH_RESTART_COUNT = 3  # restartall khi MaBomMoiNhat lệch N lần liên tiếp
+RESTART_COOLDOWN_MINUTES = 10  # Khoảng cách tối thiểu giữa hai lần restartall cùng loại
+
+# ==================== CẤU HÌNH GHI LẠI SNAPSHOT ====================
+RECORDING_DIR = get_app_dir("recordings")  # Mỗi trạm một thư mục con theo port
+RECORDING_SEGMENT_BYTES = 1024 * 1024  # Kích thước (đã nén) mỗi file trước khi xoay vòng
+RECORDING_MAX_BYTES = 64 * 1024 * 1024  # Tổng dung lượng tối đa mỗi trạm, xóa file cũ nhất khi vượt
+RECORDING_FLUSH_INTERVAL = 10  # Ghi xuống đĩa sau mỗi N giây
+RECORDING_KEYFRAME_INTERVAL = 500  # Ghi bản đầy đủ sau mỗi N bản delta
+
+# ==================== CẤU HÌNH CHECKPOINT TRẠNG THÁI ====================
+CHECKPOINT_DIR = get_app_dir("state")  # Mỗi trạm một file <port>.json
+CHECKPOINT_VERSION = 1  # Tăng khi đổi định dạng file checkpoint
+CHECKPOINT_INTERVAL = 30  # Ghi tối đa một lần mỗi N giây, chỉ khi trạng thái đổi
+# Checkpoint cũ hơn N giây thì bỏ trạng thái từng vòi (mã bơm đã có thể tăng hợp lệ
+# trong lúc client dừng); mốc restartall thì luôn được nạp lại
+CHECKPOINT_MAX_AGE = 600
+
+# ==================== CẤU HÌNH LỊCH SỬ TRÊN THIẾT BỊ ====================
+HISTORY_DIR = get_app_dir("history")  # Mỗi trạm một file <port>.ring (mmap, kích thước cố định)
+# Dung lượng file lịch sử mỗi trạm (0: tắt); 16 byte mỗi vòi mỗi lần poll, trạm 16 vòi
+# poll mỗi 2 giây giữ được khoảng 18 giờ
+HISTORY_MAX_BYTES = 8 * 1024 * 1024
+HISTORY_FLUSH_INTERVAL = 60  # Ghi trang mmap đã đổi xuống đĩa sau mỗi N giây
+HISTORY_DEFAULT_SECONDS = 600  # Lệnh history không có start: lấy N giây gần nhất
+HISTORY_CHUNK_SAMPLES = 1000  # Số mẫu mỗi message trả về station_response
+HISTORY_CHUNK_INTERVAL = 0.2  # Nghỉ giữa hai chunk (giây) để không chiếm hết đường truyền
+HISTORY_MAX_SAMPLES = 100000  # Số mẫu tối đa một lệnh; vượt quá thì trả "next" để hỏi tiếp
+
+# ==================== CẤU HÌNH METRICS ====================
+METRICS_HOST = '127.0.0.1'  # Endpoint Prometheus chỉ mở cục bộ
+METRICS_PORT = 9108  # Cổng endpoint /metrics (0: tắt)
+METRICS_HEARTBEAT_INTERVAL = 300  # Gửi metrics kèm heartbeat mỗi N giây (0: tắt)
+
+# ==================== DELTA ENCODING ====================
+def _pump_key(item):
+    """Khóa của một vòi trong snapshot (id dạng chuỗi, giống key JSON)"""
+    idcot = item.get('id') if isinstance(item, dict) else None
+    return None if idcot is None else str(idcot)
+
+class DeltaEncoder:
+    """Mã hóa GetfullupdateArr thành bản đầy đủ (keyframe) hoặc chỉ phần thay đổi
+
+    Giữ trạng thái đã gửi gần nhất của từng vòi theo `id`. Mỗi message có
+    `seq` tăng dần để phía server phát hiện mất gói và yêu cầu resync.
+    """
+
+    def __init__(self, keyframe_interval=DATA_KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.state = {}
+        self.seq = 0
+        self.since_keyframe = 0
+        self.force_keyframe = True
+
+    def request_keyframe(self):
+        """Buộc lần mã hóa tiếp theo gửi bản đầy đủ"""
+        self.force_keyframe = True
+
+    def encode(self, data):
+        """Trả về dict phần thân message, hoặc None nếu không có gì thay đổi"""
+        current = {}
+        for item in data:
+            key = _pump_key(item)
+            if key is not None:
+                current[key] = item
+
+        keyframe = (self.force_keyframe or self.since_keyframe >= self.keyframe_interval
+                    or len(current) != len(data))
+        if keyframe:
+            body = {'mode': 'full', 'data': data}
+        else:
+            changed = {}
+            unset = {}
+            for key, item in current.items():
+                previous = self.state.get(key)
+                if previous is None:
+                    changed[key] = item
+                    continue
+                fields = {field: value for field, value in item.items() if previous.get(field) != value}
+                if fields:
+                    changed[key] = fields
+                gone = [field for field in previous if field not in item]
+                if gone:
+                    unset[key] = gone
+            removed = [key for key in self.state if key not in current]
+
+            if not changed and not unset and not removed:
+                return None
+            body = {'mode': 'delta', 'changed': changed}
+            if unset:
+                body['unset'] = unset
+            if removed:
+                body['removed'] = removed
+
+        self.seq += 1
+        body['seq'] = self.seq
+        self.state = current
+        self.since_keyframe = 0 if keyframe else self.since_keyframe + 1
+        self.force_keyframe = False
+        return body
+
+class DeltaDecoder:
+    """Bộ giải mã tham chiếu cho phía server: dựng lại GetfullupdateArr từ các message"""
+
+    def __init__(self):
+        self.state = {}
+        self.seq = None
+
+    def apply(self, body):
+        """Áp dụng một message; trả về snapshot đầy đủ, hoặc None nếu cần resync"""
+        mode = body.get('mode', 'full')
+        seq = body.get('seq')
+
+        if mode == 'full':
+            self.state = {}
+            for item in body.get('data') or []:
+                key = _pump_key(item)
+                if key is not None:
+                    self.state[key] = dict(item)
+            self.seq = seq
+            return list(self.state.values())
+
+        if self.seq is None or seq != self.seq + 1:
+            logger.warning(f"⚠️ Mất chuỗi delta (đang ở {self.seq}, nhận {seq}), cần resync")
+            self.seq = None
+            return None
+
+        # Vòi thay đổi được thay bằng dict mới: snapshot đã trả về trước đó không bị sửa theo
+        for key in body.get('removed', []):
+            self.state.pop(key, None)
+        for key, fields in body.get('unset', {}).items():
+            if key in self.state:
+                self.state[key] = {field: value for field, value in self.state[key].items() if field not in fields}
+        for key, fields in body.get('changed', {}).items():
+            self.state[key] = dict(self.state.get(key, {}), **fields)
+        self.seq = seq
+        return list(self.state.values())
+
+# ==================== PAYLOAD CODEC ====================
+# Tên codec: "<serializer>[+<nén>]", ví dụ "json", "msgpack+zlib", "cbor+zstd".
+# JSON không nén giữ nguyên định dạng cũ; các codec khác thêm 1 byte tag ở đầu
+# (0xC0 | nén << 4 | serializer, không thể là byte đầu của JSON) để bên nhận
+# tự nhận diện.
+PAYLOAD_CODEC = 'json'
+CODEC_SERIALIZERS = {'json': 0x0, 'msgpack': 0x1, 'cbor': 0x2}
+CODEC_COMPRESSIONS = {None: 0x0, 'zlib': 0x1, 'zstd': 0x2}
+CODEC_TAG_BASE = 0xC0
+# Từ điển huấn luyện từ snapshot thực (clientMQTT.py --train-dictionary). Client và
+# server phải dùng cùng một file: copy sang thư mục của serverMQTT.py rồi khởi động lại.
+# Không có file thì dùng từ điển dựng sẵn bên dưới.
+CODEC_DICTIONARY_FILE = get_app_dir("codec.dict")
+CODEC_DICTIONARY_SIZE = 2048  # Kích thước từ điển khi huấn luyện (byte)
+
+# Từ điển nén dựng sẵn. Chuỗi hay gặp nhất đặt ở cuối vì zlib ưu tiên phần
+# cuối từ điển.
+BUILTIN_CODEC_DICTIONARY = (
+    '{"port":"","version":"ARM-","mac":"","timestamp":"","mode":"delta","seq":,"changed":{'
+    '"warning_type":"disconnection","nonsequential","all_disconnection","pump_id":"all",'
+    '"data":[{"id":1,"pump":,"status":"đang bơm","MaBomMoiNhat":{"pump":},"isDisconnected":false},'
+    '{"id":2,"pump":,"status":"sẵn sàng","MaBomMoiNhat":{"pump":},"isDisconnected":false},'
+).encode('utf-8')
+
+def _codec_parts(name):
+    serializer, _, compression = name.partition('+')
+    return serializer, compression or None
+
+def codec_available(name):
+    """Kiểm tra codec có dùng được trên máy này không (đủ thư viện)"""
+    serializer, compression = _codec_parts(name)
+    if serializer not in CODEC_SERIALIZERS or compression not in CODEC_COMPRESSIONS:
+        return False
+    if serializer == 'msgpack' and msgpack is None:
+        return False
+    if serializer == 'cbor' and cbor2 is None:
+        return False
+    if compression == 'zstd' and zstandard is None:
+        return False
+    return True
+
+def available_codecs():
+    """Danh sách codec dùng được, để quảng bá trong heartbeat"""
+    names = []
+    for serializer in CODEC_SERIALIZERS:
+        for compression in CODEC_COMPRESSIONS:
+            name = serializer if compression is None else f"{serializer}+{compression}"
+            if codec_available(name):
+                names.append(name)
+    return names
+
+def train_codec_dictionary(samples, size=CODEC_DICTIONARY_SIZE):
+    """Tạo từ điển nén từ các payload mẫu (đã mã hóa bytes)
+
+    Dùng zstandard nếu có; nếu không (hoặc quá ít mẫu) thì ghép phần đầu
+    các mẫu, mẫu đầu tiên (thường gặp nhất) nằm cuối từ điển.
+    """
+    if zstandard is not None and len(samples) >= 8:
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError as e:
+            logger.warning(f"⚠️ zstd không huấn luyện được từ điển ({e}), dùng cách ghép mẫu")
+    dictionary = b''
+    for sample in reversed(samples):
+        dictionary = (dictionary + sample[:size // 4])[-size:]
+    return dictionary
+
+def station_data_samples(path, limit=5000):
+    """Payload station_data (JSON gọn như codec json+zlib/zstd) dựng lại từ bản ghi snapshot
+
+    Mỗi trạm mã hóa delta riêng như publish_data nên mẫu gồm cả bản đầy đủ và delta.
+    """
+    directories = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                   if os.path.isdir(os.path.join(path, name))] or [path]
+    samples = []
+    for directory in directories:
+        encoder = DeltaEncoder()
+        port = os.path.basename(directory.rstrip('/'))
+        for recorded_at, snapshot in read_recording(directory):
+            body = encoder.encode(snapshot)
+            if body is None:
+                continue
+            message = dict(body, port=port, timestamp=recorded_at.isoformat())
+            samples.append(json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            if len(samples) >= limit:
+                return samples
+    return samples
+
+def codec_dictionary_id(dictionary):
+    """Mã ngắn của từ điển (crc32) để so khớp client/server qua heartbeat"""
+    return f"{zlib.crc32(dictionary):08x}"
+
+def load_codec_dictionary(path=CODEC_DICTIONARY_FILE, default=BUILTIN_CODEC_DICTIONARY):
+    """Đọc từ điển đã huấn luyện; thiếu file hoặc lỗi thì dùng từ điển dựng sẵn"""
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'rb') as file:
+            dictionary = file.read()
+    except OSError as e:
+        logger.warning(f"⚠️ Không đọc được từ điển nén {path}: {e}, dùng từ điển dựng sẵn")
+        return default
+    if not dictionary:
+        return default
+    logger.info(f"📖 Dùng từ điển nén {path} ({len(dictionary)} byte, id {codec_dictionary_id(dictionary)})")
+    return dictionary
+
+def write_codec_dictionary(recordings, path=CODEC_DICTIONARY_FILE, size=CODEC_DICTIONARY_SIZE):
+    """Huấn luyện từ điển từ bản ghi snapshot và ghi ra file (client và server cùng nạp khi khởi động)"""
+    samples = station_data_samples(recordings)
+    if not samples:
+        logger.error(f"❌ Không có snapshot ghi lại trong {recordings} (chạy client với --record trước)")
+        return None
+    dictionary = train_codec_dictionary(samples, size)
+    with open(path + '.tmp', 'wb') as file:
+        file.write(dictionary)
+    os.replace(path + '.tmp', path)
+    logger.info(f"📖 Đã ghi từ điển nén {path} ({len(dictionary)} byte, id {codec_dictionary_id(dictionary)}) "
+                f"từ {len(samples)} mẫu; copy file này sang server rồi khởi động lại cả hai")
+    return dictionary
+
+CODEC_DICTIONARY = load_codec_dictionary()
+
+# ZstdCompressionDict theo từ điển (tạo một lần, khóa là chính bytes từ điển nên tra
+# cứu không phải băm lại); ZstdDecompressor không dùng chung được giữa các thread nên
+# mỗi thread giữ bộ giải nén riêng cho từng từ điển
+_zstd_dictionaries = {}
+_zstd_local = local()
+
+def _zstd_dictionary(dictionary):
+    zdict = _zstd_dictionaries.get(dictionary)
+    if zdict is None:
+        zdict = _zstd_dictionaries[dictionary] = zstandard.ZstdCompressionDict(
+            dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    return zdict
+
+def _zstd_decompressor(dictionary):
+    decompressors = getattr(_zstd_local, 'decompressors', None)
+    if decompressors is None:
+        decompressors = _zstd_local.decompressors = {}
+    decompressor = decompressors.get(dictionary)
+    if decompressor is None:
+        decompressor = decompressors[dictionary] = zstandard.ZstdDecompressor(dict_data=_zstd_dictionary(dictionary))
+    return decompressor
+
+class PayloadCodec:
+    """Mã hóa/giải mã payload MQTT theo codec đã thỏa thuận"""
+
+    def __init__(self, name=PAYLOAD_CODEC, dictionary=CODEC_DICTIONARY):
+        if not codec_available(name):
+            raise ValueError(f"Codec không hỗ trợ: {name}")
+        self.name = name
+        self.serializer, self.compression = _codec_parts(name)
+        self.dictionary = dictionary
+        self.dictionary_id = codec_dictionary_id(dictionary)
+        self.tag = CODEC_TAG_BASE | CODEC_COMPRESSIONS[self.compression] << 4 | CODEC_SERIALIZERS[self.serializer]
+        if self.compression == 'zstd':
+            self._zstd_compressor = zstandard.ZstdCompressor(level=3, dict_data=_zstd_dictionary(dictionary))
+
+    def encode(self, obj):
+        """Mã hóa object thành bytes sẵn sàng publish"""
+        if self.name == 'json':
+            return json.dumps(obj).encode('utf-8')
+
+        if self.serializer == 'msgpack':
+            raw = msgpack.packb(obj, use_bin_type=True)
+        elif self.serializer == 'cbor':
+            raw = cbor2.dumps(obj)
+        else:
+            raw = json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+        if self.compression == 'zlib':
+            compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS, zdict=self.dictionary)
+            raw = compressor.compress(raw) + compressor.flush()
+        elif self.compression == 'zstd':
+            raw = self._zstd_compressor.compress(raw)
+        return bytes((self.tag,)) + raw
+
+    def decode(self, payload):
+        """Giải mã payload bất kỳ (tự nhận diện codec theo byte tag)"""
+        return decode_payload(payload, self.dictionary)
+
+def decode_payload(payload, dictionary=CODEC_DICTIONARY):
+    """Giải mã payload MQTT; JSON thuần không có tag vẫn được chấp nhận"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if not payload or payload[0] < CODEC_TAG_BASE:
+        return json.loads(payload.decode('utf-8'))
+
+    tag = payload[0]
+    raw = payload[1:]
+    compression = (tag >> 4) & 0x3
+    serializer = tag & 0x0F
+
+    if compression == CODEC_COMPRESSIONS['zlib']:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict=dictionary)
+        raw = decompressor.decompress(raw) + decompressor.flush()
+    elif compression == CODEC_COMPRESSIONS['zstd']:
+        if zstandard is None:
+            raise ValueError("Payload nén zstd nhưng chưa cài zstandard")
+        raw = _zstd_decompressor(dictionary).decompress(raw)
+    elif compression != CODEC_COMPRESSIONS[None]:
+        raise ValueError(f"Kiểu nén không hợp lệ trong tag: {tag:#04x}")
+
+    if serializer == CODEC_SERIALIZERS['msgpack']:
+        if msgpack is None:
+            raise ValueError("Payload msgpack nhưng chưa cài msgpack")
+        return msgpack.unpackb(raw, raw=False)
+    if serializer == CODEC_SERIALIZERS['cbor']:
+        if cbor2 is None:
+            raise ValueError("Payload cbor nhưng chưa cài cbor2")
+        return cbor2.loads(raw)
+    if serializer == CODEC_SERIALIZERS['json']:
+        return json.loads(raw.decode('utf-8'))
+    raise ValueError(f"Serializer không hợp lệ trong tag: {tag:#04x}")
+
+def unpack_batch(message):
+    """Các message trong một payload đã giải mã: envelope {"batch": [...]} hoặc message đơn"""
+    if isinstance(message, dict) and isinstance(message.get('batch'), list):
+        return message['batch']
+    return [message]
+
+# ==================== HÀNG ĐỢI OFFLINE (STORE-AND-FORWARD) ====================
+# Mỗi bản ghi: [độ dài body 4B][crc32 body 4B][body], body gồm
+# [qos 1B][độ dài msg_id 1B][msg_id][độ dài topic 2B][topic][payload].
+# Bản ghi bị ghi dở khi mất điện sẽ bị phát hiện qua độ dài/CRC và bỏ qua.
+_RECORD_HEADER = struct.Struct('>II')
+
+def _pack_record(msg_id, topic, payload, qos):
+    msg_id_bytes = msg_id.encode('utf-8')
+    topic_bytes = topic.encode('utf-8')
+    body = (struct.pack('>BB', qos, len(msg_id_bytes)) + msg_id_bytes
+            + struct.pack('>H', len(topic_bytes)) + topic_bytes + payload)
+    return _RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+def _unpack_record(body):
+    qos, id_len = struct.unpack_from('>BB', body, 0)
+    offset = 2
+    msg_id = body[offset:offset + id_len].decode('utf-8')
+    offset += id_len
+    (topic_len,) = struct.unpack_from('>H', body, offset)
+    offset += 2
+    topic = body[offset:offset + topic_len].decode('utf-8')
+    return msg_id, topic, body[offset + topic_len:], qos
+
+class OfflineQueue:
+    """Hàng đợi append-only trên đĩa cho các message chưa gửi được
+
+    Ghi vào các file segment, fsync theo lô để đỡ hao thẻ nhớ, giới hạn tổng
+    dung lượng (xóa segment cũ nhất khi vượt). Vị trí đã gửi được lưu trong
+    file cursor nên sau khi khởi động lại không gửi lại từ đầu.
+    """
+
+    def __init__(self, directory=OFFLINE_QUEUE_DIR, max_bytes=OFFLINE_QUEUE_MAX_BYTES,
+                 segment_bytes=OFFLINE_QUEUE_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = Lock()
+        self.writer = None
+        self.write_segment = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+        self.cursor_segment, self.cursor_offset = self._load_cursor()
+        self._count_pending()
+
+    def _segments(self):
+        return sorted(int(os.path.basename(path)[:-4]) for path in glob.glob(os.path.join(self.directory, '*.seg')))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:010d}.seg")
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, 'cursor'), 'r') as file:
+                segment, offset = file.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            segments = self._segments()
+            return (segments[0] if segments else 0), 0
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, 'cursor')
+        with open(path + '.tmp', 'w') as file:
+            file.write(f"{self.cursor_segment} {self.cursor_offset}")
+        os.replace(path + '.tmp', path)
+
+    def _count_pending(self):
+        """Đếm số bản ghi chưa gửi (chạy một lần khi khởi động)"""
+        self.pending = 0
+        for segment in self._segments():
+            if segment < self.cursor_segment:
+                continue
+            offset = self.cursor_offset if segment == self.cursor_segment else 0
+            self.pending += sum(1 for _ in self._read_records(segment, offset))
+
+    def _read_records(self, segment, offset, limit=None):
+        """Sinh (offset_sau_bản_ghi, msg_id, topic, payload, qos) từ một segment"""
+        try:
+            with open(self._segment_path(segment), 'rb') as file:
+                file.seek(offset)
+                count = 0
+                while limit is None or count < limit:
+                    header = file.read(_RECORD_HEADER.size)
+                    if len(header) < _RECORD_HEADER.size:
+                        return
+                    length, crc = _RECORD_HEADER.unpack(header)
+                    body = file.read(length)
+                    if len(body) < length or zlib.crc32(body) != crc:
+                        logger.warning(f"⚠️ Bản ghi hỏng trong segment {segment}, bỏ qua phần còn lại")
+                        return
+                    offset += _RECORD_HEADER.size + length
+                    count += 1
+                    yield (offset,) + _unpack_record(body)
+        except FileNotFoundError:
+            return
+
+    def __len__(self):
+        return self.pending
+
+    def append(self, msg_id, topic, payload, qos):
+        """Thêm một message vào hàng đợi; trả về vị trí sau bản ghi (dùng cho commit)"""
+        record = _pack_record(msg_id, topic, payload, qos)
+        with self.lock:
+            if self.writer is None or self.writer.tell() >= self.segment_bytes:
+                self._rotate()
+            self.writer.write(record)
+            self.writer.flush()
+            self.pending += 1
+            self.unsynced += 1
+            if (self.unsynced >= OFFLINE_QUEUE_FSYNC_RECORDS
+                    or time.monotonic() - self.last_sync >= OFFLINE_QUEUE_FSYNC_INTERVAL):
+                self._sync()
+            return self.write_segment, self.writer.tell()
+
+    def _sync(self):
+        if self.writer is not None and self.unsynced:
+            os.fsync(self.writer.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def _rotate(self):
+        """Mở segment mới và xóa segment cũ nhất nếu vượt giới hạn dung lượng"""
+        if self.writer is not None:
+            self._sync()
+            self.writer.close()
+        segments = self._segments()
+        self.write_segment = (segments[-1] + 1) if segments else self.cursor_segment
+        self.writer = open(self._segment_path(self.write_segment), 'ab')
+
+        segments.append(self.write_segment)
+        total = sum(os.path.getsize(self._segment_path(segment)) for segment in segments)
+        while total > self.max_bytes and len(segments) > 1:
+            oldest = segments.pop(0)
+            path = self._segment_path(oldest)
+            total -= os.path.getsize(path)
+            if oldest >= self.cursor_segment:
+                offset = self.cursor_offset if oldest == self.cursor_segment else 0
+                lost = sum(1 for _ in self._read_records(oldest, offset))
+                self.pending -= lost
+                self.dropped += lost
+                logger.warning(f"⚠️ Hàng đợi offline đầy, bỏ {lost} message cũ nhất")
+                self.cursor_segment, self.cursor_offset = segments[0], 0
+                self._save_cursor()
+            os.remove(path)
+
+    def flush(self):
+        """fsync các bản ghi đang chờ (gọi khi dừng client)"""
+        with self.lock:
+            self._sync()
+
+    def peek(self, limit):
+        """Lấy tối đa limit bản ghi đầu hàng đợi: list (vị_trí, msg_id, topic, payload, qos)"""
+        with self.lock:
+            records = []
+            for segment in self._segments():
+                if segment < self.cursor_segment:
+                    continue
+                offset = self.cursor_offset if segment == self.cursor_segment else 0
+                for record in self._read_records(segment, offset, limit - len(records)):
+                    records.append(((segment, record[0]),) + record[1:])
+                if len(records) >= limit:
+                    break
+            if not records:
+                self.pending = 0  # Phần còn lại bị hỏng, không còn gì để gửi
+            return records
+
+    def commit(self, position, count):
+        """Đánh dấu đã gửi xong tới position (sau count bản ghi)"""
+        with self.lock:
+            segment, offset = position
+            if position <= (self.cursor_segment, self.cursor_offset):
+                return  # Đã được commit (gửi lại qua thread xả hàng đợi)
+            for old in self._segments():
+                if old < segment and old != self.write_segment:
+                    os.remove(self._segment_path(old))
+            self.cursor_segment, self.cursor_offset = segment, offset
+            self.pending = max(0, self.pending - count)
+            if segment != self.write_segment and not any(True for _ in self._read_records(segment, offset, 1)):
+                # Segment đã gửi hết và không còn được ghi: chuyển cursor sang segment sau
+                os.remove(self._segment_path(segment))
+                later = [other for other in self._segments() if other > segment]
+                self.cursor_segment, self.cursor_offset = (later[0] if later else segment + 1), 0
+            self._save_cursor()
+
+# ==================== METRICS ====================
+# Định dạng text của Prometheus: giá trị nhãn thoát dấu \, " và xuống dòng; HELP thoát dấu \ và xuống dòng
+_LABEL_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+_HELP_ESCAPES = str.maketrans({'\\': '\\\\', '\n': '\\n'})
+
+def _label_text(labels):
+    return ','.join(f'{name}="{str(value).translate(_LABEL_ESCAPES)}"' for name, value in labels)
+
+class Metrics:
+    """Bộ đếm, gauge và histogram trong tiến trình, xuất theo định dạng Prometheus
+
+    Cập nhật được từ mọi thread (event loop, executor, thread xả hàng đợi).
+    Gauge có thể tính lúc đọc qua func (độ sâu hàng đợi paho, CPU, RSS...).
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.families = {}  # name -> (kind, help, buckets)
+        self.values = {}  # (name, labels) -> số, hoặc [đếm theo bucket..., +Inf, count, sum] với histogram
+        self.callbacks = {}  # (name, labels) -> func() trả về giá trị lúc đọc
+
+    def counter(self, name, help_text):
+        self.families[name] = ('counter', help_text, None)
+
+    def gauge(self, name, help_text):
+        self.families[name] = ('gauge', help_text, None)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.families[name] = ('histogram', help_text, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.families[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(buckets) + 3)
+            series[bisect.bisect_left(buckets, value)] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def register(self, name, func, **labels):
+        """Giá trị của series được tính bằng func() mỗi lần đọc"""
+        with self.lock:
+            self.callbacks[(name, tuple(sorted(labels.items())))] = func
+
+    def unregister(self, name, **labels):
+        with self.lock:
+            self.callbacks.pop((name, tuple(sorted(labels.items()))), None)
+
+    def collect(self):
+        """Trả về {(name, labels): giá trị} của mọi series, sắp theo tên"""
+        with self.lock:
+            values = {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+            callbacks = list(self.callbacks.items())
+        for key, func in callbacks:
+            try:
+                values[key] = func()
+            except Exception as e:
+                logger.debug("Không đọc được metric %s: %s", key[0], e)
+        return dict(sorted(values.items()))
+
+    def render(self):
+        """Xuất toàn bộ metrics theo định dạng text của Prometheus"""
+        lines = []
+        current = None
+        for (name, labels), value in self.collect().items():
+            kind, help_text, buckets = self.families.get(name, ('untyped', '', None))
+            if name != current:
+                lines.append(f"# HELP {name} {help_text.translate(_HELP_ESCAPES)}")
+                lines.append(f"# TYPE {name} {kind}")
+                current = name
+            if kind != 'histogram':
+                lines.append(f"{name}{{{_label_text(labels)}}} {value}" if labels else f"{name} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append(f"{name}_bucket{{{_label_text(labels + (('le', bound),))}}} {cumulative}")
+            suffix = f"{{{_label_text(labels)}}}" if labels else ''
+            lines.append(f"{name}_count{suffix} {value[-2]}")
+            lines.append(f"{name}_sum{suffix} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, port=None):
+        """Bản rút gọn để gửi kèm heartbeat: series chung và series của port
+
+        Khóa là tên bỏ tiền tố "fuel_" cùng các nhãn khác port; histogram gửi
+        [count, sum, p95 ước lượng theo bucket].
+        """
+        result = {}
+        for (name, labels), value in self.collect().items():
+            label_map = dict(labels)
+            if 'port' in label_map and label_map.pop('port') != port:
+                continue
+            key = name[5:] if name.startswith('fuel_') else name
+            if label_map:
+                key += '|' + ','.join(str(item) for item in label_map.values())
+            if isinstance(value, list):
+                buckets = self.families[name][2]
+                count = value[-2]
+                p95 = None
+                if count:
+                    seen = 0
+                    for bound, bucket_count in zip(buckets + (None,), value):
+                        seen += bucket_count
+                        if seen >= 0.95 * count:
+                            p95 = bound
+                            break
+                value = [count, round(value[-1], 3), p95]
+            elif isinstance(value, float):
+                value = round(value, 3)
+            result[key] = value
+        return result
+
+def process_cpu_seconds():
+    """CPU (user + system) mà tiến trình đã dùng"""
+    times = os.times()
+    return round(times.user + times.system, 3)
+
+def process_rss_bytes():
+    """Bộ nhớ RSS hiện tại của tiến trình (đọc /proc, Linux)"""
+    with open('/proc/self/statm', 'r') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+metrics = Metrics()
+metrics.histogram('fuel_controller_request_seconds', "Thời gian gọi HTTP tới bộ điều khiển")
+metrics.counter('fuel_controller_errors_total', "Số lần gọi bộ điều khiển lỗi theo nguyên nhân")
+metrics.histogram('fuel_snapshot_bytes', "Kích thước snapshot GetfullupdateArr (byte)",
+                  buckets=(1024, 4096, 16384, 65536, 262144, 1048576))
+metrics.histogram('fuel_check_mabom_seconds', "Thời gian xử lý một snapshot trong check_mabom")
+metrics.counter('fuel_mqtt_publish_total', "Số message gửi theo topic")
+metrics.counter('fuel_mqtt_publish_bytes_total', "Số byte payload gửi theo topic")
+metrics.counter('fuel_mqtt_batched_total', "Số message được gộp vào envelope theo topic")
+metrics.counter('fuel_mqtt_queued_total', "Số message đưa vào hàng đợi offline theo topic")
+metrics.gauge('fuel_mqtt_inflight_messages', "Số message QoS>0 đã đưa cho paho, chưa có PUBACK")
+metrics.gauge('fuel_mqtt_batch_pending_messages', "Số message đang chờ gom lô trong BatchPublisher")
+metrics.gauge('fuel_offline_queue_messages', "Số message đang nằm trong hàng đợi offline")
+metrics.gauge('fuel_mqtt_connected', "1 nếu đang kết nối broker")
+metrics.counter('fuel_mqtt_connects_total', "Số lần kết nối broker thành công")
+metrics.counter('fuel_mqtt_connect_attempts_total', "Số lần thử kết nối broker")
+metrics.counter('fuel_mqtt_tls_handshakes_total', "Số lần handshake TLS tới broker (resumed=true: dùng lại phiên)")
+metrics.counter('fuel_mqtt_disconnects_total', "Số lần mất kết nối broker")
+metrics.counter('fuel_mqtt_disconnected_seconds_total', "Tổng thời gian không kết nối được broker")
+metrics.counter('fuel_remediation_actions_total', "Số hành động xử lý sự cố (restartall/daylaidulieu) đã thực hiện")
+metrics.counter('fuel_remediation_coalesced_total', "Số yêu cầu daylaidulieu được gộp với yêu cầu đang chờ")
+metrics.histogram('fuel_remediation_seconds', "Thời gian thực hiện một hành động xử lý sự cố (giây)")
+metrics.gauge('fuel_remediation_pending', "Số hành động xử lý sự cố đang chờ hoặc đang chạy")
+metrics.counter('process_cpu_seconds_total', "CPU user + system của tiến trình (giây)")
+metrics.gauge('process_resident_memory_bytes', "Bộ nhớ RSS của tiến trình")
+metrics.counter('fuel_log_dropped_total', "Số bản ghi log bị bỏ vì hàng đợi log đầy")
+metrics.counter('fuel_commands_total', "Số lệnh từ server theo lệnh và kết quả")
+metrics.gauge('fuel_command_pending', "Số lệnh đang chạy hoặc chờ trong CommandExecutor")
+metrics.gauge('fuel_snapshot_poll_interval_seconds', "Chu kỳ poll snapshot hiện tại của trạm")
+metrics.counter('fuel_snapshot_feed_events_total', "Số sự kiện nhận từ nguồn đẩy theo loại (snapshot/update)")
+metrics.counter('fuel_snapshot_feed_fallbacks_total', "Số lần nguồn đẩy lỗi và chuyển sang poll")
+metrics.gauge('fuel_snapshot_feed_connected', "1 nếu đang nhận snapshot từ nguồn đẩy")
+metrics.counter('fuel_history_chunks_total', "Số chunk lịch sử đã gửi lên station_response")
+metrics.gauge('fuel_history_samples', "Số mẫu đang giữ trong file lịch sử của trạm")
+metrics.register('process_cpu_seconds_total', process_cpu_seconds)
+metrics.register('fuel_log_dropped_total', lambda: sum(
+    handler.dropped for handler in logging.getLogger().handlers if isinstance(handler, DroppingQueueHandler)))
+metrics.register('process_resident_memory_bytes', process_rss_bytes)
+
+def _controller_endpoint(path):
+    """Nhãn endpoint của bộ điều khiển: đoạn cuối của path (GetfullupdateArr...)"""
+    return urlsplit(path).path.rstrip('/').rsplit('/', 1)[-1] or '/'
+
+def _topic_key(topic):
+    """Khóa TOPICS của một topic đầy đủ (bỏ hậu tố port), để làm nhãn metrics"""
+    for key, base in TOPICS.items():
+        if topic == base or topic.startswith(base + '/'):
+            return key
+    return topic
+
+async def serve_metrics(reader, writer):
+    """Xử lý một request HTTP tới endpoint metrics (GET /metrics)"""
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        path = request.split(b' ', 2)[1] if request.count(b' ') >= 2 else b''
+        if path.split(b'?')[0] in (b'/metrics', b'/'):
+            status, body = '200 OK', metrics.render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('ascii') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Mở endpoint Prometheus; trả về server, hoặc None nếu tắt / không mở được cổng"""
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(serve_metrics, host, port)
+        logger.info(f"📈 Metrics Prometheus tại http://{host}:{port}/metrics")
+        return server
+    except OSError as e:
+        logger.error(f"❌ Không mở được endpoint metrics {host}:{port}: {e}")
+        return None
+
+# ==================== ASYNCIO RUNTIME ====================
+class AsyncHTTPClient:
+    """HTTP/1.1 GET tối giản trên asyncio, giữ kết nối keep-alive tới bộ điều khiển"""
+
+    def __init__(self, base_url=CONTROLLER_BASE_URL, timeout=10):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        """Đóng kết nối keep-alive"""
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ConnectionError):
+                pass
+        self.reader = self.writer = None
+
+    async def _request(self, path):
+        if self.writer is None:
+            await self._open()
+        self.writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+            f"Connection: keep-alive\r\nAccept: application/json\r\n\r\n".encode('ascii')
+        )
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Bộ điều khiển đóng kết nối")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            headers['connection'] = 'close'
+
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, body
+
+    async def get(self, path):
+        """Gửi GET, trả về (status, body); tự mở lại kết nối nếu keep-alive bị đóng"""
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    return await asyncio.wait_for(self._request(path), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                    await self.close()
+                    if attempt:
+                        raise
+                except asyncio.TimeoutError:
+                    await self.close()
+                    raise
+
+    async def get_json(self, path):
+        """Lấy dữ liệu JSON qua kết nối keep-alive, None nếu lỗi (đã ghi log và metrics)"""
+        labels = {'controller': f"{self.host}:{self.port}", 'endpoint': _controller_endpoint(path)}
+        started = time.perf_counter()
+        try:
+            http_logger.debug("🔍 Đang gọi URL: %s", path)
+            status, body = await self.get(path)
+            metrics.observe('fuel_controller_request_seconds', time.perf_counter() - started, **labels)
+            http_logger.debug("📡 Response status: %s", status)
+            if status == 200:
+                data = json.loads(body)
+                metrics.observe('fuel_snapshot_bytes', len(body), controller=labels['controller'])
+                http_logger.debug("✅ Lấy được dữ liệu: %s với %d byte", type(data), len(body))
+                return data
+            metrics.inc('fuel_controller_errors_total', reason='status', **labels)
+            http_logger.error("❌ Mã trạng thái không phải 200: %s", status)
+            http_logger.error("❌ Response content: %s...", body[:200])
+            return None
+        except asyncio.TimeoutError as e:
+            metrics.inc('fuel_controller_errors_total', reason='timeout', **labels)
+            http_logger.error("❌ Lỗi khi lấy dữ liệu từ URL: %r", e)
+            return None
+        except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+            metrics.inc('fuel_controller_errors_total', reason='connection', **labels)
+            http_logger.error("❌ Lỗi khi lấy dữ liệu từ URL: %r", e)
+            return None
+        except Exception as e:
+            metrics.inc('fuel_controller_errors_total', reason='invalid', **labels)
+            http_logger.error("❌ Lỗi không mong đợi khi xử lý dữ liệu: %s", e)
+            return None
+
+class AsyncScheduler:
+    """Chạy các tác vụ định kỳ trên asyncio với chu kỳ chính xác
+
+    Mỗi tác vụ không bao giờ chạy chồng lên chính nó; nếu một lần chạy quá
+    chu kỳ thì các nhịp bị lỡ được bỏ qua thay vì dồn lại (backpressure).
+    """
+
+    def __init__(self):
+        self.tasks = []
+
+    def every(self, interval, func, name, delay=0):
+        """Chạy coroutine func() mỗi interval giây, lần đầu sau delay giây"""
+        return self.spawn(self._run_periodic(interval, func, name, delay), name)
+
+    def spawn(self, coro, name):
+        """Chạy một coroutine dài hạn, được hủy khi scheduler dừng"""
+        task = asyncio.ensure_future(coro)
+        task.name = name
+        self.tasks.append(task)
+        return task
+
+    async def _run_periodic(self, interval, func, name, delay=0):
+        loop = asyncio.get_running_loop()
+        if delay:
+            await asyncio.sleep(delay)
+        next_run = loop.time()
+        while True:
+            try:
+                await func()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Lỗi trong tác vụ định kỳ {name}: {e}")
+
+            next_run += interval
+            now = loop.time()
+            if next_run < now:
+                skipped = int((now - next_run) // interval) + 1
+                logger.debug("⏱️ Tác vụ %s chạy quá chu kỳ, bỏ qua %d nhịp", name, skipped)
+                next_run += skipped * interval
+            await asyncio.sleep(next_run - now)
+
+    async def stop(self):
+        """Hủy mọi tác vụ và chờ chúng kết thúc"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+# ==================== PUBLISH GOM LÔ ====================
+class BatchPublisher:
+    """Gom message gửi đi trong PUBLISH_BATCH_WINDOW giây rồi gửi theo thứ tự ưu tiên
+
+    Message cùng topic (và QoS, codec) được gộp thành một envelope
+    {"batch": [...], "msg_id": ...}, mỗi message bên trong giữ msg_id riêng;
+    lô chỉ có một message thì gửi nguyên như cũ. Khi số message QoS>0 chờ
+    PUBACK (owner.inflight) đạt max_inflight, topic dữ liệu lớn được giữ lại
+    để cảnh báo không phải xếp sau chúng trong hàng đợi của paho; PUBACK làm
+    cửa sổ có chỗ trống thì on_publish gọi wake() để gửi tiếp.
+    """
+
+    def __init__(self, owner, window=PUBLISH_BATCH_WINDOW, max_messages=PUBLISH_BATCH_MAX,
+                 max_inflight=MQTT_MAX_INFLIGHT):
+        self.owner = owner  # MQTTFuelStationClient sở hữu kết nối
+        self.window = window
+        self.max_messages = max_messages
+        self.max_inflight = max_inflight
+        self.lock = Lock()
+        self.pending = {}  # (topic, qos, codec) -> [topic_key, codec, [message, ...]]
+        self.flush_scheduled = False
+        self.waiting = False  # Có lô bị giữ lại, chờ PUBACK
+
+    def add(self, topic_key, topic, message, qos, codec):
+        """Đưa message vào lô (gọi được từ mọi thread)"""
+        loop = self.owner.loop
+        with self.lock:
+            entry = self.pending.setdefault((topic, qos, codec.name), [topic_key, codec, []])
+            entry[2].append(message)
+            schedule = not self.flush_scheduled
+            self.flush_scheduled = True
+        if loop is None or loop.is_closed():
+            self.flush()
+        elif schedule:
+            self.owner._in_loop(loop.call_later, self.window, self.flush)
+
+    def flush(self):
+        """Gửi mọi lô đang chờ theo TOPIC_PRIORITY"""
+        with self.lock:
+            batches, self.pending = self.pending, {}
+            self.flush_scheduled = False
+        inflight = self.owner.inflight
+        deferred = False
+        for (topic, qos, _), (topic_key, codec, messages) in sorted(
+                batches.items(), key=lambda item: TOPIC_PRIORITY.get(item[1][0], PUBLISH_BULK_PRIORITY)):
+            if (qos and self.owner.connected and len(inflight) >= self.max_inflight
+                    and TOPIC_PRIORITY.get(topic_key, PUBLISH_BULK_PRIORITY) >= PUBLISH_BULK_PRIORITY):
+                with self.lock:
+                    self.pending.setdefault((topic, qos, codec.name), [topic_key, codec, []])[2][:0] = messages
+                deferred = True
+                continue
+            size = self.max_messages if topic_key in PUBLISH_BATCH_TOPICS else 1
+            for start in range(0, len(messages), size):
+                chunk = messages[start:start + size]
+                envelope = chunk[0] if len(chunk) == 1 else {'batch': chunk}
+                self.owner._send(topic_key, topic, envelope, qos, codec)
+            if len(messages) > 1 and size > 1:
+                metrics.inc('fuel_mqtt_batched_total', len(messages), topic=topic_key)
+        # Không hẹn giờ thử lại: on_publish gọi wake() khi cửa sổ in-flight có chỗ trống
+        self.waiting = deferred
+
+    def wake(self):
+        """Gửi tiếp các lô bị giữ lại (gọi trên thread event loop khi có PUBACK hoặc kết nối lại)"""
+        self.waiting = False
+        with self.lock:
+            schedule = bool(self.pending) and not self.flush_scheduled
+            self.flush_scheduled = self.flush_scheduled or schedule
+        if schedule:
+            self.owner._in_loop(self.owner.loop.call_soon, self.flush)
+
+# ==================== THỰC THI LỆNH ====================
+def run_shell_command(command, timeout=COMMAND_TIMEOUT, output_limit=COMMAND_OUTPUT_LIMIT):
+    """Chạy lệnh shell, chờ tối đa timeout giây; giữ tối đa output_limit byte mỗi luồng
+
+    Lệnh chạy trong process group riêng, hết giờ mà shell chưa thoát thì kill cả
+    group (kể cả tiến trình con của shell). Shell đã thoát thì trả về ngay dù
+    tiến trình nền (nohup ... &) còn giữ pipe: chúng được để chạy tiếp. Phần
+    output vượt giới hạn bị bỏ nhưng vẫn được đọc hết để lệnh không bị treo vì
+    pipe đầy.
+    """
+    started = time.monotonic()
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, start_new_session=True)
+    captured = {process.stdout: bytearray(), process.stderr: bytearray()}
+    sizes = {process.stdout: 0, process.stderr: 0}
+    deadline = started + timeout
+    timed_out = False
+    with selectors.DefaultSelector() as selector:
+        for stream in captured:
+            selector.register(stream, selectors.EVENT_READ)
+        exited = False
+        while selector.get_map() and not exited:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            ready = selector.select(min(remaining, COMMAND_EXIT_POLL_INTERVAL))
+            # Shell thoát: đọc nốt phần đã có trong pipe (một lượt) rồi thôi
+            exited = process.poll() is not None
+            if exited:
+                ready = selector.select(0)
+            for key, _ in ready:
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    continue
+                buffer = captured[key.fileobj]
+                sizes[key.fileobj] += len(chunk)
+                if len(buffer) < output_limit:
+                    buffer += chunk[:output_limit - len(buffer)]
+    try:
+        # Shell đã đóng pipe nhưng có thể chưa thoát
+        exit_code = process.wait(timeout=0 if timed_out else max(deadline - time.monotonic(), 0.1))
+    except subprocess.TimeoutExpired:
+        timed_out = True
+    if timed_out:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        exit_code = process.wait()
+    process.stdout.close()
+    process.stderr.close()
+
+    result = {
+        'status': 'timeout' if timed_out else ('ok' if exit_code == 0 else 'error'),
+        'exit_code': exit_code,
+        'duration': round(time.monotonic() - started, 3)
+    }
+    for name, stream in (('stdout', process.stdout), ('stderr', process.stderr)):
+        result[name] = captured[stream].decode('utf-8', errors='replace')
+        if sizes[stream] > output_limit:
+            result[f'{name}_truncated'] = sizes[stream] - output_limit
+    return result
+
+class CommandExecutor:
+    """Chạy lệnh chậm từ server (restart, ssh, laymabom) trên pool thread có giới hạn
+
+    Callback MQTT chỉ đưa lệnh vào hàng đợi rồi trả về ngay, nên keepalive
+    và các lệnh khác không bị chặn. Tối đa workers lệnh chạy cùng lúc và
+    queue_size lệnh chờ; hàng đợi đầy thì lệnh bị từ chối. Lệnh có
+    command_id được nhớ lại: lệnh lặp khi đang chạy bị bỏ qua, khi đã xong
+    thì gửi lại kết quả cũ thay vì chạy lần nữa.
+    """
+
+    RUNNING = object()
+
+    def __init__(self, workers=COMMAND_WORKERS, queue_size=COMMAND_QUEUE_SIZE, dedup_size=COMMAND_DEDUP_SIZE):
+        self.workers = workers
+        self.limit = workers + queue_size
+        self.jobs = queue.Queue()
+        self.threads = []
+        self.dedup_size = dedup_size
+        self.lock = Lock()
+        self.pending = 0  # Lệnh đang chờ + đang chạy
+        self.recent = OrderedDict()  # key -> RUNNING hoặc dict kết quả
+
+    def claim(self, key):
+        """Đánh dấu lệnh bắt đầu; trả về RUNNING / kết quả cũ nếu lệnh đã gặp, None nếu mới"""
+        if key is None:
+            return None
+        with self.lock:
+            if key in self.recent:
+                return self.recent[key]
+            self.recent[key] = self.RUNNING
+            while len(self.recent) > self.dedup_size:
+                self.recent.popitem(last=False)
+        return None
+
+    def remember(self, key, result):
+        if key is not None:
+            with self.lock:
+                self.recent[key] = result
+
+    def submit(self, key, func, on_done):
+        """Đưa func() vào hàng đợi; on_done(kết quả) chạy trên thread worker. False nếu hàng đợi đầy"""
+        # Thread worker (daemon) chỉ được tạo khi có lệnh đầu tiên
+        if not self.threads:
+            for index in range(self.workers):
+                thread = Thread(target=self._work, name=f'command-{index}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        with self.lock:
+            if self.pending >= self.limit:
+                self.recent.pop(key, None)
+                return False
+            self.pending += 1
+        self.jobs.put((key, func, on_done))
+        return True
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            key, func, on_done = job
+            started = time.monotonic()
+            try:
+                result = func()
+            except Exception as e:
+                result = {'status': 'error', 'error': str(e)}
+            result.setdefault('duration', round(time.monotonic() - started, 3))
+            self.remember(key, result)
+            with self.lock:
+                self.pending -= 1
+            try:
+                on_done(result)
+            except Exception as e:
+                logger.error(f"❌ Lỗi gửi kết quả lệnh: {e}")
+
+    def shutdown(self):
+        """Dừng worker sau lệnh đang chạy; lệnh còn chờ bị bỏ"""
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self.threads:
+            self.jobs.put(None)
+
+# ==================== CẤU HÌNH KẾT NỐI BROKER (TLS / WEBSOCKET) ====================
+BROKER_TLS_KEYS = ('ca_certs', 'certfile', 'keyfile', 'ciphers', 'max_version', 'resume', 'insecure')
+
+def load_broker_config(path=BROKER_CONFIG_FILE):
+    """Đọc cấu hình kết nối broker; file không tồn tại thì dùng các hằng MQTT_*
+
+    File JSON là một object, mọi khóa đều tùy chọn: {"host": "...", "port": 8883,
+    "transport": "tcp" | "websockets", "ws_path": "/mqtt", "tls": {"ca_certs": "ca.pem",
+    "certfile": "client.pem", "keyfile": "client.key", "ciphers": "...",
+    "max_version": "TLSv1.2", "resume": true, "insecure": false}}. "tls": null tắt TLS.
+    """
+    config = {'host': MQTT_BROKER_HOST, 'port': MQTT_BROKER_PORT, 'transport': MQTT_TRANSPORT,
+              'ws_path': MQTT_WS_PATH, 'tls': MQTT_TLS}
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            overrides = json.load(file)
+        if not isinstance(overrides, dict):
+            raise ValueError("File cấu hình broker phải là một object JSON")
+        unknown = set(overrides) - set(config)
+        if unknown:
+            raise ValueError(f"Khóa không hỗ trợ trong cấu hình broker: {', '.join(sorted(unknown))}")
+        config.update(overrides)
+    if config['transport'] not in ('tcp', 'websockets'):
+        raise ValueError(f"transport không hợp lệ: {config['transport']}")
+    tls = config['tls']
+    if tls is not None:
+        if not isinstance(tls, dict):
+            raise ValueError("\"tls\" phải là object JSON hoặc null")
+        unknown = set(tls) - set(BROKER_TLS_KEYS)
+        if unknown:
+            raise ValueError(f"Khóa không hỗ trợ trong cấu hình TLS: {', '.join(sorted(unknown))}")
+    config['port'] = int(config['port'])
+    return config
+
+class ResumableTLSContext(ssl.SSLContext):
+    """SSLContext nhớ phiên TLS của kết nối trước để kết nối lại không cần handshake đầy đủ
+
+    paho gọi wrap_socket mỗi lần reconnect; phiên đã lưu được truyền vào để
+    broker nhận lại session ticket (TLS 1.3 PSK / TLS 1.2 ticket): bỏ qua trao
+    đổi khóa và xác thực chứng chỉ, tiết kiệm một round-trip và phần lớn CPU.
+    Phiên chỉ sống trong bộ nhớ của tiến trình.
+    """
+
+    session = None
+    last_socket = None
+    resume = MQTT_TLS_RESUME
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.resume and self.session is not None:
+            kwargs.setdefault('session', self.session)
+        self.last_socket = super().wrap_socket(sock, *args, **kwargs)
+        return self.last_socket
+
+    def remember(self):
+        """Lưu phiên của kết nối hiện tại; trả về True nếu kết nối này dùng lại phiên cũ
+
+        Gọi sau CONNACK: với TLS 1.3, session ticket tới sau handshake nên
+        sock.session chỉ dùng lại được khi đã đọc dữ liệu ứng dụng đầu tiên.
+        """
+        sock = self.last_socket
+        if sock is None:
+            return False
+        if self.resume and sock.session is not None:
+            self.session = sock.session
+        return sock.session_reused
+
+def create_tls_context(tls):
+    """Tạo ResumableTLSContext từ dict cấu hình TLS (xem load_broker_config)"""
+    context = ResumableTLSContext(ssl.PROTOCOL_TLS_CLIENT)
+    if tls.get('ca_certs'):
+        context.load_verify_locations(cafile=tls['ca_certs'])
+    else:
+        context.load_default_certs()
+    if tls.get('certfile'):
+        # Chứng chỉ client: broker xác thực từng trạm (mTLS)
+        context.load_cert_chain(tls['certfile'], tls.get('keyfile'))
+    context.set_ciphers(tls.get('ciphers') or MQTT_TLS_CIPHERS)
+    if tls.get('max_version'):
+        context.maximum_version = ssl.TLSVersion[tls['max_version'].replace('.', '_')]
+    context.resume = tls.get('resume', MQTT_TLS_RESUME)
+    if tls.get('insecure'):
+        # Chỉ dùng khi thử nghiệm: không kiểm tra chứng chỉ broker
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
 # ==================== MQTT CLIENT CLASS ====================
+class ReconnectBackoff:
+    """Thời gian chờ trước mỗi lần kết nối lại: exponential backoff với full jitter
+
+    Lần thứ n chờ ngẫu nhiên trong [0, min(cap, base * 2^n)], để cả đội trạm
+    mất kết nối cùng lúc (broker khởi động lại) không kết nối lại cùng một nhịp.
+    """
+
+    def __init__(self, base=MQTT_RECONNECT_BASE_DELAY, cap=MQTT_RECONNECT_MAX_DELAY, rng=random):
+        self.base = base
+        self.cap = cap
+        self.rng = rng
+        self.attempts = 0
+
+    def next_delay(self):
+        ceiling = min(self.cap, self.base * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return self.rng.uniform(0, ceiling)
+
+    def reset(self):
+        self.attempts = 0
+
+def session_client_id(ports, mac, prefix=MQTT_CLIENT_ID_PREFIX):
+    """Client ID ổn định qua các lần khởi động để broker nhận lại phiên bền
+
+    Một trạm: <prefix>-<port>-<MAC>; gateway: <prefix>-gw<hash danh sách port>-<MAC>.
+    MAC tránh hai máy cấu hình trùng port giành nhau cùng một phiên.
+    """
+    ports = sorted(str(port) for port in ports)
+    if len(ports) == 1:
+        name = ports[0]
+    else:
+        name = 'gw' + hashlib.sha1(','.join(ports).encode('utf-8')).hexdigest()[:8]
+    return f"{prefix}-{name}-{(mac or '').replace(':', '').lower()}"
+
 class MQTTFuelStationClient:
-    def __init__(self):
-        self.client = mqtt.Client()
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.on_disconnect = self.on_disconnect
-        self.client.on_log = self.on_log
-        self.connected = False
+    def __init__(self, connection=None, broker=None):
+        # connection: client MQTT sở hữu kết nối broker (chế độ gateway, nhiều trạm
+        # dùng chung một kết nối). Mặc định mỗi client tự sở hữu kết nối của mình.
+        # broker: cấu hình kết nối (load_broker_config); mặc định đọc BROKER_CONFIG_FILE
+        self.connection = connection or self
+        self.stations = {}  # port -> MQTTFuelStationClient dùng chung kết nối này
+        # Pool thực thi lệnh chậm, dùng chung cho mọi trạm trên kết nối
+        self.commands = CommandExecutor() if connection is None else connection.commands
+        self.publisher = BatchPublisher(self) if connection is None else None
+        if connection is None:
+            self.broker = broker or load_broker_config()
+            self.tls_context = None
+            if self.broker['tls'] is not None:
+                self.tls_context = create_tls_context(self.broker['tls'])
+        else:
+            self.broker = connection.broker
+            self.tls_context = connection.tls_context
+        # paho Client của kết nối: tạo ở attach_loop, khi đã biết client ID của phiên bền
+        self._client = None
+        self.clean_session = MQTT_CLEAN_SESSION
+        self.is_connected = False
         self.port = None
+        self.controller_url = CONTROLLER_BASE_URL
         self.version = None
         self.mac = None
         self.mabom_history = {}
         self.connection_status = {}
         self.is_all_disconnect_restart = [False]
-        self.last_restart_all = None
-        self.last_non_sequential_restart = None
         self.should_stop = False  # Đánh dấu để dừng client
         self.should_reconnect = False  # Đánh dấu để kết nối lại
+        self.backoff = ReconnectBackoff()
+        self.client_id = None  # Client ID của phiên bền, đặt khi tạo paho Client (create_client)
+        self.subscribed = set()  # Topic lệnh broker đang giữ trong phiên
+        self.getdata_enabled = False  # Mặc định tắt gửi dữ liệu
+        self.data_mode = 'full'  # 'full': gửi toàn bộ mảng, 'delta': chỉ gửi phần thay đổi
+        self.data_encoder = DeltaEncoder()
+        self.codec = PayloadCodec(PAYLOAD_CODEC)
+        self.offline_queue = None  # Tạo khi bắt đầu kết nối (cần thư mục trên đĩa)
+        self.drain_wakeup = Event()
+        self.drain_thread = None
+        # mid -> [vị trí trong hàng đợi offline, đã có PUBACK]: message bền gửi thẳng, theo thứ tự gửi
+        self.unacked = OrderedDict()
+        self.inflight = set()  # mid các message QoS>0 đã đưa cho paho, chưa có PUBACK (chỉ đổi trên thread event loop)
+        self.loop = None  # Event loop asyncio điều khiển socket của paho
+        self.loop_thread = None
+        self.connack_event = None  # Đặt khi nhận CONNACK (thành công hay bị từ chối)
+        self.disconnected_event = None
+        self.info_pending = True  # Gửi heartbeat đầy đủ thông tin ở lần tới
+        self.on_command = None  # callback() khi trạm nhận lệnh từ server
+        self.history = None  # HistoryRing của trạm (lệnh history), None khi tắt
+        self.last_metrics_report = None  # Lần gửi metrics kèm heartbeat gần nhất (monotonic)
+        self.disconnected_since = time.monotonic()  # None khi đang kết nối
+        self.disconnected_seconds = 0.0  # Tổng thời gian mất kết nối đã kết thúc
         
+    @property
+    def client(self):
+        """paho Client của kết nối broker (dùng chung trong chế độ gateway); None trước attach_loop"""
+        return self.connection._client
+
+    @property
+    def connected(self):
+        """Trạng thái kết nối của kết nối broker (dùng chung trong chế độ gateway)"""
+        return self.connection.is_connected
+
+    @connected.setter
+    def connected(self, value):
+        self.connection.is_connected = value
+
+    def add_station(self, station):
+        """Đăng ký một trạm (theo port) để nhận lệnh qua kết nối này"""
+        self.stations[str(station.port)] = station
+        if self.connected:
+            self.subscribe_commands()
+
+    def command_topics(self):
+        """Topic lệnh cần subscribe cho mọi trạm trên kết nối"""
+        topics = {f"{TOPICS['station_command']}/{port}" for port in self.stations}
+        topics.add(f"{TOPICS['station_command']}/all")
+        return topics
+
+    def subscribe_commands(self):
+        """Subscribe (một gói SUBSCRIBE) các topic lệnh broker chưa giữ trong phiên"""
+        missing = sorted(self.command_topics() - self.subscribed)
+        if not missing:
+            return
+        self.client.subscribe([(topic, MQTT_QOS) for topic in missing])
+        self.subscribed.update(missing)
+        logger.info(f"📡 Đã subscribe command topics cho port {', '.join(self.stations)}")
+
+    def attach_loop(self, loop):
+        """Cho paho chạy trên event loop asyncio thay vì thread loop_start()
+
+        Socket của paho được đăng ký với add_reader/add_writer, nên không còn
+        thread mạng riêng; loop_misc (keepalive) chạy như tác vụ định kỳ.
+        """
+        self.loop = loop
+        self.loop_thread = get_ident()
+        self.connack_event = asyncio.Event()
+        self.disconnected_event = asyncio.Event()
+        self.disconnected_event.set()
+        if self._client is None:
+            self._client = self.create_client()
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.register_metrics()
+
+    def create_client(self):
+        """Tạo paho Client với client ID của phiên bền
+
+        paho 1.6 không đổi được client ID sau khi tạo, nên client chỉ được tạo khi
+        các trạm của kết nối đã đăng ký (port/MAC quyết định client ID, xem
+        session_client_id). Kết nối chưa có trạm nào thì dùng client ID ngẫu nhiên.
+        """
+        if self.stations:
+            macs = sorted(station.mac for station in self.stations.values() if station.mac)
+            self.client_id = session_client_id(self.stations, macs[0] if macs else self.mac)
+        else:
+            self.client_id = f"{MQTT_CLIENT_ID_PREFIX}-{uuid.uuid4().hex[:12]}"
+        client = mqtt.Client(client_id=self.client_id, clean_session=self.clean_session,
+                             transport=self.broker['transport'])
+        if self.broker['transport'] == 'websockets':
+            client.ws_set_options(path=self.broker['ws_path'])
+        if self.tls_context is not None:
+            client.tls_set_context(self.tls_context)
+        client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+        client.on_publish = self.on_publish
+        client.enable_logger(logger.getChild('paho'))
+        return client
+
+    def register_metrics(self):
+        """Gauge tính lúc đọc cho kết nối broker (chỉ client sở hữu kết nối)"""
+        metrics.register('fuel_mqtt_connected', lambda: int(self.connected))
+        metrics.register('fuel_mqtt_inflight_messages', lambda: len(self.inflight))
+        metrics.register('fuel_mqtt_batch_pending_messages',
+                         lambda: sum(len(entry[2]) for entry in list(self.publisher.pending.values())))
+        metrics.register('fuel_command_pending', lambda: self.commands.pending)
+        metrics.register('fuel_offline_queue_messages',
+                         lambda: len(self.offline_queue) if self.offline_queue is not None else 0)
+        metrics.register('fuel_mqtt_disconnected_seconds_total', lambda: round(
+            self.disconnected_seconds + (time.monotonic() - self.disconnected_since
+                                         if self.disconnected_since is not None else 0), 3))
+
+    def _in_loop(self, func, *args):
+        """Gọi func trên thread của event loop (paho có thể gọi callback từ thread khác)"""
+        if self.loop is None:
+            return
+        if get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        # Tắt Nagle: CONNECT/PUBLISH nhỏ ghi ngay sau Finished của TLS không phải chờ
+        # ACK trễ (~40 ms) của broker
+        try:
+            getattr(sock, '_socket', sock).setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError):
+            pass
+        self._in_loop(self.loop.add_reader, sock, self.read_socket)
+
+    def read_socket(self):
+        """Đọc socket khi event loop báo có dữ liệu
+
+        Với TLS/WebSocket, một lần đọc có thể kéo nhiều gói vào buffer của lớp
+        SSL/WebSocket; phần còn lại không làm socket sẵn sàng đọc lần nữa nên
+        phải đọc tiếp tới khi buffer rỗng (như paho kiểm tra pending() trong loop()).
+        """
+        client = self.client
+        while client.loop_read() == mqtt.MQTT_ERR_SUCCESS:
+            sock = client.socket()
+            if sock is None or not hasattr(sock, 'pending') or not sock.pending():
+                break
+
+    def on_socket_close(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_reader, sock)
+        self._in_loop(self.loop.remove_writer, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_writer, sock)
+
+    async def loop_misc(self):
+        """Tác vụ định kỳ: để paho gửi PINGREQ và phát hiện timeout keepalive"""
+        self.client.loop_misc()
+
     def on_connect(self, client, userdata, flags, rc):
         """Callback khi kết nối MQTT"""
+        self._in_loop(self.connack_event.set)
         if rc == 0:
             self.connected = True
-            logger.info("✅ Kết nối MQTT thành công")
+            metrics.inc('fuel_mqtt_connects_total')
+            if self.tls_context is not None:
+                resumed = self.tls_context.remember()
+                metrics.inc('fuel_mqtt_tls_handshakes_total', resumed=str(resumed).lower())
+                mqtt_logger.info("🔒 TLS %s (%s)", 'dùng lại phiên' if resumed else 'handshake đầy đủ',
+                                 self.tls_context.last_socket.version())
+            if self.disconnected_since is not None:
+                self.disconnected_seconds += time.monotonic() - self.disconnected_since
+                self.disconnected_since = None
+            for station in self.stations.values():
+                station.data_encoder.request_keyframe()
+                station.info_pending = True
+            self.drain_wakeup.set()
+            if self.publisher is not None and self.publisher.waiting:
+                self._in_loop(self.publisher.wake)
+            self._in_loop(self.disconnected_event.clear)
             
-            # Subscribe các topics cần thiết
-            self.client.subscribe(f"{TOPICS['station_command']}/{self.port}", qos=MQTT_QOS)
-            self.client.subscribe(f"{TOPICS['station_command']}/all", qos=MQTT_QOS)
-            logger.info(f"📡 Đã subscribe command topics cho port {self.port}")
+            # Phiên bền còn trên broker: subscription vẫn còn, lệnh QoS 1 gửi trong lúc
+            # mất kết nối được broker chuyển tiếp ngay; chỉ subscribe topic còn thiếu
+            if flags.get('session present'):
+                logger.info("✅ Kết nối MQTT thành công, tiếp tục phiên cũ trên broker")
+            else:
+                self.subscribed.clear()
+                logger.info("✅ Kết nối MQTT thành công")
+            self.subscribe_commands()
             
         else:
             logger.error(f"❌ Lỗi kết nối MQTT: {rc}")
@@ -96,6 +1841,15 @@ class MQTTFuelStationClient:
     def on_disconnect(self, client, userdata, rc):
         """Callback khi mất kết nối MQTT"""
         self.connected = False
+        # Message chưa có PUBACK vẫn nằm trong hàng đợi offline, được gửi lại sau khi kết nối lại
+        self.unacked.clear()
+        # Lô đang chờ cửa sổ in-flight được đưa vào hàng đợi offline thay vì chờ PUBACK
+        if self.publisher is not None and self.publisher.waiting:
+            self._in_loop(self.publisher.wake)
+        metrics.inc('fuel_mqtt_disconnects_total')
+        if self.disconnected_since is None:
+            self.disconnected_since = time.monotonic()
+        self._in_loop(self.disconnected_event.set)
         logger.warning(f"⚠️ Mất kết nối MQTT: {rc}")
         
         # Không dừng client, chỉ đánh dấu mất kết nối để reconnect
@@ -103,122 +1857,585 @@ class MQTTFuelStationClient:
             logger.warning("⚠️ Mất kết nối không mong muốn, sẽ thử kết nối lại...")
             self.should_reconnect = True
         
-    def on_log(self, client, userdata, level, buf):
-        """Callback cho log MQTT"""
-        logger.debug(f"MQTT Log: {buf}")
-        
+    def on_publish(self, client, userdata, mid):
+        """Callback khi broker xác nhận (PUBACK) một message QoS 1 hoặc đã ghi xong message QoS 0"""
+        self.inflight.discard(mid)
+        if self.publisher is not None and self.publisher.waiting and len(self.inflight) < self.publisher.max_inflight:
+            self.publisher.wake()
+        entry = self.unacked.get(mid)
+        if entry is not None:
+            entry[1] = True
+            self.commit_acked()
+
+    def commit_acked(self):
+        """Tiến cursor hàng đợi offline qua các message gửi thẳng liên tiếp đã được xác nhận"""
+        position, count = None, 0
+        while self.unacked:
+            mid, (record_position, acked) = next(iter(self.unacked.items()))
+            if not acked:
+                break
+            del self.unacked[mid]
+            position = record_position
+            count += 1
+        if position is not None:
+            self.offline_queue.commit(position, count)
+            if len(self.offline_queue) > len(self.unacked):
+                self.drain_wakeup.set()
+
     def on_message(self, client, userdata, msg):
         """Callback khi nhận message MQTT"""
         try:
             topic = msg.topic
-            payload = json.loads(msg.payload.decode('utf-8'))
+            payload = self.codec.decode(msg.payload)
             
-            logger.info(f"📨 Nhận message từ {topic}")
+            mqtt_logger.info("📨 Nhận message từ %s", topic)
             
             if topic.startswith(TOPICS['station_command']):
-                self.handle_command(payload)
+                # Định tuyến lệnh theo port trong topic; "all" gửi tới mọi trạm
+                target = topic.rsplit('/', 1)[-1]
+                if target == 'all':
+                    stations = list(self.stations.values())
+                else:
+                    stations = [self.stations[target]] if target in self.stations else []
+                for station in stations:
+                    station.handle_command(payload)
                 
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ Lỗi parse JSON từ MQTT: {e}")
+        except ValueError as e:
+            logger.error(f"❌ Lỗi giải mã payload từ MQTT: {e}")
         except Exception as e:
             logger.error(f"❌ Lỗi xử lý message MQTT: {e}")
             
+    # Lệnh có thể chặn lâu (tiến trình con, HTTP) chạy trên CommandExecutor
+    BLOCKING_COMMANDS = ('restart', 'ssh', 'laymabom', 'history')
+
     def handle_command(self, command_data):
-        """Xử lý lệnh từ server"""
+        """Xử lý lệnh từ server; lệnh chậm được đưa vào pool, kết quả gửi lên station_response"""
         try:
             command = command_data.get('command')
             port = command_data.get('port')
             data = command_data.get('data', {})
+            command_id = command_data.get('command_id') or command_data.get('msg_id')
+            if command == 'ssh' and 'capture' not in data:
+                # Server cũ (không command_id) gửi lệnh chạy rồi bỏ (tunnel, nohup ... &):
+                # giữ hành vi cũ; có command_id thì chờ và thu output trừ khi detach
+                data = dict(data, capture='command_id' in command_data and not data.get('detach'))
             
             logger.info(f"📋 Nhận lệnh: {command} cho port {port}")
-            
-            if command == 'restart':
-                self.handle_restart_command()
-            elif command == 'ssh':
-                self.handle_ssh_command(data.get('command', ''))
-            elif command == 'getdata':
-                self.handle_getdata_command(data.get('getdata', 'Off'))
-            elif command == 'laymabom':
-                self.handle_laymabom_command(data.get('pump_id', ''))
+            if self.on_command is not None:
+                self.connection._in_loop(self.on_command)
+
+            key = (self.port, command_id) if command_id else None
+            previous = self.commands.claim(key)
+            if previous is CommandExecutor.RUNNING:
+                logger.info(f"⏭️ Bỏ qua lệnh {command} lặp lại ({command_id}), đang chạy")
+                return
+            if previous is not None:
+                logger.info(f"⏭️ Lệnh {command} ({command_id}) đã chạy, gửi lại kết quả")
+                self.publish_response(command, command_id, previous)
+                return
+
+            if command in self.BLOCKING_COMMANDS:
+                def publish_later(result):
+                    self.connection._in_loop(self.publish_response, command, command_id, result)
+                if not self.commands.submit(key, lambda: self.run_blocking_command(command, data, command_id),
+                                            publish_later):
+                    logger.warning(f"⚠️ Hàng đợi lệnh đầy, từ chối lệnh {command}")
+                    self.publish_response(command, command_id, {'status': 'rejected', 'error': 'queue full'})
+                return
+
+            if command == 'getdata':
+                result = self.handle_getdata_command(data.get('getdata', 'Off'), data.get('mode'))
+            elif command == 'resync':
+                result = self.handle_resync_command()
+            elif command == 'codec':
+                result = self.handle_codec_command(data.get('codec', PAYLOAD_CODEC))
+            else:
+                result = {'status': 'unknown', 'error': f"Lệnh không hỗ trợ: {command}"}
+            self.commands.remember(key, result)
+            self.publish_response(command, command_id, result)
                 
         except Exception as e:
             logger.error(f"❌ Lỗi xử lý lệnh: {e}")
+
+    def run_blocking_command(self, command, data, command_id=None):
+        """Chạy trên thread của CommandExecutor; trả về dict kết quả"""
+        timeout = data.get('timeout') or COMMAND_TIMEOUTS.get(command, COMMAND_TIMEOUT)
+        if command == 'restart':
+            return self.handle_restart_command(timeout)
+        if command == 'ssh':
+            return self.handle_ssh_command(data.get('command', ''), timeout, capture=bool(data.get('capture')))
+        if command == 'history':
+            return self.handle_history_command(data, command_id, timeout)
+        return self.handle_laymabom_command(data.get('pump_id', ''), timeout)
             
-    def handle_restart_command(self):
+    def handle_restart_command(self, timeout=COMMAND_TIMEOUT):
         """Xử lý lệnh restart"""
         try:
             logger.info("🔄 Nhận lệnh restart, đang khởi động lại hệ thống...")
-            subprocess.run(['reboot', 'now'], check=True)
+            subprocess.run(['reboot', 'now'], check=True, timeout=timeout)
+            return {'status': 'ok'}
+        except subprocess.TimeoutExpired:
+            logger.error(f"❌ Lệnh restart quá {timeout} giây")
+            return {'status': 'timeout'}
         except subprocess.CalledProcessError as e:
             logger.error(f"❌ Lỗi thực thi lệnh restart: {e}")
+            return {'status': 'error', 'exit_code': e.returncode}
         except Exception as e:
             logger.error(f"❌ Lỗi không mong muốn khi restart: {e}")
+            return {'status': 'error', 'error': str(e)}
             
-    def handle_ssh_command(self, ssh_command):
-        """Xử lý lệnh SSH"""
+    def handle_ssh_command(self, ssh_command, timeout=COMMAND_TIMEOUT, capture=False):
+        """Xử lý lệnh SSH
+
+        Mặc định (như client cũ) chỉ khởi chạy rồi trả về, không thu output, để lệnh
+        chạy lâu như mở tunnel không bị kill. capture: chờ tối đa timeout giây và trả
+        về exit code + output (xem run_shell_command).
+        """
         try:
             logger.info(f"💻 Nhận lệnh SSH: {ssh_command}")
-            subprocess.Popen(ssh_command, shell=True)
-            logger.info(f"✅ Đã bắt đầu thực thi lệnh: {ssh_command}")
+            if not capture:
+                process = subprocess.Popen(ssh_command, shell=True, stdin=subprocess.DEVNULL,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                           start_new_session=True)
+                logger.info(f"✅ Đã bắt đầu thực thi lệnh: {ssh_command}")
+                return {'status': 'started', 'pid': process.pid}
+            result = run_shell_command(ssh_command, timeout)
+            logger.info(f"✅ Lệnh SSH kết thúc ({result['status']}, exit {result['exit_code']}, {result['duration']} giây)")
+            return result
         except Exception as e:
             logger.error(f"❌ Lỗi thực thi lệnh SSH: {e}")
+            return {'status': 'error', 'error': str(e)}
             
-    def handle_getdata_command(self, getdata_status):
+    def handle_history_command(self, data, command_id, timeout=COMMAND_TIMEOUT):
+        """Xử lý lệnh history: gửi các mẫu trong khoảng thời gian thành nhiều chunk lên station_response
+
+        data: start / end (epoch hoặc ISO, mặc định HISTORY_DEFAULT_SECONDS giây gần
+        nhất tới hiện tại) hoặc seconds, pumps (danh sách id vòi), step (giây, rút
+        gọn mỗi vòi một mẫu mỗi step giây), changes (chỉ mẫu có thay đổi),
+        max_samples. Mỗi chunk có "chunk" (thứ tự) và "samples" dạng cột; kết quả
+        cuối (status, samples, chunks) gửi sau chunk cuối cùng. Còn dữ liệu chưa
+        gửi thì truncated = true và "next" là start để hỏi tiếp.
+        """
+        if self.history is None:
+            return {'status': 'error', 'error': 'history disabled'}
+        try:
+            end = parse_history_time(data['end']) if data.get('end') is not None else time.time()
+            if data.get('start') is not None:
+                start = parse_history_time(data['start'])
+            else:
+                start = end - float(data.get('seconds') or HISTORY_DEFAULT_SECONDS)
+            pumps = {int(pump_id) for pump_id in data['pumps']} if data.get('pumps') else None
+            step = float(data.get('step') or 0)
+            limit = min(int(data.get('max_samples') or HISTORY_MAX_SAMPLES), HISTORY_MAX_SAMPLES)
+        except (TypeError, ValueError) as e:
+            return {'status': 'error', 'error': f"Tham số history không hợp lệ: {e}"}
+
+        logger.info(f"🕘 Nhận lệnh history port {self.port}: {datetime.fromtimestamp(start).isoformat()}"
+                    f" -> {datetime.fromtimestamp(end).isoformat()}, step {step}, changes {bool(data.get('changes'))}")
+        deadline = time.monotonic() + timeout
+        samples = downsample_history(self.history.samples(start, end, pumps), step, bool(data.get('changes')))
+        result = {'status': 'ok', 'start': start, 'end': end, 'samples': 0, 'chunks': 0, 'truncated': False}
+        chunk = []
+        last_time = None
+        for sample in samples:
+            # Chỉ cắt giữa hai lần poll để lần hỏi tiếp (start = next) không lặp lại mẫu
+            if sample[0] != last_time and (result['samples'] + len(chunk) >= limit or time.monotonic() >= deadline):
+                result.update(truncated=True, next=sample[0])
+                break
+            last_time = sample[0]
+            chunk.append(sample)
+            if len(chunk) >= HISTORY_CHUNK_SAMPLES:
+                if not self.send_history_chunk(command_id, result, chunk):
+                    return dict(result, status='aborted', error='mất kết nối broker')
+                chunk = []
+        if chunk and not self.send_history_chunk(command_id, result, chunk):
+            return dict(result, status='aborted', error='mất kết nối broker')
+        logger.info(f"✅ Đã gửi {result['samples']} mẫu lịch sử ({result['chunks']} chunk) port {self.port}")
+        return result
+
+    def send_history_chunk(self, command_id, result, chunk):
+        """Gửi một chunk lịch sử (gọi từ thread lệnh); False khi mất kết nối broker"""
+        if result['chunks']:
+            time.sleep(HISTORY_CHUNK_INTERVAL)
+        # Mất kết nối thì dừng, server hỏi lại khi cần (không dồn lịch sử vào hàng đợi offline)
+        if not self.connected:
+            return False
+        timestamps, pump_ids, statuses, flags, mabom = zip(*chunk)
+        message = {
+            'port': self.port,
+            'command': 'history',
+            'command_id': command_id,
+            'chunk': result['chunks'],
+            'samples': {
+                't': [round(timestamp, 3) for timestamp in timestamps],
+                'id': list(pump_ids),
+                'status': list(statuses),
+                'pump': list(mabom),
+                'isDisconnected': [bool(flag & HistoryRing.FLAG_DISCONNECTED) for flag in flags],
+                'mismatch': [bool(flag & HistoryRing.FLAG_MISMATCH) for flag in flags]
+            },
+            'timestamp': datetime.now().isoformat()
+        }
+        self.connection._in_loop(self._send_history_chunk, message)
+        result['chunks'] += 1
+        result['samples'] += len(chunk)
+        return True
+
+    def _send_history_chunk(self, message):
+        # Khóa riêng (không thuộc DURABLE_TOPICS): gửi thẳng, không vào hàng đợi offline,
+        # và byte lịch sử được đếm tách khỏi station_response
+        if self.connected:
+            self._send('station_history', TOPICS['station_response'], message, MQTT_QOS, self.codec)
+            metrics.inc('fuel_history_chunks_total')
+
+    def handle_getdata_command(self, getdata_status, mode=None):
         """Xử lý lệnh getdata"""
         try:
             logger.info(f"📊 Nhận lệnh getdata: {getdata_status}")
             
+            if mode in ('full', 'delta'):
+                self.data_mode = mode
+                logger.info(f"📊 Chế độ dữ liệu: {mode}")
+            
             # Cập nhật trạng thái gửi dữ liệu
             if getdata_status.lower() == 'on':
                 self.getdata_enabled = True
+                self.data_encoder.request_keyframe()
                 logger.info("✅ Bật chế độ gửi dữ liệu")
             else:
                 self.getdata_enabled = False
                 logger.info("⏸️ Tắt chế độ gửi dữ liệu, chỉ gửi heartbeat")
+            return {'status': 'ok'}
                 
         except Exception as e:
             logger.error(f"❌ Lỗi xử lý lệnh getdata: {e}")
+            return {'status': 'error', 'error': str(e)}
+            
+    def handle_resync_command(self):
+        """Xử lý lệnh resync: gửi lại bản dữ liệu đầy đủ ở lần gửi tới"""
+        logger.info("🔁 Nhận lệnh resync, lần gửi dữ liệu tới sẽ là bản đầy đủ")
+        self.data_encoder.request_keyframe()
+        return {'status': 'ok'}
             
-    def handle_laymabom_command(self, pump_id):
-        """Xử lý lệnh laymabom"""
+    def handle_codec_command(self, codec_name):
+        """Xử lý lệnh codec: đổi codec mã hóa payload gửi lên server"""
+        try:
+            self.codec = PayloadCodec(codec_name)
+            self.data_encoder.request_keyframe()
+            logger.info(f"🗜️ Đã chuyển codec payload sang {codec_name}")
+            return {'status': 'ok'}
+        except ValueError as e:
+            logger.error(f"❌ Không thể chuyển codec: {e}")
+            return {'status': 'error', 'error': str(e)}
+            
+    def handle_laymabom_command(self, pump_id, timeout=COMMAND_TIMEOUTS['laymabom']):
+        """Xử lý lệnh laymabom (chỉ chạy trên thread của CommandExecutor)"""
+        # Gọi HTTP đồng bộ tới timeout giây: chạy trên event loop sẽ chặn keepalive và mọi trạm khác
+        if get_ident() == self.connection.loop_thread:
+            logger.error("❌ Lệnh laymabom không được chạy trên event loop, phải qua CommandExecutor")
+            return {'status': 'error', 'error': 'laymabom phải chạy trên CommandExecutor'}
         try:
             logger.info(f"🔢 Nhận lệnh laymabom cho pump: {pump_id}")
             # Gọi API daylaidulieu
-            self.call_daylaidulieu_api(pump_id)
+            status_code = call_daylaidulieu_api(pump_id, self.controller_url, timeout)
+            if status_code is None:
+                return {'status': 'error', 'error': 'Không gọi được daylaidulieu'}
+            return {'status': 'ok' if status_code == 200 else 'error', 'http_status': status_code}
         except Exception as e:
             logger.error(f"❌ Lỗi xử lý lệnh laymabom: {e}")
+            return {'status': 'error', 'error': str(e)}
             
-    def connect(self):
-        """Kết nối đến MQTT broker"""
+    async def connect(self, timeout=MQTT_CONNECT_TIMEOUT):
+        """Kết nối đến MQTT broker, chờ CONNACK thay vì sleep cố định"""
+        self.start_offline_queue()
+        if LIVENESS_MODE == 'will':
+            # Broker tự công bố "offline" (retained) khi kết nối mất mà không có DISCONNECT
+            # (mất điện, mất mạng, quá 1.5 x keepalive không có gói nào)
+            self.client.will_set(self.connection_topic(), self.codec.encode(self.connection_message('offline', 'will')),
+                                 qos=MQTT_QOS, retain=True)
+        metrics.inc('fuel_mqtt_connect_attempts_total')
         try:
-            logger.info(f"🔌 Đang kết nối đến MQTT broker {MQTT_BROKER_HOST}:{MQTT_BROKER_PORT}")
-            self.client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_KEEPALIVE)
-            self.client.loop_start()
-            
-            # Chờ một chút để kết nối được thiết lập
-            time.sleep(2)
-            
-            if self.connected:
-                logger.info("✅ Kết nối MQTT thành công")
-                self.should_reconnect = False
-                return True
-            else:
-                logger.warning("⚠️ Kết nối chưa thành công")
+            host, port = self.broker['host'], self.broker['port']
+            scheme = ('wss' if self.tls_context else 'ws') if self.broker['transport'] == 'websockets' else (
+                'mqtts' if self.tls_context else 'mqtt')
+            logger.info(f"🔌 Đang kết nối đến MQTT broker {scheme}://{host}:{port} "
+                        f"(client ID {self.client_id})")
+            self.connack_event.clear()
+            # connect() của paho chặn (DNS + TCP + handshake TLS/WebSocket), chạy trong executor
+            await self.loop.run_in_executor(None, self.client.connect, host, port, MQTT_KEEPALIVE)
+            await asyncio.wait_for(self.connack_event.wait(), timeout)
+            if not self.connected:
                 return False
+            
+            self.should_reconnect = False
+            return True
                 
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ Kết nối chưa thành công")
+            return False
         except Exception as e:
             logger.error(f"❌ Lỗi kết nối MQTT: {e}")
             return False
             
     def disconnect(self):
         """Ngắt kết nối MQTT"""
+        self.should_stop = True
+        self.drain_wakeup.set()
+        self.commands.shutdown()
+        if self.publisher is not None:
+            self.publisher.flush()
+        if self.offline_queue is not None:
+            self.offline_queue.flush()
         try:
-            self.client.loop_stop()
+            if LIVENESS_MODE == 'will' and self.connected:
+                # DISCONNECT chủ động thì broker bỏ Last Will: tự công bố offline
+                self._publish_retained('station_connection', self.connection_topic(),
+                                       self.connection_message('offline', 'shutdown'))
             self.client.disconnect()
+            # Gửi gói DISCONNECT ngay vì event loop sắp dừng
+            self.client.loop_write()
             logger.info("🔌 Đã ngắt kết nối MQTT")
         except Exception as e:
             logger.error(f"❌ Lỗi ngắt kết nối MQTT: {e}")
             
+    async def maintain_connection(self):
+        """Kết nối và tự kết nối lại khi mất kết nối MQTT (chờ sự kiện, không poll)
+
+        Lần kết nối đầu tiên chạy ngay; mỗi lần kết nối lại chờ theo ReconnectBackoff.
+        """
+        connected_at = None
+        while not self.should_stop:
+            await self.disconnected_event.wait()
+            if self.connected:
+                continue
+            
+            if connected_at is not None:
+                # Phiên vừa mất đã ổn định đủ lâu: không phải broker chập chờn, chờ lại từ mức ban đầu
+                if time.monotonic() - connected_at >= MQTT_RECONNECT_STABLE_SECONDS:
+                    self.backoff.reset()
+                connected_at = None
+                delay = self.backoff.next_delay()
+                logger.warning(f"⚠️ Mất kết nối MQTT, thử kết nối lại sau {delay:.1f} giây...")
+                await asyncio.sleep(delay)
+                if self.should_stop:
+                    break
+            if await self.connect():
+                connected_at = time.monotonic()
+                self.announce_stations()
+            else:
+                delay = self.backoff.next_delay()
+                logger.warning(f"⚠️ Chưa thể kết nối, thử lại sau {delay:.1f} giây...")
+                self.should_reconnect = True
+                await asyncio.sleep(delay)
+
+    def announce_stations(self):
+        """Công bố trạm ngay sau khi kết nối
+
+        Chế độ 'will': trạng thái online (retained) của kết nối rồi của từng trạm kèm
+        thông tin trạm; chế độ 'heartbeat': heartbeat đầy đủ thông tin cho mọi trạm.
+        """
+        if LIVENESS_MODE == 'will':
+            self._publish_retained('station_connection', self.connection_topic(), self.connection_message('online'))
+            for station in self.stations.values():
+                station.publish_presence()
+            return
+        for station in self.stations.values():
+            station.send_heartbeat()
+
+    def connection_topic(self):
+        """Topic trạng thái retained của kết nối broker (theo client ID ổn định)"""
+        return f"{TOPICS['station_connection']}/{self.connection.client_id}"
+
+    def connection_message(self, status, reason=None):
+        message = {
+            'connection': self.connection.client_id,
+            'status': status,
+            'ports': sorted(self.connection.stations),
+            'timestamp': datetime.now().isoformat()
+        }
+        if reason:
+            message['reason'] = reason
+        return message
+
+    def publish_presence(self):
+        """Gửi trạng thái online của trạm kèm thông tin trạm (retained, thay heartbeat đầy đủ)"""
+        try:
+            message = {
+                'port': self.port,
+                'status': 'online',
+                'connection': self.connection.client_id,
+                'version': self.version,
+                'mac': self.mac,
+                'codec': self.codec.name,
+                'codec_dictionary': self.codec.dictionary_id,
+                'codecs': available_codecs(),
+                'timestamp': datetime.now().isoformat()
+            }
+            self._publish_retained('station_status', f"{TOPICS['station_status']}/{self.port}", message)
+            self.info_pending = False
+            mqtt_logger.info("📋 Đã gửi trạng thái online và thông tin trạm (port %s)", self.port)
+            return True
+
+        except Exception as e:
+            logger.error(f"❌ Lỗi gửi trạng thái trạm MQTT: {e}")
+            return False
+
+    def publish_packet(self, topic, payload, qos, retain=False):
+        """client.publish (trên thread event loop); message QoS>0 nằm trong connection.inflight tới khi có PUBACK"""
+        connection = self.connection
+        info = connection.client.publish(topic, payload, qos=qos, retain=retain)
+        # paho giữ message QoS>0 để gửi lại sau khi kết nối lại, trừ khi hàng đợi của nó đầy
+        if qos and info.rc != mqtt.MQTT_ERR_QUEUE_SIZE:
+            connection.inflight.add(info.mid)
+        return info
+
+    def _publish_retained(self, topic_key, topic, message):
+        """Gửi ngay một message retained (không gom lô, không qua hàng đợi offline: gửi lại mỗi lần kết nối)"""
+        message['msg_id'] = uuid.uuid4().hex
+        payload = self.codec.encode(message)
+        info = self.publish_packet(topic, payload, MQTT_QOS, retain=True)
+        metrics.inc('fuel_mqtt_publish_total', topic=topic_key)
+        metrics.inc('fuel_mqtt_publish_bytes_total', len(payload), topic=topic_key)
+        return info
+
+    def send_heartbeat(self):
+        """Gửi heartbeat (đầy đủ thông tin lần đầu sau mỗi lần kết nối)"""
+        if not self.connected:
+            return
+        
+        # Metrics rút gọn đi kèm heartbeat mỗi METRICS_HEARTBEAT_INTERVAL giây
+        now = time.monotonic()
+        include_metrics = bool(METRICS_HEARTBEAT_INTERVAL) and (
+            self.last_metrics_report is None or now - self.last_metrics_report >= METRICS_HEARTBEAT_INTERVAL)
+        if include_metrics:
+            self.last_metrics_report = now
+
+        # Chế độ 'will': thông tin trạm đi theo trạng thái retained, heartbeat chỉ còn metrics
+        if LIVENESS_MODE == 'will':
+            if self.info_pending:
+                self.publish_presence()
+            self.publish_heartbeat(include_info=False, include_metrics=include_metrics)
+            return
+
+        # Gửi heartbeat với thông tin đầy đủ lần đầu, sau đó chỉ gửi heartbeat đơn giản
+        if self.info_pending:
+            self.publish_heartbeat(include_info=True, include_metrics=include_metrics)
+            self.info_pending = False
+            mqtt_logger.info("📋 Đã gửi thông tin đầy đủ lần đầu (port %s)", self.port)
+        else:
+            self.publish_heartbeat(include_info=False, include_metrics=include_metrics)
+            mqtt_logger.debug("💓 Đã gửi heartbeat đơn giản (port %s)", self.port)
+
+    def start_offline_queue(self):
+        """Mở hàng đợi offline và khởi động thread xả hàng đợi (chỉ một lần)"""
+        if self.offline_queue is None:
+            try:
+                self.offline_queue = OfflineQueue()
+                if len(self.offline_queue):
+                    logger.info(f"📦 Hàng đợi offline còn {len(self.offline_queue)} message chưa gửi")
+            except OSError as e:
+                logger.error(f"❌ Không mở được hàng đợi offline, chỉ dùng bộ nhớ: {e}")
+                return
+        if self.drain_thread is None:
+            self.drain_thread = Thread(target=self.drain_offline_queue, daemon=True)
+            self.drain_thread.start()
+
+    def _publish(self, topic_key, message, suffix=None, qos=None):
+        """Đưa message vào BatchPublisher (hoặc gửi ngay khi PUBLISH_BATCH_WINDOW = 0)
+
+        Mỗi message có msg_id ổn định (giữ nguyên khi gửi lại) để server loại trùng.
+        QoS mặc định theo TOPIC_QOS.
+        """
+        topic = TOPICS[topic_key] if suffix is None else f"{TOPICS[topic_key]}/{suffix}"
+        message['msg_id'] = uuid.uuid4().hex
+        qos = TOPIC_QOS.get(topic_key, MQTT_QOS) if qos is None else qos
+        publisher = self.connection.publisher
+        if publisher is not None and publisher.window > 0:
+            publisher.add(topic_key, topic, message, qos, self.codec)
+            return None
+        return self._send(topic_key, topic, message, qos, self.codec)
+
+    def _send(self, topic_key, topic, message, qos, codec):
+        """Mã hóa và gửi một message / envelope; message quan trọng luôn ghi vào hàng đợi offline trước
+
+        Message bền được gửi thẳng khi đang kết nối và mọi message trước nó trong
+        hàng đợi đều đã gửi (chỉ còn chờ PUBACK); cursor chỉ tiến khi broker xác nhận
+        (commit_acked), nên tiến trình bị kill hoặc đường truyền treo trước PUBACK
+        thì message được gửi lại từ hàng đợi.
+        """
+        message.setdefault('msg_id', uuid.uuid4().hex)
+        payload = codec.encode(message)
+        connection = self.connection
+        offline_queue = connection.offline_queue
+
+        if topic_key not in DURABLE_TOPICS or offline_queue is None:
+            info = self.publish_packet(topic, payload, qos)
+            metrics.inc('fuel_mqtt_publish_total', topic=topic_key)
+            metrics.inc('fuel_mqtt_publish_bytes_total', len(payload), topic=topic_key)
+            return info
+
+        position = offline_queue.append(message['msg_id'], topic, payload, qos)
+        if self.connected and len(offline_queue) == len(connection.unacked) + 1:
+            info = self.publish_packet(topic, payload, qos)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                connection.unacked[info.mid] = [position, info.is_published()]
+                connection.commit_acked()
+                metrics.inc('fuel_mqtt_publish_total', topic=topic_key)
+                metrics.inc('fuel_mqtt_publish_bytes_total', len(payload), topic=topic_key)
+                return info
+
+        metrics.inc('fuel_mqtt_queued_total', topic=topic_key)
+        mqtt_logger.debug("📦 Đã lưu message %s vào hàng đợi offline (%d)", message['msg_id'], len(offline_queue))
+        return None
+
+    def drain_offline_queue(self):
+        """Thread xả hàng đợi offline sau khi kết nối lại, có giới hạn tốc độ"""
+        interval = 1.0 / OFFLINE_QUEUE_DRAIN_RATE
+        while not self.should_stop:
+            self.drain_wakeup.wait(timeout=OFFLINE_QUEUE_FSYNC_INTERVAL)
+            self.drain_wakeup.clear()
+            # Còn message gửi thẳng chờ PUBACK: để commit_acked tiến cursor trước, tránh gửi trùng
+            if not self.connected or not len(self.offline_queue) or self.unacked:
+                continue
+
+            records = self.offline_queue.peek(OFFLINE_QUEUE_DRAIN_BATCH)
+            infos = []
+            for position, msg_id, topic, payload, qos in records:
+                if not self.connected:
+                    break
+                # Gửi trên thread event loop: connection.inflight chỉ được đổi ở đó
+                try:
+                    info = asyncio.run_coroutine_threadsafe(
+                        self._publish_in_loop(topic, payload, qos), self.loop).result(timeout=MQTT_KEEPALIVE)
+                except Exception as e:
+                    logger.warning(f"⚠️ Không gửi được message từ hàng đợi offline: {e}")
+                    break
+                infos.append((position, info))
+                metrics.inc('fuel_mqtt_publish_total', topic=_topic_key(topic))
+                metrics.inc('fuel_mqtt_publish_bytes_total', len(payload), topic=_topic_key(topic))
+                time.sleep(interval)
+
+            # Chỉ tiến cursor tới message cuối cùng liên tiếp đã được broker xác nhận
+            acked = 0
+            position = None
+            for record_position, info in infos:
+                try:
+                    info.wait_for_publish(timeout=MQTT_KEEPALIVE)
+                except (RuntimeError, ValueError):
+                    break
+                if not info.is_published():
+                    break
+                acked += 1
+                position = record_position
+            if position is not None:
+                self.offline_queue.commit(position, acked)
+                mqtt_logger.info("📤 Đã gửi %d message từ hàng đợi offline, còn %d", acked, len(self.offline_queue))
+            if len(self.offline_queue):
+                self.drain_wakeup.set()
+
+    async def _publish_in_loop(self, topic, payload, qos):
+        return self.publish_packet(topic, payload, qos)
+
     def publish_data(self, data):
         """Gửi dữ liệu trạm qua MQTT"""
         try:
@@ -226,12 +2443,20 @@ class MQTTFuelStationClient:
                 'port': self.port,
                 'version': self.version,
                 'mac': self.mac,
-                'timestamp': datetime.now().isoformat(),
-                'data': data
+                'timestamp': datetime.now().isoformat()
             }
             
-            self.client.publish(TOPICS['station_data'], json.dumps(message), qos=MQTT_QOS)
-            logger.debug(f"📤 Đã gửi dữ liệu trạm qua MQTT")
+            if self.data_mode == 'delta':
+                body = self.data_encoder.encode(data)
+                if body is None:
+                    mqtt_logger.debug("📤 Dữ liệu trạm không thay đổi, bỏ qua lần gửi")
+                    return True
+                message.update(body)
+            else:
+                message['data'] = data
+            
+            self._publish('station_data', message)
+            mqtt_logger.debug("📤 Đã gửi dữ liệu trạm qua MQTT")
             return True
             
         except Exception as e:
@@ -247,8 +2472,8 @@ class MQTTFuelStationClient:
                 'timestamp': datetime.now().isoformat()
             }
             
-            self.client.publish(TOPICS['station_status'], json.dumps(message), qos=MQTT_QOS)
-            logger.debug(f"📤 Đã gửi trạng thái trạm qua MQTT")
+            self._publish('station_status', message)
+            mqtt_logger.debug("📤 Đã gửi trạng thái trạm qua MQTT")
             return True
             
         except Exception as e:
@@ -266,7 +2491,7 @@ class MQTTFuelStationClient:
                 'timestamp': datetime.now().isoformat()
             }
             
-            self.client.publish(TOPICS['station_warning'], json.dumps(message), qos=MQTT_QOS)
+            self._publish('station_warning', message)
             logger.warning(f"⚠️ Đã gửi cảnh báo {warning_type} qua MQTT")
             return True
             
@@ -274,7 +2499,43 @@ class MQTTFuelStationClient:
             logger.error(f"❌ Lỗi gửi cảnh báo MQTT: {e}")
             return False
             
-    def publish_heartbeat(self, include_info=False):
+    def publish_events(self, events):
+        """Gửi các sự kiện vòi bơm của một snapshot qua topic sự kiện theo port"""
+        try:
+            message = {
+                'port': self.port,
+                'timestamp': datetime.now().isoformat(),
+                'events': events
+            }
+            
+            self._publish('station_event', message, suffix=self.port)
+            mqtt_logger.debug("📤 Đã gửi %d sự kiện qua MQTT", len(events))
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ Lỗi gửi sự kiện MQTT: {e}")
+            return False
+            
+    def publish_response(self, command, command_id, result):
+        """Gửi kết quả thực thi lệnh lên station_response"""
+        try:
+            message = {
+                'port': self.port,
+                'command': command,
+                'command_id': command_id,
+                'timestamp': datetime.now().isoformat()
+            }
+            message.update(result)
+            metrics.inc('fuel_commands_total', command=str(command), status=str(result.get('status')))
+            self._publish('station_response', message)
+            mqtt_logger.debug("📤 Đã gửi kết quả lệnh %s (%s)", command, result.get('status'))
+            return True
+
+        except Exception as e:
+            logger.error(f"❌ Lỗi gửi kết quả lệnh MQTT: {e}")
+            return False
+
+    def publish_heartbeat(self, include_info=False, include_metrics=False):
         """Gửi heartbeat qua MQTT"""
         try:
             message = {
@@ -285,11 +2546,16 @@ class MQTTFuelStationClient:
             if include_info:
                 message.update({
                     'version': self.version,
-                    'mac': self.mac
+                    'mac': self.mac,
+                    'codec': self.codec.name,
+                    'codec_dictionary': self.codec.dictionary_id,
+                    'codecs': available_codecs()
                 })
+            if include_metrics:
+                message['metrics'] = metrics.summary(str(self.port))
             
-            self.client.publish(TOPICS['station_heartbeat'], json.dumps(message), qos=MQTT_QOS)
-            logger.debug(f"💓 Đã gửi heartbeat qua MQTT")
+            self._publish('station_heartbeat', message)
+            mqtt_logger.debug("💓 Đã gửi heartbeat qua MQTT")
             return True
             
         except Exception as e:
@@ -300,193 +2566,1350 @@ class MQTTFuelStationClient:
 def get_cpu_arch():
     """Lấy kiến trúc CPU"""
     try:
-        arch = subprocess.check_output(['uname', '-m']).decode().strip()
+        arch = os.uname().machine
         if 'arm' in arch.lower() or 'aarch64' in arch.lower():
             return 'ARM'
         elif 'x86' in arch.lower() or 'i686' in arch.lower():
             return 'X86'
         else:
             return 'Unknown'
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Lỗi khi lấy kiến trúc CPU: {e}")
-        return 'Unknown'
     except Exception as e:
         logger.error(f"Lỗi không mong muốn khi lấy kiến trúc CPU: {e}")
         return 'Unknown'
 
-def get_version_from_js():
-    """Lấy version từ file JavaScript"""
-    possible_paths = [
-        '/home/Phase_3/GasController.js',
-        '/home/giang/Phase_3/GasController.js'
-    ]
+def get_version_from_js():
+    """Lấy version từ file JavaScript"""
+    possible_paths = GAS_CONTROLLER_PATHS
+
+    has_ips = False
+    has_fuelmet = False
+    try:
+        with open(AUTORUN_FILE, 'r') as file:
+            content = file.read()
+            if './ips' in content:
+                has_ips = True
+            if 'fuelmet' in content:
+                has_fuelmet = True
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc file {AUTORUN_FILE}: {e}")
+
+    cpu_arch = get_cpu_arch()
+    for path in possible_paths:
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                content = file.read()
+                match = re.search(r'const\s+ver\s*=\s*"([^"]+)"', content)
+                if match:
+                    version = match.group(1)
+                    version = f"{cpu_arch}-{version}"
+                    if has_ips and has_fuelmet:
+                        return version + "-IPS-Fuelmet"
+                    elif has_ips:
+                        return version + "-IPS"
+                    elif has_fuelmet:
+                        return version + "-Fuelmet"
+                    return version
+    
+    version = f"{cpu_arch}-1.0"
+    if has_ips and has_fuelmet:
+        return version + "-IPS-Fuelmet"
+    elif has_ips:
+        return version + "-IPS"
+    elif has_fuelmet:
+        return version + "-Fuelmet"
+    return version
+
+def get_port_from_file():
+    """Lấy port từ file autorun"""
+    try:
+        with open(AUTORUN_FILE, 'r') as file:
+            content = file.read()
+            match = re.search(r'(\s\d{4}|\d{5}):localhost:22', content)
+            if match:
+                port = match.group(1).strip()
+                return port
+            else:
+                logger.error("Không tìm thấy port trong file.")
+                return None
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc port từ file: {e}")
+        return None
+
+def get_default_interface():
+    """Interface của route mặc định (như `ip route get`), đọc thẳng /proc/net/route"""
+    try:
+        with open('/proc/net/route', 'r') as file:
+            routes = [line.split() for line in file.readlines()[1:]]
+    except OSError:
+        return None
+    # Cột: Iface Destination Gateway Flags RefCnt Use Metric ...; cờ 0x1 = RTF_UP
+    default = [(int(fields[6]), fields[0]) for fields in routes
+               if len(fields) > 6 and fields[1] == '00000000' and int(fields[3], 16) & 1]
+    return min(default)[1] if default else None
+
+def read_interface_mac(interface):
+    """Địa chỉ MAC của interface từ sysfs; None nếu không đọc được"""
+    try:
+        with open(f'/sys/class/net/{interface}/address', 'r') as file:
+            mac = file.read().strip()
+    except OSError:
+        return None
+    return mac if mac and mac != '00:00:00:00:00:00' else None
+
+def get_mac():
+    """Lấy địa chỉ MAC của interface mặc định (procfs/sysfs, dự phòng bằng lệnh ip)"""
+    interface = get_default_interface()
+    mac = read_interface_mac(interface) if interface else None
+    return mac or get_mac_from_ip()
+
+def get_mac_from_ip():
+    """Lấy địa chỉ MAC bằng lệnh ip (khi không đọc được /proc, /sys)"""
+    try:
+        interface_cmd = "ip route get 1.1.1.1 | grep -oP 'dev \\K\\w+'"
+        interface = subprocess.check_output(interface_cmd, shell=True).decode().strip()
+        result = subprocess.check_output(f"ip link show {interface}", shell=True).decode()
+        mac_match = re.search(r"ether ([\da-fA-F:]+)", result)
+        if mac_match:
+            return mac_match.group(1)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Lỗi khi chạy lệnh ip link: {e}")
+    except Exception as e:
+        logger.error(f"Lỗi lấy MAC Address: {e}")
+    return "00:00:00:00:00:00"
+
+def call_daylaidulieu_api(pump_id, base_url=CONTROLLER_BASE_URL, timeout=10):
+    """Gọi API daylaidulieu (đồng bộ, không gọi từ event loop)"""
+    api_url = f"{base_url}/daylaidulieu/{pump_id}"
+    labels = {'controller': urlsplit(base_url).netloc, 'endpoint': 'daylaidulieu'}
+    started = time.perf_counter()
+    try:
+        response = requests.get(api_url, timeout=timeout)
+        metrics.observe('fuel_controller_request_seconds', time.perf_counter() - started, **labels)
+        http_logger.info("Đã gọi API daylaidulieu cho pump ID %s. Mã trạng thái: %s", pump_id, response.status_code)
+        return response.status_code
+    except requests.exceptions.RequestException as e:
+        metrics.inc('fuel_controller_errors_total', reason='connection', **labels)
+        logger.error(f"Lỗi khi gọi API daylaidulieu: {e}")
+        return None
+
+def check_disk_and_clear_logs(threshold=DISK_USAGE_THRESHOLD):
+    """Kiểm tra dung lượng ổ cứng và xóa log nếu cần (chạy nền, không chặn khởi động)"""
+    try:
+        usage = shutil.disk_usage('/')
+        # Cùng cách tính cột Use% của df: đã dùng / (đã dùng + còn trống cho user thường)
+        disk_usage_percent = usage.used * 100 / (usage.used + usage.free)
+        logger.info(f"Mức sử dụng ổ cứng hiện tại: {disk_usage_percent:.2f}%")
+
+        if disk_usage_percent > threshold:
+            logger.warning(f"Ổ cứng sử dụng vượt quá {threshold}%. Tiến hành xóa các file log...")
+            try:
+                # Xóa file log (tính năng giải phóng dung lượng)
+                subprocess.run("find / -type f -name '*.log' -execdir rm -- '{}' +", shell=True, check=True)
+                logger.info("Đã xóa các file log trong toàn bộ hệ thống")
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Lỗi khi xóa file log: {e}")
+        else:
+            logger.info(f"Ổ cứng sử dụng dưới ngưỡng {threshold}%, không cần xóa file log.")
+    except Exception as e:
+        logger.error(f"Lỗi khi kiểm tra ổ cứng: {e}")
+
+# ==================== THÔNG TIN TRẠM (CACHE) ====================
+class IdentityCache:
+    """port / version / MAC của trạm, lưu ra đĩa giữa các lần khởi động
+
+    port và version chỉ đọc lại khi mtime của AUTORUN_FILE hoặc
+    GasController.js đổi (hoặc kiến trúc CPU đổi); MAC đọc lại từ sysfs mỗi
+    lần vì rất rẻ, chỉ dùng bản cache khi sysfs không đọc được.
+    """
+
+    def __init__(self, path=IDENTITY_CACHE_FILE):
+        self.path = path
+        self.lock = Lock()
+        self.loaded = False
+        self.stamp = None
+        self.identity = None
+
+    def _load(self):
+        self.loaded = True
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                cached = json.load(file)
+            self.stamp = cached['stamp']
+            self.identity = cached['identity']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    @staticmethod
+    def source_stamp():
+        """mtime các file nguồn + kiến trúc CPU; đổi thì phải đọc lại port/version"""
+        stamp = {'arch': os.uname().machine}
+        for path in [AUTORUN_FILE] + GAS_CONTROLLER_PATHS:
+            try:
+                stamp[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                stamp[path] = None
+        return stamp
+
+    def get(self):
+        """Trả về dict port/version/mac (an toàn khi gọi từ nhiều thread)"""
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            stamp = self.source_stamp()
+            identity = dict(self.identity or {})
+            changed = stamp != self.stamp
+            if changed:
+                identity['port'] = get_port_from_file()
+                identity['version'] = get_version_from_js()
+            interface = get_default_interface()
+            mac = (read_interface_mac(interface) if interface else None) or identity.get('mac') or get_mac_from_ip()
+            changed = changed or mac != identity.get('mac')
+            identity['mac'] = mac
+            if changed:
+                self.stamp = stamp
+                self.identity = identity
+                self._save()
+            return dict(identity)
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump({'stamp': self.stamp, 'identity': self.identity}, file)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            logger.warning(f"⚠️ Không ghi được cache thông tin trạm {self.path}: {e}")
+
+station_identity = IdentityCache()
+
+# ==================== SNAPSHOT POLLER ====================
+class AdaptivePollInterval:
+    """Chu kỳ poll thích ứng theo hoạt động của trạm
+
+    Poll nhanh (min_interval) khi có vòi không 'sẵn sàng' hoặc đang mất kết
+    nối (bộ đếm DISCONNECT_ALERT_SECONDS đang chạy); khi mọi vòi rảnh và
+    snapshot không đổi idle_polls lần liên tiếp thì giãn chu kỳ thêm một bước,
+    tối đa max_interval. Có thay đổi trạng thái hoặc lệnh từ server thì quay
+    lại poll nhanh ngay.
+
+    Vòi mất kết nối khi đang giãn chu kỳ chỉ được thấy ở lần poll sau (mất kết
+    nối ngắn hơn chu kỳ hiện tại thì không thấy). check_mabom tính thời điểm mất
+    kết nối từ lần poll trước (SnapshotPoller.previous_time, không lùi quá một
+    chu kỳ) nên cảnh báo vẫn không muộn hơn DISCONNECT_ALERT_SECONDS sau lúc mất
+    kết nối thật; đổi lại cảnh báo có thể sớm tới một chu kỳ. max_interval bị giới hạn ở một phần tư
+    DISCONNECT_ALERT_SECONDS để vòi mất kết nối dưới 3/4 ngưỡng không bao giờ
+    bị cảnh báo.
+    """
+
+    READY_STATUS = 'sẵn sàng'
+
+    def __init__(self, min_interval=SNAPSHOT_POLL_INTERVAL, max_interval=SNAPSHOT_POLL_MAX_INTERVAL,
+                 backoff=SNAPSHOT_POLL_BACKOFF, idle_polls=SNAPSHOT_POLL_IDLE_POLLS):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, min(max_interval, DISCONNECT_ALERT_SECONDS / 4))
+        self.backoff = backoff
+        self.idle_polls = idle_polls
+        self.current = min_interval
+        self.stable_polls = 0
+        self.signature = None  # (id, status, pump, isDisconnected) của snapshot trước
+
+    def reset(self):
+        """Quay lại poll nhanh; trả về chu kỳ tới"""
+        self.current = self.min_interval
+        self.stable_polls = 0
+        return self.current
+
+    def observe(self, data):
+        """Cập nhật theo snapshot vừa lấy; trả về chu kỳ tới"""
+        busy = False
+        signature = []
+        for item in data:
+            status = item.get('status')
+            disconnected = item.get('isDisconnected', False)
+            if disconnected or status != self.READY_STATUS:
+                busy = True
+            signature.append((item.get('id'), status, item.get('pump'), disconnected))
+        changed = signature != self.signature
+        self.signature = signature
+
+        if busy or changed:
+            if self.current != self.min_interval:
+                logger.debug("⏩ Trạm có hoạt động, poll lại mỗi %s giây", self.min_interval)
+            return self.reset()
+        self.stable_polls += 1
+        if self.stable_polls >= self.idle_polls and self.current < self.max_interval:
+            self.stable_polls = 0
+            self.current = min(self.current * self.backoff, self.max_interval)
+            logger.debug("⏸️ Trạm rảnh, giãn chu kỳ poll lên %.1f giây", self.current)
+        return self.current
+
+class SnapshotPoller:
+    """Lấy GetfullupdateArr một lần mỗi chu kỳ và phân phối cho các subscriber
+
+    Dùng chung một kết nối HTTP keep-alive để không mở kết nối mới mỗi lần
+    gọi; mọi subscriber nhận cùng một snapshot.
+    """
+
+    def __init__(self, url=GETFULLUPDATE_URL, interval=SNAPSHOT_POLL_INTERVAL, http=None):
+        parts = urlsplit(url)
+        self.url = url
+        self.path = parts.path or '/'
+        self.interval = interval
+        # http: có thể dùng chung giữa các trạm trỏ tới cùng một bộ điều khiển
+        self.http = http or AsyncHTTPClient(f"{parts.scheme}://{parts.netloc}")
+        self.subscribers = []
+        self.latest = None
+        self.latest_time = None
+        self.previous_time = None  # Snapshot trước còn đúng tới thời điểm này (xem known_until)
+        self.pacer = AdaptivePollInterval(min_interval=interval)
+        self.wakeup = None  # asyncio.Event, tạo khi run() chạy
+
+    def subscribe(self, callback):
+        """Đăng ký callback(data) nhận mỗi snapshot mới"""
+        self.subscribers.append(callback)
+
+    def known_until(self, now):
+        """Thời điểm snapshot trước được coi là còn đúng: khi poll chỉ biết tới lần poll trước
+
+        Không lùi quá một chu kỳ poll: sau khi bộ điều khiển/HTTP không trả lời nhiều
+        phút, lần poll thành công trước đã quá cũ, vòi mất kết nối thấy ngay khi lên
+        lại không được tính là mất từ trước sự cố (cảnh báo giả ở lần poll kế tiếp).
+        """
+        if self.latest_time is None:
+            return None
+        return max(self.latest_time, now - timedelta(seconds=self.pacer.current))
+
+    def dispatch(self, data):
+        """Gửi snapshot tới tất cả subscriber"""
+        now = datetime.now()
+        self.previous_time = self.known_until(now)
+        self.latest = data
+        self.latest_time = now
+        for callback in self.subscribers:
+            try:
+                callback(data)
+            except Exception as e:
+                logger.error(f"❌ Lỗi subscriber {getattr(callback, '__name__', callback)}: {e}")
+
+    async def poll_once(self):
+        """Lấy một snapshot; subscriber chạy trong executor để không chặn event loop"""
+        data = await self.http.get_json(self.path)
+        if not data:
+            logger.warning(f"⚠️ Không lấy được dữ liệu từ {self.url}")
+            return None
+
+        await asyncio.get_running_loop().run_in_executor(None, self.dispatch, data)
+        return data
+
+    async def poll_step(self):
+        """Một lần poll; trả về chu kỳ chờ tới lần poll sau"""
+        try:
+            data = await self.poll_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Lỗi khi poll snapshot {self.url}: {e}")
+            data = None
+        # Không lấy được snapshot: poll nhanh để thấy bộ điều khiển lên lại
+        return self.pacer.observe(data) if data else self.pacer.reset()
+
+    async def run(self, delay=0):
+        """Poll liên tục với chu kỳ thích ứng (xem AdaptivePollInterval)"""
+        self.wakeup = asyncio.Event()
+        if delay:
+            await asyncio.sleep(delay)
+        await self.poll_loop()
+
+    async def poll_loop(self, duration=None):
+        """Vòng poll; duration: dừng sau khoảng N giây (None: chạy mãi)
+
+        Chu kỳ tính từ lúc bắt đầu mỗi lần poll; wake() cắt ngang thời gian chờ.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if duration is None else loop.time() + duration
+        while deadline is None or loop.time() < deadline:
+            started = loop.time()
+            self.wakeup.clear()
+            interval = await self.poll_step()
+            timeout = started + interval - loop.time()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def wake(self):
+        """Poll ngay và quay lại chu kỳ nhanh (gọi trên thread của event loop)"""
+        self.pacer.reset()
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def close(self):
+        """Đóng kết nối HTTP"""
+        await self.http.close()
+
+# ==================== NGUỒN ĐẨY SNAPSHOT (PUSH) ====================
+def _feed_line(line):
+    """Một dòng NDJSON của nguồn đẩy -> (loại, dữ liệu)
+
+    Dòng là mảng (snapshot đầy đủ) hoặc {"event": "snapshot"|"update", "data": [...]}.
+    """
+    message = json.loads(line)
+    if isinstance(message, list):
+        return 'snapshot', message
+    return message.get('event', 'update'), message.get('data')
+
+class PushSnapshotFeed(SnapshotPoller):
+    """Nhận thay đổi snapshot do bộ điều khiển đẩy tới thay vì poll GetfullupdateArr
+
+    Sự kiện "snapshot" thay toàn bộ danh sách vòi, "update" thay/ghép các vòi
+    theo id ({"id": ..., "removed": true} để xóa). Mỗi sự kiện được phân phối
+    ngay cho subscriber. Giữa các sự kiện, snapshot trong bộ nhớ được phân phối
+    lại theo chu kỳ của AdaptivePollInterval (không gọi HTTP) để các ngưỡng thời
+    gian của check_mabom (mất kết nối quá DISCONNECT_ALERT_SECONDS) vẫn chạy.
+    Sau khi kết nối, nếu chưa có bản đầy đủ khi sự kiện "update" đầu tiên tới
+    (hoặc sau một chu kỳ chờ) thì lấy qua GetfullupdateArr. Nguồn đẩy lỗi
+    thì poll như SnapshotPoller trong retry_interval giây rồi thử lại.
+
+    Lớp con cài đặt _open, _read_event (trả về (loại, dữ liệu), raise
+    ConnectionError khi nguồn đóng) và _close_feed.
+    """
+
+    backend = None
+
+    def __init__(self, feed_url, url=GETFULLUPDATE_URL, interval=SNAPSHOT_POLL_INTERVAL, http=None,
+                 retry_interval=SNAPSHOT_FEED_RETRY_INTERVAL):
+        super().__init__(url=url, interval=interval, http=http)
+        self.feed_url = feed_url
+        self.retry_interval = retry_interval
+        self.pumps = None  # id -> vòi của snapshot hiện tại; None khi chưa có bản đầy đủ
+        self.connected = False
+
+    async def run(self, delay=0):
+        self.wakeup = asyncio.Event()
+        if delay:
+            await asyncio.sleep(delay)
+        while True:
+            try:
+                self.pumps = None
+                await self._open()
+                self.connected = True
+                logger.info(f"📡 Nhận snapshot từ nguồn đẩy {self.feed_url}")
+                await self.consume()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Nguồn đẩy {self.feed_url} lỗi ({e!r}), poll {self.url} "
+                               f"trong {self.retry_interval:g} giây")
+            finally:
+                self.connected = False
+                await self._close_feed()
+            metrics.inc('fuel_snapshot_feed_fallbacks_total', backend=self.backend)
+            await self.poll_loop(self.retry_interval)
+
+    async def consume(self):
+        """Nhận sự kiện cho tới khi nguồn đẩy đóng; phân phối lại snapshot khi hết chu kỳ chờ"""
+        loop = asyncio.get_running_loop()
+        # Đã có bản đầy đủ khi mở nguồn (file): phân phối ngay
+        timeout = 0 if self.pumps is not None else self.pacer.reset()
+        read = asyncio.ensure_future(self._read_event())
+        try:
+            while True:
+                self.wakeup.clear()
+                woken = asyncio.ensure_future(self.wakeup.wait())
+                await asyncio.wait((read, woken), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if read.done():
+                    kind, data = read.result()
+                    read = asyncio.ensure_future(self._read_event())
+                    metrics.inc('fuel_snapshot_feed_events_total', backend=self.backend, kind=kind)
+                    if self.pumps is None and kind != 'snapshot' and not await self._fetch_baseline():
+                        continue
+                    self.apply(kind, data)
+                elif self.pumps is None and not await self._fetch_baseline():
+                    timeout = self.pacer.reset()
+                    continue
+                data = list(self.pumps.values())
+                await loop.run_in_executor(None, self.dispatch, data)
+                timeout = self.pacer.observe(data)
+        finally:
+            read.cancel()
+
+    def known_until(self, now):
+        # Đang nhận từ nguồn đẩy: mọi thay đổi được báo ngay, snapshot trước đúng tới bây giờ
+        return now if self.connected else super().known_until(now)
+
+    def apply(self, kind, data):
+        """Cập nhật snapshot trong bộ nhớ theo một sự kiện"""
+        if not isinstance(data, list):
+            raise ValueError(f"Sự kiện {kind} không có danh sách vòi")
+        if kind == 'snapshot':
+            self.pumps = {}
+        for item in data:
+            key = _pump_key(item)
+            if key is None:
+                continue
+            if item.get('removed'):
+                self.pumps.pop(key, None)
+            else:
+                # Bản mới thay bản cũ (không sửa dict cũ: snapshot đã phân phối giữ nguyên)
+                self.pumps[key] = {**self.pumps[key], **item} if key in self.pumps else item
+
+    async def _fetch_baseline(self):
+        """Lấy bản đầy đủ qua GetfullupdateArr khi nguồn đẩy chưa gửi"""
+        data = await self.http.get_json(self.path)
+        if not data:
+            logger.warning(f"⚠️ Không lấy được dữ liệu từ {self.url}")
+            return False
+        self.apply('snapshot', data)
+        return True
+
+    async def _open(self):
+        raise NotImplementedError
+
+    async def _read_event(self):
+        raise NotImplementedError
+
+    async def _close_feed(self):
+        pass
+
+class SSESnapshotFeed(PushSnapshotFeed):
+    """Nguồn đẩy Server-Sent Events (GET text/event-stream, "event:" là loại, "data:" là JSON)"""
+
+    backend = 'sse'
+
+    def __init__(self, feed_url, **kwargs):
+        super().__init__(feed_url, **kwargs)
+        parts = urlsplit(feed_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        self.reader = None
+        self.writer = None
+        self.buffer = bytearray()
+        self.chunked = False
+        self.chunk_left = 0
+        self.chunk_started = False
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(
+            f"GET {self.target} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+            f"Accept: text/event-stream\r\nCache-Control: no-cache\r\n\r\n".encode('ascii')
+        )
+        await self.writer.drain()
+        status_line = await asyncio.wait_for(self.reader.readline(), self.http.timeout)
+        if not status_line:
+            raise ConnectionError("Bộ điều khiển đóng kết nối")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if status != 200:
+            raise ConnectionError(f"Mã trạng thái {status}")
+        self.buffer = bytearray()
+        self.chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        self.chunk_left = 0
+        self.chunk_started = False
+
+    async def _fill(self):
+        """Đọc thêm body vào buffer (bỏ khung chunked)"""
+        if self.chunked:
+            if not self.chunk_left:
+                if self.chunk_started:
+                    await self.reader.readexactly(2)  # CRLF sau chunk trước
+                self.chunk_started = True
+                self.chunk_left = int((await self.reader.readline()).split(b';')[0] or b'0', 16)
+                if not self.chunk_left:
+                    raise ConnectionError("Nguồn đẩy kết thúc stream")
+            data = await self.reader.read(min(self.chunk_left, HTTP_READ_CHUNK))
+            self.chunk_left -= len(data)
+        else:
+            data = await self.reader.read(HTTP_READ_CHUNK)
+        if not data:
+            raise ConnectionError("Nguồn đẩy đóng kết nối")
+        self.buffer += data
+
+    async def _readline(self):
+        while True:
+            index = self.buffer.find(b'\n')
+            if index >= 0:
+                line = bytes(self.buffer[:index])
+                del self.buffer[:index + 1]
+                return line.rstrip(b'\r').decode('utf-8')
+            await self._fill()
+
+    async def _read_event(self):
+        kind, data = 'snapshot', []
+        while True:
+            line = await self._readline()
+            if not line:
+                if data:
+                    return kind, json.loads('\n'.join(data))
+                kind = 'snapshot'
+                continue
+            if line.startswith(':'):
+                continue  # Comment / keepalive
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if field == 'event':
+                kind = value
+            elif field == 'data':
+                data.append(value)
+
+    async def _close_feed(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+class UnixSnapshotFeed(PushSnapshotFeed):
+    """Nguồn đẩy qua Unix domain socket, mỗi dòng NDJSON một sự kiện (xem _feed_line)"""
+
+    backend = 'unix'
+
+    def __init__(self, feed_url, **kwargs):
+        super().__init__(feed_url, **kwargs)
+        self.feed_path = urlsplit(feed_url).path
+        self.reader = None
+        self.writer = None
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.feed_path, limit=SNAPSHOT_FEED_LINE_LIMIT)
+
+    async def _read_event(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("Nguồn đẩy đóng kết nối")
+            if line.strip():
+                return _feed_line(line)
+
+    async def _close_feed(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+class FileSnapshotFeed(PushSnapshotFeed):
+    """Đọc đuôi file NDJSON bộ điều khiển ghi thêm (như tail -F): bắt đầu từ cuối file,
+    mở lại khi file bị xoay vòng hoặc cắt ngắn
+
+    Không có thông báo khi file đổi nên vẫn phải đọc định kỳ: nhanh ngay sau khi
+    có dữ liệu, giãn dần tới max_poll_interval khi bộ điều khiển im lặng.
+    """
+
+    backend = 'file'
+
+    def __init__(self, feed_url, poll_interval=SNAPSHOT_FEED_FILE_INTERVAL,
+                 max_poll_interval=SNAPSHOT_FEED_FILE_MAX_INTERVAL, rotate_check=SNAPSHOT_FEED_FILE_ROTATE_CHECK,
+                 **kwargs):
+        super().__init__(feed_url, **kwargs)
+        self.feed_path = urlsplit(feed_url).path
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(poll_interval, max_poll_interval)
+        self.delay = poll_interval
+        self.rotate_check = rotate_check
+        self.next_rotate_check = 0
+        self.file = None
+        self.partial = b''
+
+    async def _open(self):
+        self.file = open(self.feed_path, 'rb')
+        self.file.seek(0, os.SEEK_END)
+        self.partial = b''
+        # File chỉ có phần thay đổi: lấy bản đầy đủ ngay (sau khi đã đánh dấu vị trí đọc)
+        await self._fetch_baseline()
+
+    def _rotated(self):
+        try:
+            stat = os.stat(self.feed_path)
+        except FileNotFoundError:
+            return False  # Đang xoay vòng, chờ file mới
+        return stat.st_ino != os.fstat(self.file.fileno()).st_ino or stat.st_size < self.file.tell()
+
+    async def _read_event(self):
+        while True:
+            line = self.file.readline()
+            if line:
+                self.delay = self.poll_interval
+            if line.endswith(b'\n'):
+                line, self.partial = self.partial + line, b''
+                if not line.strip():
+                    continue
+                try:
+                    return _feed_line(line)
+                except ValueError:
+                    # Đọc từ giữa dòng: file bị cắt ngắn rồi ghi lại quá vị trí đang đọc trước
+                    # lần kiểm tra xoay vòng. Đọc tiếp từ cuối file và lấy lại bản đầy đủ
+                    logger.warning(f"⚠️ Dòng hỏng trong {self.feed_path} (file bị cắt ngắn?), lấy lại bản đầy đủ")
+                    self.file.seek(0, os.SEEK_END)
+                    if not await self._fetch_baseline():
+                        raise
+                    return 'snapshot', list(self.pumps.values())
+            self.partial += line
+            now = time.monotonic()
+            if now >= self.next_rotate_check:
+                self.next_rotate_check = now + self.rotate_check
+                if self._rotated():
+                    self.file.close()
+                    self.file = open(self.feed_path, 'rb')
+                    self.partial = b''
+                    continue
+            await asyncio.sleep(self.delay)
+            self.delay = min(self.delay * 2, self.max_poll_interval)
+
+    async def _close_feed(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+SNAPSHOT_FEEDS = {'http': SSESnapshotFeed, 'unix': UnixSnapshotFeed, 'file': FileSnapshotFeed}
+
+def create_snapshot_source(controller_url=CONTROLLER_BASE_URL, feed=SNAPSHOT_FEED, http=None):
+    """SnapshotPoller (feed rỗng) hoặc nguồn đẩy theo scheme của feed (xem SNAPSHOT_FEED)"""
+    url = f"{controller_url}/GetfullupdateArr"
+    if not feed:
+        return SnapshotPoller(url=url, http=http)
+    if feed.startswith('/'):
+        feed = f"{controller_url}{feed}"
+    scheme = urlsplit(feed).scheme
+    if scheme not in SNAPSHOT_FEEDS:
+        raise ValueError(f"Không hỗ trợ nguồn đẩy {feed} (dùng http://, unix:// hoặc file://)")
+    return SNAPSHOT_FEEDS[scheme](feed, url=url, http=http)
+
+# ==================== GHI LẠI SNAPSHOT (REPLAY) ====================
+def recording_files(directory):
+    """Các file ghi lại của một trạm, theo thứ tự thời gian"""
+    return sorted(glob.glob(os.path.join(directory, '*.jsonl.gz')))
+
+class SnapshotRecorder:
+    """Ghi mỗi snapshot GetfullupdateArr kèm thời điểm vào file xoay vòng để replay offline
+
+    Mỗi dòng là JSON {"t": thời điểm ISO, "d": message delta} (không có "d"
+    khi snapshot không đổi), nén gzip. Mỗi file bắt đầu bằng một keyframe nên
+    đọc được độc lập; khi tổng dung lượng vượt max_bytes thì xóa file cũ nhất.
+    """
+
+    def __init__(self, directory, segment_bytes=RECORDING_SEGMENT_BYTES, max_bytes=RECORDING_MAX_BYTES,
+                 flush_interval=RECORDING_FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.encoder = DeltaEncoder(keyframe_interval=RECORDING_KEYFRAME_INTERVAL)
+        self.keys = None
+        self.raw = None
+        self.file = None
+        self.last_flush = time.monotonic()
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_segment(self):
+        # Luôn mở file mới: file cũ có thể bị cắt ngang khi client dừng đột ngột
+        files = recording_files(self.directory)
+        number = int(os.path.basename(files[-1]).split('.')[0]) + 1 if files else 0
+        self.raw = open(os.path.join(self.directory, f"{number:010d}.jsonl.gz"), 'wb')
+        self.file = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        self.encoder.request_keyframe()
+        self._trim()
+
+    def _close_segment(self):
+        if self.file is not None:
+            self.file.close()
+            self.raw.close()
+            self.file = None
+            self.raw = None
+
+    def _trim(self):
+        files = recording_files(self.directory)
+        sizes = [os.path.getsize(path) for path in files]
+        total = sum(sizes)
+        for path, size in zip(files[:-1], sizes):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def record(self, data, when=None):
+        """Ghi một snapshot; when mặc định là thời điểm hiện tại"""
+        when = when or datetime.now()
+        with self.lock:
+            try:
+                if self.file is None:
+                    self._open_segment()
+                # Thứ tự vòi đổi thì delta không giữ được, ghi bản đầy đủ
+                keys = [_pump_key(item) for item in data]
+                if keys != self.keys:
+                    self.encoder.request_keyframe()
+                    self.keys = keys
+                record = {'t': when.isoformat()}
+                body = self.encoder.encode(data)
+                if body is not None:
+                    record['d'] = body
+                self.file.write((json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8'))
+
+                now = time.monotonic()
+                if now - self.last_flush >= self.flush_interval:
+                    self.file.flush()
+                    self.last_flush = now
+                    if self.raw.tell() >= self.segment_bytes:
+                        self._close_segment()
+            except (OSError, TypeError, ValueError) as e:
+                logger.error(f"❌ Lỗi ghi snapshot vào {self.directory}: {e}")
+                self._close_segment()
+
+    def close(self):
+        """Ghi nốt dữ liệu và đóng file hiện tại"""
+        with self.lock:
+            self._close_segment()
+
+def read_recording(path):
+    """Đọc bản ghi của SnapshotRecorder (thư mục của trạm hoặc một file), trả về từng (thời điểm, snapshot)"""
+    files = recording_files(path) if os.path.isdir(path) else [path]
+    for file_path in files:
+        decoder = DeltaDecoder()
+        snapshot = None
+        try:
+            with gzip.open(file_path, 'rt', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Dòng cuối bị cắt ngang
+                    body = record.get('d')
+                    if body is not None:
+                        snapshot = decoder.apply(body)
+                        if body.get('mode') == 'full':
+                            snapshot = body.get('data')  # Giữ nguyên cả phần tử hỏng / trùng id
+                    if snapshot is not None:
+                        yield datetime.fromisoformat(record['t']), snapshot
+        except (EOFError, OSError, zlib.error) as e:
+            logger.warning(f"⚠️ File ghi lại {file_path} kết thúc bất thường: {e}")
+
+# ==================== CHECKPOINT TRẠNG THÁI ====================
+def _encode_state(value):
+    """datetime -> {"$dt": iso}, tuple -> {"$t": [...]} để JSON giữ nguyên kiểu khi nạp lại"""
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    if isinstance(value, tuple):
+        return {'$t': [_encode_state(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode_state(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _encode_state(item) for key, item in value.items()}
+    return value
+
+def _decode_state(value):
+    if isinstance(value, list):
+        return [_decode_state(item) for item in value]
+    if isinstance(value, dict):
+        if len(value) == 1 and '$dt' in value:
+            return datetime.fromisoformat(value['$dt'])
+        if len(value) == 1 and '$t' in value:
+            return tuple(_decode_state(item) for item in value['$t'])
+        return {key: _decode_state(item) for key, item in value.items()}
+    return value
+
+class StateCheckpoint:
+    """Lưu trạng thái phát hiện của một trạm ra đĩa để khởi động lại không mất dấu
+
+    File JSON nhỏ, ghi nguyên tử (file tạm + fsync + rename). Chỉ ghi khi
+    nội dung đổi và tối đa mỗi interval giây để đỡ ghi thẻ nhớ; flush() ghi
+    ngay phần còn chờ (gọi khi dừng client).
+    """
+
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.last_body = None  # JSON của trạng thái đã ghi, để bỏ qua lần ghi không đổi
+        self.last_write = None  # monotonic
+        self.pending = None  # Trạng thái đã đổi nhưng chưa tới lúc ghi
+        self.saved = None  # Thời điểm lưu của checkpoint đã nạp
+
+    def load(self):
+        """Đọc checkpoint; trả về dict trạng thái hoặc None nếu không có / hỏng / khác phiên bản"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                document = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Bỏ qua checkpoint hỏng {self.path}: {e}")
+            return None
+        if not isinstance(document, dict) or document.get('version') != CHECKPOINT_VERSION:
+            logger.warning(f"⚠️ Bỏ qua checkpoint {self.path}: phiên bản {document.get('version') if isinstance(document, dict) else None}")
+            return None
+        try:
+            self.saved = datetime.fromisoformat(document['saved'])
+        except (KeyError, TypeError, ValueError):
+            self.saved = None
+        state = document.get('state', {})
+        self.last_body = json.dumps(state, ensure_ascii=False, separators=(',', ':'))
+        return _decode_state(state)
+
+    def update(self, state, force=False):
+        """Ghi trạng thái nếu đã đổi; trong vòng interval giây kể từ lần ghi trước thì để chờ
+        (force: ghi ngay, dùng cho mốc restartall)"""
+        self.pending = state
+        now = time.monotonic()
+        if force or self.last_write is None or now - self.last_write >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Ghi ngay trạng thái đang chờ (nếu khác bản trên đĩa)"""
+        if self.pending is None:
+            return
+        state, self.pending = self.pending, None
+        body = json.dumps(_encode_state(state), ensure_ascii=False, separators=(',', ':'))
+        if body == self.last_body:
+            return
+        payload = (f'{{"version":{CHECKPOINT_VERSION},"saved":"{datetime.now().isoformat()}",'
+                   f'"state":{body}}}')
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+                file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self.path + '.tmp', self.path)
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError as e:
+            logger.error(f"❌ Lỗi ghi checkpoint {self.path}: {e}")
+            return
+        self.last_body = body
+        self.last_write = time.monotonic()
+
+# ==================== LỊCH SỬ TRÊN THIẾT BỊ (RING BUFFER) ====================
+def _history_mabom(value):
+    """Mã bơm dạng int32 để lưu vào bản ghi lịch sử (-1: không có / không phải số)"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return -1
+    return value if 0 <= value < 2 ** 31 else -1
+
+class HistoryRing:
+    """Lịch sử mẫu từng vòi của một trạm trong file mmap kích thước cố định
+
+    File gồm một trang header (magic, phiên bản, sức chứa, tổng số bản ghi đã
+    ghi, bảng mã trạng thái dạng JSON) và capacity bản ghi 16 byte: thời điểm
+    (epoch), id vòi, mã trạng thái, cờ (bit 0: mất kết nối, bit 1:
+    MaBomMoiNhat lệch), mã bơm. Bản ghi thứ n nằm ở ô n % capacity nên khi đầy
+    thì ghi đè bản cũ nhất. Ghi vào mmap nên dữ liệu còn lại khi tiến trình bị
+    kill; xuống đĩa (mất điện) sau tối đa flush_interval giây.
+    """
+
+    MAGIC = b'FUELHIST'
+    VERSION = 1
+    PAGE = 4096
+    HEADER = struct.Struct('<8sHHIQ')  # magic, phiên bản, kích thước bản ghi, sức chứa, tổng số đã ghi
+    RECORD = struct.Struct('<dHBBi')  # thời điểm, id vòi, mã trạng thái, cờ, mã bơm
+    STATUS_OFFSET = 64  # [độ dài 4B][JSON danh sách trạng thái]
+    UNKNOWN_STATUS = 255  # Trạng thái không vừa bảng mã
+    FLAG_DISCONNECTED = 1
+    FLAG_MISMATCH = 2
+    READ_BATCH = 4096  # Số bản ghi đọc mỗi lần giữ khóa khi truy vấn
+
+    def __init__(self, path, max_bytes=HISTORY_MAX_BYTES, flush_interval=HISTORY_FLUSH_INTERVAL):
+        self.path = path
+        self.capacity = (max_bytes - self.PAGE) // self.RECORD.size
+        if self.capacity <= 0:
+            raise ValueError(f"Dung lượng lịch sử quá nhỏ: {max_bytes} byte")
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.last_flush = time.monotonic()
+        size = self.PAGE + self.capacity * self.RECORD.size
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, version, record_size, capacity, self.count = self.HEADER.unpack_from(self.map, 0)
+        self.statuses = self._load_statuses() if (magic, version, record_size, capacity) == (
+            self.MAGIC, self.VERSION, self.RECORD.size, self.capacity) else None
+        if self.statuses is None:
+            # File mới, khác định dạng hoặc đổi dung lượng: bắt đầu lại từ đầu
+            self.count = 0
+            self.statuses = []
+            self._store_statuses()
+            self._store_count()
+        self.status_codes = {status: code for code, status in enumerate(self.statuses)}
 
-    has_ips = False
-    has_fuelmet = False
-    try:
-        with open('/opt/autorun', 'r') as file:
-            content = file.read()
-            if './ips' in content:
-                has_ips = True
-            if 'fuelmet' in content:
-                has_fuelmet = True
-    except Exception as e:
-        logger.error(f"Lỗi khi đọc file /opt/autorun: {e}")
+    def _load_statuses(self):
+        (length,) = struct.unpack_from('<I', self.map, self.STATUS_OFFSET)
+        start = self.STATUS_OFFSET + 4
+        if start + length > self.PAGE:
+            return None
+        try:
+            statuses = json.loads(self.map[start:start + length].decode('utf-8')) if length else []
+        except ValueError:
+            return None
+        return statuses if isinstance(statuses, list) else None
 
-    cpu_arch = get_cpu_arch()
-    for path in possible_paths:
-        if os.path.exists(path):
-            with open(path, 'r') as file:
-                content = file.read()
-                match = re.search(r'const\s+ver\s*=\s*"([^"]+)"', content)
-                if match:
-                    version = match.group(1)
-                    version = f"{cpu_arch}-{version}"
-                    if has_ips and has_fuelmet:
-                        return version + "-IPS-Fuelmet"
-                    elif has_ips:
-                        return version + "-IPS"
-                    elif has_fuelmet:
-                        return version + "-Fuelmet"
-                    return version
-    
-    version = f"{cpu_arch}-1.0"
-    if has_ips and has_fuelmet:
-        return version + "-IPS-Fuelmet"
-    elif has_ips:
-        return version + "-IPS"
-    elif has_fuelmet:
-        return version + "-Fuelmet"
-    return version
+    def _store_statuses(self):
+        body = json.dumps(self.statuses, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        struct.pack_into('<I', self.map, self.STATUS_OFFSET, len(body))
+        self.map[self.STATUS_OFFSET + 4:self.STATUS_OFFSET + 4 + len(body)] = body
 
-def get_port_from_file():
-    """Lấy port từ file autorun"""
-    try:
-        with open('/opt/autorun', 'r') as file:
-            content = file.read()
-            match = re.search(r'(\s\d{4}|\d{5}):localhost:22', content)
-            if match:
-                port = match.group(1).strip()
-                return port
+    def _store_count(self):
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.VERSION, self.RECORD.size, self.capacity, self.count)
+
+    def _status_code(self, status):
+        code = self.status_codes.get(status)
+        if code is not None:
+            return code
+        if len(self.statuses) >= self.UNKNOWN_STATUS:
+            return self.UNKNOWN_STATUS
+        self.statuses.append(status)
+        if len(json.dumps(self.statuses, ensure_ascii=False).encode('utf-8')) > self.PAGE - self.STATUS_OFFSET - 4:
+            self.statuses.pop()
+            return self.UNKNOWN_STATUS
+        self._store_statuses()
+        code = self.status_codes[status] = len(self.statuses) - 1
+        return code
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, data, when):
+        """Ghi một mẫu cho mỗi vòi trong snapshot GetfullupdateArr (when: datetime)"""
+        timestamp = when.timestamp()
+        with self.lock:
+            for item in data:
+                try:
+                    pump_id = int(item.get('id'))
+                    mabom = item.get('pump')
+                    latest = (item.get('MaBomMoiNhat') or {}).get('pump')
+                except (AttributeError, TypeError, ValueError):
+                    continue  # Phần tử hỏng: bỏ qua như check_mabom
+                if not 0 <= pump_id < 65536:
+                    continue
+                flags = self.FLAG_DISCONNECTED if item.get('isDisconnected') else 0
+                if latest and latest != mabom:
+                    flags |= self.FLAG_MISMATCH
+                status = item.get('status')
+                code = self._status_code(status if isinstance(status, (str, int, float, bool, type(None))) else str(status))
+                offset = self.PAGE + (self.count % self.capacity) * self.RECORD.size
+                self.RECORD.pack_into(self.map, offset, timestamp, pump_id, code, flags, _history_mabom(mabom))
+                self.count += 1
+            # Tổng số ghi sau bản ghi: bị kill giữa chừng chỉ mất các bản ghi chưa được đếm
+            self._store_count()
+            now = time.monotonic()
+            if now - self.last_flush >= self.flush_interval:
+                self.map.flush()
+                self.last_flush = now
+
+    def _time_at(self, index):
+        return struct.unpack_from('<d', self.map, self.PAGE + (index % self.capacity) * self.RECORD.size)[0]
+
+    def _search(self, timestamp):
+        """Chỉ số (logic) của bản ghi đầu tiên có thời điểm >= timestamp; gọi khi giữ khóa"""
+        low, high = max(0, self.count - self.capacity), self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._time_at(middle) < timestamp:
+                low = middle + 1
             else:
-                logger.error("Không tìm thấy port trong file.")
-                return None
-    except Exception as e:
-        logger.error(f"Lỗi khi đọc port từ file: {e}")
-        return None
+                high = middle
+        return low
 
-def get_mac():
-    """Lấy địa chỉ MAC"""
-    try:
-        interface_cmd = "ip route get 1.1.1.1 | grep -oP 'dev \\K\\w+'"
-        interface = subprocess.check_output(interface_cmd, shell=True).decode().strip()
-        result = subprocess.check_output(f"ip link show {interface}", shell=True).decode()
-        mac_match = re.search(r"ether ([\da-fA-F:]+)", result)
-        if mac_match:
-            return mac_match.group(1)
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Lỗi khi chạy lệnh ip link: {e}")
-    except Exception as e:
-        logger.error(f"Lỗi lấy MAC Address: {e}")
-    return "00:00:00:00:00:00"
+    def samples(self, start, end, pumps=None):
+        """Các bản ghi có start <= thời điểm < end theo thứ tự ghi:
+        (thời điểm, id vòi, trạng thái, cờ, mã bơm hoặc None)
 
-def get_data_from_url(url):
-    """Lấy dữ liệu từ URL (fallback cho HTTP)"""
-    try:
-        logger.info(f"🔍 Đang gọi URL: {url}")
-        response = requests.get(url, timeout=10)
-        logger.info(f"📡 Response status: {response.status_code}")
-        
-        if response.status_code == 200:
-            data = response.json()
-            logger.info(f"✅ Lấy được dữ liệu: {type(data)} với {len(str(data))} ký tự")
-            return data
-        else:
-            logger.error(f"❌ Mã trạng thái không phải 200: {response.status_code}")
-            logger.error(f"❌ Response content: {response.text[:200]}...")
-            return None
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Lỗi khi lấy dữ liệu từ URL: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"❌ Lỗi không mong đợi khi xử lý dữ liệu: {e}")
-        return None
+        Đọc từng lô dưới khóa nên không chặn lâu vòng poll; bản ghi bị ghi đè
+        trong lúc đọc (truy vấn sát đầu cũ nhất) thì bị bỏ qua.
+        """
+        with self.lock:
+            index = self._search(start)
+        record_size = self.RECORD.size
+        while True:
+            with self.lock:
+                index = max(index, self.count - self.capacity)
+                stop = min(self.count, index + self.READ_BATCH)
+                batch = [self.RECORD.unpack_from(self.map, self.PAGE + (position % self.capacity) * record_size)
+                         for position in range(index, stop)]
+                statuses = self.statuses
+            index = stop
+            for timestamp, pump_id, code, flags, mabom in batch:
+                if timestamp >= end:
+                    return
+                if pumps is not None and pump_id not in pumps:
+                    continue
+                yield (timestamp, pump_id, statuses[code] if code < len(statuses) else None, flags,
+                       None if mabom < 0 else mabom)
+            if len(batch) < self.READ_BATCH:
+                return
 
-def call_daylaidulieu_api(pump_id):
-    """Gọi API daylaidulieu"""
-    api_url = f"http://localhost:6969/daylaidulieu/{pump_id}"
-    try:
-        response = requests.get(api_url, timeout=10)
-        logger.info(f"Đã gọi API daylaidulieu cho pump ID {pump_id}. Mã trạng thái: {response.status_code}")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Lỗi khi gọi API daylaidulieu: {e}")
+    def flush(self):
+        with self.lock:
+            self.map.flush()
+            self.last_flush = time.monotonic()
 
-def check_disk_and_clear_logs(threshold=85):
-    """Kiểm tra dung lượng ổ cứng và xóa log nếu cần"""
-    try:
-        output = subprocess.check_output(['df', '-h', '/'], stderr=subprocess.STDOUT).decode()
-        lines = output.splitlines()
-        for line in lines:
-            if line.strip().endswith(' /'):
-                parts = line.split()
-                if len(parts) >= 5:
-                    usage_str = parts[4].replace('%', '')
-                    disk_usage_percent = float(usage_str)
-                    logger.info(f"Mức sử dụng ổ cứng hiện tại: {disk_usage_percent:.2f}%")
-                    
-                    if disk_usage_percent > threshold:
-                        logger.warning(f"Ổ cứng sử dụng vượt quá {threshold}%. Tiến hành xóa các file log...")
-                        try:
-                            # Xóa file log (tính năng giải phóng dung lượng)
-                            subprocess.run("find / -type f -name '*.log' -execdir rm -- '{}' +", shell=True, check=True)
-                            logger.info("Đã xóa các file log trong toàn bộ hệ thống")
-                        except subprocess.CalledProcessError as e:
-                            logger.error(f"Lỗi khi xóa file log: {e}")
-                    else:
-                        logger.info(f"Ổ cứng sử dụng dưới ngưỡng {threshold}%, không cần xóa file log.")
-                break
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Lỗi khi chạy lệnh df: {e}")
-    except Exception as e:
-        logger.error(f"Lỗi khi kiểm tra ổ cứng: {e}")
+    def close(self):
+        """Ghi xuống đĩa và đóng mmap"""
+        with self.lock:
+            if not self.map.closed:
+                self.map.flush()
+                self.map.close()
+
+def downsample_history(samples, step=0, changes=False):
+    """Rút gọn chuỗi mẫu của HistoryRing.samples
+
+    step > 0: mỗi vòi giữ mẫu cuối của mỗi khoảng step giây, cờ là OR của cả
+    khoảng (mất kết nối ngắn không bị mất). changes: chỉ giữ mẫu mà trạng thái
+    / cờ / mã bơm khác mẫu trước của cùng vòi. Mẫu trả về theo thứ tự thời gian.
+    """
+    previous = {}
+    if step <= 0:
+        for sample in samples:
+            if changes:
+                state = sample[2:]
+                if previous.get(sample[1]) == state:
+                    continue
+                previous[sample[1]] = state
+            yield sample
+        return
+
+    bucket = None
+    pending = {}  # id vòi -> (mẫu cuối, cờ gộp) trong khoảng hiện tại
+
+    def emit():
+        for pump_id in sorted(pending, key=lambda key: (pending[key][0][0], key)):
+            sample, flags = pending[pump_id]
+            sample = (sample[0], pump_id, sample[2], flags, sample[4])
+            if changes:
+                if previous.get(pump_id) == sample[2:]:
+                    continue
+                previous[pump_id] = sample[2:]
+            yield sample
+        pending.clear()
+
+    for sample in samples:
+        current = int(sample[0] // step)
+        if current != bucket:
+            yield from emit()
+            bucket = current
+        flags = pending[sample[1]][1] if sample[1] in pending else 0
+        pending[sample[1]] = (sample, flags | sample[3])
+    yield from emit()
+
+def parse_history_time(value):
+    """Thời điểm trong lệnh history: epoch (số) hoặc chuỗi ISO (giờ máy trạm); trả về epoch"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(str(value)).timestamp()
+
+# ==================== XỬ LÝ SỰ CỐ (RESTARTALL / DAYLAIDULIEU) ====================
+class RemediationEngine:
+    """Hàng đợi hành động xử lý sự cố của một trạm, chạy tách khỏi vòng phát hiện
+
+    check_mabom (chạy trong executor) chỉ xếp hành động vào hàng đợi, không
+    chặn vòng poll; một tác vụ asyncio thực hiện lần lượt theo thứ tự: restartall chạy tiến trình con
+    không chặn event loop rồi chờ bộ điều khiển lên lại, daylaidulieu gọi
+    HTTP trên kết nối keep-alive riêng (không tranh khóa với kết nối poll).
+
+    - Cooldown theo loại hành động (restart_all, restart_nonsequential) tính
+      theo thời điểm snapshot, nên replay với đồng hồ ảo vẫn đúng.
+    - daylaidulieu trùng vòi còn đang chờ trong hàng đợi được gộp làm một;
+      sau một restartall thì yêu cầu mới không gộp với yêu cầu xếp trước đó.
+    - Kết quả mỗi hành động được gửi lên như một sự kiện "remediation".
+    """
+
+    def __init__(self, controller_url=CONTROLLER_BASE_URL, restart_command=RESTART_ALL_COMMAND, report=None):
+        parts = urlsplit(controller_url)
+        self.path_prefix = parts.path.rstrip('/')
+        self.http = AsyncHTTPClient(f"{parts.scheme}://{parts.netloc}", timeout=DAYLAIDULIEU_TIMEOUT)
+        self.restart_command = list(restart_command)
+        self.report = report  # callback(event) khi một hành động kết thúc
+        # Ngưỡng lấy theo cấu hình lúc tạo (replay có thể thay đổi trước đó)
+        cooldown = timedelta(minutes=RESTART_COOLDOWN_MINUTES)
+        self.cooldowns = {'restart_all': cooldown, 'restart_nonsequential': cooldown}
+        self.last_run = {}  # loại cooldown -> thời điểm (snapshot) thực hiện gần nhất
+        self.lock = Lock()
+        self.queue = []  # [hành động, ...] chờ thực hiện
+        self.queued_pumps = {}  # pump_id -> hành động daylaidulieu đang chờ (để gộp)
+        self.loop = None
+        self.wakeup = None  # asyncio.Event, tạo khi run()
+        self.current = None  # Hành động đang thực hiện
+
+    @property
+    def pending(self):
+        return len(self.queue) + (self.current is not None)
+
+    def acquire(self, key, now):
+        """True (và ghi nhận mốc) nếu hành động loại key đã qua cooldown tại thời điểm now"""
+        last = self.last_run.get(key)
+        if last is not None and now - last <= self.cooldowns[key]:
+            return False
+        self.last_run[key] = now
+        return True
+
+    def restore(self, last_run):
+        """Nạp lại mốc cooldown từ checkpoint"""
+        self.last_run = {key: value for key, value in last_run.items() if key in self.cooldowns and value}
+
+    def restart(self, settle_time=0, reason=None, pump_id='all'):
+        """Xếp restartall vào hàng đợi; chờ settle_time giây sau đó trước hành động tiếp theo"""
+        with self.lock:
+            self.queued_pumps = {}
+        self._submit({'action': 'restartall', 'pump_id': pump_id, 'reason': reason, 'settle_time': settle_time})
+
+    def daylaidulieu(self, pump_id, reason=None):
+        """Xếp daylaidulieu cho vòi vào hàng đợi; False nếu đã có yêu cầu đang chờ cho vòi này"""
+        with self.lock:
+            if pump_id in self.queued_pumps:
+                metrics.inc('fuel_remediation_coalesced_total', action='daylaidulieu')
+                return False
+            self.queued_pumps[pump_id] = self._submit({'action': 'daylaidulieu', 'pump_id': pump_id,
+                                                       'reason': reason})
+        return True
+
+    def _submit(self, action):
+        """Thêm hành động vào hàng đợi (gọi được từ mọi thread)"""
+        action['queued'] = time.monotonic()
+        self.queue.append(action)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return action
+
+    async def run(self):
+        """Tác vụ dài hạn: thực hiện lần lượt các hành động trong hàng đợi"""
+        self.wakeup = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        try:
+            while True:
+                self.wakeup.clear()
+                if not self.queue:
+                    await self.wakeup.wait()
+                    continue
+                with self.lock:
+                    self.current = action = self.queue.pop(0)
+                    if self.queued_pumps.get(action['pump_id']) is action:
+                        del self.queued_pumps[action['pump_id']]
+                await self._execute(action)
+                self.current = None
+        finally:
+            if self.queue:
+                logger.warning(f"⚠️ Bỏ {len(self.queue)} hành động xử lý sự cố chưa thực hiện khi dừng")
+            await self.http.close()
+
+    async def _execute(self, action):
+        started = time.monotonic()
+        name = action['action']
+        try:
+            if name == 'restartall':
+                result = await self._restart(action['settle_time'])
+            else:
+                result = await self._daylaidulieu(action['pump_id'])
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            result = {'status': 'timeout'}
+        except Exception as e:
+            result = {'status': 'error', 'error': str(e)}
+        finished = time.monotonic()
+        metrics.inc('fuel_remediation_actions_total', action=name, status=result['status'])
+        metrics.observe('fuel_remediation_seconds', finished - started, action=name)
+        if result['status'] != 'ok':
+            logger.error(f"❌ {name} cho vòi {action['pump_id']} thất bại: {result}")
+        if self.report is not None:
+            event = {'type': 'remediation', 'pump_id': action['pump_id'], 'time': datetime.now().isoformat(),
+                     'action': name, 'queued_ms': round((started - action['queued']) * 1000),
+                     'duration_ms': round((finished - started) * 1000)}
+            if action['reason']:
+                event['reason'] = action['reason']
+            event.update(result)
+            self.report(event)
+
+    async def _restart(self, settle_time):
+        """Chạy lệnh restartall như tiến trình con (không chặn event loop)"""
+        logger.warning(f"🔄 Thực hiện {' '.join(self.restart_command)}")
+        process = await asyncio.create_subprocess_exec(*self.restart_command, stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.DEVNULL)
+        try:
+            returncode = await asyncio.wait_for(process.wait(), RESTART_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        if settle_time:
+            # Chờ bộ điều khiển lên lại trước hành động tiếp theo (thường là daylaidulieu)
+            await asyncio.sleep(settle_time)
+        return {'status': 'ok' if returncode == 0 else 'error', 'returncode': returncode}
+
+    async def _daylaidulieu(self, pump_id):
+        status, _ = await self.http.get(f"{self.path_prefix}/daylaidulieu/{pump_id}")
+        http_logger.info("Đã gọi API daylaidulieu cho pump ID %s. Mã trạng thái: %s", pump_id, status)
+        return {'status': 'ok' if status == 200 else 'error', 'http_status': status}
 
 # ==================== MAIN CLIENT CLASS ====================
 class FuelStationClient:
-    def __init__(self):
-        self.mqtt_client = MQTTFuelStationClient()
+    def __init__(self, mqtt_client=None, controller_url=CONTROLLER_BASE_URL, http=None, feed=SNAPSHOT_FEED):
+        self.mqtt_client = mqtt_client or MQTTFuelStationClient()
+        self.controller_url = controller_url
+        self.mqtt_client.controller_url = controller_url
+        # Poll GetfullupdateArr, hoặc nhận thay đổi từ nguồn đẩy (poll khi nguồn đẩy lỗi)
+        self.poller = create_snapshot_source(controller_url, feed, http)
+        self.poller.subscribe(self.check_mabom)
+        self.poller.subscribe(self.publish_snapshot)
+        # restartall / daylaidulieu chạy nền, kết quả gửi lên như sự kiện của trạm
+        self.remediation = RemediationEngine(controller_url, report=self.report_remediation)
         self.port = None
         self.version = None
         self.mac = None
         self.mabom_history = {}
         self.connection_status = {}
         self.is_all_disconnect_restart = [False]
-        self.last_restart_all = None
-        self.last_non_sequential_restart = None
-        self.getdata_enabled = False  # Mặc định tắt gửi dữ liệu
-        self.info_sent = False  # Đánh dấu đã gửi thông tin chưa
+        self.pump_status = {}  # Trạng thái gần nhất của từng vòi, để phát hiện status_changed
+        self.pending_events = []  # Sự kiện phát sinh trong snapshot đang xử lý
+        self.last_data_publish = None  # Thời điểm gửi dữ liệu trạm gần nhất (monotonic)
+        self.recorder = None  # SnapshotRecorder khi bật ghi lại snapshot
+        self.history = None  # HistoryRing khi bật lịch sử trên thiết bị
+        self.checkpoint = None  # StateCheckpoint, tạo khi initialize() biết port
+        self.checkpointed_restarts = {}
+        self.host_identity = []  # Trường (mac/version) lấy từ máy, được làm mới nền
         self.should_stop = False  # Đánh dấu để dừng client
-        self.should_reconnect = False  # Đánh dấu để kết nối lại
         
-    def initialize(self):
-        """Khởi tạo client"""
+    def initialize(self, port=None, mac=None, version=None):
+        """Khởi tạo client (chế độ gateway truyền sẵn port/mac/version của trạm)"""
         try:
-            # Lấy thông tin cơ bản
-            self.port = get_port_from_file()
+            # Lấy thông tin cơ bản (phần không truyền vào lấy từ cache thông tin trạm)
+            identity = station_identity.get() if not (port and mac and version) else {}
+            self.host_identity = [field for field, value in (('mac', mac), ('version', version)) if not value]
+            self.port = port or identity.get('port')
             if not self.port:
                 logger.error("Không tìm thấy port. Thoát.")
                 return False
                 
-            self.mac = get_mac()
+            self.mac = mac or identity.get('mac')
             if not self.mac:
                 logger.error("Không tìm thấy MAC. Thoát.")
                 return False
                 
-            self.version = get_version_from_js()
+            self.version = version or identity.get('version')
             
             # Thiết lập MQTT client
             self.mqtt_client.port = self.port
             self.mqtt_client.version = self.version
             self.mqtt_client.mac = self.mac
+            self.mqtt_client.connection.add_station(self.mqtt_client)
+
+            # Nạp trạng thái phát hiện từ lần chạy trước
+            self.checkpoint = StateCheckpoint(os.path.join(CHECKPOINT_DIR, f"{self.port}.json"))
+            self.restore_state(self.checkpoint.load(), self.checkpoint.saved)
+            self.poller.subscribe(self.save_checkpoint)
             
             logger.info(f"Sử dụng port: {self.port}")
             logger.info(f"Sử dụng MAC: {self.mac}")
@@ -498,92 +3921,167 @@ class FuelStationClient:
             logger.error(f"Lỗi khởi tạo client: {e}")
             return False
             
-    def connect(self):
-        """Kết nối MQTT"""
-        success = self.mqtt_client.connect()
-        if not success:
-            logger.warning("⚠️ Không thể kết nối MQTT, sẽ thử lại sau")
-            self.should_reconnect = True
-        return success
-        
-    def disconnect(self):
-        """Ngắt kết nối MQTT"""
-        self.mqtt_client.disconnect()
-        
-    def send_data_continuously(self):
-        """Gửi heartbeat liên tục và dữ liệu khi cần thiết"""
-        while not self.should_stop:
-            try:
-                # Kiểm tra kết nối MQTT trước khi gửi
-                if not self.mqtt_client.connected or self.should_reconnect:
-                    logger.warning("⚠️ Mất kết nối MQTT, đang thử kết nối lại...")
-                    
-                    # Thử kết nối lại
-                    if self.mqtt_client.connect():
-                        logger.info("✅ Đã kết nối lại MQTT thành công")
-                        self.should_reconnect = False
-                        self.info_sent = False  # Reset để gửi thông tin đầy đủ lại
-                    else:
-                        logger.warning("⚠️ Chưa thể kết nối lại, chờ 5 giây...")
-                        time.sleep(5)
-                        continue
-                
-                # Gửi heartbeat với thông tin đầy đủ lần đầu, sau đó chỉ gửi heartbeat đơn giản
-                if not self.info_sent:
-                    self.mqtt_client.publish_heartbeat(include_info=True)
-                    self.info_sent = True
-                    logger.info("📋 Đã gửi thông tin đầy đủ lần đầu")
-                else:
-                    self.mqtt_client.publish_heartbeat(include_info=False)
-                    logger.info("💓 Đã gửi heartbeat đơn giản")
-                
-                # Chỉ gửi dữ liệu khi getdata_enabled = True (như client cũ)
-                if self.getdata_enabled:
-                    logger.info("📊 Chế độ gửi dữ liệu đã bật, đang lấy dữ liệu từ localhost...")
-                    data_from_url = get_data_from_url("http://localhost:6969/GetfullupdateArr")
-                    if data_from_url:
-                        # Gửi dữ liệu qua MQTT
-                        logger.info(f"📊 Dữ liệu lấy được: {len(str(data_from_url))} ký tự")
-                        self.mqtt_client.publish_data(data_from_url)
-                        logger.info("📊 Đã gửi dữ liệu tới MQTT broker")
-                    else:
-                        logger.warning("⚠️ Không lấy được dữ liệu từ localhost:6969")
-                else:
-                    logger.info("⏸️ Chế độ gửi dữ liệu tắt, chỉ gửi heartbeat")
-                
-            except Exception as e:
-                logger.error(f"❌ Lỗi trong vòng lặp gửi dữ liệu: {e}")
-                # Đánh dấu cần kết nối lại thay vì dừng client
-                self.should_reconnect = True
-                time.sleep(5)  # Chờ 5 giây trước khi thử lại
-                continue
-            
-            # Sleep cố định cho heartbeat (nằm ngoài try-except)
-            if not self.should_stop:
-                time.sleep(10)  # Gửi heartbeat mỗi 10 giây
+    def checkpoint_state(self):
+        """Trạng thái cần giữ qua lần khởi động lại (xem StateCheckpoint)"""
+        return {
+            'connection_status': self.connection_status,
+            'mabom_history': self.mabom_history,
+            'pump_status': self.pump_status,
+            'cooldowns': dict(self.remediation.last_run),
+            'is_all_disconnect_restart': self.is_all_disconnect_restart[0]
+        }
+
+    def restore_state(self, state, saved=None):
+        """Nạp lại trạng thái từ checkpoint; trạng thái từng vòi chỉ nạp khi checkpoint còn mới"""
+        if not state:
+            return
+        try:
+            cooldowns = state.get('cooldowns')
+            if cooldowns is None:
+                # Checkpoint trước khi có RemediationEngine
+                cooldowns = {'restart_all': state.get('last_restart_all'),
+                             'restart_nonsequential': state.get('last_non_sequential_restart')}
+            self.remediation.restore(cooldowns)
+            self.checkpointed_restarts = dict(self.remediation.last_run)
+            age = (datetime.now() - saved).total_seconds() if saved else None
+            if age is None or age > CHECKPOINT_MAX_AGE:
+                logger.info(f"💾 Checkpoint port {self.port} đã cũ, chỉ nạp lại mốc restartall")
+                return
+            self.connection_status = state.get('connection_status', {})
+            self.mabom_history = state.get('mabom_history', {})
+            self.pump_status = state.get('pump_status', {})
+            self.is_all_disconnect_restart[0] = bool(state.get('is_all_disconnect_restart'))
+            logger.info(f"💾 Nạp checkpoint port {self.port}: {len(self.mabom_history)} vòi, lưu {age:.0f} giây trước")
+        except Exception as e:
+            logger.error(f"❌ Lỗi nạp checkpoint port {self.port}: {e}")
+            self.connection_status = {}
+            self.mabom_history = {}
+            self.pump_status = {}
+
+    def save_checkpoint(self, data):
+        """Subscriber của poller: cập nhật checkpoint sau check_mabom (ghi ngay khi vừa restartall)"""
+        restarts = dict(self.remediation.last_run)
+        self.checkpoint.update(self.checkpoint_state(), force=restarts != self.checkpointed_restarts)
+        self.checkpointed_restarts = restarts
+
+    def enable_recording(self, directory=None):
+        """Ghi lại mọi snapshot của trạm (mặc định vào RECORDING_DIR/<port>) để replay offline"""
+        directory = directory or os.path.join(RECORDING_DIR, str(self.port))
+        self.recorder = SnapshotRecorder(directory)
+        self.poller.subscribe(self.record_snapshot)
+        logger.info(f"📼 Ghi lại snapshot vào {directory}")
+
+    def record_snapshot(self, data):
+        """Subscriber của poller: ghi snapshot cùng thời điểm poll"""
+        self.recorder.record(data, self.poller.latest_time)
+
+    def enable_history(self, max_bytes=HISTORY_MAX_BYTES, directory=HISTORY_DIR):
+        """Ghi mẫu từng vòi mỗi lần poll vào HISTORY_DIR/<port>.ring để trả lời lệnh history"""
+        if not max_bytes:
+            return
+        path = os.path.join(directory, f"{self.port}.ring")
+        try:
+            self.history = HistoryRing(path, max_bytes=max_bytes)
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Không mở được file lịch sử {path}: {e}")
+            return
+        self.mqtt_client.history = self.history
+        self.poller.subscribe(self.record_history)
+        metrics.register('fuel_history_samples', lambda: len(self.history), port=str(self.port))
+        logger.info(f"🕘 Lịch sử trên thiết bị: {path} ({self.history.capacity} mẫu, đang có {len(self.history)})")
+
+    def record_history(self, data):
+        """Subscriber của poller: ghi mẫu từng vòi cùng thời điểm poll"""
+        self.history.append(data, self.poller.latest_time)
+
+    def start(self, scheduler, delay=0):
+        """Đăng ký các tác vụ của trạm (heartbeat định kỳ, vòng poll snapshot) vào scheduler"""
+        heartbeat_interval = SLOW_HEARTBEAT_INTERVAL if LIVENESS_MODE == 'will' else HEARTBEAT_INTERVAL
+        scheduler.every(heartbeat_interval, self.send_heartbeat, f'heartbeat-{self.port}', delay=delay)
+        scheduler.spawn(self.poller.run(delay=delay), f'snapshot-poll-{self.port}')
+        scheduler.spawn(self.remediation.run(), f'remediation-{self.port}')
+        if self.host_identity:
+            scheduler.every(IDENTITY_REFRESH_INTERVAL, self.refresh_identity, f'identity-{self.port}',
+                            delay=IDENTITY_REFRESH_INTERVAL)
+        # Lệnh từ server thường đi kèm thao tác trên trạm: poll nhanh lại ngay
+        self.mqtt_client.on_command = self.poller.wake
+        metrics.register('fuel_snapshot_poll_interval_seconds', lambda: self.poller.pacer.current,
+                         port=str(self.port))
+        if isinstance(self.poller, PushSnapshotFeed):
+            metrics.register('fuel_snapshot_feed_connected', lambda: int(self.poller.connected), port=str(self.port))
+        metrics.register('fuel_remediation_pending', lambda: self.remediation.pending, port=str(self.port))
+
+    async def run(self):
+        """Chạy client một trạm trên asyncio cho tới khi nhận SIGINT/SIGTERM"""
+        await FuelStationGateway([self], self.mqtt_client).run()
         
-        logger.info("🛑 Client đã dừng")
-            
-    def check_mabom_continuously(self):
-        """Kiểm tra mã bơm liên tục (luôn lấy dữ liệu từ localhost như client cũ)"""
-        while not self.should_stop:
-            try:
-                # Luôn lấy dữ liệu từ localhost để kiểm tra mã bơm (như client cũ)
-                data_from_url = get_data_from_url("http://localhost:6969/GetfullupdateArr")
-                if data_from_url:
-                    self.check_mabom(data_from_url)
-                else:
-                    logger.warning("Không lấy được dữ liệu để kiểm tra mã bơm")
-                    
-            except Exception as e:
-                logger.error(f"Lỗi trong vòng lặp kiểm tra mã bơm: {e}")
-                
-            time.sleep(2)
+    async def refresh_identity(self):
+        """Đọc lại MAC/version từ máy (trong executor); báo lại server ở heartbeat tới nếu đổi"""
+        identity = await asyncio.get_running_loop().run_in_executor(None, station_identity.get)
+        changed = [field for field in self.host_identity if identity.get(field) and identity[field] != getattr(self, field)]
+        for field in changed:
+            logger.info(f"🔄 {field} của port {self.port} đổi: {getattr(self, field)} -> {identity[field]}")
+            setattr(self, field, identity[field])
+            setattr(self.mqtt_client, field, identity[field])
+        if changed:
+            self.mqtt_client.info_pending = True
+
+    async def send_heartbeat(self):
+        """Gửi heartbeat của trạm"""
+        self.mqtt_client.send_heartbeat()
             
-    def check_mabom(self, data):
-        """Kiểm tra mã bơm (giữ nguyên logic cũ)"""
-        current_time = datetime.now()
+    def publish_snapshot(self, data):
+        """Subscriber của poller: gửi dữ liệu trạm khi getdata bật (tối đa mỗi DATA_PUBLISH_INTERVAL giây)"""
+        # Chỉ gửi dữ liệu khi getdata_enabled = True (như client cũ). Đang mất kết nối thì
+        # vẫn gửi: station_data là topic bền, _send ghi vào hàng đợi offline và gửi lại sau
+        if not self.mqtt_client.getdata_enabled:
+            return
+
+        now = time.monotonic()
+        if self.last_data_publish is not None and now - self.last_data_publish < DATA_PUBLISH_INTERVAL:
+            return
+
+        self.mqtt_client.publish_data(data)
+        self.last_data_publish = now
+        mqtt_logger.debug("📊 Đã gửi dữ liệu (%d vòi) tới MQTT broker", len(data))
+
+    @property
+    def restart_command(self):
+        """Lệnh khởi động lại bộ điều khiển của trạm (gateway có thể đặt riêng từng trạm)"""
+        return self.remediation.restart_command
+
+    @restart_command.setter
+    def restart_command(self, command):
+        self.remediation.restart_command = list(command)
+
+    def restart_controller(self, settle_time=0, reason=None, pump_id='all'):
+        """Xếp lệnh khởi động lại bộ điều khiển vào hàng đợi xử lý sự cố (không chặn)
+
+        Hành động xếp sau chỉ chạy khi bộ điều khiển đã có settle_time giây để lên lại.
+        """
+        self.remediation.restart(settle_time, reason=reason, pump_id=pump_id)
+
+    def call_daylaidulieu(self, pump_id, reason=None):
+        """Xếp lệnh gọi API daylaidulieu vào hàng đợi xử lý sự cố (gộp nếu vòi đã có yêu cầu chờ)"""
+        self.remediation.daylaidulieu(pump_id, reason=reason)
+
+    def report_remediation(self, event):
+        """Gửi kết quả một hành động xử lý sự cố lên server (topic sự kiện của trạm)"""
+        self.mqtt_client.publish_events([event])
+
+    def check_mabom(self, data, now=None, since=None):
+        """Kiểm tra mã bơm (giữ nguyên logic cũ); now cho phép truyền thời điểm snapshot
+
+        since: snapshot trước còn đúng tới thời điểm này (mặc định lấy của poller khi
+        không truyền now); vòi vừa thấy mất kết nối được tính là mất từ since để
+        cảnh báo DISCONNECT_ALERT_SECONDS không bị trễ thêm một chu kỳ poll.
+        """
+        started = time.perf_counter()
+        current_time = now or datetime.now()
+        if now is None and since is None:
+            since = self.poller.previous_time
         all_disconnected = True
+        self.pending_events = []
 
         try:
             for item in data:
@@ -602,6 +4100,11 @@ class FuelStationClient:
                 if not is_disconnected:
                     all_disconnected = False
 
+                previous_status = self.pump_status.get(pump_id)
+                if previous_status is not None and previous_status != statusnow:
+                    self.add_event('status_changed', pump_id, current_time, old=previous_status, new=statusnow)
+                self.pump_status[pump_id] = statusnow
+
                 if pump_id not in self.connection_status:
                     self.connection_status[pump_id] = {
                         'is_disconnected': is_disconnected,
@@ -611,23 +4114,30 @@ class FuelStationClient:
                         'mismatch_count': 0,
                         'restart_done': False
                     }
+                    # Vòi mất kết nối ngay lần đầu thấy cũng là một lần chuyển trạng thái
+                    if is_disconnected:
+                        self.add_event('disconnected', pump_id, current_time, mabom=mabomtiep)
                 else:
                     if is_disconnected:
                         if not self.connection_status[pump_id]['is_disconnected']:
                             self.connection_status[pump_id]['is_disconnected'] = True
-                            self.connection_status[pump_id]['disconnect_time'] = current_time
+                            self.connection_status[pump_id]['disconnect_time'] = since or current_time
                             self.connection_status[pump_id]['alert_sent'] = False
                             self.connection_status[pump_id]['restart_done'] = False
+                            self.add_event('disconnected', pump_id, current_time, mabom=mabomtiep)
                         else:
-                            if current_time - self.connection_status[pump_id]['disconnect_time'] > timedelta(seconds=65):
+                            if current_time - self.connection_status[pump_id]['disconnect_time'] > timedelta(seconds=DISCONNECT_ALERT_SECONDS):
                                 if not self.connection_status[pump_id]['alert_sent']:
-                                    logger.warning(f"Pump ID {pump_id} mất kết nối quá 65 giây.")
+                                    logger.warning(f"Pump ID {pump_id} mất kết nối quá {DISCONNECT_ALERT_SECONDS} giây.")
                                     self.mqtt_client.publish_warning("disconnection", pump_id, mabomtiep)
                                     self.connection_status[pump_id]['alert_sent'] = True
                     else:
                         if self.connection_status[pump_id]['is_disconnected']:
-                            if current_time - self.connection_status[pump_id]['disconnect_time'] <= timedelta(seconds=65):
-                                logger.info(f"Pump ID {pump_id} đã kết nối lại trong vòng 65 giây.")
+                            downtime = current_time - self.connection_status[pump_id]['disconnect_time']
+                            if downtime <= timedelta(seconds=DISCONNECT_ALERT_SECONDS):
+                                logger.info(f"Pump ID {pump_id} đã kết nối lại trong vòng {DISCONNECT_ALERT_SECONDS} giây.")
+                            self.add_event('reconnected', pump_id, current_time, mabom=mabomtiep,
+                                           downtime=round(downtime.total_seconds(), 1))
                             self.connection_status[pump_id] = {
                                 'is_disconnected': False,
                                 'disconnect_time': None,
@@ -643,6 +4153,10 @@ class FuelStationClient:
                 if self.mabom_history[pump_id] and isinstance(self.mabom_history[pump_id][-1], tuple) and self.mabom_history[pump_id][-1][0] == mabomtiep:
                     continue
                 else:
+                    last_entries = [entry for entry in self.mabom_history[pump_id] if isinstance(entry, tuple)]
+                    if last_entries and last_entries[-1][0] != mabomtiep:
+                        self.add_event('transaction_completed', pump_id, current_time,
+                                       mabom=mabomtiep, previous=last_entries[-1][0], status=statusnow)
                     self.mabom_history[pump_id].append((mabomtiep, current_time.strftime('%Y-%m-%d %H:%M:%S')))
                     if len(self.mabom_history[pump_id]) > 10:
                         self.mabom_history[pump_id].pop(0)
@@ -652,19 +4166,19 @@ class FuelStationClient:
                 if statusnow == 'sẵn sàng':
                     if mabom_moinhat and mabom_moinhat != pump:
                         self.connection_status[pump_id]['mismatch_count'] += 1
+                        self.add_event('mismatch', pump_id, current_time, mabom=pump, latest=mabom_moinhat,
+                                       count=self.connection_status[pump_id]['mismatch_count'])
                         logger.warning(f"Mã bơm không khớp lần {self.connection_status[pump_id]['mismatch_count']} cho pump ID {pump_id}: {mabom_moinhat} != {pump}")
 
-                        if self.connection_status[pump_id]['mismatch_count'] == 3:
-                            if self.last_non_sequential_restart is None or (current_time - self.last_non_sequential_restart) > timedelta(minutes=10):
-                                logger.warning(f"Pump ID {pump_id} có mã bơm không khớp 3 lần. Thực hiện restartall.")
-                                subprocess.run(['forever', 'restartall'])
-                                self.last_non_sequential_restart = current_time
-                                time.sleep(3)
-                                call_daylaidulieu_api(pump_id)
+                        if self.connection_status[pump_id]['mismatch_count'] == MISMATCH_RESTART_COUNT:
+                            if self.remediation.acquire('restart_nonsequential', current_time):
+                                logger.warning(f"Pump ID {pump_id} có mã bơm không khớp {MISMATCH_RESTART_COUNT} lần. Thực hiện restartall.")
+                                self.restart_controller(settle_time=3, reason='mismatch', pump_id=pump_id)
+                                self.call_daylaidulieu(pump_id, reason='mismatch')
                                 self.mqtt_client.publish_warning("nonsequential", pump_id, mabomtiep)
                                 self.connection_status[pump_id]['mismatch_count'] = 0
                             else:
-                                logger.info("Phát hiện mã bơm không liên tiếp, nhưng đã restartall gần đây. Đợi 10 phút.")
+                                logger.info(f"Phát hiện mã bơm không liên tiếp, nhưng đã restartall gần đây. Đợi {RESTART_COOLDOWN_MINUTES} phút.")
                     else:
                         self.connection_status[pump_id]['mismatch_count'] = 0
 
@@ -675,7 +4189,7 @@ class FuelStationClient:
                                 if self.connection_status[pump_id]['last_alerted_mabom'] != mabomtiep:
                                     logger.warning(f"Lỗi mã bơm không liên tiếp: Vòi bơm {pump_id} của port {self.port}.")
                                     self.mqtt_client.publish_warning("nonsequential", pump_id, mabomtiep)
-                                    call_daylaidulieu_api(pump_id)
+                                    self.call_daylaidulieu(pump_id, reason='nonsequential')
                                     self.mabom_history[pump_id].append({
                                         'type': 'nonsequential',
                                         'time': current_time.strftime('%Y-%m-%d %H:%M:%S')
@@ -685,16 +4199,15 @@ class FuelStationClient:
                                 self.mabom_history[pump_id] = [entry for entry in self.mabom_history[pump_id] if not (isinstance(entry, dict) and entry.get('type') == 'nonsequential')]
 
             if all_disconnected and not any(conn['restart_done'] for conn in self.connection_status.values()) and not self.is_all_disconnect_restart[0]:
-                if self.last_restart_all is None or (current_time - self.last_restart_all) > timedelta(minutes=10):
+                if self.remediation.acquire('restart_all', current_time):
                     logger.warning("Tất cả các vòi đều mất kết nối. Thực hiện restartall.")
-                    subprocess.run(['forever', 'restartall'])
-                    self.last_restart_all = current_time
+                    self.restart_controller(reason='all_disconnection')
                     for conn in self.connection_status.values():
                         conn['restart_done'] = True
                     self.mqtt_client.publish_warning("all_disconnection", "all", "Tất cả các vòi đều mất kết nối.")
                     self.is_all_disconnect_restart[0] = True
                 else:
-                    logger.info("Tất cả các vòi mất kết nối, nhưng đã restartall gần đây. Đợi 10 phút.")
+                    logger.info(f"Tất cả các vòi mất kết nối, nhưng đã restartall gần đây. Đợi {RESTART_COOLDOWN_MINUTES} phút.")
             
             if not all_disconnected:
                 self.is_all_disconnect_restart[0] = False
@@ -702,65 +4215,501 @@ class FuelStationClient:
         except Exception as e:
             logger.error(f"Lỗi trong check_mabom: {e}")
 
+        self.flush_events()
+        metrics.observe('fuel_check_mabom_seconds', time.perf_counter() - started, port=str(self.port))
+
+    def add_event(self, event_type, pump_id, event_time, **fields):
+        """Ghi nhận một sự kiện vòi bơm trong snapshot hiện tại"""
+        event = {'type': event_type, 'pump_id': pump_id, 'time': event_time.isoformat()}
+        event.update(fields)
+        self.pending_events.append(event)
+
+    def flush_events(self):
+        """Gửi các sự kiện của snapshot (một message cho cả snapshot)"""
+        if self.pending_events:
+            self.mqtt_client.publish_events(self.pending_events)
+        self.pending_events = []
+
+# ==================== KIỂM TRA MÃ BƠM DẠNG CỘT ====================
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_FAST_INT_LIMIT = 1 << 62  # Số nguyên trong khoảng này so sánh bằng int64, ngoài khoảng thì so sánh kiểu Python
+
+def _is_fast_int(value):
+    return type(value) is int and -_FAST_INT_LIMIT < value < _FAST_INT_LIMIT
+
+def _int_column(values, none_as_zero=False):
+    """Trả về (mảng int64, mặt nạ các giá trị là số nguyên nhỏ); giá trị khác được ghi 0
+
+    none_as_zero: None cũng tính là số nguyên nhỏ 0 (đều falsy với logic cũ)
+    """
+    count = len(values)
+    types = set(map(type, values))
+    try:
+        if types <= {int}:
+            fast = np.ones(count, dtype=np.bool_)
+            column = np.array(values, dtype=np.int64)
+        else:
+            # Lọc theo kiểu bằng map (chạy trong C), chỉ các số nguyên được đổi sang int64
+            fast = np.fromiter(map(operator.is_, map(type, values), repeat(int)), dtype=np.bool_, count=count)
+            column = np.zeros(count, dtype=np.int64)
+            column[fast] = np.fromiter(values, dtype=object, count=count)[fast].astype(np.int64)
+        fast &= (column > -_FAST_INT_LIMIT) & (column < _FAST_INT_LIMIT)
+    except OverflowError:
+        # Có số vượt int64: xét từng giá trị
+        fast = np.fromiter(map(_is_fast_int, values), dtype=np.bool_, count=count)
+        column = np.fromiter((value if is_fast else 0 for value, is_fast in zip(values, fast)),
+                             dtype=np.int64, count=count)
+    if none_as_zero and type(None) in types:
+        fast |= np.fromiter(map(operator.is_, values, repeat(None)), dtype=np.bool_, count=count)
+    return column, fast
+
+def _first_not_instance(values, kind):
+    """Vị trí phần tử đầu tiên không phải kind, hoặc None"""
+    if set(map(type, values)) <= {kind}:
+        return None
+    return next((i for i, value in enumerate(values) if not isinstance(value, kind)), None)
+
+class ColumnarMabomChecker:
+    """Bản dạng cột của FuelStationClient.check_mabom cho số vòi lớn (gateway, replay phía server)
+
+    Trạng thái từng vòi nằm trong các mảng numpy theo chỉ số vòi (mất kết nối,
+    thời điểm mất kết nối, số lần lệch mã, mã bơm cuối, mã đã cảnh báo...);
+    mỗi snapshot được đánh giá bằng phép so sánh theo lô. check() không có tác
+    dụng phụ mà trả về các hành động theo đúng thứ tự logic cũ thực hiện:
+
+        ('warning', loại, pump_id, mabom)
+        ('restart', settle_time)
+        ('daylaidulieu', pump_id)
+
+    Giá trị không phải số nguyên nhỏ (chuỗi, bool, số rất lớn) đi theo nhánh
+    so sánh Python từng vòi để giữ đúng ngữ nghĩa của ==/!= và isinstance(int).
+    """
+
+    KIND_NONE, KIND_TUPLE, KIND_MARKER = 0, 1, 2  # Phần tử cuối của mabom_history
+    READY_STATUS = 'sẵn sàng'
+    NO_LATEST = {}  # Giá trị mặc định của MaBomMoiNhat (chỉ đọc)
+
+    def __init__(self, capacity=1024):
+        if _load_numpy() is None:
+            raise RuntimeError("ColumnarMabomChecker cần numpy")
+        # Ngưỡng lấy theo cấu hình lúc tạo (replay có thể thay đổi trước đó)
+        self.disconnect_alert_us = DISCONNECT_ALERT_SECONDS * 1000000
+        self.mismatch_restart_count = MISMATCH_RESTART_COUNT
+        self.restart_cooldown = timedelta(minutes=RESTART_COOLDOWN_MINUTES)
+        self.index = {}  # pump_id -> hàng
+        self.pump_ids = []
+        self.size = 0
+        self.capacity = 0
+        self.columns = {
+            'is_disconnected': np.bool_,
+            'disconnect_us': np.int64,
+            'alert_sent': np.bool_,
+            'mismatch_count': np.int64,
+            'restart_done': np.bool_,
+            'last_kind': np.int8,
+            'last_fast': np.bool_,
+            'last_int': np.int64,
+            'last_value': object,
+            'alerted_fast': np.bool_,
+            'alerted_int': np.int64,
+            'last_alerted': object,
+        }
+        for name, dtype in self.columns.items():
+            setattr(self, name, np.zeros(0, dtype=dtype))
+        self._grow(max(capacity, 1))
+        self._cached_ids = None
+        self._cached_rows = None
+        self.last_restart_all = None
+        self.last_non_sequential_restart = None
+        self.is_all_disconnect_restart = False
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, capacity):
+        for name in self.columns:
+            old = getattr(self, name)
+            column = np.zeros(capacity, dtype=old.dtype)
+            if column.dtype == object:
+                column[:] = None
+            column[:len(old)] = old
+            setattr(self, name, column)
+        self.capacity = capacity
+
+    def _row(self, pump_id):
+        row = self.index.get(pump_id)
+        if row is None:
+            if self.size == self.capacity:
+                self._grow(self.capacity * 2)
+            row = self.index[pump_id] = self.size
+            self.pump_ids.append(pump_id)
+            self.size += 1
+        return row
+
+    def check(self, data, now, since=None):
+        """Đánh giá một snapshot GetfullupdateArr tại thời điểm now, trả về danh sách hành động
+
+        since: như check_mabom, vòi đã biết vừa mất kết nối được tính là mất từ since
+        """
+        try:
+            items = list(data)
+        except TypeError:
+            return []
+
+        # Logic cũ dừng ở phần tử hỏng đầu tiên (ngoại lệ) và bỏ qua bước kiểm tra tất cả mất kết nối
+        aborted = False
+        broken = _first_not_instance(items, dict)
+        if broken is not None:
+            items, aborted = items[:broken], True
+        # Lấy cột bằng map(dict.get, ...) để vòng lặp chạy trong C (phần tử đều là dict)
+        latest = list(map(dict.get, items, repeat('MaBomMoiNhat'), repeat(self.NO_LATEST)))
+        broken = _first_not_instance(latest, dict)
+        if broken is not None:
+            items, latest, aborted = items[:broken], latest[:broken], True
+
+        ids = list(map(dict.get, items, repeat('id')))
+        values = list(map(dict.get, items, repeat('pump')))
+        latest = list(map(dict.get, latest, repeat('pump')))
+        ready = list(map(operator.eq, map(dict.get, items, repeat('status')), repeat(self.READY_STATUS)))
+        disconnected = list(map(bool, map(dict.get, items, repeat('isDisconnected'), repeat(False))))
+        positions = range(len(items))
+        if None in ids or None in values:
+            positions = [i for i in positions if ids[i] is not None and values[i] is not None]
+            ids, values, latest, ready, disconnected = (
+                [column[i] for i in positions] for column in (ids, values, latest, ready, disconnected))
+        ids = list(map(str, ids))
+
+        now_us = (now - _EPOCH) // _MICROSECOND
+        since_us = (since - _EPOCH) // _MICROSECOND if since else now_us
+        actions = []
+        # Một vòi xuất hiện nhiều lần trong snapshot: tách thành các đoạn xử lý tuần tự
+        if len(set(ids)) == len(ids):
+            segments = [range(len(ids))]
+        else:
+            segments, seen = [[]], set()
+            for i, pump_id in enumerate(ids):
+                if pump_id in seen:
+                    segments.append([])
+                    seen = set()
+                segments[-1].append(i)
+                seen.add(pump_id)
+        for segment in segments:
+            if len(segments) > 1:
+                columns = ([column[i] for i in segment] for column in (positions, ids, values, latest, ready, disconnected))
+            else:
+                columns = (positions, ids, values, latest, ready, disconnected)
+            self._check_segment(*columns, now, now_us, since_us, actions)
+        actions.sort(key=lambda action: action[:2])
+        actions = [action[2] for action in actions]
+
+        if aborted:
+            return actions
+
+        all_disconnected = all(disconnected)
+        if all_disconnected and not self.restart_done[:self.size].any() and not self.is_all_disconnect_restart:
+            if self.last_restart_all is None or now - self.last_restart_all > self.restart_cooldown:
+                actions.append(('restart', 0))
+                self.last_restart_all = now
+                self.restart_done[:self.size] = True
+                actions.append(('warning', 'all_disconnection', 'all', "Tất cả các vòi đều mất kết nối."))
+                self.is_all_disconnect_restart = True
+        if not all_disconnected:
+            self.is_all_disconnect_restart = False
+        return actions
+
+    def _rows(self, pump_ids):
+        # Snapshot của một trạm thường giữ nguyên danh sách vòi giữa các lần poll
+        if pump_ids != self._cached_ids:
+            self._cached_rows = np.fromiter(map(self._row, pump_ids), dtype=np.int64, count=len(pump_ids))
+            self._cached_ids = list(pump_ids)
+        return self._cached_rows
+
+    def _check_segment(self, positions, pump_ids, values, latest, ready, disconnected, now, now_us, since_us,
+                       actions):
+        """Xử lý một đoạn snapshot trong đó mỗi vòi xuất hiện tối đa một lần"""
+        count = len(pump_ids)
+        known = self.size
+        rows = self._rows(pump_ids)
+        value_int, value_fast = _int_column(values)
+        values = np.fromiter(values, dtype=object, count=count)
+        # None coi như 0 (đều falsy) để MaBomMoiNhat so sánh được bằng int64
+        latest_int, latest_fast = _int_column(latest, none_as_zero=True)
+        ready = np.fromiter(ready, dtype=np.bool_, count=count)
+        disconnected = np.fromiter(disconnected, dtype=np.bool_, count=count)
+
+        # Mất kết nối / kết nối lại (vòi mới mặc định đang kết nối, xử lý giống chuyển trạng thái)
+        was_disconnected = self.is_disconnected[rows]
+        went_down = disconnected & ~was_disconnected
+        came_up = ~disconnected & was_disconnected
+        alert = (disconnected & was_disconnected & ~self.alert_sent[rows]
+                 & (now_us - self.disconnect_us[rows] > self.disconnect_alert_us))
+        for i in np.flatnonzero(alert):
+            actions.append((positions[i], 0, ('warning', 'disconnection', pump_ids[i], values[i])))
+        self.is_disconnected[rows[went_down]] = True
+        # Vòi mới thấy lần đầu đã mất kết nối: không biết từ lúc nào, tính từ now
+        self.disconnect_us[rows[went_down]] = np.where(rows[went_down] < known, since_us, now_us)
+        self.alert_sent[rows[went_down]] = False
+        self.restart_done[rows[went_down]] = False
+        self.alert_sent[rows[alert]] = True
+        self.is_disconnected[rows[came_up]] = False
+        self.alert_sent[rows[came_up]] = False
+
+        # Lịch sử mã bơm: bỏ qua vòi có mã trùng với bản ghi cuối
+        kind = self.last_kind[rows]
+        previous_fast = self.last_fast[rows]
+        previous_int = self.last_int[rows]
+        previous = self.last_value[rows]
+        both_fast = value_fast & previous_fast
+        same = both_fast & (value_int == previous_int)
+        for i in np.flatnonzero((kind == self.KIND_TUPLE) & ~both_fast):
+            same[i] = bool(previous[i] == values[i])
+        same &= kind == self.KIND_TUPLE
+        active = ~same
+        had_previous = kind != self.KIND_NONE
+        changed = rows[active]
+        self.last_kind[changed] = self.KIND_TUPLE
+        self.last_fast[changed] = value_fast[active]
+        self.last_int[changed] = value_int[active]
+        self.last_value[changed] = values[active]
+
+        checking = active & ready
+        if not checking.any():
+            return
+
+        # MaBomMoiNhat lệch với mã bơm hiện tại
+        comparable = value_fast & latest_fast
+        mismatch = comparable & (latest_int != 0) & (latest_int != value_int)
+        for i in np.flatnonzero(checking & ~comparable):
+            mismatch[i] = bool(latest[i]) and bool(latest[i] != values[i])
+        mismatch_count = self.mismatch_count[rows]
+        mismatch_count[checking & mismatch] += 1
+        mismatch_count[checking & ~mismatch] = 0
+        for i in np.flatnonzero(checking & mismatch & (mismatch_count == self.mismatch_restart_count)):
+            if self.last_non_sequential_restart is None or now - self.last_non_sequential_restart > self.restart_cooldown:
+                actions.append((positions[i], 1, ('restart', 3)))
+                actions.append((positions[i], 1, ('daylaidulieu', pump_ids[i])))
+                actions.append((positions[i], 1, ('warning', 'nonsequential', pump_ids[i], values[i])))
+                self.last_non_sequential_restart = now
+                mismatch_count[i] = 0
+        self.mismatch_count[rows] = mismatch_count
+
+        # Mã bơm không liên tiếp so với bản ghi trước
+        sequence = checking & had_previous
+        alerted = self.last_alerted[rows]
+        alerted_fast = self.alerted_fast[rows]
+        never_alerted = np.fromiter(map(operator.is_, alerted, repeat(None)), dtype=np.bool_, count=count)
+        fast = value_fast & previous_fast & (alerted_fast | never_alerted)
+        already = alerted_fast & (self.alerted_int[rows] == value_int)
+        gap = fast & (value_int != previous_int + 1) & ~already
+        for i in np.flatnonzero(sequence & ~fast):
+            value, before = values[i], previous[i]
+            gap[i] = (isinstance(value, int) and isinstance(before, int)
+                      and value != before + 1 and bool(alerted[i] != value))
+        gap &= sequence
+        for i in np.flatnonzero(gap):
+            actions.append((positions[i], 2, ('warning', 'nonsequential', pump_ids[i], values[i])))
+            actions.append((positions[i], 2, ('daylaidulieu', pump_ids[i])))
+        alert_rows = rows[gap]
+        self.last_kind[alert_rows] = self.KIND_MARKER
+        self.last_alerted[alert_rows] = values[gap]
+        self.alerted_fast[alert_rows] = value_fast[gap]
+        self.alerted_int[alert_rows] = value_int[gap]
+
+    def apply(self, client, data, now=None):
+        """Thực hiện các hành động của một snapshot qua FuelStationClient (cảnh báo, restart, daylaidulieu)"""
+        since = client.poller.previous_time if now is None else None
+        for action in self.check(data, now or datetime.now(), since):
+            if action[0] == 'warning':
+                client.mqtt_client.publish_warning(*action[1:])
+            elif action[0] == 'restart':
+                client.restart_controller(settle_time=action[1])
+            else:
+                client.call_daylaidulieu(action[1])
+
+# ==================== GATEWAY (NHIỀU TRẠM) ====================
+GATEWAY_CONFIG_FILE = get_app_dir("stations.json")
+
+def load_station_definitions(path=GATEWAY_CONFIG_FILE):
+    """Đọc danh sách trạm cho chế độ gateway
+
+    File JSON là một mảng, mỗi phần tử: {"port": "12345",
+    "controller_url": "http://localhost:6969", "mac": "...", "version": "...",
+    "restart_command": ["forever", "restartall"], "record": false,
+    "feed": "/events", "history_bytes": 8388608}; chỉ "port" là bắt buộc.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        definitions = json.load(file)
+    if not isinstance(definitions, list):
+        raise ValueError("File cấu hình gateway phải là một mảng JSON")
+    for definition in definitions:
+        if not definition.get('port'):
+            raise ValueError(f"Thiếu port trong định nghĩa trạm: {definition}")
+    return definitions
+
+class FuelStationGateway:
+    """Chạy một hoặc nhiều trạm trên cùng một kết nối MQTT và một event loop
+
+    Mỗi trạm giữ trạng thái mã bơm riêng (FuelStationClient), còn kết nối
+    broker, hàng đợi offline, scheduler và kết nối HTTP tới cùng một bộ điều
+    khiển được dùng chung.
+    """
+
+    def __init__(self, stations, connection, metrics_port=None):
+        self.stations = stations
+        self.connection = connection
+        self.metrics_port = metrics_port  # None: dùng METRICS_PORT
+        self.metrics_server = None
+        self.scheduler = None
+        self.stop_event = None
+
+    @classmethod
+    def from_definitions(cls, definitions, record=False, broker=None, feed=SNAPSHOT_FEED):
+        """Tạo gateway từ danh sách định nghĩa trạm (xem load_station_definitions)
+
+        record: bật ghi lại snapshot cho mọi trạm (mỗi trạm có thể ghi đè bằng "record")
+        broker: cấu hình kết nối broker dùng chung (xem load_broker_config)
+        feed: nguồn đẩy snapshot mặc định (mỗi trạm có thể ghi đè bằng "feed", xem SNAPSHOT_FEED)
+        Mỗi trạm có thể đổi dung lượng lịch sử trên thiết bị bằng "history_bytes" (0: tắt)
+        """
+        connection = MQTTFuelStationClient(broker=broker)
+        http_clients = {}
+        stations = []
+        for definition in definitions:
+            controller_url = definition.get('controller_url', CONTROLLER_BASE_URL).rstrip('/')
+            if controller_url not in http_clients:
+                http_clients[controller_url] = AsyncHTTPClient(controller_url)
+            station = FuelStationClient(
+                mqtt_client=MQTTFuelStationClient(connection=connection),
+                controller_url=controller_url,
+                http=http_clients[controller_url],
+                feed=definition.get('feed', feed)
+            )
+            if 'restart_command' in definition:
+                station.restart_command = list(definition['restart_command'])
+            record = definition.get('record', record)
+
+            # mac/version không khai báo thì lấy của máy (cache thông tin trạm)
+            if station.initialize(port=str(definition['port']), mac=definition.get('mac'),
+                                  version=definition.get('version')):
+                if record:
+                    station.enable_recording()
+                station.enable_history(definition.get('history_bytes', HISTORY_MAX_BYTES))
+                stations.append(station)
+        logger.info(f"🏭 Gateway quản lý {len(stations)} trạm trên một kết nối MQTT")
+        return cls(stations, connection)
+
+    async def run(self):
+        """Chạy các trạm cho tới khi nhận SIGINT/SIGTERM hoặc stop()"""
+        loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        self.connection.attach_loop(loop)
+        self.metrics_server = await start_metrics_server(
+            port=METRICS_PORT if self.metrics_port is None else self.metrics_port)
+        self.scheduler = AsyncScheduler()
+        self.scheduler.spawn(self.connection.maintain_connection(), 'mqtt-connection')
+        self.scheduler.every(MQTT_MISC_INTERVAL, self.connection.loop_misc, 'mqtt-misc')
+        # Dọn ổ cứng chạy nền, không nằm trên đường khởi động
+        self.scheduler.every(DISK_CHECK_INTERVAL, self.check_disk, 'disk-check', delay=DISK_CHECK_DELAY)
+        # Rải đều thời điểm poll của các trạm để không dồn tải vào cùng một lúc
+        for index, station in enumerate(self.stations):
+            station.start(self.scheduler, delay=SNAPSHOT_POLL_INTERVAL * index / len(self.stations))
+        logger.info("✅ Client đã khởi động thành công")
+
+        try:
+            await self.stop_event.wait()
+            logger.info("⏹️ Nhận tín hiệu dừng, đang tắt client...")
+        finally:
+            await self.scheduler.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+            # Đóng mỗi kết nối HTTP dùng chung một lần
+            for poller in {id(station.poller.http): station.poller for station in self.stations}.values():
+                await poller.close()
+            for station in self.stations:
+                if station.recorder is not None:
+                    station.recorder.close()
+                if station.checkpoint is not None:
+                    station.checkpoint.flush()
+                if station.history is not None:
+                    station.history.close()
+            self.connection.disconnect()
+            logger.info("🛑 Client đã dừng")
+
+    async def check_disk(self):
+        """Tác vụ định kỳ: kiểm tra ổ cứng trong executor (find / có thể chạy rất lâu)"""
+        await asyncio.get_running_loop().run_in_executor(None, check_disk_and_clear_logs)
+
+    def stop(self):
+        """Yêu cầu dừng (an toàn khi gọi từ thread khác)"""
+        if self.stop_event is not None and self.connection.loop is not None:
+            self.connection.loop.call_soon_threadsafe(self.stop_event.set)
+
 # ==================== MAIN FUNCTION ====================
 def main():
     """Hàm chính khởi động client"""
+    parser = argparse.ArgumentParser(description="MQTT Fuel Station Client")
+    parser.add_argument('--gateway', metavar='FILE',
+                        help=f"Chạy chế độ gateway nhiều trạm (mặc định dùng {GATEWAY_CONFIG_FILE} nếu tồn tại)")
+    parser.add_argument('--record', action='store_true',
+                        help=f"Ghi lại mọi snapshot vào {RECORDING_DIR} để replay offline (xem replay.py)")
+    parser.add_argument('--log-level', metavar='LEVELS',
+                        help="Mức log, ví dụ DEBUG hoặc \"http=DEBUG,paho=INFO\" cho từng phân hệ")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help=f"Cổng endpoint Prometheus trên {METRICS_HOST} (0: tắt)")
+    parser.add_argument('--broker-config', metavar='FILE', default=BROKER_CONFIG_FILE,
+                        help="File JSON cấu hình host/port/transport/TLS của broker")
+    parser.add_argument('--feed', metavar='URL', default=SNAPSHOT_FEED,
+                        help="Nguồn đẩy snapshot: /events (SSE), unix:///đường/dẫn.sock hoặc file:///đường/dẫn.ndjson")
+    parser.add_argument('--train-dictionary', metavar='DIR', nargs='?', const=RECORDING_DIR,
+                        help=f"Huấn luyện từ điển nén từ bản ghi snapshot (mặc định {RECORDING_DIR}), "
+                             f"ghi vào {CODEC_DICTIONARY_FILE} rồi thoát")
+    args = parser.parse_args()
+    if args.log_level:
+        configure_log_levels(args.log_level)
+    if args.train_dictionary:
+        write_codec_dictionary(args.train_dictionary)
+        return
+    
     try:
         logger.info("🚀 Khởi động MQTT Fuel Station Client")
+        broker = load_broker_config(args.broker_config)
         
-        # Kiểm tra dung lượng ổ cứng
-        check_disk_and_clear_logs()
-        
-        # Khởi tạo client
-        client = FuelStationClient()
-        if not client.initialize():
-            logger.error("❌ Không thể khởi tạo client")
-            return
-            
-        # Kết nối MQTT
-        if not client.connect():
-            logger.error("❌ Không thể kết nối MQTT")
-            return
-            
-        # Khởi động các thread
-        data_thread = Thread(target=client.send_data_continuously, daemon=True)
-        mabom_thread = Thread(target=client.check_mabom_continuously, daemon=True)
-        
-        data_thread.start()
-        mabom_thread.start()
-        
-        logger.info("✅ Client đã khởi động thành công")
-        
-        # Giữ chương trình chạy
-        try:
-            while not client.should_stop:
-                time.sleep(1)
-                
-                # Không dừng client khi mất kết nối, để nó tự reconnect
-                # Chỉ log trạng thái kết nối
-                if not client.mqtt_client.connected:
-                    logger.info("⚠️ Mất kết nối MQTT, client sẽ tự động kết nối lại...")
-                    
-        except KeyboardInterrupt:
-            logger.info("⏹️ Nhận tín hiệu dừng, đang tắt client...")
-            client.should_stop = True
+        gateway_file = args.gateway or (GATEWAY_CONFIG_FILE if os.path.exists(GATEWAY_CONFIG_FILE) else None)
+        if gateway_file:
+            logger.info(f"🏭 Chế độ gateway, đọc danh sách trạm từ {gateway_file}")
+            runner = FuelStationGateway.from_definitions(load_station_definitions(gateway_file), record=args.record,
+                                                         broker=broker, feed=args.feed)
+            if not runner.stations:
+                logger.error("❌ Không có trạm hợp lệ trong cấu hình gateway")
+                return
+        else:
+            # Khởi tạo client
+            client = FuelStationClient(mqtt_client=MQTTFuelStationClient(broker=broker), feed=args.feed)
+            if not client.initialize():
+                logger.error("❌ Không thể khởi tạo client")
+                return
+            if args.record:
+                client.enable_recording()
+            client.enable_history()
+            runner = FuelStationGateway([client], client.mqtt_client)
+        runner.metrics_port = args.metrics_port
             
-        # Dừng các thread
-        logger.info("🛑 Đang dừng các thread...")
-        client.should_stop = True
-        
-        # Chờ các thread kết thúc
-        if 'data_thread' in locals() and data_thread.is_alive():
-            data_thread.join(timeout=5)
-        if 'mabom_thread' in locals() and mabom_thread.is_alive():
-            mabom_thread.join(timeout=5)
+        # Chạy client trên asyncio cho tới khi nhận SIGINT/SIGTERM.
+        # Không thoát khi chưa kết nối được MQTT, client tự kết nối lại.
+        asyncio.run(runner.run())
             
+    except KeyboardInterrupt:
+        logger.info("⏹️ Nhận tín hiệu dừng, đang tắt client...")
     except Exception as e:
         logger.error(f"❌ Lỗi khởi động client: {e}")
     finally:
-        # Dọn dẹp
-        if 'client' in locals():
-            client.disconnect()
         logger.info("✅ Client đã được tắt")
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replay snapshot đã ghi lại (clientMQTT.py --record) qua check_mabom
+Chạy trên máy dev/lab với đồng hồ ảo: không restartall, không gửi MQTT, chỉ
+in ra các cảnh báo / restartall / daylaidulieu mà client đã (hoặc sẽ) làm.
+
+    python3 replay.py recordings/12345
+    python3 replay.py recordings/12345 --disconnect-seconds 90 --mismatch-count 5
+    python3 replay.py recordings/12345 --engine columnar --quiet --json
+"""
+
+import argparse
+import json
+import time
+from collections import Counter
+from datetime import datetime
+
+import clientMQTT
+
+# ==================== TRẠM GIẢ LẬP ====================
+class StubMQTT:
+    """Thay MQTTFuelStationClient: ghi lại cảnh báo thay vì gửi lên broker"""
+
+    def __init__(self, actions):
+        self.actions = actions
+        self.controller_url = None
+
+    def publish_warning(self, warning_type, pump_id, mabom):
+        self.actions.append(('warning', warning_type, pump_id, mabom))
+
+    def publish_events(self, events):
+        pass
+
+class ReplayStation(clientMQTT.FuelStationClient):
+    """check_mabom gốc, ghi lại restart/daylaidulieu thay vì chạy thật"""
+
+    def __init__(self):
+        self.actions = []
+        super().__init__(mqtt_client=StubMQTT(self.actions))
+
+    def restart_controller(self, settle_time=0, reason=None, pump_id='all'):
+        self.actions.append(('restart', settle_time))
+
+    def call_daylaidulieu(self, pump_id, reason=None):
+        self.actions.append(('daylaidulieu', pump_id))
+
+    def check(self, data, now, since=None):
+        """Cùng giao diện với ColumnarMabomChecker.check"""
+        del self.actions[:]
+        self.check_mabom(data, now=now, since=since)
+        return list(self.actions)
+
+def make_engine(name):
+    """Tạo engine kiểm tra mã bơm theo tên: check_mabom (gốc) hoặc columnar"""
+    if name == 'columnar':
+        return clientMQTT.ColumnarMabomChecker()
+    return ReplayStation()
+
+# ==================== REPLAY ====================
+def replay(stream, engine, on_action=None):
+    """Chạy chuỗi (thời điểm, snapshot) qua engine; trả về (số snapshot, Counter hành động)"""
+    snapshots = 0
+    counts = Counter()
+    previous = None  # Bản ghi lấy theo lần poll: snapshot trước đúng tới lần poll trước
+    for now, snapshot in stream:
+        snapshots += 1
+        actions = engine.check(snapshot, now, previous)
+        previous = now
+        for action in actions:
+            counts[action[0] if action[0] != 'warning' else f"warning:{action[1]}"] += 1
+            if on_action:
+                on_action(now, action)
+    return snapshots, counts
+
+def parse_time(value):
+    return datetime.fromisoformat(value)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay snapshot đã ghi lại qua check_mabom")
+    parser.add_argument('path', help="Thư mục ghi lại của một trạm (recordings/<port>) hoặc một file .jsonl.gz")
+    parser.add_argument('--engine', choices=['check_mabom', 'columnar'], default='check_mabom')
+    parser.add_argument('--from', dest='start', type=parse_time, help="Chỉ replay từ thời điểm này (ISO)")
+    parser.add_argument('--to', dest='end', type=parse_time, help="Chỉ replay tới thời điểm này (ISO)")
+    parser.add_argument('--disconnect-seconds', type=float, default=clientMQTT.DISCONNECT_ALERT_SECONDS,
+                        help="Ngưỡng cảnh báo mất kết nối (giây)")
+    parser.add_argument('--mismatch-count', type=int, default=clientMQTT.MISMATCH_RESTART_COUNT,
+                        help="Số lần MaBomMoiNhat lệch liên tiếp trước khi restartall")
+    parser.add_argument('--restart-cooldown', type=float, default=clientMQTT.RESTART_COOLDOWN_MINUTES,
+                        help="Khoảng cách tối thiểu giữa hai lần restartall (phút)")
+    parser.add_argument('--quiet', action='store_true', help="Chỉ in tổng kết, không in từng hành động")
+    parser.add_argument('--json', action='store_true', help="In tổng kết dạng JSON")
+    args = parser.parse_args()
+
+    # Không ghi log của từng snapshot vào client_mqtt.log
+    clientMQTT.configure_log_levels('CRITICAL')
+    clientMQTT.DISCONNECT_ALERT_SECONDS = args.disconnect_seconds
+    clientMQTT.MISMATCH_RESTART_COUNT = args.mismatch_count
+    clientMQTT.RESTART_COOLDOWN_MINUTES = args.restart_cooldown
+    engine = make_engine(args.engine)
+
+    stream = clientMQTT.read_recording(args.path)
+    if args.start or args.end:
+        stream = ((now, snapshot) for now, snapshot in stream
+                  if (not args.start or now >= args.start) and (not args.end or now <= args.end))
+
+    def print_action(now, action):
+        print(f"{now.isoformat(sep=' ')}  {' '.join(str(field) for field in action)}")
+
+    started = time.perf_counter()
+    snapshots, counts = replay(stream, engine, None if args.quiet or args.json else print_action)
+    elapsed = time.perf_counter() - started
+
+    if args.json:
+        print(json.dumps({'snapshots': snapshots, 'seconds': round(elapsed, 3), 'actions': dict(counts)},
+                         ensure_ascii=False))
+        return
+    print(f"Replay {snapshots} snapshot trong {elapsed:.2f} s ({snapshots / max(elapsed, 1e-9):.0f} snapshot/s)")
+    for name, count in sorted(counts.items()):
+        print(f"  {name:<32}{count:>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,835 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dịch vụ thu nhận phía server cho Fuel Station Management System
+Subscribe các topic fuel_station/* mà MQTTFuelStationClient gửi lên (cùng TOPICS,
+codec và envelope gom lô), chia tải cho nhiều tiến trình worker bằng shared
+subscription (riêng station_data đi qua một tiến trình giải mã delta theo thứ tự
+của từng trạm), giữ bảng trạng thái online của từng trạm (theo trạng thái retained /
+Last Will của kết nối, hoặc heartbeat với client cũ) và ghi mọi message vào kho
+dạng cột chỉ-ghi-thêm.
+
+    python3 serverMQTT.py run --workers 4
+    python3 serverMQTT.py scan warning --columns port,warning_type,pump_id
+    python3 serverMQTT.py liveness
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import struct
+import time
+import zlib
+from array import array
+from collections import deque
+from datetime import datetime
+from threading import Event
+
+import paho.mqtt.client as mqtt
+
+import clientMQTT
+from clientMQTT import TOPICS, decode_payload, unpack_batch, _topic_key
+
+logger = logging.getLogger('serverMQTT')
+
+# ==================== CẤU HÌNH THU NHẬN ====================
+INGEST_BROKER_HOST = "127.0.0.1"  # Dịch vụ chạy cùng máy với broker
+INGEST_BROKER_PORT = clientMQTT.MQTT_BROKER_PORT
+INGEST_QOS = 1
+INGEST_SHARE_GROUP = 'fuel_ingest'  # Tên nhóm shared subscription ($share/<nhóm>/<topic>)
+# Topic được thu nhận (không gồm station_command do chính server gửi xuống)
+INGEST_TOPICS = ('station_data', 'station_status', 'station_warning', 'station_heartbeat',
+                 'station_event', 'station_response', 'station_connection')
+INGEST_SUBTOPICS = ('station_event', 'station_status', 'station_connection')  # Có hậu tố /<port> hoặc /<client ID>
+# Topic đi qua subscription thường của một tiến trình giải mã riêng thay vì nhóm shared: shared
+# subscription chia message của cùng một trạm cho nhiều worker nên không dựng lại được chuỗi delta
+INGEST_ORDERED_TOPICS = ('station_data',)
+# Topic trạng thái retained: đọc lại khi dịch vụ khởi động (broker không gửi retained cho shared subscription)
+PRESENCE_TOPICS = ('station_status', 'station_connection')
+INGEST_WORKERS = os.cpu_count() or 1  # Số tiến trình worker
+INGEST_BATCH_SIZE = 1000  # Giải mã / ghi theo lô N message ...
+INGEST_BATCH_WINDOW = 0.1  # ... hoặc sau N giây
+INGEST_REPORT_INTERVAL = 10  # Ghi log thông lượng mỗi N giây
+DATA_RESYNC_INTERVAL = 30  # Gửi lệnh resync cho cùng một trạm tối đa một lần mỗi N giây
+
+# ==================== CẤU HÌNH KHO DẠNG CỘT ====================
+STORE_DIR = clientMQTT.get_app_dir("ingest")
+STORE_SEGMENT_BYTES = 64 * 1024 * 1024  # Kích thước tối đa mỗi file segment
+STORE_FSYNC_INTERVAL = 2  # fsync segment sau mỗi N giây
+STORE_MAGIC = b'FCB1'  # Đầu mỗi block trong file segment
+
+# ==================== CẤU HÌNH TRẠNG THÁI TRẠM ====================
+LIVENESS_TIMEOUT = 3 * clientMQTT.HEARTBEAT_INTERVAL  # Client gửi heartbeat: không nhận message nào trong N giây thì coi là offline
+# Client dùng Last Will: offline do broker báo; hạn dự phòng nếu mất cả message Last Will
+LIVENESS_SESSION_TIMEOUT = 3 * clientMQTT.SLOW_HEARTBEAT_INTERVAL
+LIVENESS_SWEEP_INTERVAL = 1  # Chu kỳ kiểm tra trạm quá hạn (giây)
+LIVENESS_FILE = os.path.join(STORE_DIR, "liveness.json")  # Ảnh chụp bảng trạng thái cho công cụ khác đọc
+# Trường trong heartbeat đầy đủ (include_info) được giữ lại trong bảng trạng thái
+LIVENESS_INFO_FIELDS = ('version', 'mac', 'codec', 'codec_dictionary', 'connection')
+
+# Tên bảng trong kho theo khóa TOPICS
+INGEST_TABLES = {key: key.split('_', 1)[1] for key in INGEST_TOPICS}
+HISTORY_TABLE = 'history'  # Chunk trả lời lệnh history (station_response), một dòng mỗi mẫu
+
+# ==================== KHO DẠNG CỘT (CHỈ GHI THÊM) ====================
+# Mỗi bảng là một thư mục, mỗi worker ghi file segment riêng (không cần khóa).
+# Mỗi lô ghi một block: [magic 4B][độ dài header 4B][crc32 4B][header JSON][dữ liệu cột...].
+# Header liệt kê các cột (tên, kiểu, số byte) để chỉ giải mã các cột cần đọc.
+# Kiểu cột: i8 (int64), f8 (float64), dict (từ điển giá trị JSON + mã uint32 mỗi dòng).
+_BLOCK_HEADER = struct.Struct('>4sII')
+
+def encode_column(values):
+    """Mã hóa một cột; trả về (kiểu, bytes, số byte từ điển)"""
+    kinds = {value.__class__ for value in values}
+    if kinds == {int}:
+        try:
+            return 'i8', array('q', values).tobytes(), 0
+        except OverflowError:
+            pass
+    elif kinds <= {int, float} and kinds:
+        return 'f8', array('d', values).tobytes(), 0
+    index = {}
+    dictionary = []
+    codes = array('I')
+    for value in values:
+        key = value if value.__class__ is str else (value.__class__, json.dumps(value, sort_keys=True))
+        code = index.get(key)
+        if code is None:
+            code = index[key] = len(dictionary)
+            dictionary.append(value)
+        codes.append(code)
+    encoded = json.dumps(dictionary, ensure_ascii=False).encode('utf-8')
+    return 'dict', encoded + codes.tobytes(), len(encoded)
+
+def decode_column(kind, data, dictionary_size):
+    """Ngược lại với encode_column: trả về list giá trị"""
+    if kind == 'i8':
+        return array('q', data).tolist()
+    if kind == 'f8':
+        return array('d', data).tolist()
+    dictionary = json.loads(data[:dictionary_size].decode('utf-8'))
+    return [dictionary[code] for code in array('I', data[dictionary_size:])]
+
+def encode_block(rows):
+    """Ghép các dòng (dict) thành một block; cột thiếu ở dòng nào thì là null"""
+    names = {}
+    for row in rows:
+        for name in row:
+            names[name] = None
+    columns = []
+    chunks = []
+    for name in names:
+        kind, data, dictionary_size = encode_column([row.get(name) for row in rows])
+        columns.append({'name': name, 'type': kind, 'size': len(data), 'dict': dictionary_size})
+        chunks.append(data)
+    header = json.dumps({'rows': len(rows), 'columns': columns}, ensure_ascii=False).encode('utf-8')
+    body = header + b''.join(chunks)
+    return _BLOCK_HEADER.pack(STORE_MAGIC, len(header), zlib.crc32(body)) + body
+
+class ColumnStoreWriter:
+    """Ghi thêm các lô dòng vào kho dạng cột của một worker"""
+
+    def __init__(self, directory=STORE_DIR, writer_id='0', segment_bytes=STORE_SEGMENT_BYTES,
+                 fsync_interval=STORE_FSYNC_INTERVAL):
+        self.directory = directory
+        self.writer_id = writer_id
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.files = {}  # bảng -> file segment đang ghi
+        self.last_sync = time.monotonic()
+        self.rows = 0
+        self.bytes = 0
+
+    def _segment(self, table):
+        file = self.files.get(table)
+        if file is not None and file.tell() < self.segment_bytes:
+            return file
+        if file is not None:
+            self._sync(file)
+            file.close()
+        table_dir = os.path.join(self.directory, table)
+        os.makedirs(table_dir, exist_ok=True)
+        # Tên segment sắp theo thời gian tạo; pid tránh trùng khi worker khởi động lại trong cùng giây
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{self.writer_id}-{os.getpid()}.fcol"
+        file = self.files[table] = open(os.path.join(table_dir, name), 'ab')
+        return file
+
+    @staticmethod
+    def _sync(file):
+        file.flush()
+        os.fsync(file.fileno())
+
+    def append(self, table, rows):
+        """Ghi một lô dòng vào bảng (một block)"""
+        if not rows:
+            return
+        block = encode_block(rows)
+        file = self._segment(table)
+        file.write(block)
+        self.rows += len(rows)
+        self.bytes += len(block)
+        if time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.flush()
+
+    def flush(self):
+        """Đẩy dữ liệu các segment xuống đĩa"""
+        for file in self.files.values():
+            self._sync(file)
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.flush()
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+def read_blocks(path, columns=None):
+    """Đọc các block của một file segment: mỗi block một dict tên cột -> list giá trị
+
+    columns: chỉ giải mã các cột này (cột không có trong block thì toàn null).
+    Dừng ở block hỏng / ghi dở ở cuối file (tiến trình bị tắt giữa chừng).
+    """
+    with open(path, 'rb') as file:
+        while True:
+            prefix = file.read(_BLOCK_HEADER.size)
+            if len(prefix) < _BLOCK_HEADER.size:
+                return
+            magic, header_size, crc = _BLOCK_HEADER.unpack(prefix)
+            header_bytes = file.read(header_size)
+            if magic != STORE_MAGIC or len(header_bytes) < header_size:
+                logger.warning(f"⚠️ Block không hợp lệ trong {path}, bỏ phần còn lại")
+                return
+            header = json.loads(header_bytes.decode('utf-8'))
+            data = file.read(sum(column['size'] for column in header['columns']))
+            if zlib.crc32(data, zlib.crc32(header_bytes)) != crc:
+                logger.warning(f"⚠️ Sai CRC block trong {path}, bỏ phần còn lại")
+                return
+            block = {}
+            offset = 0
+            for column in header['columns']:
+                if columns is None or column['name'] in columns:
+                    block[column['name']] = decode_column(
+                        column['type'], data[offset:offset + column['size']], column['dict'])
+                offset += column['size']
+            for name in columns or ():
+                block.setdefault(name, [None] * header['rows'])
+            yield block
+
+def table_segments(table, directory=STORE_DIR):
+    """Các file segment của một bảng, sắp theo thời gian tạo"""
+    table_dir = os.path.join(directory, table)
+    if not os.path.isdir(table_dir):
+        return []
+    return [os.path.join(table_dir, name) for name in sorted(os.listdir(table_dir)) if name.endswith('.fcol')]
+
+def scan_table(table, columns=None, directory=STORE_DIR):
+    """Duyệt mọi dòng của một bảng (theo thứ tự segment), mỗi dòng một dict"""
+    for path in table_segments(table, directory):
+        for block in read_blocks(path, columns):
+            names = list(block)
+            for values in zip(*(block[name] for name in names)):
+                yield dict(zip(names, values))
+
+# ==================== GIẢI MÃ VÀ KIỂM TRA ====================
+def _flatten(item, prefix=''):
+    """Trải object một tầng: {'MaBomMoiNhat': {'pump': 1}} -> {'MaBomMoiNhat.pump': 1}"""
+    row = {}
+    for key, value in item.items():
+        if value.__class__ is dict:
+            for sub_key, sub_value in value.items():
+                row[f"{prefix}{key}.{sub_key}"] = sub_value
+        else:
+            row[prefix + key] = value
+    return row
+
+def validate_message(topic_key, message):
+    """Lý do message không hợp lệ, hoặc None"""
+    if not isinstance(message, dict):
+        return 'not_object'
+    if topic_key == 'station_connection':
+        if not message.get('connection') or message.get('status') not in ('online', 'offline'):
+            return 'bad_connection'
+        return None if isinstance(message.get('ports'), list) else 'bad_ports'
+    port = message.get('port')
+    if port is None or port == '':
+        return 'missing_port'
+    if topic_key == 'station_data':
+        if message.get('mode', 'full') == 'delta':
+            return None if isinstance(message.get('changed'), dict) else 'bad_delta'
+        return None if isinstance(message.get('data'), list) else 'bad_data'
+    if topic_key == 'station_event':
+        return None if isinstance(message.get('events'), list) else 'bad_events'
+    if topic_key == 'station_warning':
+        return None if message.get('warning_type') else 'missing_warning_type'
+    if topic_key == 'station_status':
+        return None if 'status' in message else 'missing_status'
+    if topic_key == 'station_response':
+        if not message.get('command'):
+            return 'missing_command'
+        if is_history_chunk(topic_key, message):
+            columns = message['samples']
+            if not isinstance(columns, dict) or not isinstance(columns.get('t'), list) or any(
+                    not isinstance(values, list) or len(values) != len(columns['t']) for values in columns.values()):
+                return 'bad_history'
+    return None
+
+def is_history_chunk(topic_key, message):
+    """Chunk dữ liệu của lệnh history (kết quả cuối của lệnh không có "samples")"""
+    return topic_key == 'station_response' and message.get('command') == 'history' and 'samples' in message
+
+def message_rows(topic_key, message, received_at, state=None):
+    """Các dòng ghi vào kho cho một message đã hợp lệ
+
+    station_data: một dòng mỗi vòi (bản đầy đủ) hoặc mỗi vòi thay đổi (delta; vòi
+    bị xóa có removed = true). Delta có state (trạng thái đã dựng lại, id -> vòi)
+    thì dòng chứa đủ mọi trường của vòi, không có thì chỉ có các trường thay đổi.
+    station_event: một dòng mỗi sự kiện. station_connection: một dòng mỗi port của
+    kết nối. Chunk lệnh history: một dòng mỗi mẫu ("t" là epoch của lần poll trên
+    trạm), ghi vào bảng HISTORY_TABLE. Topic khác: một dòng mỗi message.
+    """
+    if topic_key == 'station_connection':
+        fields = {key: message.get(key) for key in ('connection', 'status', 'reason', 'msg_id', 'timestamp')}
+        return [dict(fields, received_at=received_at, port=str(port)) for port in message['ports']]
+    base = {'received_at': received_at, 'port': str(message['port']), 'msg_id': message.get('msg_id'),
+            'timestamp': message.get('timestamp')}
+    if topic_key == 'station_data':
+        base['seq'] = message.get('seq')
+        base['mode'] = message.get('mode', 'full')
+        if base['mode'] == 'delta':
+            rows = []
+            for key, fields in message['changed'].items():
+                row = dict(base, id=int(key) if key.isdigit() else key)
+                row.update(_flatten(fields if state is None else state.get(key, fields)))
+                rows.append(row)
+            for key in message.get('removed', ()):
+                rows.append(dict(base, id=int(key) if key.isdigit() else key, removed=True))
+            return rows
+        return [dict(base, **_flatten(item)) for item in message['data'] if isinstance(item, dict)]
+    if topic_key == 'station_event':
+        return [dict(base, **_flatten(event)) for event in message['events'] if isinstance(event, dict)]
+    if is_history_chunk(topic_key, message):
+        base['command_id'] = message.get('command_id')
+        base['chunk'] = message.get('chunk')
+        columns = message['samples']
+        names = list(columns)
+        return [dict(base, **dict(zip(names, values))) for values in zip(*(columns[name] for name in names))]
+    row = dict(base)
+    for key, value in message.items():
+        if key not in row:
+            row[key] = value
+    return [row]
+
+class StationDataDecoder:
+    """Dựng lại trạng thái đầy đủ của từng trạm từ chuỗi station_data (keyframe + delta)
+
+    Mỗi port một clientMQTT.DeltaDecoder, nên message của một trạm phải tới
+    đúng thứ tự gửi (subscription thường, xem INGEST_ORDERED_TOPICS). Delta tới
+    khi chưa có keyframe hoặc sau khi mất seq vẫn được ghi nhưng chỉ có các
+    trường thay đổi (synced = false), và port được đưa vào danh sách cần gửi
+    lệnh resync cho tới keyframe tiếp theo.
+    """
+
+    def __init__(self, resync_interval=DATA_RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.decoders = {}  # port -> DeltaDecoder
+        self.resync = {}  # port -> lần yêu cầu resync gần nhất (epoch, 0: chưa gửi)
+        self.counts = {'synced': 0, 'unsynced': 0, 'duplicate': 0}
+
+    def rows(self, message, received_at):
+        """Các dòng của một message station_data đã hợp lệ"""
+        port = str(message['port'])
+        decoder = self.decoders.get(port)
+        if decoder is None:
+            decoder = self.decoders[port] = clientMQTT.DeltaDecoder()
+        seq = message.get('seq')
+        if message.get('mode', 'full') == 'full':
+            decoder.apply(message)
+            self.resync.pop(port, None)
+        elif decoder.seq is not None and seq == decoder.seq:
+            # QoS 1 gửi lại message đã nhận
+            self.counts['duplicate'] += 1
+            return []
+        elif decoder.seq is None or decoder.apply(message) is None:
+            self.counts['unsynced'] += 1
+            self.resync.setdefault(port, 0)
+            return [dict(row, synced=False) for row in message_rows('station_data', message, received_at)]
+        self.counts['synced'] += 1
+        return [dict(row, synced=True) for row in message_rows('station_data', message, received_at, decoder.state)]
+
+    def due_resync(self, now):
+        """Các port cần gửi lệnh resync lúc now (mỗi port tối đa một lần mỗi resync_interval)"""
+        due = [port for port, sent in self.resync.items() if now - sent >= self.resync_interval]
+        for port in due:
+            self.resync[port] = now
+        return due
+
+class IngestBatch:
+    """Giải mã, kiểm tra một lô message thô và gom dòng theo bảng
+
+    decoder (StationDataDecoder): dựng lại station_data đầy đủ; không có thì delta
+    được ghi nguyên dạng (chỉ các trường thay đổi).
+    """
+
+    def __init__(self, decoder=None):
+        self.decoder = decoder
+        self.tables = {}  # bảng -> list dòng
+        self.seen = {}  # port -> thời điểm nhận message mới nhất
+        self.info = {}  # port -> thông tin trạm trong heartbeat đầy đủ / trạng thái retained
+        self.connections = []  # (client ID, online/offline, [port], lý do, thời điểm nhận)
+        self.messages = 0
+        self.rejected = {}  # lý do -> số message
+
+    def reject(self, reason):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def add(self, topic, payload, received_at, store=True):
+        """store=False: chỉ cập nhật trạng thái trạm, không ghi dòng (bản retained đọc lại)"""
+        topic_key = _topic_key(topic)
+        table = INGEST_TABLES.get(topic_key)
+        if table is None:
+            self.reject('unknown_topic')
+            return
+        try:
+            decoded = decode_payload(payload)
+        except (ValueError, UnicodeDecodeError, zlib.error) as e:
+            logger.debug(f"Bỏ payload không giải mã được trên {topic}: {e}")
+            self.reject('decode')
+            return
+        rows = self.tables.setdefault(table, []) if store else []
+        for message in unpack_batch(decoded):
+            reason = validate_message(topic_key, message)
+            if reason is not None:
+                self.reject(reason)
+                continue
+            self.messages += 1
+            if topic_key == 'station_connection':
+                ports = [str(port) for port in message['ports']]
+                self.connections.append((message['connection'], message['status'], ports,
+                                         message.get('reason'), received_at))
+                if message['status'] == 'online':
+                    self.seen.update((port, received_at) for port in ports)
+            else:
+                port = str(message['port'])
+                self.seen[port] = received_at
+                if topic_key in ('station_heartbeat', 'station_status') and 'version' in message:
+                    self.info[port] = {field: message.get(field) for field in LIVENESS_INFO_FIELDS if field in message}
+            if is_history_chunk(topic_key, message):
+                if store:
+                    self.tables.setdefault(HISTORY_TABLE, []).extend(message_rows(topic_key, message, received_at))
+                continue
+            if topic_key == 'station_data' and self.decoder is not None:
+                rows.extend(self.decoder.rows(message, received_at))
+                continue
+            rows.extend(message_rows(topic_key, message, received_at))
+
+# ==================== TRẠNG THÁI TRẠM ====================
+class LivenessIndex:
+    """Bảng trạng thái online của các trạm theo port
+
+    Trạm đã công bố kết nối (trạng thái retained có "connection") chuyển sang
+    offline khi kết nối báo offline (Last Will hoặc tắt chủ động), hạn
+    session_timeout chỉ là dự phòng. Trạm chỉ gửi heartbeat (client cũ) hết
+    hạn sau timeout giây không có message. Hạn của từng trạm nằm trong một
+    heap (xóa lười): mỗi lần kiểm tra chỉ xem các trạm đã tới hạn, không
+    duyệt toàn bộ bảng.
+    """
+
+    def __init__(self, timeout=LIVENESS_TIMEOUT, session_timeout=LIVENESS_SESSION_TIMEOUT):
+        self.timeout = timeout
+        self.session_timeout = session_timeout
+        self.last_seen = {}  # port -> thời điểm (epoch) nhận message mới nhất
+        self.info = {}  # port -> version / mac / codec / connection
+        self.online = set()
+        self.deadlines = []  # heap (hạn, port)
+
+    def port_timeout(self, port):
+        return self.session_timeout if self.info.get(port, {}).get('connection') else self.timeout
+
+    def update_info(self, port, fields):
+        self.info.setdefault(port, {}).update(fields)
+
+    def touch(self, port, seen):
+        """Ghi nhận message từ trạm; trả về True nếu trạm vừa chuyển sang online"""
+        previous = self.last_seen.get(port)
+        if previous is not None and seen <= previous:
+            return False
+        self.last_seen[port] = seen
+        heapq.heappush(self.deadlines, (seen + self.port_timeout(port), port))
+        if port in self.online:
+            return False
+        self.online.add(port)
+        return True
+
+    def expire(self, now):
+        """Các trạm vừa quá hạn (chuyển sang offline) tính tới now"""
+        expired = []
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, port = heapq.heappop(deadlines)
+            if port in self.online and self.last_seen[port] + self.port_timeout(port) <= now:
+                self.online.discard(port)
+                expired.append(port)
+        return expired
+
+    def disconnect(self, connection, ports, at):
+        """Kết nối báo offline tại thời điểm at; trả về các trạm vừa chuyển sang offline
+
+        Bỏ qua trạm đã có message mới hơn (đã kết nối lại) hoặc đang thuộc kết nối khác.
+        """
+        offline = []
+        for port in ports:
+            if port not in self.online or self.last_seen.get(port, 0) > at:
+                continue
+            if self.info.get(port, {}).get('connection', connection) != connection:
+                continue
+            self.online.discard(port)
+            offline.append(port)
+        return offline
+
+    def snapshot(self):
+        """{port: {online, last_seen, ...info}} để ghi ra LIVENESS_FILE"""
+        return {port: dict(self.info.get(port, {}), online=port in self.online, last_seen=seen)
+                for port, seen in self.last_seen.items()}
+
+    def save(self, path=LIVENESS_FILE):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.snapshot(), file, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+# ==================== WORKER ====================
+class IngestWorker:
+    """Một tiến trình thu nhận: một kết nối MQTT trong nhóm shared subscription
+
+    Thread mạng của paho chỉ xếp message thô vào hàng đợi; luồng chính lấy
+    theo lô, giải mã, kiểm tra, ghi kho rồi báo port đã thấy về tiến trình
+    chính. PUBACK được gửi khi message vào hàng đợi, nên message của lô đang
+    xử lý có thể mất nếu worker bị tắt đột ngột.
+
+    ordered=True: subscription thường cho INGEST_ORDERED_TOPICS, nhận mọi
+    message theo thứ tự gửi của từng trạm để StationDataDecoder dựng lại chuỗi
+    delta; trạm mất seq được gửi lệnh resync.
+    """
+
+    def __init__(self, index, reports, stop, host=INGEST_BROKER_HOST, port=INGEST_BROKER_PORT,
+                 directory=STORE_DIR, batch_size=INGEST_BATCH_SIZE, batch_window=INGEST_BATCH_WINDOW,
+                 ordered=False):
+        self.index = index
+        self.ordered = ordered
+        self.decoder = StationDataDecoder() if ordered else None
+        self.reports = reports
+        self.stop = stop
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.pending = deque()
+        self.ready = Event()
+        self.store = ColumnStoreWriter(directory, writer_id=str(index))
+        self.counts = {'packets': 0, 'messages': 0, 'rows': 0, 'rejected': 0, 'batches': 0}
+        self.client = mqtt.Client(client_id=f"fuel-ingest-{socket.gethostname()}-{index}", clean_session=True)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.error(f"❌ Worker {self.index} kết nối broker thất bại, mã {rc}")
+            return
+        if self.ordered:
+            client.subscribe(ingest_subscriptions(topics=INGEST_ORDERED_TOPICS))
+            logger.info(f"✅ Worker {self.index} đã subscribe {', '.join(INGEST_ORDERED_TOPICS)} (giải mã delta)")
+            return
+        client.subscribe(ingest_subscriptions(f"$share/{INGEST_SHARE_GROUP}/"))
+        logger.info(f"✅ Worker {self.index} đã subscribe nhóm {INGEST_SHARE_GROUP}")
+
+    def on_message(self, client, userdata, message):
+        if message.retain:
+            # Bản retained chỉ tới qua subscription thường (PresenceSync), không ghi trùng
+            return
+        self.pending.append((message.topic, message.payload, time.time()))
+        if len(self.pending) >= self.batch_size:
+            self.ready.set()
+
+    def process(self):
+        """Xử lý mọi message đang chờ theo lô; trả về số message thô đã lấy"""
+        taken = 0
+        while self.pending:
+            batch = IngestBatch(self.decoder)
+            pending = self.pending
+            for _ in range(min(len(pending), self.batch_size)):
+                batch.add(*pending.popleft())
+                taken += 1
+            for table, rows in batch.tables.items():
+                self.store.append(table, rows)
+                self.counts['rows'] += len(rows)
+            self.counts['messages'] += batch.messages
+            self.counts['rejected'] += sum(batch.rejected.values())
+            self.counts['batches'] += 1
+            if batch.rejected:
+                logger.debug(f"Worker {self.index} bỏ message: {batch.rejected}")
+            self.reports.put(('seen', self.index, batch.seen, batch.info, batch.connections))
+        self.counts['packets'] += taken
+        if self.decoder is not None:
+            self.request_resync()
+        return taken
+
+    def request_resync(self):
+        """Gửi lệnh resync tới các trạm mất chuỗi delta (trạm gửi bản đầy đủ ở lần gửi tới)"""
+        now = time.time()
+        for port in self.decoder.due_resync(now):
+            command = {'command': 'resync', 'port': port, 'command_id': f"resync-{port}-{int(now)}"}
+            self.client.publish(f"{TOPICS['station_command']}/{port}", json.dumps(command), qos=INGEST_QOS)
+            logger.info(f"🔁 Trạm {port} mất chuỗi delta, đã gửi lệnh resync")
+
+    def stats(self):
+        """Bộ đếm gửi về tiến trình chính (worker giải mã có thêm số delta đồng bộ / chưa đồng bộ)"""
+        return dict(self.counts, **self.decoder.counts) if self.decoder is not None else dict(self.counts)
+
+    def run(self):
+        self.client.connect_async(self.host, self.port, clientMQTT.MQTT_KEEPALIVE)
+        self.client.loop_start()
+        last_report = 0
+        try:
+            while not self.stop.is_set():
+                self.ready.wait(self.batch_window)
+                self.ready.clear()
+                self.process()
+                if time.monotonic() - last_report >= 1:
+                    self.reports.put(('stats', self.index, self.stats()))
+                    last_report = time.monotonic()
+        finally:
+            self.client.disconnect()
+            self.client.loop_stop()
+            self.process()
+            self.store.close()
+            self.reports.put(('stats', self.index, self.stats()))
+
+def ingest_subscriptions(prefix='', topics=None):
+    """Danh sách (topic filter, QoS) của dịch vụ thu nhận, prefix: "$share/<nhóm>/" hoặc rỗng
+
+    topics mặc định là mọi topic thu nhận trừ INGEST_ORDERED_TOPICS (do tiến trình giải mã riêng nhận).
+    """
+    if topics is None:
+        topics = [key for key in INGEST_TOPICS if key not in INGEST_ORDERED_TOPICS]
+    subscriptions = [(f"{prefix}{TOPICS[key]}", INGEST_QOS) for key in topics if key != 'station_connection']
+    return subscriptions + [(f"{prefix}{TOPICS[key]}/+", INGEST_QOS) for key in topics if key in INGEST_SUBTOPICS]
+
+class PresenceSync:
+    """Đọc lại trạng thái retained (station_status/+, station_connection/+) khi dịch vụ khởi động
+
+    Broker không gửi message retained cho shared subscription, nên tiến trình
+    chính giữ một subscription thường cho các topic trạng thái; chỉ bản
+    retained (gửi ngay sau SUBSCRIBE) được dùng, message trực tiếp đã do
+    worker xử lý.
+    """
+
+    def __init__(self, reports, host=INGEST_BROKER_HOST, port=INGEST_BROKER_PORT):
+        self.reports = reports
+        self.host = host
+        self.port = port
+        self.client = mqtt.Client(client_id=f"fuel-ingest-{socket.gethostname()}-presence", clean_session=True)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe([(f"{TOPICS[key]}/+", INGEST_QOS) for key in PRESENCE_TOPICS])
+
+    def on_message(self, client, userdata, message):
+        if not message.retain:
+            return
+        batch = IngestBatch()
+        batch.add(message.topic, message.payload, time.time(), store=False)
+        if not batch.messages:
+            return
+        # Trạng thái online của trạm theo bản retained của kết nối; station_status chỉ bổ sung thông tin
+        # (bản retained "online" của trạm vẫn còn sau khi kết nối đã gửi Last Will)
+        seen = batch.seen if _topic_key(message.topic) == 'station_connection' else {}
+        self.reports.put(('seen', 'presence', seen, batch.info, batch.connections))
+
+    def start(self):
+        self.client.connect_async(self.host, self.port, clientMQTT.MQTT_KEEPALIVE)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+def run_worker(index, reports, stop, host, port, directory, log_level, ordered=False):
+    """Điểm vào của tiến trình worker"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Tiến trình chính điều phối việc dừng
+    clientMQTT.configure_log_levels(log_level)
+    IngestWorker(index, reports, stop, host, port, directory, ordered=ordered).run()
+
+# ==================== DỊCH VỤ ====================
+class IngestService:
+    """Tiến trình chính: khởi động worker, gộp báo cáo và giữ LivenessIndex
+
+    Chuyển trạng thái online/offline được ghi log và ghi vào bảng liveness.
+    """
+
+    def __init__(self, workers=INGEST_WORKERS, host=INGEST_BROKER_HOST, port=INGEST_BROKER_PORT,
+                 directory=STORE_DIR, timeout=LIVENESS_TIMEOUT, log_level=None):
+        self.worker_count = max(1, workers)
+        self.host = host
+        self.port = port
+        self.directory = directory
+        self.log_level = log_level or logging.getLevelName(logging.getLogger().level)
+        self.liveness = LivenessIndex(timeout)
+        self.liveness_file = os.path.join(directory, os.path.basename(LIVENESS_FILE))
+        self.store = ColumnStoreWriter(directory, writer_id='main')
+        self.context = multiprocessing.get_context('spawn')  # Không fork tiến trình đang có thread
+        self.reports = self.context.Queue()
+        self.stop_event = self.context.Event()
+        self.processes = []
+        self.counts = {}  # worker -> bộ đếm mới nhất
+        self.presence = PresenceSync(self.reports, host, port)
+
+    def start(self):
+        for index in range(self.worker_count):
+            process = self.context.Process(
+                target=run_worker, name=f"fuel-ingest-{index}", daemon=True,
+                args=(index, self.reports, self.stop_event, self.host, self.port, self.directory, self.log_level))
+            process.start()
+            self.processes.append(process)
+        # Một tiến trình riêng nhận station_data theo thứ tự để giải mã delta
+        process = self.context.Process(
+            target=run_worker, name="fuel-ingest-data", daemon=True,
+            args=('data', self.reports, self.stop_event, self.host, self.port, self.directory, self.log_level, True))
+        process.start()
+        self.processes.append(process)
+        self.presence.start()
+        logger.info(f"🚀 Đã khởi động {self.worker_count} worker thu nhận và worker giải mã dữ liệu "
+                    f"(broker {self.host}:{self.port})")
+
+    def totals(self):
+        """Tổng bộ đếm của mọi worker"""
+        totals = {}
+        for counts in self.counts.values():
+            for name, value in counts.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def poll(self, timeout=LIVENESS_SWEEP_INTERVAL):
+        """Nhận báo cáo của worker trong tối đa timeout giây rồi kiểm tra trạm quá hạn"""
+        deadline = time.monotonic() + timeout
+        transitions = []
+        while True:
+            try:
+                report = self.reports.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if report[0] == 'stats':
+                self.counts[report[1]] = report[2]
+                continue
+            _, _, seen, info, connections = report
+            for port, fields in info.items():
+                self.liveness.update_info(port, fields)
+            for port, seen_at in seen.items():
+                if self.liveness.touch(port, seen_at):
+                    transitions.append({'received_at': seen_at, 'port': port, 'state': 'online'})
+                    logger.info(f"🟢 Trạm {port} online")
+            for connection, status, ports, reason, at in connections:
+                if status != 'offline':
+                    continue
+                for port in self.liveness.disconnect(connection, ports, at):
+                    transitions.append({'received_at': at, 'port': port, 'state': 'offline',
+                                        'last_seen': self.liveness.last_seen[port], 'reason': reason})
+                    logger.warning(f"🔴 Trạm {port} offline ({reason or 'kết nối đóng'}, kết nối {connection})")
+        now = time.time()
+        for port in self.liveness.expire(now):
+            transitions.append({'received_at': now, 'port': port, 'state': 'offline',
+                                'last_seen': self.liveness.last_seen[port], 'reason': 'timeout'})
+            logger.warning(f"🔴 Trạm {port} không gửi message nào trong {self.liveness.port_timeout(port):g} s, "
+                           f"coi là offline")
+        self.store.append('liveness', transitions)
+        return transitions
+
+    def stop(self):
+        self.presence.stop()
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        # Lấy nốt báo cáo cuối cùng của các worker
+        self.poll(timeout=0.2)
+        self.store.close()
+        self.liveness.save(self.liveness_file)
+
+    def run(self):
+        """Chạy cho tới khi nhận SIGINT/SIGTERM"""
+        stopping = Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+        self.start()
+        last_report = time.monotonic()
+        last_messages = 0
+        try:
+            while not stopping.is_set():
+                self.poll()
+                self.liveness.save(self.liveness_file)
+                elapsed = time.monotonic() - last_report
+                if elapsed >= INGEST_REPORT_INTERVAL:
+                    totals = self.totals()
+                    messages = totals.get('messages', 0)
+                    logger.info(f"📊 {(messages - last_messages) / elapsed:.0f} msg/s, trạm online "
+                                f"{len(self.liveness.online)}/{len(self.liveness.last_seen)}, tổng {totals}")
+                    last_report, last_messages = time.monotonic(), messages
+                    dead = [process.name for process in self.processes if not process.is_alive()]
+                    if dead:
+                        logger.error(f"❌ Worker đã dừng: {', '.join(dead)}")
+        finally:
+            logger.info("⏹️ Đang dừng các worker thu nhận...")
+            self.stop()
+
+# ==================== MAIN FUNCTION ====================
+def main():
+    parser = argparse.ArgumentParser(description="Dịch vụ thu nhận MQTT phía server")
+    parser.add_argument('--store', default=STORE_DIR, help="Thư mục kho dạng cột")
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Subscribe và ghi message vào kho")
+    run_parser.add_argument('--workers', type=int, default=INGEST_WORKERS)
+    run_parser.add_argument('--host', default=INGEST_BROKER_HOST)
+    run_parser.add_argument('--port', type=int, default=INGEST_BROKER_PORT)
+    run_parser.add_argument('--log-level', metavar='LEVELS', help="Mức log, ví dụ DEBUG")
+
+    scan_parser = subparsers.add_parser('scan', help="In các dòng của một bảng dạng JSON lines")
+    scan_parser.add_argument('table', help=f"Một trong: {', '.join(sorted([*INGEST_TABLES.values(), HISTORY_TABLE]))}, liveness")
+    scan_parser.add_argument('--columns', help="Chỉ đọc các cột này (phân cách bằng dấu phẩy)")
+    scan_parser.add_argument('--limit', type=int, default=0, help="Số dòng tối đa (0: tất cả)")
+
+    subparsers.add_parser('liveness', help="In bảng trạng thái trạm đã lưu")
+    args = parser.parse_args()
+
+    if args.action == 'run':
+        if args.log_level:
+            clientMQTT.configure_log_levels(args.log_level)
+        IngestService(args.workers, args.host, args.port, args.store).run()
+    elif args.action == 'scan':
+        columns = args.columns.split(',') if args.columns else None
+        for count, row in enumerate(scan_table(args.table, columns, args.store), 1):
+            print(json.dumps(row, ensure_ascii=False))
+            if count == args.limit:
+                break
+    else:
+        path = os.path.join(args.store, os.path.basename(LIVENESS_FILE))
+        if not os.path.exists(path):
+            print("Chưa có bảng trạng thái (dịch vụ chưa chạy?)")
+            return
+        with open(path, 'r', encoding='utf-8') as file:
+            for port, state in sorted(json.load(file).items()):
+                seen = datetime.fromtimestamp(state['last_seen']).isoformat(sep=' ', timespec='seconds')
+                print(f"{port:<12}{'online' if state['online'] else 'offline':<9}{seen}  "
+                      f"{state.get('version') or ''} {state.get('mac') or ''}")
+
+if __name__ == "__main__":
+    main()
@@ -207,7 +207,7 @@ for package in "${REQUIRED_PACKAGES[@]}"; do
 done
 
 # Kiểm tra thư viện built-in (không cần cài đặt)
-BUILTIN_MODULES=("json" "time" "os" "subprocess" "re" "random" "logging" "datetime" "threading")
+BUILTIN_MODULES=("json" "time" "os" "subprocess" "re" "random" "logging" "datetime" "threading" "asyncio" "signal" "struct" "uuid" "glob" "zlib" "gzip" "bisect" "queue" "shutil" "atexit" "selectors" "collections" "socket" "ssl" "mmap" "operator" "itertools")
 log "Kiểm tra thư viện built-in Python..."
 for module in "${BUILTIN_MODULES[@]}"; do
     if python3 -c "import $module" 2>/dev/null; then
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""StateCheckpoint: ghi/nạp trạng thái phát hiện qua lần khởi động lại"""
+
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import clientMQTT
+import replay
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    clientMQTT.configure_log_levels('CRITICAL')
+
+def write_document(path, state, version=clientMQTT.CHECKPOINT_VERSION, saved=None):
+    document = {'version': version, 'saved': (saved or datetime.now()).isoformat(),
+                'state': clientMQTT._encode_state(state)}
+    path.write_text(json.dumps(document), encoding='utf-8')
+
+def test_round_trip_keeps_datetime_and_tuple(tmp_path):
+    path = str(tmp_path / 'state' / '10001.json')
+    seen = datetime(2026, 1, 1, 8, 30, 15, 250000)
+    state = {
+        'connection_status': {'1': {'disconnected': True, 'since': seen}},
+        'mabom_history': {'1': (12, seen, [(1, 2), 'x'])},
+        'cooldowns': {'restart_all': seen},
+        'nested': [{'$dt': 'không phải datetime', 'khác': 1}, None],
+    }
+    checkpoint = clientMQTT.StateCheckpoint(path, interval=3600)
+    checkpoint.update(state)
+    loaded = clientMQTT.StateCheckpoint(path)
+    restored = loaded.load()
+    assert restored == state
+    assert isinstance(restored['mabom_history']['1'], tuple)
+    assert isinstance(restored['mabom_history']['1'][2][0], tuple)
+    assert restored['connection_status']['1']['since'] == seen
+    assert abs((datetime.now() - loaded.saved).total_seconds()) < 60
+
+    # Trong interval: để chờ, flush() mới ghi
+    changed = dict(state, cooldowns={'restart_all': seen + timedelta(minutes=1)})
+    checkpoint.update(changed)
+    assert clientMQTT.StateCheckpoint(path).load() == state
+    checkpoint.flush()
+    assert clientMQTT.StateCheckpoint(path).load() == changed
+
+@pytest.mark.parametrize('content', [
+    b'{"version": 1, "saved": "2026-01-01T08:00:00", "state": {"pump',  # Ghi dở
+    b'\xff\xfe\x00',  # Không phải UTF-8
+    b'[1, 2, 3]',
+    b'{"version": 999, "saved": "2026-01-01T08:00:00", "state": {}}',
+    b'{"saved": "2026-01-01T08:00:00", "state": {}}',
+])
+def test_corrupt_or_unknown_version_ignored(tmp_path, content):
+    path = tmp_path / '10001.json'
+    path.write_bytes(content)
+    assert clientMQTT.StateCheckpoint(str(path)).load() is None
+    assert clientMQTT.StateCheckpoint(str(tmp_path / 'missing.json')).load() is None
+
+def restore(tmp_path, state, age):
+    path = tmp_path / '10001.json'
+    write_document(path, state, saved=datetime.now() - timedelta(seconds=age))
+    checkpoint = clientMQTT.StateCheckpoint(str(path))
+    station = replay.ReplayStation()
+    station.restore_state(checkpoint.load(), checkpoint.saved)
+    return station
+
+def test_stale_checkpoint_keeps_only_cooldowns(tmp_path):
+    restarted = datetime(2026, 1, 1, 7, 55)
+    state = {'connection_status': {'1': {'disconnected': True}},
+             'mabom_history': {'1': 10}, 'pump_status': {'1': 'đang bơm'},
+             'cooldowns': {'restart_all': restarted, 'không biết': restarted},
+             'is_all_disconnect_restart': True}
+
+    fresh = restore(tmp_path, state, age=clientMQTT.CHECKPOINT_MAX_AGE - 60)
+    assert fresh.mabom_history == {'1': 10}
+    assert fresh.pump_status == {'1': 'đang bơm'}
+    assert fresh.connection_status == {'1': {'disconnected': True}}
+    assert fresh.is_all_disconnect_restart == [True]
+    assert fresh.remediation.last_run == {'restart_all': restarted}
+
+    stale = restore(tmp_path, state, age=clientMQTT.CHECKPOINT_MAX_AGE + 60)
+    assert stale.mabom_history == {} and stale.pump_status == {} and stale.connection_status == {}
+    assert stale.is_all_disconnect_restart == [False]
+    assert stale.remediation.last_run == {'restart_all': restarted}
+    assert stale.checkpointed_restarts == {'restart_all': restarted}
+
+def test_legacy_restart_keys_restored_as_cooldowns(tmp_path):
+    # Checkpoint trước khi đổi sang cooldowns của RemediationEngine
+    restarted = datetime(2026, 1, 1, 7, 55)
+    station = restore(tmp_path, {'mabom_history': {'1': 10}, 'last_restart_all': restarted,
+                                 'last_non_sequential_restart': None}, age=30)
+    assert station.remediation.last_run == {'restart_all': restarted}
+    assert station.mabom_history == {'1': 10}
+    assert not station.remediation.acquire('restart_all', restarted + timedelta(minutes=1))
+    assert station.remediation.acquire('restart_nonsequential', restarted + timedelta(minutes=1))
+    assert station.checkpoint_state()['cooldowns'] == {'restart_all': restarted,
+                                                         'restart_nonsequential': restarted + timedelta(minutes=1)}
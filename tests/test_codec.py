@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Từ điển nén huấn luyện từ snapshot ghi lại: ghi/nạp file, mã hóa hai chiều và bộ giải nén dùng lại"""
+
+import pytest
+
+import benchmark
+import clientMQTT
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    clientMQTT.configure_log_levels('CRITICAL')
+
+@pytest.fixture(scope='module')
+def recordings(tmp_path_factory):
+    """Thư mục bản ghi của hai trạm như RECORDING_DIR (mỗi trạm một thư mục con theo port)"""
+    directory = tmp_path_factory.mktemp('recordings')
+    for port, seed in (('10001', 0), ('10002', 1)):
+        recorder = clientMQTT.SnapshotRecorder(str(directory / port))
+        for now, snapshot in benchmark.station_day_stream(16, 4, seed=seed):
+            recorder.record(snapshot, now)
+        recorder.close()
+    return str(directory)
+
+def encoded_size(codec, samples):
+    return sum(len(codec.encode(clientMQTT.json.loads(sample))) for sample in samples)
+
+def test_trained_dictionary_roundtrip(recordings, tmp_path):
+    path = str(tmp_path / 'codec.dict')
+    dictionary = clientMQTT.write_codec_dictionary(recordings, path)
+    assert dictionary and len(dictionary) <= clientMQTT.CODEC_DICTIONARY_SIZE
+    assert clientMQTT.load_codec_dictionary(path) == dictionary
+    assert clientMQTT.load_codec_dictionary(str(tmp_path / 'missing.dict')) == clientMQTT.BUILTIN_CODEC_DICTIONARY
+
+    samples = clientMQTT.station_data_samples(recordings)
+    ports = {clientMQTT.json.loads(sample)['port'] for sample in samples}
+    assert ports == {'10001', '10002'}
+    for name in clientMQTT.available_codecs():
+        codec = clientMQTT.PayloadCodec(name, dictionary)
+        for sample in samples[:50]:
+            message = clientMQTT.json.loads(sample)
+            assert codec.decode(codec.encode(message)) == message
+
+    # Từ điển học từ dữ liệu thực nén tốt hơn từ điển dựng sẵn
+    trained = encoded_size(clientMQTT.PayloadCodec('json+zlib', dictionary), samples)
+    builtin = encoded_size(clientMQTT.PayloadCodec('json+zlib'), samples)
+    assert trained < builtin, (trained, builtin)
+
+def test_zstd_decompressor_cached_per_dictionary():
+    pytest.importorskip('zstandard')
+    codec = clientMQTT.PayloadCodec('json+zstd')
+    payload = codec.encode({'port': '10001', 'seq': 1})
+    assert clientMQTT.decode_payload(payload) == {'port': '10001', 'seq': 1}
+    decompressor = clientMQTT._zstd_decompressor(clientMQTT.CODEC_DICTIONARY)
+    assert clientMQTT.decode_payload(payload) == {'port': '10001', 'seq': 1}
+    assert clientMQTT._zstd_decompressor(clientMQTT.CODEC_DICTIONARY) is decompressor
+    other = b'{"port":"","seq":' * 8
+    assert clientMQTT._zstd_decompressor(other) is not decompressor
+    assert clientMQTT.PayloadCodec('json+zstd', other).dictionary_id != codec.dictionary_id
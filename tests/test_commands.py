@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Lệnh từ server: chạy trên CommandExecutor, thu output lệnh shell, loại lệnh lặp, từ chối khi đầy"""
+
+import asyncio
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import clientMQTT
+
+@pytest.fixture(autouse=True)
+def quiet_logs(monkeypatch, tmp_path):
+    clientMQTT.configure_log_levels('CRITICAL')
+    monkeypatch.chdir(tmp_path)  # hàng đợi offline của client nằm trong thư mục tạm
+
+def alive(pid):
+    """Tiến trình còn chạy (zombie chưa được init thu dọn coi như đã chết)"""
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            return file.read().rsplit(')', 1)[1].split()[0] not in 'ZX'
+    except OSError:
+        return False
+
+def wait_dead(pid, timeout=2):
+    deadline = time.monotonic() + timeout
+    while alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return not alive(pid)
+
+def kill(pid):
+    """Dọn tiến trình test để lại: cả group nếu pid là trưởng group (lệnh ssh chạy rồi bỏ)"""
+    for kill_function in (os.killpg, os.kill):
+        try:
+            kill_function(pid, signal.SIGKILL)
+            return
+        except OSError:
+            pass
+
+class CommandStation:
+    """Một trạm gắn event loop, ghi lại station_response thay vì publish"""
+
+    def __init__(self):
+        self.connection = clientMQTT.MQTTFuelStationClient()
+        self.station = clientMQTT.MQTTFuelStationClient(connection=self.connection)
+        self.station.port = '10001'
+        self.connection.add_station(self.station)
+        self.connection.attach_loop(asyncio.get_running_loop())
+        self.responses = []
+        self.changed = asyncio.Event()
+        self.station.publish_response = self.publish_response
+
+    def publish_response(self, command, command_id, result):
+        self.responses.append((command, command_id, result, threading.get_ident()))
+        self.changed.set()
+
+    def send(self, name, command_id=None, **data):
+        message = {'command': name, 'port': '10001', 'data': data}
+        if command_id is not None:
+            message['command_id'] = command_id
+        self.station.handle_command(message)
+
+    async def wait_responses(self, count, timeout=10):
+        while len(self.responses) < count:
+            self.changed.clear()
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        return self.responses
+
+# ==================== run_shell_command ====================
+def test_shell_output_truncated_and_counted():
+    result = clientMQTT.run_shell_command("head -c 50000 /dev/zero | tr '\\0' o; printf 'err' >&2; exit 3",
+                                          timeout=10, output_limit=1000)
+    assert (result['status'], result['exit_code']) == ('error', 3)
+    assert result['stdout'] == 'o' * 1000
+    assert result['stdout_truncated'] == 49000
+    assert result['stderr'] == 'err' and 'stderr_truncated' not in result
+
+def test_shell_timeout_kills_background_children():
+    started = time.monotonic()
+    result = clientMQTT.run_shell_command('sleep 30 & echo $!; wait', timeout=0.5)
+    assert result['status'] == 'timeout'
+    assert time.monotonic() - started < 5
+    pid = int(result['stdout'])
+    assert wait_dead(pid)
+
+def test_shell_exited_leaves_daemons_running():
+    # Shell thoát ngay, tiến trình nền giữ pipe: không chờ tới timeout, không kill
+    started = time.monotonic()
+    result = clientMQTT.run_shell_command('sleep 30 & echo $!', timeout=10)
+    pid = int(result['stdout'])
+    try:
+        assert (result['status'], result['exit_code']) == ('ok', 0)
+        assert time.monotonic() - started < 3
+        assert alive(pid)
+    finally:
+        kill(pid)
+
+# ==================== handle_command ====================
+def test_legacy_ssh_is_fire_and_forget():
+    async def scenario():
+        commands = CommandStation()
+        commands.send('ssh', command='sleep 30')  # Server cũ: không command_id, không capture
+        return (await commands.wait_responses(1))[0]
+
+    command, command_id, result, _ = asyncio.run(scenario())
+    try:
+        assert (command, result['status']) == ('ssh', 'started')
+        assert alive(result['pid'])
+    finally:
+        kill(result['pid'])
+
+def test_ssh_with_command_id_captures_and_replays(monkeypatch):
+    runs = []
+    run_shell_command = clientMQTT.run_shell_command
+
+    def counted(command, timeout):
+        runs.append(command)
+        return run_shell_command(command, timeout)
+
+    monkeypatch.setattr(clientMQTT, 'run_shell_command', counted)
+
+    async def scenario():
+        commands = CommandStation()
+        commands.send('ssh', 'c1', command='sleep 0.3; echo hi')
+        commands.send('ssh', 'c1', command='sleep 0.3; echo hi')  # Lặp khi đang chạy: bỏ qua
+        await commands.wait_responses(1)
+        commands.send('ssh', 'c1', command='sleep 0.3; echo hi')  # Lặp khi đã xong: gửi lại kết quả
+        await commands.wait_responses(2)
+        await asyncio.sleep(0.2)
+        return commands.responses
+
+    responses = asyncio.run(scenario())
+    assert len(runs) == 1
+    assert len(responses) == 2
+    first, replay = responses[0][2], responses[1][2]
+    assert (first['status'], first['stdout']) == ('ok', 'hi\n')
+    assert replay == first
+
+def test_queue_full_rejects_command():
+    async def scenario():
+        commands = CommandStation()
+        commands.station.commands = clientMQTT.CommandExecutor(workers=1, queue_size=1)
+        for index in range(3):
+            commands.send('ssh', f'q{index}', command='sleep 0.3')
+        await commands.wait_responses(3)
+        return {command_id: result['status'] for _, command_id, result, _ in commands.responses}
+
+    assert asyncio.run(scenario()) == {'q0': 'ok', 'q1': 'ok', 'q2': 'rejected'}
+
+def test_laymabom_runs_off_the_event_loop(monkeypatch):
+    calls = []
+
+    def slow_api(pump_id, base_url, timeout):
+        calls.append((pump_id, timeout, threading.get_ident()))
+        time.sleep(0.3)
+        return 200
+
+    monkeypatch.setattr(clientMQTT, 'call_daylaidulieu_api', slow_api)
+
+    async def scenario():
+        commands = CommandStation()
+        started = time.monotonic()
+        commands.send('laymabom', 'c1', pump_id='3', timeout=7)
+        assert time.monotonic() - started < 0.1  # Callback trả về ngay, API chạy trên pool
+        await commands.wait_responses(1)
+
+        # Gọi thẳng trên event loop bị từ chối thay vì chặn loop
+        direct = commands.station.handle_laymabom_command('4')
+        return commands.connection.loop_thread, commands.responses, direct
+
+    loop_thread, responses, direct = asyncio.run(scenario())
+    assert [(pump_id, timeout) for pump_id, timeout, _ in calls] == [('3', 7)]
+    assert calls[0][2] != loop_thread
+    command, command_id, result, thread = responses[0]
+    assert (command, command_id, result['status'], result['http_status']) == ('laymabom', 'c1', 'ok', 200)
+    assert thread == loop_thread  # Kết quả được gửi lại trên event loop
+    assert direct['status'] == 'error'
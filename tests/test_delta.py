@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Delta encoding station_data: byte tiết kiệm trên snapshot đã ghi lại và bộ giải mã phía server"""
+
+import itertools
+
+import pytest
+
+import benchmark
+import clientMQTT
+import serverMQTT
+
+PORT = '10001'
+
+@pytest.fixture(scope='module')
+def recorded(tmp_path_factory):
+    """8 giờ của trạm 16 vòi (đêm rảnh, sáng đông khách) ghi bằng SnapshotRecorder rồi đọc lại"""
+    directory = tmp_path_factory.mktemp('recording')
+    source = list(benchmark.station_day_stream(16, 8, seed=0))
+    recorder = clientMQTT.SnapshotRecorder(str(directory))
+    for now, snapshot in source:
+        recorder.record(snapshot, now)
+    recorder.close()
+    snapshots = list(clientMQTT.read_recording(str(directory)))
+    assert snapshots == source
+    return snapshots
+
+def station_messages(snapshots, encoder):
+    """(snapshot, body) của các lần client gửi station_data như send_station_data"""
+    for _, snapshot in snapshots:
+        body = encoder.encode(snapshot)
+        if body is not None:
+            yield snapshot, dict(body, port=PORT, msg_id=f"d{body['seq']}")
+
+# Nén zlib với từ điển dùng chung đã thu nhỏ bản đầy đủ nên tỉ lệ tiết kiệm thấp hơn
+@pytest.mark.parametrize('codec_name, max_ratio', [('json', 0.15), ('json+zlib', 0.4)])
+def test_delta_bytes_on_recorded_snapshots(recorded, codec_name, max_ratio):
+    codec = clientMQTT.PayloadCodec(codec_name)
+    full_bytes = delta_bytes = sent = 0
+    for snapshot, body in station_messages(recorded, clientMQTT.DeltaEncoder()):
+        full_bytes += len(codec.encode({'port': PORT, 'data': snapshot, 'msg_id': body['msg_id']}))
+        delta_bytes += len(codec.encode(body))
+        sent += 1
+    assert sent > 100
+    # Mỗi DATA_KEYFRAME_INTERVAL lần gửi có một bản đầy đủ, còn lại chỉ 1-2 vòi đổi
+    assert delta_bytes < max_ratio * full_bytes, (delta_bytes, full_bytes)
+
+def ingest(decoder, body, received_at=0.0):
+    batch = serverMQTT.IngestBatch(decoder)
+    batch.add(clientMQTT.TOPICS['station_data'], clientMQTT.PayloadCodec('json').encode(body), received_at)
+    assert not batch.rejected
+    return batch.tables.get('data', [])
+
+def test_server_decoder_rebuilds_snapshots(recorded):
+    decoder = serverMQTT.StationDataDecoder()
+    stored = {}  # id -> dòng mới nhất trong kho
+    for snapshot, body in station_messages(recorded, clientMQTT.DeltaEncoder()):
+        rows = ingest(decoder, body)
+        assert rows and all(row['synced'] for row in rows)
+        if body['mode'] == 'full':
+            stored = {}
+        stored.update((row['id'], row) for row in rows)
+        expected = {item['id']: serverMQTT._flatten(item) for item in snapshot}
+        assert {key: {name: row[name] for name in expected[key]} for key, row in stored.items()} == expected
+    assert decoder.counts['unsynced'] == 0
+    assert decoder.due_resync(0) == []
+
+def test_seq_gap_requests_resync_until_keyframe(recorded):
+    decoder = serverMQTT.StationDataDecoder(resync_interval=30)
+    encoder = clientMQTT.DeltaEncoder(keyframe_interval=1000)
+    messages = station_messages(recorded, encoder)
+    for _, body in itertools.islice(messages, 5):
+        ingest(decoder, body)
+    next(messages)  # Mất một delta
+    _, body = next(messages)
+    rows = ingest(decoder, body, received_at=100)
+    assert rows and not any(row['synced'] for row in rows)
+    assert decoder.due_resync(100) == [PORT]
+    assert decoder.due_resync(110) == []  # Chưa hết resync_interval
+    assert decoder.due_resync(130) == [PORT]
+
+    # Trạm nhận lệnh resync: lần gửi tới là bản đầy đủ, các delta sau lại được dựng lại
+    encoder.request_keyframe()
+    _, body = next(messages)
+    assert body['mode'] == 'full'
+    assert all(row['synced'] for row in ingest(decoder, body))
+    _, body = next(messages)
+    assert body['mode'] == 'delta'
+    assert all(row['synced'] for row in ingest(decoder, body))
+    assert decoder.due_resync(1000) == []
+
+def test_duplicate_delta_is_not_stored_twice(recorded):
+    decoder = serverMQTT.StationDataDecoder()
+    messages = station_messages(recorded, clientMQTT.DeltaEncoder())
+    for _, body in itertools.islice(messages, 3):
+        ingest(decoder, body)
+    assert body['mode'] == 'delta'
+    assert ingest(decoder, body) == []
+    assert decoder.counts['duplicate'] == 1
+    _, body = next(messages)
+    assert all(row['synced'] for row in ingest(decoder, body))
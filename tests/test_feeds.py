@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Nguồn đẩy snapshot (SSE, Unix socket, file NDJSON) với bộ điều khiển giả lập có đẩy thay đổi"""
+
+import asyncio
+import json
+import os
+
+import pytest
+
+import benchmark
+import clientMQTT
+
+STATION = '0'
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    clientMQTT.configure_log_levels('CRITICAL')
+
+def ids(snapshot):
+    return {item['id']: item for item in snapshot}
+
+async def wait_until(predicate, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "Hết giờ chờ snapshot"
+        await asyncio.sleep(0.01)
+
+class Feed:
+    """Chạy một nguồn đẩy trên event loop, ghi lại mọi snapshot được phân phối"""
+
+    def __init__(self, feed_class, feed_url, controller, **kwargs):
+        kwargs.setdefault('interval', 0.2)
+        self.source = feed_class(feed_url, url=f"{controller.url(STATION)}/GetfullupdateArr", **kwargs)
+        self.snapshots = []
+        self.source.subscribe(self.snapshots.append)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.source.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await self.source.close()
+
+    async def wait_for(self, predicate):
+        await wait_until(lambda: self.snapshots and predicate(ids(self.snapshots[-1])))
+        return ids(self.snapshots[-1])
+
+def run(scenario):
+    """Chạy kịch bản với một FakeController (1 trạm, 4 vòi), luôn đóng controller"""
+    async def main():
+        controller = benchmark.FakeController(1, 4, seed=0)
+        await controller.start()
+        try:
+            await scenario(controller)
+        finally:
+            controller.close()
+    asyncio.run(main())
+
+def test_update_merges_by_id():
+    feed = clientMQTT.PushSnapshotFeed('file:///dev/null')
+    feed.apply('snapshot', [{'id': 1, 'pump': 10, 'status': 'sẵn sàng'}, {'id': 2, 'pump': 20, 'status': 'sẵn sàng'},
+                            {'pump': 99}])
+    before = list(feed.pumps.values())
+    feed.apply('update', [{'id': 1, 'status': 'đang bơm'}, {'id': 2, 'removed': True}, {'id': '3', 'pump': 30}])
+    assert feed.pumps == {'1': {'id': 1, 'pump': 10, 'status': 'đang bơm'}, '3': {'id': '3', 'pump': 30}}
+    assert before[0] == {'id': 1, 'pump': 10, 'status': 'sẵn sàng'}  # Snapshot đã phân phối giữ nguyên
+    feed.apply('update', [{'id': 3, 'status': 'sẵn sàng'}])  # id số và chuỗi là cùng một vòi
+    assert feed.pumps['3'] == {'id': 3, 'pump': 30, 'status': 'sẵn sàng'}
+    with pytest.raises(ValueError):
+        feed.apply('update', {'id': 1})
+
+def test_sse_feed_pushes_updates_without_polling():
+    async def scenario(controller):
+        feed = Feed(clientMQTT.SSESnapshotFeed, f"{controller.url(STATION)}/events", controller)
+        feed.start()
+        try:
+            await feed.wait_for(lambda pumps: pumps == ids(controller.snapshot(STATION)))
+            requests = controller.requests
+            controller.set_disconnected(STATION, 2, True)
+            pumps = await feed.wait_for(lambda pumps: pumps[2]['isDisconnected'])
+            assert pumps == ids(controller.snapshot(STATION))
+            assert feed.source.connected
+            assert controller.requests == requests  # Không gọi GetfullupdateArr
+        finally:
+            await feed.stop()
+    run(scenario)
+
+def test_feed_error_falls_back_to_polling():
+    async def scenario(controller):
+        # Endpoint sự kiện trả 404: poll GetfullupdateArr trong retry_interval rồi thử lại
+        feed = Feed(clientMQTT.SSESnapshotFeed, f"{controller.url(STATION)}/missing", controller, retry_interval=0.5)
+        feed.start()
+        try:
+            await feed.wait_for(lambda pumps: pumps == ids(controller.snapshot(STATION)))
+            assert not feed.source.connected
+            controller.set_disconnected(STATION, 3, True)
+            await feed.wait_for(lambda pumps: pumps[3]['isDisconnected'])
+            fallbacks = controller.requests
+            await asyncio.sleep(0.7)
+            assert controller.requests > fallbacks  # Vẫn poll và thử mở lại nguồn đẩy
+        finally:
+            await feed.stop()
+    run(scenario)
+
+def test_unix_feed_reconnects_after_socket_closes(tmp_path):
+    async def scenario(controller):
+        path = str(tmp_path / 'feed.sock')
+        server = await controller.start_unix_feed(STATION, path)
+        feed = Feed(clientMQTT.UnixSnapshotFeed, f"unix://{path}", controller, retry_interval=0.3)
+        feed.start()
+        try:
+            await feed.wait_for(lambda pumps: pumps == ids(controller.snapshot(STATION)))
+            await wait_until(lambda: feed.source.connected)
+            server.close()
+            for writer, _ in list(controller.feeds[STATION]):
+                writer.close()
+            await wait_until(lambda: not feed.source.connected)
+            controller.set_disconnected(STATION, 1, True)  # Chỉ thấy qua poll
+            await feed.wait_for(lambda pumps: pumps[1]['isDisconnected'])
+            os.remove(path)
+            await controller.start_unix_feed(STATION, path)
+            await wait_until(lambda: feed.source.connected, timeout=5)
+            controller.set_disconnected(STATION, 1, False)
+            await feed.wait_for(lambda pumps: not pumps[1]['isDisconnected'])
+        finally:
+            await feed.stop()
+    run(scenario)
+
+def test_feed_starting_with_update_fetches_full_snapshot(tmp_path):
+    async def scenario(controller):
+        # Nguồn đẩy chỉ gửi phần thay đổi: lấy bản đầy đủ qua GetfullupdateArr trước khi ghép
+        async def serve(reader, writer):
+            writer.write((json.dumps({'event': 'update', 'data': [{'id': 4, 'status': 'đang bơm'}]}) + '\n').encode())
+            await writer.drain()
+            await reader.read()
+
+        path = str(tmp_path / 'updates.sock')
+        server = await asyncio.start_unix_server(serve, path)
+        feed = Feed(clientMQTT.UnixSnapshotFeed, f"unix://{path}", controller)
+        feed.start()
+        try:
+            pumps = await feed.wait_for(lambda pumps: True)
+            expected = ids(controller.snapshot(STATION))
+            expected[4] = dict(expected[4], status='đang bơm')
+            assert pumps == expected
+            assert controller.requests == 1
+        finally:
+            await feed.stop()
+            server.close()
+    run(scenario)
+
+def test_file_feed_follows_rotation_and_truncation(tmp_path):
+    async def scenario(controller):
+        path = str(tmp_path / 'feed.ndjson')
+        controller.add_feed_file(STATION, path)
+        with open(path, 'ab') as file:
+            file.write(b'{"event": "update", "data": [{"id": 1, "status": "c\\u0169"}]}\n')  # Đã có trước khi mở: bỏ qua
+        feed = Feed(clientMQTT.FileSnapshotFeed, f"file://{path}", controller,
+                    poll_interval=0.01, max_poll_interval=0.05, rotate_check=0.05)
+        feed.start()
+        try:
+            await feed.wait_for(lambda pumps: pumps == ids(controller.snapshot(STATION)))
+            controller.set_disconnected(STATION, 1, True)
+            await feed.wait_for(lambda pumps: pumps[1]['isDisconnected'])
+
+            # Dòng ghi dở: chỉ áp dụng khi đủ dòng
+            line = json.dumps({'event': 'update', 'data': [{'id': 2, 'status': 'đang bơm'}]}).encode() + b'\n'
+            with open(path, 'ab') as file:
+                file.write(line[:10])
+            await asyncio.sleep(0.1)
+            with open(path, 'ab') as file:
+                file.write(line[10:])
+            await feed.wait_for(lambda pumps: pumps[2]['status'] == 'đang bơm')
+
+            # Xoay vòng: file cũ đổi tên, bộ điều khiển ghi vào file mới
+            os.rename(path, path + '.1')
+            controller.set_disconnected(STATION, 3, True)
+            await feed.wait_for(lambda pumps: pumps[3]['isDisconnected'])
+
+            # Cắt ngắn tại chỗ (copytruncate), thấy qua kích thước nhỏ hơn vị trí đang đọc
+            with open(path, 'r+b') as file:
+                file.truncate(0)
+            await asyncio.sleep(0.2)
+            controller.set_disconnected(STATION, 4, True)
+            await feed.wait_for(lambda pumps: pumps[4]['isDisconnected'])
+            assert controller.requests == 1  # Chỉ một lần lấy bản đầy đủ khi mở
+
+            # Cắt ngắn rồi ghi dòng dài hơn vị trí đang đọc trước lần kiểm tra: đọc từ giữa
+            # dòng, lấy lại bản đầy đủ thay vì bỏ nguồn đẩy
+            controller.state[STATION][1]['pump'] += 1
+            expected = ids(controller.snapshot(STATION))
+            padding = 'x' * (os.path.getsize(path) + 100)
+            with open(path, 'r+b') as file:
+                file.truncate(0)
+                file.write(json.dumps({'event': 'update', 'data': [{'id': 2, 'note': padding}]}).encode() + b'\n')
+            pumps = await feed.wait_for(lambda pumps: pumps[2]['pump'] == expected[2]['pump'])
+            assert pumps == expected
+            assert controller.requests == 2
+            assert feed.source.connected
+        finally:
+            await feed.stop()
+    run(scenario)
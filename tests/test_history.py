@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""HistoryRing (vòng ghi đè trên mmap), rút gọn mẫu và phân trang lệnh history"""
+
+from datetime import datetime
+
+import pytest
+
+import clientMQTT
+
+BASE = 1767225600  # Bội của 10 để khoảng step bắt đầu đúng lần poll đầu
+PUMPS = 4
+
+@pytest.fixture(autouse=True)
+def quiet_logs(monkeypatch):
+    clientMQTT.configure_log_levels('CRITICAL')
+    monkeypatch.setattr(clientMQTT, 'HISTORY_CHUNK_INTERVAL', 0)
+
+def snapshot(poll):
+    return [{'id': pump_id, 'pump': 1000 * pump_id + poll // 3,
+             'status': 'đang bơm' if (poll + pump_id) % 4 == 0 else 'sẵn sàng',
+             'MaBomMoiNhat': {'pump': 1000 * pump_id + poll // 3},
+             'isDisconnected': pump_id == PUMPS and poll in (5, 6)} for pump_id in range(1, PUMPS + 1)]
+
+def make_ring(tmp_path, polls, capacity):
+    ring = clientMQTT.HistoryRing(str(tmp_path / '10001.ring'),
+                                  max_bytes=clientMQTT.HistoryRing.PAGE + capacity * clientMQTT.HistoryRing.RECORD.size)
+    for poll in range(polls):
+        ring.append(snapshot(poll), datetime.fromtimestamp(BASE + 5 * poll))
+    return ring
+
+def test_wrapped_ring_search(tmp_path):
+    # 30 lần poll x 4 vòi vào 50 ô: ô cũ nhất nằm giữa lần poll 17, ghi đè giữa file
+    ring = make_ring(tmp_path, polls=30, capacity=50)
+    assert len(ring) == 50 and ring.count == 120
+    records = list(ring.samples(0, float('inf')))
+    assert len(records) == 50
+    assert [(record[0], record[1]) for record in records[:3]] == [(BASE + 85, 3), (BASE + 85, 4), (BASE + 90, 1)]
+    assert records[-1][:2] == (BASE + 145, PUMPS)
+    assert records[-1][4] == 1000 * PUMPS + 29 // 3
+    assert records[-1][3] == 0 and records[0][3] == 0
+
+    # Tìm nhị phân qua điểm nối: khớp lọc tuần tự với mọi mốc, kể cả ngoài khoảng còn giữ
+    for start in [0, BASE + 85, BASE + 87.5, BASE + 95, BASE + 99.9, BASE + 145, BASE + 146]:
+        for end in [BASE + 100, BASE + 146, float('inf')]:
+            expected = [record for record in records if start <= record[0] < end]
+            assert list(ring.samples(start, end)) == expected, (start, end)
+    assert [record[1] for record in ring.samples(BASE + 100, BASE + 120, pumps={2})] == [2] * 4
+
+    # Mở lại file: giữ nguyên vòng đã ghi
+    ring.close()
+    reopened = clientMQTT.HistoryRing(ring.path, max_bytes=ring.PAGE + 50 * ring.RECORD.size)
+    assert list(reopened.samples(0, float('inf'))) == records
+    reopened.close()
+
+def test_downsample_step_and_changes():
+    samples = [(0, 1, 'sẵn sàng', 0, 10), (0, 2, 'sẵn sàng', 0, 20),
+               (1, 1, 'sẵn sàng', 1, 10), (1, 2, 'sẵn sàng', 0, 20),
+               (2, 1, 'đang bơm', 0, 10), (2, 2, 'sẵn sàng', 0, 20),
+               (12, 2, 'sẵn sàng', 0, 21), (13, 1, 'đang bơm', 0, 10)]
+    downsample = clientMQTT.downsample_history
+
+    assert list(downsample(iter(samples))) == samples
+    # Mẫu cuối mỗi khoảng, cờ OR cả khoảng (mất kết nối ngắn không bị mất), theo thứ tự thời gian
+    assert list(downsample(iter(samples), step=10)) == [
+        (2, 1, 'đang bơm', 1, 10), (2, 2, 'sẵn sàng', 0, 20),
+        (12, 2, 'sẵn sàng', 0, 21), (13, 1, 'đang bơm', 0, 10)]
+    assert list(downsample(iter(samples), changes=True)) == [
+        (0, 1, 'sẵn sàng', 0, 10), (0, 2, 'sẵn sàng', 0, 20),
+        (1, 1, 'sẵn sàng', 1, 10), (2, 1, 'đang bơm', 0, 10), (12, 2, 'sẵn sàng', 0, 21)]
+    assert list(downsample(iter(samples), step=10, changes=True)) == [
+        (2, 1, 'đang bơm', 1, 10), (2, 2, 'sẵn sàng', 0, 20), (12, 2, 'sẵn sàng', 0, 21),
+        (13, 1, 'đang bơm', 0, 10)]
+
+class HistoryStation:
+    """MQTTFuelStationClient trả lời lệnh history, giữ lại các chunk đã gửi"""
+
+    def __init__(self, ring):
+        self.client = clientMQTT.MQTTFuelStationClient()
+        self.client.port = '10001'
+        self.client.history = ring
+        self.client.connected = True
+        self.client.connection._in_loop = lambda func, *args: func(*args)
+        self.chunks = []
+        self.client._send = lambda topic_key, topic, message, qos, codec: self.chunks.append(message)
+
+    def query(self, **data):
+        """Một lệnh history; trả về (kết quả, [(thời điểm, id vòi), ...] của các chunk)"""
+        del self.chunks[:]
+        result = self.client.handle_history_command(data, 'h1')
+        assert [chunk['chunk'] for chunk in self.chunks] == list(range(result['chunks']))
+        samples = [sample for chunk in self.chunks for sample in zip(chunk['samples']['t'], chunk['samples']['id'])]
+        assert len(samples) == result['samples']
+        return result, samples
+
+@pytest.mark.parametrize('options', [{}, {'step': 10}, {'pumps': [1, 4]}])
+def test_history_pages_never_repeat_samples(tmp_path, monkeypatch, options):
+    monkeypatch.setattr(clientMQTT, 'HISTORY_CHUNK_SAMPLES', 3)
+    station = HistoryStation(make_ring(tmp_path, polls=20, capacity=1000))
+    end = BASE + 100
+    result, expected = station.query(start=BASE, end=end, **options)
+    assert not result['truncated'] and expected
+
+    pages, seen, start = 0, [], BASE
+    while True:
+        result, samples = station.query(start=start, end=end, max_samples=6, **options)
+        pages += 1
+        assert samples and len(samples) <= 6 + PUMPS  # Chỉ cắt giữa hai lần poll
+        seen.extend(samples)
+        if not result['truncated']:
+            break
+        assert result['next'] > samples[-1][0]
+        start = result['next']
+    assert pages > 2
+    assert len(set(seen)) == len(seen)
+    assert seen == expected
+
+def test_history_changes_and_disabled(tmp_path):
+    station = HistoryStation(make_ring(tmp_path, polls=20, capacity=1000))
+    _, everything = station.query(start=BASE, end=BASE + 100)
+    result, changed = station.query(start=datetime.fromtimestamp(BASE).isoformat(), end=BASE + 100, changes=True)
+    assert result['status'] == 'ok' and PUMPS <= len(changed) < len(everything)
+    assert set(changed) <= set(everything)
+    assert station.client.handle_history_command({'start': 'không phải thời điểm'}, 'h2')['status'] == 'error'
+    station.client.history = None
+    assert station.client.handle_history_command({}, 'h3') == {'status': 'error', 'error': 'history disabled'}
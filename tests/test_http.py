@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""AsyncHTTPClient.get_json: body chunked cắt ngang chuỗi / escape / số, body không phải mảng, keep-alive"""
+
+import asyncio
+import json
+
+import pytest
+
+import clientMQTT
+
+SNAPSHOT = [{'id': 1, 'pump': 12345, 'status': 'đang bơm', 'note': 'a "b" \\ é', 'price': 23.5},
+            {'id': 2, 'pump': -7, 'status': 'sẵn sàng', 'MaBomMoiNhat': {'pump': 1e3}, 'isDisconnected': True}]
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    clientMQTT.configure_log_levels('CRITICAL')
+
+def chunked(body, size):
+    """Body chunked, mỗi chunk size byte (cắt ngang ký tự UTF-8, escape và số)"""
+    parts = [body[index:index + size] for index in range(0, len(body), size)]
+    return b''.join(b'%x\r\n%s\r\n' % (len(part), part) for part in parts) + b'0\r\n\r\n'
+
+async def serve(responses):
+    """Bộ điều khiển giả: trả lần lượt các response trên cùng kết nối keep-alive"""
+    requests = []
+
+    async def handle(reader, writer):
+        try:
+            while (line := await reader.readline()):
+                requests.append(line)
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                writer.write(responses.pop(0))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, requests, f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+def test_get_json_chunk_boundaries_and_fallbacks():
+    body = json.dumps(SNAPSHOT, ensure_ascii=False).encode('utf-8')
+    responses = [b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + chunked(body, size)
+                 for size in (1, 2, 3, 7)]
+    responses.append(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+    other = json.dumps({'error': 'busy'}).encode('utf-8')
+    responses.append(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + chunked(other, 5))
+    responses.append(b'HTTP/1.1 500 Error\r\nContent-Length: 4\r\n\r\nbusy')
+    responses.append(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n[1, 2')
+
+    async def scenario():
+        server, requests, url = await serve(responses)
+        client = clientMQTT.AsyncHTTPClient(url)
+        try:
+            results = [await client.get_json('/GetfullupdateArr') for _ in range(8)]
+        finally:
+            await client.close()
+            server.close()
+        return results, requests
+
+    results, requests = asyncio.run(scenario())
+    assert results[:5] == [SNAPSHOT] * 5
+    assert results[5] == {'error': 'busy'}  # Body không phải mảng vẫn được trả về nguyên vẹn
+    assert results[6] is None and results[7] is None
+    assert len(requests) == 8  # Body lỗi cũng được đọc hết, request sau không bị lệch
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Đối chiếu ColumnarMabomChecker với check_mabom gốc trên chuỗi snapshot đã ghi lại và giả lập"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import benchmark
+import clientMQTT
+import replay
+
+pytest.importorskip('numpy')
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    clientMQTT.configure_log_levels('CRITICAL')
+
+def record(tmp_path, stream):
+    """Ghi chuỗi bằng SnapshotRecorder rồi đọc lại như replay.py / benchmark.py mabom --snapshots"""
+    recorder = clientMQTT.SnapshotRecorder(str(tmp_path))
+    for now, snapshot in stream:
+        recorder.record(snapshot, now)
+    recorder.close()
+    return benchmark.recorded_stream(str(tmp_path))
+
+def assert_same_actions(stream, min_actions):
+    count, total, difference = benchmark.compare_engines(stream)
+    assert difference is None, f"Khác biệt tại snapshot {difference[0]} ({difference[1]}): {difference[2:]}"
+    assert total >= min_actions, (count, total)
+
+def test_recorded_station_day(tmp_path):
+    # 24 giờ của trạm 16 vòi: giao dịch, mất kết nối ngắn và quá ngưỡng cảnh báo
+    assert_same_actions(record(tmp_path, benchmark.station_day_stream(16, 24, seed=1)), min_actions=5)
+
+def test_recorded_synthetic_anomalies(tmp_path):
+    # Bản ghi giữ nguyên phần tử hỏng / trùng id của snapshot
+    assert_same_actions(record(tmp_path, benchmark.mabom_stream(24, 5000, seed=2)), min_actions=1000)
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_synthetic_stream(seed):
+    assert_same_actions(benchmark.mabom_stream(24, 10000, seed), min_actions=2000)
+
+def test_large_station():
+    assert_same_actions(benchmark.mabom_stream(2000, 200, seed=3), min_actions=2000)
+
+def test_int_column_fallbacks():
+    clientMQTT._load_numpy()
+    values = [5, 1 << 70, '7', None, True, -3, 2.0]
+    column, fast = clientMQTT._int_column(values)
+    assert fast.tolist() == [True, False, False, False, False, True, False]
+    assert column[fast].tolist() == [5, -3]
+    column, fast = clientMQTT._int_column([None, 4, 'x'], none_as_zero=True)
+    assert fast.tolist() == [True, True, False]
+    assert column.tolist() == [0, 4, 0]
+
+def test_disconnected_event_on_first_sight():
+    # Vòi đã mất kết nối ngay snapshot đầu tiên vẫn phải có sự kiện disconnected
+    station = replay.ReplayStation()
+    events = []
+    station.mqtt_client.publish_events = events.extend
+    start = datetime(2026, 1, 1, 8)
+
+    def snapshot(disconnected):
+        return [{'id': 1, 'pump': 10, 'status': 'sẵn sàng', 'MaBomMoiNhat': {'pump': 10}, 'isDisconnected': disconnected},
+                {'id': 2, 'pump': 20, 'status': 'sẵn sàng', 'MaBomMoiNhat': {'pump': 20}, 'isDisconnected': False}]
+
+    station.check(snapshot(True), start)
+    assert [(event['type'], event['pump_id']) for event in events] == [('disconnected', '1')]
+    station.check(snapshot(True), start + timedelta(seconds=5))
+    station.check(snapshot(False), start + timedelta(seconds=10))
+    assert [(event['type'], event['pump_id']) for event in events] == [('disconnected', '1'), ('reconnected', '1')]
+    assert events[1]['downtime'] == 10.0
+
+class FakeClock(datetime):
+    """datetime.now() điều khiển được cho poller và check_mabom"""
+    current = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+class FakeHTTP:
+    """Thay AsyncHTTPClient: trả về lần lượt các snapshot (None: poll lỗi)"""
+
+    def __init__(self):
+        self.responses = []
+
+    async def get_json(self, path):
+        return self.responses.pop(0)
+
+def test_disconnect_after_poll_outage_is_not_backdated(monkeypatch):
+    # Bộ điều khiển không trả lời 5 phút rồi lên lại với vòi 1 mất kết nối:
+    # không được coi là mất từ trước sự cố (cảnh báo giả ở lần poll kế tiếp)
+    monkeypatch.setattr(clientMQTT, 'datetime', FakeClock)
+    station = replay.ReplayStation()
+    poller = station.poller
+    poller.http = FakeHTTP()
+    start = datetime(2026, 1, 1, 8)
+
+    def snapshot(disconnected):
+        return [{'id': 1, 'pump': 10, 'status': 'sẵn sàng', 'MaBomMoiNhat': {'pump': 10}, 'isDisconnected': disconnected},
+                {'id': 2, 'pump': 20, 'status': 'sẵn sàng', 'MaBomMoiNhat': {'pump': 20}, 'isDisconnected': False}]
+
+    def poll(seconds, data):
+        FakeClock.current = start + timedelta(seconds=seconds)
+        poller.http.responses.append(data)
+        return poller.poll_step()
+
+    async def scenario():
+        await poll(0, snapshot(False))
+        for seconds in range(2, 300, 2):
+            assert await poll(seconds, None) == poller.pacer.min_interval
+        await poll(300, snapshot(True))
+        assert poller.previous_time == start + timedelta(seconds=298)
+        await poll(302, snapshot(True))
+        assert station.actions == []
+        # Tính mất kết nối từ lần poll (lỗi) ngay trước: cảnh báo khi quá ngưỡng kể từ 298
+        await poll(298 + clientMQTT.DISCONNECT_ALERT_SECONDS, snapshot(True))
+        assert station.actions == []
+        await poll(298 + clientMQTT.DISCONNECT_ALERT_SECONDS + 1, snapshot(True))
+        assert station.actions == [('warning', 'disconnection', '1', 10)]
+
+    asyncio.run(scenario())
+
+def test_known_until_bounded_after_push_feed_fallback():
+    feed = clientMQTT.PushSnapshotFeed('file:///dev/null')
+    now = datetime(2026, 1, 1, 8)
+    feed.latest_time = now - timedelta(minutes=10)
+    feed.connected = True
+    assert feed.known_until(now) == now
+    feed.connected = False
+    assert feed.known_until(now) == now - timedelta(seconds=feed.pacer.current)
+    feed.latest_time = now - timedelta(seconds=1)
+    assert feed.known_until(now) == feed.latest_time
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""Xuất metrics theo định dạng text của Prometheus"""
+
+import clientMQTT
+
+def test_label_values_are_escaped():
+    registry = clientMQTT.Metrics()
+    registry.counter('fuel_test_total', "Dòng 1\nDòng 2 \\ hết")
+    registry.inc('fuel_test_total', topic='a"b\\c\nd')
+    text = registry.render()
+    assert '# HELP fuel_test_total Dòng 1\\nDòng 2 \\\\ hết\n' in text
+    assert 'fuel_test_total{topic="a\\"b\\\\c\\nd"} 1\n' in text
+
+def test_histogram_labels_are_escaped():
+    registry = clientMQTT.Metrics()
+    registry.histogram('fuel_test_seconds', "Thời gian", buckets=(1,))
+    registry.observe('fuel_test_seconds', 0.5, port='1"2')
+    text = registry.render()
+    assert 'fuel_test_seconds_bucket{port="1\\"2",le="1"} 1\n' in text
+    assert 'fuel_test_seconds_count{port="1\\"2"} 1\n' in text
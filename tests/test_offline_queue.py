@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""Dữ liệu trạm khi mất kết nối MQTT: ghi vào hàng đợi offline thay vì bị bỏ"""
+
+import pytest
+
+import benchmark
+import clientMQTT
+
+@pytest.fixture(autouse=True)
+def quiet_logs(monkeypatch, tmp_path):
+    clientMQTT.configure_log_levels('CRITICAL')
+    monkeypatch.chdir(tmp_path)
+
+def test_station_data_queued_while_disconnected(tmp_path):
+    mqtt_client = clientMQTT.MQTTFuelStationClient()
+    mqtt_client.port = '10001'
+    mqtt_client.version, mqtt_client.mac = 'TEST-1.0', '02:00:00:00:00:00'
+    mqtt_client.getdata_enabled, mqtt_client.data_mode = True, 'delta'
+    offline_queue = mqtt_client.connection.offline_queue = clientMQTT.OfflineQueue(str(tmp_path / 'queue'))
+    station = clientMQTT.FuelStationClient(mqtt_client=mqtt_client)
+    assert not mqtt_client.connected
+
+    snapshot = benchmark.make_snapshot(16)
+    station.publish_snapshot(snapshot)
+    station.publish_snapshot(snapshot)  # Chưa hết DATA_PUBLISH_INTERVAL: bỏ qua như khi đang kết nối
+    station.last_data_publish -= clientMQTT.DATA_PUBLISH_INTERVAL
+    snapshot = [dict(snapshot[0], pump=snapshot[0]['pump'] + 1)] + snapshot[1:]
+    station.publish_snapshot(snapshot)
+
+    records = offline_queue.peek(10)
+    assert [topic for _, _, topic, _, _ in records] == [clientMQTT.TOPICS['station_data']] * 2
+    bodies = [clientMQTT.decode_payload(payload) for _, _, _, payload, _ in records]
+    assert [(body['port'], body['mode'], body['seq']) for body in bodies] == [('10001', 'full', 1), ('10001', 'delta', 2)]
+    assert [msg_id for _, msg_id, _, _, _ in records] == [body['msg_id'] for body in bodies]
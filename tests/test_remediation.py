@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""RemediationEngine: thứ tự hành động, gộp daylaidulieu theo lượt restartall"""
+
+import asyncio
+import sys
+
+import pytest
+
+import benchmark
+import clientMQTT
+
+STATION = '0'
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    clientMQTT.configure_log_levels('CRITICAL')
+
+def test_daylaidulieu_coalesced_only_within_restart_generation():
+    async def scenario():
+        controller = benchmark.FakeController(1, 4, seed=0)
+        await controller.start()
+        events = []
+        engine = clientMQTT.RemediationEngine(controller.url(STATION), restart_command=[sys.executable, '-c', 'pass'],
+                                              report=events.append)
+        task = None
+        try:
+            # Xếp trước khi engine chạy để cả hàng đợi cùng chờ
+            engine.restart(reason='lần 1')
+            assert engine.daylaidulieu('2', reason='gap')
+            assert not engine.daylaidulieu('2', reason='gap')  # Trùng yêu cầu đang chờ: gộp
+            engine.restart(reason='lần 2')
+            assert engine.daylaidulieu('2', reason='gap')  # Sau restartall: không gộp với yêu cầu trước đó
+            assert engine.pending == 4
+
+            task = asyncio.ensure_future(engine.run())
+            deadline = asyncio.get_running_loop().time() + 10
+            while len(events) < 4:
+                assert asyncio.get_running_loop().time() < deadline, events
+                await asyncio.sleep(0.01)
+            assert [(event['action'], event['pump_id'], event['status']) for event in events] == [
+                ('restartall', 'all', 'ok'), ('daylaidulieu', '2', 'ok'),
+                ('restartall', 'all', 'ok'), ('daylaidulieu', '2', 'ok')]
+            assert [event['reason'] for event in events] == ['lần 1', 'gap', 'lần 2', 'gap']
+            assert controller.daylaidulieu_calls == 2
+            assert engine.pending == 0 and engine.queued_pumps == {}
+
+            # Hàng đợi trống: yêu cầu mới cho cùng vòi lại được xếp
+            assert engine.daylaidulieu('2')
+            while len(events) < 5:
+                assert asyncio.get_running_loop().time() < deadline, events
+                await asyncio.sleep(0.01)
+            assert controller.daylaidulieu_calls == 3
+        finally:
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            controller.close()
+    asyncio.run(scenario())